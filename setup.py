@@ -184,6 +184,7 @@ setup(
     # projects.
     extras_require={  # Optional
         'dev': ['pyqt5ac'],
+        'numpy': ['numpy'],
         },
 
     # If there are data files included in your packages that need to be
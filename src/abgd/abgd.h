@@ -8,6 +8,7 @@
 /*if more than MAXSEQ4NEWICK then the newick string will not be computed (but all partitions will be computed) */
 #define MAXSEQ4NEWICK 700
 #define SIZE_NAME_DIST 100   /* do not store characters after SIZE_NAME_DIST */
+#define SPART_BUFSIZ 65536   /* stdio buffer used when writing the spart files */
 #define WEB_ADMIN "sophie.brouillet@mnhn.fr"
 
 
@@ -56,6 +57,51 @@ struct Composante {
 
 };
 
+/*
+	The BIONJ tree kept in memory: the newick text as written by BIONJ
+	and, for each leaf, where its name ends and which sequence it is.
+	Group labels are added while writing, the text itself is never modified.
+*/
+struct NewickTree {
+
+	char *text;         /* newick string, '\0' terminated */
+	long len;           /* length of text */
+	long nalloc;        /* allocated size of text */
+
+	int nleaf;          /* number of leaves */
+	long *leaf_end;     /* offset in text just after each leaf name, in newick order */
+	int *leaf_node;     /* row of each leaf in the distance matrix */
+
+};
+
+/*
+	What is drawn from the sorted pairwise distances: histogram bins and the ranks kept for the rank curve
+*/
+struct DistSummary {
+	int nbbids;         /* number of bins */
+	int *histo;         /* count in each bin (nbbids+2 allocated) */
+	float maxi;         /* largest distance */
+	long N;             /* number of distances */
+	long nrank;         /* number of ranks kept */
+	long *rank;         /* ranks kept for the rank curve, in increasing order, the last is N-1 */
+	double *value;      /* distance at each kept rank */
+};
+
+/*
+	Pi and the slope for each window size of a sorted list of distances.
+	These do not depend on the prior or minSlopeIncrease, so they are computed once for a sweep.
+*/
+struct PeakCache {
+	double *Array;      /* sorted distances, not owned */
+	long N;             /* number of distances */
+	long windsize_min;  /* window sizes explored, as in find_abgd() */
+	long windsize_max;
+	long windsize_step;
+	long nwin;          /* number of window sizes */
+	double *Pi;         /* average from Array[0] to Array[i] */
+	double **Slope;     /* slopes for each window size, NULL until first needed */
+};
+
 struct FastaSeq {
 char *name;
 char *seq;
@@ -70,9 +116,90 @@ typedef struct spart{
 #define MINI(a,b) ((a<=b)?a:b)
 
 struct DistanceMatrix GetDistMat (int nseq, struct FastaSeq *mesSeqs, int method,float ts_t,FILE *f,char *d);
+typedef void (*DistanceFunction)( struct FastaSeq *, int, struct DistanceMatrix, FILE *, char * );
+extern long abgd_rows_first, abgd_rows_last;
+double *GetDistTile (int nseq, struct FastaSeq *mesSeqs, int method, float ts_tv, long first, long last, long *count);
 struct Peak find_abgd( double *Array, long N, long windsize_min, long windsize_max, short output_slope, double MaxDist ,double SlopeIncrease );
 struct Peak FindFirstPeak( double *Array, long N, int winsiz, short output_slope, double *Pi, double MaxDist,double SlopeIncrease  );
+struct Peak FindPeakInSlope( double *Array, long N, int winsiz, double *Slope, double *Pi, double MaxDist,double SlopeIncrease  );
+struct PeakCache init_peak_cache( double *Array, long N, long windsize_min, long windsize_max );
+void free_peak_cache( struct PeakCache cache );
+struct Peak find_abgd_cached( struct PeakCache *cache, double MaxDist ,double SlopeIncrease );
+
+/* called on long loops with their progress, a non-zero return asks them to stop */
+#define ABGD_PHASE_DISTANCES 0
+#define ABGD_PHASE_PRIORS 1
+#define ABGD_PHASE_REPLICATES 2
+int abgd_progress( int phase, long done, long total );
+
+/* messages of abgd_log() above abgd_log_level are dropped, errors are never rate limited */
+#define ABGD_LOG_ERROR 0
+#define ABGD_LOG_INFO 1
+#define ABGD_LOG_DEBUG 2
+extern int abgd_log_level;
+extern long abgd_log_rate;                                   /* most messages per second, 0 for no limit */
+extern void (*abgd_log_sink)( int level, const char *text ); /* if NULL, messages go to stdout */
+void abgd_log( int level, const char *format, ... );
+void abgd_log_flush( void );
+
+/* wall and cpu time, calls and memory of each phase -- phases may nest, recursion includes its sorts, peaks and components */
+#define ABGD_METRIC_TOTAL 0
+#define ABGD_METRIC_PARSE 1
+#define ABGD_METRIC_NAMES 2
+#define ABGD_METRIC_DISTANCES 3
+#define ABGD_METRIC_HISTOGRAM 4
+#define ABGD_METRIC_SORT 5
+#define ABGD_METRIC_PEAKS 6
+#define ABGD_METRIC_COMPONENTS 7
+#define ABGD_METRIC_RECURSION 8
+#define ABGD_METRIC_TREE 9
+#define ABGD_METRIC_OUTPUT 10
+#define ABGD_NMETRICS 11
+
+/* counters of the inner loops */
+#define ABGD_COUNT_PAIRS 0           /* pairwise distances computed */
+#define ABGD_COUNT_WINDOWS 1         /* window sizes tried by the peak search */
+#define ABGD_COUNT_ROUNDS 2          /* rounds of recursive splitting */
+#define ABGD_NCOUNTS 3
+
+struct PhaseMetric {
+	double wall;        /* seconds */
+	double cpu;         /* seconds */
+	long calls;
+	long maxrss;        /* peak resident memory of the process when the phase last ended, in kB */
+};
+
+struct PhaseClock {
+	double wall;
+	double cpu;
+};
+
+extern struct PhaseMetric abgd_metrics[ABGD_NMETRICS];
+extern long abgd_counts[ABGD_NCOUNTS];
+extern const char *abgd_metric_names[ABGD_NMETRICS];
+extern const char *abgd_count_names[ABGD_NCOUNTS];
+void abgd_metrics_reset( void );
+struct PhaseClock abgd_phase_start( void );
+void abgd_phase_stop( int phase, struct PhaseClock start );
+
+/* timeline of a run, only recorded while abgd_tracing: phases are spans too */
+struct TraceEvent {
+	const char *name;
+	const char *argname;  /* NULL if no argument */
+	long arg;
+	double start;         /* seconds since abgd_trace_reset() */
+	double duration;
+};
+
+extern int abgd_tracing;
+extern struct TraceEvent *abgd_trace_events;
+extern long abgd_ntrace;
+void abgd_trace_reset( int enable );
+void abgd_trace( const char *name, const char *argname, long arg, struct PhaseClock start );
 double *matrix2list( struct DistanceMatrix  distmat, char *mask, long *Nval );
+double *matrix2sample( struct DistanceMatrix  distmat, char *mask, long nsample, long *Nval );
+extern long idum_ran1;
+void BootStrapArray(double * array_in, double * array_out, long n);
 void setcomp( int node, int compid, int * node_compid, struct DistanceMatrix matrix, double max_dist, char *mask);
 struct Composante compute_node_compid(  struct DistanceMatrix matrix, double max_dist, char *mask );
 struct Composante extract_composante(  struct DistanceMatrix matrix, double max_dist, char *mask );
@@ -83,14 +210,14 @@ void distanceJC69 (struct FastaSeq *,int l,struct  DistanceMatrix  mymat,FILE *f
 
 int comparaison(const void *v1, const void *v2);
 
-void CreateSpartFile(Spart *myspar,Spart *myspar2,char *ledir,int nbstepABGD,char *dataFilename,int **sub,int nbSamples,char *ladate,FILE *fres,char *workdir,char *meth,float slope,double *bcode);
+void CreateSpartFile(Spart *myspar,Spart *myspar2,const char *ledir,int nbstepABGD,char *dataFilename,int **sub,int nbSamples,const char *ladate,FILE *fres,char *workdir,char *meth,float slope,double *bcode);
 
 //void CreateSpartFile(Spart *myspar,Spart *myspar2,char *ledir,int nbstepABGD,char *dataFilename,int **sub,int nbSamples,char *ladate,FILE *fres, char *w);
-void exit_properly(char *ledir);
+void exit_properly(const char *ledir);
 void html_error(FILE *f,int nb );
 int check_compat(char *s1,char *s2,int l);
 int check_names(struct FastaSeq *mesSeq, int nbseq);
-int mainBionj(struct DistanceMatrix distMat ,char *file_out);
+int mainBionj(struct DistanceMatrix distMat ,struct NewickTree *tree);
 void mem_spart_files( struct Composante my_comp ,Spart *Myspar,int nbC,int **nbsub,int which,int nbspecimens,FILE *fres);
 long min_ws( long nval );
 void reset_composante( struct Composante * c );
@@ -101,7 +228,8 @@ void update_composante(  struct Composante *main_comp, int id, struct Composante
 
 void free_composante(  struct Composante c  );
 void print_groups_files( struct Composante my_comp , struct DistanceMatrix distmat  ,FILE *f,int);
-void print_groups_files_newick( struct Composante my_comp , struct DistanceMatrix distmat  ,FILE *f,char *lastring, FILE *f2, int html,FILE *fres,char *d);
+void print_groups_files_newick( struct Composante my_comp , struct DistanceMatrix distmat  ,FILE *f,struct NewickTree tree, FILE *f2, int html);
+void free_newick( struct NewickTree tree );
 void print_groups_newick( struct Composante my_comp , struct DistanceMatrix distmat  ,char *lastring, FILE *f2,FILE *fres,char *d);
 void free_distmat(  struct DistanceMatrix mat );
 void print_distmat(  struct DistanceMatrix distmat  );
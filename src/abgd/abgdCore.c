@@ -42,11 +42,166 @@
 #include <ctype.h>
 #include <sys/stat.h>
 #include <errno.h>  /* errno */
+#include <stdarg.h>
+#include <limits.h>
+#ifndef _WIN32
+#include <sys/resource.h>
+#endif
 #include "abgd.h"
 static char DEBUG;
 static short verbose;
 
 
+/*
+	Leveled logging: cheap to call when the level is off
+*/
+int abgd_log_level = ABGD_LOG_INFO;
+long abgd_log_rate = 0;
+void (*abgd_log_sink)( int level, const char *text ) = NULL;
+
+static time_t log_second = 0;      /* messages are counted for each second */
+static long log_count = 0;
+static long log_dropped = 0;
+
+/* tell how many messages were dropped by the rate limit, if any */
+void abgd_log_flush( void ){
+
+	char text[64];
+
+	if (log_dropped > 0){
+		snprintf(text, sizeof(text), "(%ld messages dropped)\n", log_dropped);
+		if (abgd_log_sink) abgd_log_sink(ABGD_LOG_INFO, text);
+		else fputs(text, stdout);
+	}
+	log_second = 0;
+	log_count = log_dropped = 0;
+}
+
+/*
+	Per-phase metrics: always collected, a few clock reads per phase
+*/
+struct PhaseMetric abgd_metrics[ABGD_NMETRICS];
+long abgd_counts[ABGD_NCOUNTS];
+const char *abgd_metric_names[ABGD_NMETRICS] = {"total", "parse", "names", "distances", "histogram",
+	"sort", "peaks", "components", "recursion", "tree", "output"};
+const char *abgd_count_names[ABGD_NCOUNTS] = {"pairs", "windows", "rounds"};
+
+void abgd_metrics_reset( void ){
+
+	memset(abgd_metrics, 0, sizeof(abgd_metrics));
+	memset(abgd_counts, 0, sizeof(abgd_counts));
+}
+
+struct PhaseClock abgd_phase_start( void ){
+
+	struct PhaseClock now;
+#ifdef _WIN32
+	now.wall = now.cpu = (double)clock()/CLOCKS_PER_SEC;
+#else
+	struct timespec ts;
+
+	clock_gettime(CLOCK_MONOTONIC, &ts);
+	now.wall = ts.tv_sec + ts.tv_nsec*1e-9;
+	clock_gettime(CLOCK_PROCESS_CPUTIME_ID, &ts);
+	now.cpu = ts.tv_sec + ts.tv_nsec*1e-9;
+#endif
+	return now;
+}
+
+int abgd_tracing = 0;
+struct TraceEvent *abgd_trace_events = NULL;
+long abgd_ntrace = 0;
+static long trace_alloc = 0;
+static double trace_origin = 0;
+
+/* forget all events, record new ones only if enable */
+void abgd_trace_reset( int enable ){
+
+	free(abgd_trace_events);
+	abgd_trace_events = NULL;
+	abgd_ntrace = trace_alloc = 0;
+	abgd_tracing = enable;
+	trace_origin = abgd_phase_start().wall;
+}
+
+static void trace_span( const char *name, const char *argname, long arg, double start, double end ){
+
+	struct TraceEvent *event;
+
+	if (abgd_ntrace == trace_alloc){
+		trace_alloc = trace_alloc ? 2*trace_alloc : 1024;
+		abgd_trace_events = realloc(abgd_trace_events, sizeof(struct TraceEvent)*trace_alloc);
+		if (!abgd_trace_events) fprintf(stderr, "trace_span: cannot allocate events, bye\n"), exit(2);
+	}
+	event = abgd_trace_events + abgd_ntrace++;
+	event->name = name;
+	event->argname = argname;
+	event->arg = arg;
+	event->start = start - trace_origin;
+	event->duration = end - start;
+}
+
+/* a span from start to now */
+void abgd_trace( const char *name, const char *argname, long arg, struct PhaseClock start ){
+
+	if (abgd_tracing)
+		trace_span(name, argname, arg, start.wall, abgd_phase_start().wall);
+}
+
+void abgd_phase_stop( int phase, struct PhaseClock start ){
+
+	struct PhaseClock now = abgd_phase_start();
+
+	if (abgd_tracing)
+		trace_span(abgd_metric_names[phase], NULL, 0, start.wall, now.wall);
+
+	abgd_metrics[phase].wall += now.wall - start.wall;
+	abgd_metrics[phase].cpu += now.cpu - start.cpu;
+	abgd_metrics[phase].calls++;
+#ifndef _WIN32
+	struct rusage usage;
+
+	getrusage(RUSAGE_SELF, &usage);
+#ifdef __APPLE__
+	abgd_metrics[phase].maxrss = usage.ru_maxrss/1024;     /* in bytes there */
+#else
+	abgd_metrics[phase].maxrss = usage.ru_maxrss;
+#endif
+#endif
+}
+
+void abgd_log( int level, const char *format, ... ){
+
+	char text[1024];
+	va_list args;
+	time_t now;
+
+	if (level > abgd_log_level)
+		return;
+
+	if (abgd_log_rate > 0 && level > ABGD_LOG_ERROR){
+		now = time(NULL);
+		if (now != log_second){
+			abgd_log_flush();
+			log_second = now;
+		}
+		if (++log_count > abgd_log_rate){
+			log_dropped++;
+			return;
+		}
+	}
+
+	va_start(args, format);
+	if (abgd_log_sink){
+		vsnprintf(text, sizeof(text), format, args);
+		abgd_log_sink(level, text);
+	}
+	else
+		vprintf(format, args);
+	va_end(args);
+}
+
+
 
 #define ABS( x )  (((x)>0)?(x):(-x))
 
@@ -109,7 +264,7 @@ double ran1()
 
 
 
-void exit_properly(char *ledir)
+void exit_properly(const char *ledir)
 {
 	char commande [1024];
 	if (strlen (ledir) >1)
@@ -246,7 +401,7 @@ void BootStrapArray(double * array_in, double * array_out, long n){
 
 	long i=0;
 	for(i=0;i<n;i++)
-		array_out[i]=array_in[ ( int ) floor(uniform_dev()*n) ];
+		array_out[i]=array_in[ ( long ) floor(uniform_dev()*n) ];
 
 }
 /********************
@@ -364,33 +519,12 @@ short compare_DNA( char s1, char s2 ){
 
 struct Peak FindFirstPeak( double *Array, long N, int winsiz, short output_slope, double *Pi, double PriorDist ,double minSlopeIncrease){
 
-	long i,             /* Indice of the slope */
-	     top=0;         /* indices the summit of the preak */
-
+	long i;                  /* Indice of the slope */
 
 	double *Slope;           /* Slope <=> derivative of array */
-	double SlopeMax;         /* Current max of Slope */
-
-
-	float Mean_i=0;          /* The a priori rank of the summit --> then it is set to j+0.5 */
-
-	double Mean_dist=0.0;    /* The distance that corresponds to SlopeMax */
 
 	struct Peak my_abgd;     /* The structure that contain both the estimated indice and distance */
 
-//	extern char DEBUG;
-
-
-	long wt;
-	long ct;
-
-
-//	DEBUG=1;
-
-	my_abgd.Dist = -1;
-	my_abgd.Rank = -1;
-	my_abgd.theta_hat = 0;
-
 	/*
 	printf("\n\n***********%f******\n",minSlopeIncrease);
 	printf("Prior: %f\n", PriorDist);
@@ -409,22 +543,6 @@ struct Peak FindFirstPeak( double *Array, long N, int winsiz, short output_slope
 		Slope[i] = (Array[i+winsiz-1]-Array[i])/(double)(winsiz-1);
 
 
-
-
-	/*
-		Compute Pi up to the maximum of interest
-		Compute The largest Slope in this area
-	*/
-
-
-	for(i=1; i<N && Array[i] <= PriorDist  ; i++);
-	my_abgd.theta_hat = Pi[i-1];
-
-
-
-	/*printf("theta[%d] is %f\n", i-1, Pi[i-1]);*/
-
-
 	/*
 		Print out stuff if needed
 	*/
@@ -443,6 +561,61 @@ struct Peak FindFirstPeak( double *Array, long N, int winsiz, short output_slope
 		exit(5);
 	}
 
+	my_abgd = FindPeakInSlope( Array, N, winsiz, Slope, Pi, PriorDist, minSlopeIncrease );
+
+	free(Slope);
+
+	return my_abgd;
+}
+
+
+/*
+	The peak search itself, once the Slope for winsiz is known.
+	Slope only depends on Array and winsiz, so it can be shared
+	between several priors and minSlopeIncrease values.
+*/
+
+struct Peak FindPeakInSlope( double *Array, long N, int winsiz, double *Slope, double *Pi, double PriorDist ,double minSlopeIncrease){
+
+	long i,             /* Indice of the slope */
+	     top=0;         /* indices the summit of the preak */
+
+
+	double SlopeMax;         /* Current max of Slope */
+
+
+	float Mean_i=0;          /* The a priori rank of the summit --> then it is set to j+0.5 */
+
+	double Mean_dist=0.0;    /* The distance that corresponds to SlopeMax */
+
+	struct Peak my_abgd;     /* The structure that contain both the estimated indice and distance */
+
+//	extern char DEBUG;
+
+
+	long wt;
+	long ct;
+
+
+//	DEBUG=1;
+
+	my_abgd.Dist = -1;
+	my_abgd.Rank = -1;
+	my_abgd.theta_hat = 0;
+
+	/*
+		Compute Pi up to the maximum of interest
+		Compute The largest Slope in this area
+	*/
+
+
+	for(i=1; i<N && Array[i] <= PriorDist  ; i++);
+	my_abgd.theta_hat = Pi[i-1];
+
+
+
+	/*printf("theta[%d] is %f\n", i-1, Pi[i-1]);*/
+
 
 
 	/*
@@ -564,8 +737,6 @@ struct Peak FindFirstPeak( double *Array, long N, int winsiz, short output_slope
 
 	}
 
-	free(Slope);
-
 	return my_abgd;
 }
 
@@ -585,6 +756,8 @@ struct Peak find_abgd( double *Array, long N, long windsize_min, long windsize_m
 
 	double stable_dist=-1;
 
+	struct PhaseClock started = abgd_phase_start();
+
 	my_abgd.Dist = -1;
 	my_abgd.Rank = -1;
 	my_abgd.theta_hat = -1;
@@ -599,6 +772,7 @@ struct Peak find_abgd( double *Array, long N, long windsize_min, long windsize_m
 	for(c=windsize_min; c <= windsize_max && stable<3; c+=windsize_step){
 
 			my_abgd = FindFirstPeak( Array, N, c, output_slope, Pi,  PriorDist, minSlopeIncrease );
+			abgd_counts[ABGD_COUNT_WINDOWS]++;
 
 			if(DEBUG)
 				fprintf(stderr,"abs( %f - %f )= %f vs %f\n", my_abgd.Dist,stable_dist, fabs(my_abgd.Dist-stable_dist) , 0.1*stable_dist );
@@ -627,7 +801,99 @@ struct Peak find_abgd( double *Array, long N, long windsize_min, long windsize_m
 
 	free(Pi);
 
+	abgd_phase_stop(ABGD_METRIC_PEAKS, started);
+	return my_abgd;
+}
+
+
+/*
+	Pi and the Slope of each window size for a sorted Array, computed once.
+	Slopes are only computed the first time a window size is visited.
+*/
+
+struct PeakCache init_peak_cache( double *Array, long N, long windsize_min, long windsize_max ){
+
+	struct PeakCache cache;
+	long i;
+
+	cache.Array = Array;
+	cache.N = N;
+	cache.windsize_min = windsize_min;
+	cache.windsize_max = windsize_max;
+	cache.windsize_step = (windsize_min>10)?windsize_min/10:1;
+	cache.nwin = (windsize_max>=windsize_min)?(windsize_max-windsize_min)/cache.windsize_step+1:0;
+
+	cache.Pi = (double *)malloc(  (size_t) N *sizeof(double) );
+	cache.Slope = (double **)calloc( (size_t) cache.nwin+1, sizeof(double *) );
+	if(!cache.Pi || !cache.Slope)fprintf(stderr, "init_peak_cache: cannot allocate Pi --%ld double--, bye\n", N ), exit(2);
+
+	for(cache.Pi[0]=Array[0], i=1; i<N ; i++)
+		cache.Pi[i] = (Array[i] + cache.Pi[i-1]*i)/(i+1.0);
+
+	return cache;
+}
+
+void free_peak_cache( struct PeakCache cache ){
+
+	long w;
+
+	for(w=0; w<cache.nwin; w++)
+		free(cache.Slope[w]);
+	free(cache.Slope);
+	free(cache.Pi);
+}
+
+/*
+	Same as find_abgd() but with Pi and the Slopes taken from cache
+*/
+
+struct Peak find_abgd_cached( struct PeakCache *cache, double PriorDist ,double minSlopeIncrease ){
+
+	double *Array=cache->Array;
+	long N=cache->N;
+	long c,i,w;
+	int stable=0;
+
+	struct Peak my_abgd;
+
+	double stable_dist=-1;
+
+	struct PhaseClock started = abgd_phase_start();
+
+	my_abgd.Dist = -1;
+	my_abgd.Rank = -1;
+	my_abgd.theta_hat = -1;
+
+	for(w=0, c=cache->windsize_min; c <= cache->windsize_max && stable<3; w++, c+=cache->windsize_step){
+
+			if(cache->Slope[w]==NULL){
+				cache->Slope[w] = (double *)malloc(  (size_t) (N-c+1) *sizeof(double) );
+				if(!cache->Slope[w])fprintf(stderr, "find_abgd_cached: cannot allocate SlopeS --%ld double--, bye\n", N-c+1 ), exit(2);
+				for(i=0; i <= N-c ; i++)
+					cache->Slope[w][i] = (Array[i+c-1]-Array[i])/(double)(c-1);
+			}
+
+			my_abgd = FindPeakInSlope( Array, N, c, cache->Slope[w], cache->Pi, PriorDist, minSlopeIncrease );
+			abgd_counts[ABGD_COUNT_WINDOWS]++;
+
+			if( my_abgd.Dist != -1 && fabs( my_abgd.Dist-stable_dist) < 0.1*stable_dist ){
+
+				stable++;
+			}
+			else{
+				stable=1;
+				stable_dist=my_abgd.Dist;
+			}
+	}
+
+	if(my_abgd.Dist == -1){
+
+		my_abgd.Dist=Array[N-1];
+		my_abgd.Rank = N+0.5;
 
+	}
+
+	abgd_phase_stop(ABGD_METRIC_PEAKS, started);
 	return my_abgd;
 }
 
@@ -689,8 +955,10 @@ void distancesimple(struct FastaSeq *mesSeqs,int l,struct  DistanceMatrix  my_ma
 	if (l==0)
 		html_error(fres,100);
 	;
-	for (a=0;a<nseq-1;a++)
+	for (a=abgd_rows_first;a<nseq-1 && a<abgd_rows_last;a++)
 	{
+		if (abgd_progress(ABGD_PHASE_DISTANCES, a, nseq))
+			return;
 		s1= mesSeqs[a].seq;
 		my_mat.dist[a][a]=0;
 
@@ -742,8 +1010,10 @@ int nseq=mymat.n;
 if (l==0)
 html_error(fres,100);
 
-for (a=0;a<nseq-1;a++)
+for (a=abgd_rows_first;a<nseq-1 && a<abgd_rows_last;a++)
 	{
+	if (abgd_progress(ABGD_PHASE_DISTANCES, a, nseq))
+		return;
 	s1= mesSeqs[a].seq;
 	mymat.dist[a][a]=0;
 	for (b=a+1;b<nseq;b++)
@@ -779,7 +1049,7 @@ for (a=0;a<nseq-1;a++)
 
 		}
 	}
-printf("doneJC\n");
+abgd_log(ABGD_LOG_DEBUG, "doneJC\n");
 }
 
 
@@ -918,8 +1188,10 @@ void distanceK80 (struct FastaSeq *mesSeqs,int l,struct  DistanceMatrix  my_mat,
 int nseq=my_mat.n;
 
 
-	for(i=0;i<nseq; i++){
-		printf("seq:%d\n",i);
+	for(i=abgd_rows_first;i<nseq && i<abgd_rows_last; i++){
+		if (abgd_progress(ABGD_PHASE_DISTANCES, i, nseq))
+			return;
+		abgd_log(ABGD_LOG_DEBUG, "seq:%d\n",i);
 		my_mat.dist[i][i]=0;
 
 		for(j=i+1;j<nseq; j++){
@@ -985,7 +1257,7 @@ int nseq=my_mat.n;
 if (l==0)
 html_error(fres,100);
 
-for (a=0;a<nseq-1;a++)
+for (a=abgd_rows_first;a<nseq-1 && a<abgd_rows_last;a++)
 	{
 	s1= mesSeqs[a].seq;
 	my_mat.dist[a][a]=0;
@@ -1116,7 +1388,7 @@ void print_groups_files( struct Composante my_comp , struct DistanceMatrix distm
 
 //see pb with user dir for abgd CL
 
-void CreateSpartFile(Spart *myspar,Spart *myspar2,char *ledir,int nbstepABGD,char *dataFilename,int **sub,int nbSamples,char *ladate,FILE *fres,char *workdir,char *meth,float slope,double *bcode)
+void CreateSpartFile(Spart *myspar,Spart *myspar2,const char *ledir,int nbstepABGD,char *dataFilename,int **sub,int nbSamples,const char *ladate,FILE *fres,char *workdir,char *meth,float slope,double *bcode)
 {
 	int i,j,k;
 	FILE *f;
@@ -1136,6 +1408,7 @@ void CreateSpartFile(Spart *myspar,Spart *myspar2,char *ledir,int nbstepABGD,cha
 		//fprintf(stderr,"PARTFILE: %s******\n",lename);
 		f=fopen(lename,"w");
 		if (f==NULL) {fprintf(fres,"%s not opened",lename);fclose (fres);exit_properly(ledir);}
+		setvbuf(f,NULL,_IOFBF,SPART_BUFSIZ);      /* one large buffer instead of a flush every few hundred bytes */
 		//printf("------>%s\n",lename);
 		fprintf(f,"begin spart;\n");
 		//strcpy_spart_simp(proj,dataFilename);
@@ -1169,34 +1442,16 @@ void CreateSpartFile(Spart *myspar,Spart *myspar2,char *ledir,int nbstepABGD,cha
 		fprintf(f,"%e]\n",bcode[i]);
 		fprintf(f,"[WARNING: The sample names below may have been changed to fit SPART specification (only alphanumeric characters and _ )]\n");
 		fprintf(f,"Individual_assignment = \n");
-		for (i=0;i<nbSamples-1;i++)
-		{
 
-			fprintf(f,"%s : ",myspar[i].name); // alea
-			if (j==0)
-				for (k=0;k<nbstepABGD-1;k++)
-					fprintf(f,"%d / ",myspar[i].specie[k]);
-				else
-					for (k=0;k<nbstepABGD-1;k++)
-						fprintf(f,"%d / ",myspar2[i].specie[k]);
-			if (j==0)
-				fprintf(f,"%d\n",myspar[i].specie[k]);
-			else
-				fprintf(f,"%d\n",myspar2[i].specie[k]);
+		mySpar_generic=(j==0)?myspar:myspar2;
+		for (i=0;i<nbSamples;i++)
+		{
+			fputs(mySpar_generic[i].name,f);
+			fputs(" : ",f);
+			for (k=0;k<nbstepABGD-1;k++)
+				fprintf(f,"%d / ",mySpar_generic[i].specie[k]);
+			fprintf(f,"%d%s\n",mySpar_generic[i].specie[k],(i==nbSamples-1)?";":"");
 		}
-		if (j==0)
-			fprintf(f,"%s : ",myspar[i].name); // alea
-		else
-			fprintf(f,"%s : ",myspar2[i].name);
-		for (k=0;k<nbstepABGD-1;k++)
-			if (j==0)
-				fprintf(f,"%d / ",myspar[i].specie[k]);
-			else
-				fprintf(f,"%d / ",myspar2[i].specie[k]);
-			if (j==0)
-			fprintf(f,"%d;\n",myspar[i].specie[k]);
-			else
-			fprintf(f,"%d;\n",myspar2[i].specie[k]);
 		fprintf(f,"end;\n");
 
 		fclose(f);
@@ -1206,24 +1461,13 @@ void CreateSpartFile(Spart *myspar,Spart *myspar2,char *ledir,int nbstepABGD,cha
 
 
 
-int locate(int ind,struct Composante my_comp )
-{
-
-
-	int i,j;
-	for(i=0; i<my_comp.nc; i++)
-	{
-		for(j=0; j< my_comp.n_in_comp[i]; j++)
-			if (ind== my_comp.comp[i][j])
-				return i;
-	}
-	return -1;
-}
-
+/*
+	group of each specimen is read from node_compid (kept up to date by update_composante)
+*/
 void mem_spart_files( struct Composante my_comp ,Spart *Myspar,int nbC,int **nbsub,int which,int nbspecimens,FILE *fres){
-int i,j,gr;
+int i,gr;
 for(i=0; i<nbspecimens; i++){
-	gr=locate(i,my_comp);
+	gr=my_comp.node_compid[i];
 	if (gr==-1){fprintf(fres,"problemo");exit(1);}
 	Myspar[i].specie[nbC]=gr+1;
 
@@ -1274,38 +1518,26 @@ char *extract_posit_mot( char *lastring, char *nom )
 	return (bou);
 }
 
-/*
-	point on the exact location of nom in string (taking into account that name can be a substring of another name)
-*/
-char *extract_posit_mot_2( char *lastring, char *nom )
-{
-	char *p=lastring;             /* pointer to the string */
-	size_t l = strlen( nom );     /* lenght of nom */
-
-	while( (p = strstr( p, nom )) != NULL  )
-	{
-
-		if( *(p+l) ==')' || *(p+l) =='(' || *(p+l) ==':'|| *(p+l) ==',' || *(p+l)==' ')
-			break;
-		else
-			p++;
-	}
-
-	return (p);
-}
-
-
 /*
 	if html==1 then print HTML balises
+	The group of each leaf is written after its name in the tree, using the blanks
+	BIONJ reserved there; tree.text is left untouched, so it needs no restoring.
 */
-void print_groups_files_newick( struct Composante my_comp , struct DistanceMatrix distmat  ,FILE *f,char *lastring, FILE *f2, int html,FILE *fres,char *ledir){
+void print_groups_files_newick( struct Composante my_comp , struct DistanceMatrix distmat  ,FILE *f,struct NewickTree tree, FILE *f2, int html){
 
 
-	int i,j,k=0,taillenom=1;
-	char *nom=NULL,*bou;
-	char chiffre[15];
+	int i,j,k;
+	int *group;                /* group of each node, -1 for masked ones */
+	long from=0,               /* first char of tree.text not written yet */
+	     blank;                /* number of blanks after the leaf name */
+	char chiffre[24];
+	int l;
 
-	nom=malloc(sizeof(char) *1);
+	group=(int *)malloc( (size_t)distmat.n*sizeof(int) );
+	if(!group)fprintf(stderr, "print_groups_files_newick: cannot allocate group, bye\n"), exit(2);
+
+	for(i=0; i<distmat.n; i++)
+		group[i]=-1;
 
 	for(i=0; i<my_comp.nc; i++){
 
@@ -1319,50 +1551,10 @@ void print_groups_files_newick( struct Composante my_comp , struct DistanceMatri
 
 		fprintf(f,"id:" );
 
-
 		for(j=0; j< my_comp.n_in_comp[i]; j++)
 		{
-
-				if (strlen(distmat.names[my_comp.comp[i][j]]) >taillenom)
-					{
-					taillenom=strlen(distmat.names[my_comp.comp[i][j]]);
-			//		printf("-->realloc %d-%d <BR>\n",i,j);
-					nom=realloc(nom, sizeof(char)*(taillenom+3));
-					}
-			//SOFIZ sprintf(nom,"%s",distmat.names[my_comp.comp[i][j]]);
-			strcpy(nom,distmat.names[my_comp.comp[i][j]]);
-			//printf("-->%s\n%s\n\n",nom,lastring);
 			fprintf(f," %s", distmat.names[my_comp.comp[i][j]]);
-//			printf("*****NOM:%d-%d %s<BR>\n",i,j,nom,strlen(nom));
-			bou= extract_posit_mot_2( lastring , nom );
-
-			if (bou==NULL)   /* should never arrives */
-			{
-				fprintf(fres,"print_groups_files_newick %s not found in\n%s \n",nom,lastring);
-				html_error(fres,255);
-				fclose(fres);exit_properly(ledir);
-			}
-/*			else
-			if (strlen(bou)<= strlen(nom)+1)
-			{
-				printf("UNEXPECTED PROBLEM<BR>");
-				html_error(255);
-			}*/
-//				bou+=strlen(nom)+1;
-				bou+=strlen(nom)+1;
-
-			sprintf(chiffre,"%d",i+1);
-				*bou++='_';
-
-			*bou++='g';
-			*bou++='r';
-			*bou++='o';
-			*bou++='u';
-			*bou++='p';
-			*bou++=' ';
-
-			for (k=0;k<strlen(chiffre);k++)
-				*bou++=chiffre[k];
+			group[ my_comp.comp[i][j] ] = i;
 		}
 
 		if (html)
@@ -1372,10 +1564,39 @@ void print_groups_files_newick( struct Composante my_comp , struct DistanceMatri
 
 	}
 
-	fprintf(f2,"%s\n",lastring);
+	/*
+		One pass on the tree: copy the text up to each leaf name, then its label
+	*/
+	for(k=0; k<tree.nleaf; k++){
+
+		fwrite( tree.text+from, sizeof(char), (size_t)(tree.leaf_end[k]-from), f2 );
+
+		for(blank=0; tree.text[ tree.leaf_end[k]+blank ]==' '; blank++);
+		from = tree.leaf_end[k]+blank;
+
+		if( group[ tree.leaf_node[k] ] == -1 ){          /* not in any group, leave it as is */
+			fwrite( tree.text+tree.leaf_end[k], sizeof(char), (size_t)blank, f2 );
+			continue;
+		}
+
+		l=sprintf(chiffre," _group %d", group[ tree.leaf_node[k] ]+1);
+		fputs(chiffre, f2);
+
+		for(; blank>l; blank--)
+			fputc(' ', f2);
+	}
+	fwrite( tree.text+from, sizeof(char), (size_t)(tree.len-from), f2 );
+
+	fprintf(f2,"\n");
 	fclose(f2);
-	if (nom)
-		free(nom);
+	free(group);
+}
+
+void free_newick( struct NewickTree tree ){
+
+	free(tree.text);
+	free(tree.leaf_end);
+	free(tree.leaf_node);
 }
 
 void print_groups_files_No_newick( struct Composante my_comp , struct DistanceMatrix distmat  ,FILE *f){
@@ -1542,26 +1763,30 @@ Take off sites with gaps
 /*
 take a fasta file as input and compute distance as method(seq1,seq2,length)
 */
-struct DistanceMatrix GetDistMat (int nseq, struct FastaSeq *mesSeqs, int method,float ts_tv,FILE *fres,char *ledir)
-{
+/*
+	Rows of the upper triangle computed by the distance functions, all by default.
+	See GetDistTile().
+*/
+long abgd_rows_first=0;
+long abgd_rows_last=LONG_MAX;
 
-	struct DistanceMatrix my_mat;                  /* store distance matrix, names and matrix size */
-	void (*distance) (struct FastaSeq *,int ,struct DistanceMatrix ,FILE *,char *)=NULL;      /* pointeur de fonction */;
-	int a;
-	int length;
+/*
+	The distance function for method
+*/
+static DistanceFunction pick_distance( int method ){
 
-	length=strlen(mesSeqs[0].seq);
+	DistanceFunction distance=NULL;
 
 	switch(method){
 
 		case 0:
 			distance=distanceK80;
-			printf("Kimura distance\n");
+			abgd_log(ABGD_LOG_INFO, "Kimura distance\n");
 			break;
 
 		case 1:
 			distance=distanceJC69;
-			printf("Jukes Cantor distance\n");
+			abgd_log(ABGD_LOG_INFO, "Jukes Cantor distance\n");
 			break;
 
 		case 2:
@@ -1570,9 +1795,23 @@ struct DistanceMatrix GetDistMat (int nseq, struct FastaSeq *mesSeqs, int method
 
 		case 3:
 			distance=distancesimple;
-			printf("Simple distance\n");
+			abgd_log(ABGD_LOG_INFO, "Simple distance\n");
 			break;
 	}
+	return distance;
+}
+
+struct DistanceMatrix GetDistMat (int nseq, struct FastaSeq *mesSeqs, int method,float ts_tv,FILE *fres,char *ledir)
+{
+
+	struct DistanceMatrix my_mat;                  /* store distance matrix, names and matrix size */
+	DistanceFunction distance;                     /* pointeur de fonction */
+	struct PhaseClock started;
+	int a;
+	int length;
+
+	length=strlen(mesSeqs[0].seq);
+	distance=pick_distance(method);
 
 	my_mat.names = (char **)malloc( (size_t) sizeof(char *)*nseq+1);
 
@@ -1603,12 +1842,75 @@ struct DistanceMatrix GetDistMat (int nseq, struct FastaSeq *mesSeqs, int method
 	}
 //printf("calculating distances %d seq\n<BR>",my_mat.n);
 
+	started = abgd_phase_start();
 	distance(mesSeqs,length,my_mat,fres,ledir);
+	abgd_phase_stop(ABGD_METRIC_DISTANCES, started);
+	abgd_counts[ABGD_COUNT_PAIRS] += (long)nseq*(nseq-1)/2;
 //print_distmat(my_mat);
 	return my_mat;
 
 }
 
+/*
+	Upper triangle of rows [first, last) of the distance matrix, one row after the other:
+	(first, first+1) ... (first, nseq-1), (first+1, first+2) ... (last-1, nseq-1).
+	Each shard of a run split over several machines computes one such tile.
+	The distance functions also write the mirrored values, which are never read:
+	rows outside of the range all share a single scratch row.
+*/
+double *GetDistTile (int nseq, struct FastaSeq *mesSeqs, int method, float ts_tv, long first, long last, long *count)
+{
+
+	struct DistanceMatrix my_mat;
+	DistanceFunction distance;
+	struct PhaseClock started;
+	double *scratch, *tile;
+	long a, k;
+	int length;
+
+	length=strlen(mesSeqs[0].seq);
+	distance=pick_distance(method);
+
+	my_mat.n=nseq;
+	my_mat.ratio_ts_tv=ts_tv;
+	my_mat.names = (char **)malloc( (size_t) sizeof(char *)*nseq );
+	my_mat.dist = (double **)malloc( (size_t) sizeof(double *)*nseq );
+	scratch = (double *)malloc( (size_t) sizeof(double)*nseq );
+	if( !my_mat.names || !my_mat.dist || !scratch )fprintf(stderr, "GetDistTile: cannot allocate rows, bye\n"), exit(4);
+	for(a=0;a<nseq;a++){
+		my_mat.names[a]=mesSeqs[a].name;
+		my_mat.dist[a]=scratch;
+	}
+	for(a=first;a<last;a++){
+		my_mat.dist[a] = (double *)malloc( (size_t) sizeof(double)*nseq );
+		if( ! my_mat.dist[a] )fprintf(stderr, "GetDistTile: cannot allocate row %ld, bye\n", a), exit(4);
+	}
+
+	started = abgd_phase_start();
+	abgd_rows_first=first;
+	abgd_rows_last=last;
+	distance(mesSeqs,length,my_mat,stdout,"");
+	abgd_rows_first=0;
+	abgd_rows_last=LONG_MAX;
+	abgd_phase_stop(ABGD_METRIC_DISTANCES, started);
+
+	*count=0;
+	for(a=first;a<last;a++)
+		*count += nseq-1-a;
+	abgd_counts[ABGD_COUNT_PAIRS] += *count;
+	tile = (double *)malloc( (size_t) sizeof(double)*(*count ? *count : 1) );
+	if( !tile )fprintf(stderr, "GetDistTile: cannot allocate tile, bye\n"), exit(4);
+	for(k=0, a=first;a<last;a++){
+		memcpy(tile+k, my_mat.dist[a]+a+1, (size_t) sizeof(double)*(nseq-1-a));
+		k += nseq-1-a;
+		free(my_mat.dist[a]);
+	}
+	free(scratch);
+	free(my_mat.dist);
+	free(my_mat.names);
+	return tile;
+}
+
 
 void free_distmat(  struct DistanceMatrix mat ){
 
@@ -1665,6 +1967,56 @@ double *matrix2list( struct DistanceMatrix  distmat, char *mask, long *Nval ){
 }
 
 
+/*
+	Stratified sample of the pairwise distances between masked sequences, for very large sets:
+	pairs are cut into nsample strata of consecutive pairs, and one pair is drawn in each stratum (see ran1()).
+	If there are no more than nsample pairs, all of them are returned as by matrix2list().
+*/
+double *matrix2sample( struct DistanceMatrix  distmat, char *mask, long nsample, long *Nval ){
+
+	long i, s, nseq=0;
+	long npairs, index, row, col, rowstart;
+	long *seqs;
+	double *Pairs;
+
+	for(i=0;i<distmat.n;i++)
+		nseq+=mask[i];
+
+	npairs = (nseq*(nseq-1))/2;
+	if( npairs <= nsample )
+		return matrix2list( distmat, mask, Nval );
+
+	seqs = (long *)malloc( nseq*sizeof(long) );
+	Pairs = (double *)malloc( nsample*sizeof(double) );
+	if(!seqs || !Pairs)fprintf(stderr, "matrix2sample: cannot allocate Pairs, bye\n"), exit(4);
+
+	for(i=0, s=0; i<distmat.n; i++)
+		if( mask[i] )
+			seqs[s++] = i;
+
+	row=0;
+	rowstart=0;                      /* index of the first pair of row, which is (row, row+1) */
+	for(s=0; s<nsample; s++){
+
+		index = (long)( (s + uniform_dev()) * ((double)npairs / nsample) );
+		if( index >= npairs )
+			index = npairs-1;
+
+		while( index >= rowstart + (nseq-1-row) ){     /* strata only move forward */
+			rowstart += nseq-1-row;
+			row++;
+		}
+		col = row + 1 + (index - rowstart);
+		Pairs[s] = distmat.dist[ seqs[row] ][ seqs[col] ];
+	}
+
+	free(seqs);
+	*Nval = nsample;
+	return Pairs;
+
+}
+
+
 
 /********************
 
@@ -1767,6 +2119,7 @@ struct Composante extract_composante(  struct DistanceMatrix matrix, double max_
 
 	int i;
 	struct Composante my_comp;
+	struct PhaseClock started = abgd_phase_start();
 
 
 	/*
@@ -1823,7 +2176,7 @@ struct Composante extract_composante(  struct DistanceMatrix matrix, double max_
 		my_comp.n_in_comp[ my_comp.node_compid[i] ] ++;
 	}
 
-
+	abgd_phase_stop(ABGD_METRIC_COMPONENTS, started);
 	return my_comp;
 }
 /*
@@ -1857,7 +2210,7 @@ void update_composante(  struct Composante *main_comp, int id, struct Composante
 	for(i =0; i < main_comp->nn+main_comp->nm ; i++){
 
 		if( sub_comp.node_compid[ i ] > 0 )
-			main_comp->node_compid[ i ] = main_comp->nc + sub_comp.node_compid[ i ];
+			main_comp->node_compid[ i ] = main_comp->nc + sub_comp.node_compid[ i ] - 1;    /* same slot as in comp/n_in_comp below */
 	}
 
 
@@ -1932,38 +2285,88 @@ long min_ws( long nval ){
 	return (nval/10>1)?nval/10:1;
 }
 
+/*
+	sort on names, ties kept in file order so that the first occurence comes first
+*/
+static int CompareSeqNames(const void *v1, const void *v2){
+
+	struct FastaSeq *s1=*(struct FastaSeq **)v1,
+	                *s2=*(struct FastaSeq **)v2;
+	int c=strcmp(s1->name,s2->name);
+
+	if (c!=0)
+		return c;
+	return (s1<s2)?-1:(s1>s2);
+}
+
+/*
+	first entry of the sorted array whose name is >= key
+*/
+static int LowerBoundName(struct FastaSeq **sorted, int nbseq, char *key){
+
+	int lo=0,hi=nbseq,mid;
+
+	while (lo<hi){
+		mid=(lo+hi)/2;
+		if (strcmp(sorted[mid]->name,key)<0)
+			lo=mid+1;
+		else
+			hi=mid;
+	}
+	return lo;
+}
+
 /*check that names are uniques in alignment*/
+/*
+	names are sorted once: identical names are then neighbours, and all names starting with "name " form
+	a contiguous block found by binary search. Every conflict is reported, 0 is returned if any was found
+*/
 int check_names(struct FastaSeq *mesSeq, int nbseq)
 {
-int i,j,c;
-for (i=0;i<nbseq-1;i++)
-	for (j=i+1;j<nbseq;j++)
+int i,j,k,c,ok=1;
+long maxlen=0;
+struct FastaSeq **sorted;
+char *key;
+
+if (nbseq<2)
+	return(1);
+
+sorted=(struct FastaSeq **)malloc(sizeof(struct FastaSeq *)*nbseq);
+if(!sorted)fprintf(stderr, "check_names: cannot allocate sorted, bye\n"), exit(2);
+
+for (i=0;i<nbseq;i++)
 	{
-		if (strcmp(mesSeq[i].name,mesSeq[j].name)==0)
-			{
-			printf("seq %d: %s and seq %d: %s have same name\n",i+1,mesSeq[i].name,j+1,mesSeq[j].name);
-			return(0);
-			}
+	sorted[i]=&mesSeq[i];
+	if ((long)strlen(mesSeq[i].name)>maxlen)
+		maxlen=strlen(mesSeq[i].name);
+	}
+qsort((void *)sorted,(size_t)nbseq,sizeof(struct FastaSeq *),CompareSeqNames);
 
-		if (strstr(mesSeq[i].name,mesSeq[j].name)!=NULL) //name j included in i
-			{
-			c=strlen(mesSeq[j].name);
-			if (mesSeq[i].name[c]==' ')
-				{
-				printf("seq %d: %s has a name included in seq %d: %s . ABGD can't deal with that; change at least one of the names\n",i+1,mesSeq[i].name,j+1,mesSeq[j].name);
-				return(0);
-				}
-			}
+key=(char *)malloc(sizeof(char)*(maxlen+2));
+if(!key)fprintf(stderr, "check_names: cannot allocate key, bye\n"), exit(2);
 
-		if  (strstr(mesSeq[j].name,mesSeq[i].name)!=NULL)
-			{
-			c=strlen(mesSeq[i].name);
-			if (mesSeq[j].name[c]==' ')
-				{
-				printf("seq %d: %s has a name included in seq %d: %s . ABGD can't deal with that; change at least one of the names\n\n",i+1,mesSeq[i].name,j+1,mesSeq[j].name);
-				return(0);
-				}
-			}
+for (i=0;i<nbseq;i=j)
+	{
+	/* run of identical names */
+	for (j=i+1;j<nbseq && strcmp(sorted[i]->name,sorted[j]->name)==0;j++)
+		{
+		printf("seq %d: %s and seq %d: %s have same name\n",(int)(sorted[i]-mesSeq)+1,sorted[i]->name,(int)(sorted[j]-mesSeq)+1,sorted[j]->name);
+		ok=0;
+		}
+
+	/* names that start with this one followed by a space */
+	c=strlen(sorted[i]->name);
+	strcpy(key,sorted[i]->name);
+	key[c]=' ';
+	key[c+1]='\0';
+	for (k=LowerBoundName(sorted,nbseq,key);k<nbseq && strncmp(sorted[k]->name,key,c+1)==0;k++)
+		{
+		printf("seq %d: %s has a name included in seq %d: %s . ABGD can't deal with that; change at least one of the names\n",(int)(sorted[k]-mesSeq)+1,sorted[k]->name,(int)(sorted[i]-mesSeq)+1,sorted[i]->name);
+		ok=0;
+		}
 	}
-return(1);
+
+free(key);
+free(sorted);
+return(ok);
 }
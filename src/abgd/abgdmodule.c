@@ -27,6 +27,10 @@ https://www.python.org/dev/peps/pep-0489/
 #include <Python.h>
 #include <stdlib.h>
 #include <stdio.h>
+#include <math.h>
+#ifndef _WIN32
+#include <pthread.h>
+#endif
 #include "abgd.h"
 #include "main_abgd.h"
 
@@ -34,7 +38,7 @@ https://www.python.org/dev/peps/pep-0489/
 static int Increase(const void *v1, const void *v2){  	return (int)SIGN( *((double *)v1) - *((double *)v2));  };
 #undef SIGN
 
-// Set var = dict[str], do nothing if key does not exist.
+// Set var = dict[str], do nothing if key or dict does not exist.
 // On failure, sets error indicator and returns -1.
 // Return 0 on success.
 // Beware: parsing strings allocates memory!
@@ -42,6 +46,7 @@ int parseItem(PyObject *dict, const char *str, const char t, void *var) {
 
 	PyObject *item;
 	PyObject *value;
+	if (dict == NULL) return 0;
 	switch(t){
 		case 'b':
 			item = PyDict_GetItemString(dict, str);
@@ -88,8 +93,9 @@ int parseItem(PyObject *dict, const char *str, const char t, void *var) {
 				return -1;
 			}
 			const char *bytes = PyBytes_AS_STRING(value);
-			*(const char **)var = malloc(strlen (bytes) + 1);
-			strcpy(*(const char **)var, bytes);
+			char *copy = malloc(strlen (bytes) + 1);
+			strcpy(copy, bytes);
+			*(const char **)var = copy;
 			Py_XDECREF(value);
 			break;
 		default:
@@ -99,8 +105,723 @@ int parseItem(PyObject *dict, const char *str, const char t, void *var) {
 	return 0;
 }
 
+// Set dict[str] = value and release the reference to value.
+// On failure (including a NULL value), returns -1 with the error indicator set.
+int setItem(PyObject *dict, const char *str, PyObject *value) {
+
+	int res;
+	if (value == NULL) return -1;
+	res = PyDict_SetItemString(dict, str, value);
+	Py_DECREF(value);
+	return res;
+}
+
+// Append value to list and release the reference to value, same errors as setItem()
+int appendItem(PyObject *list, PyObject *value) {
+
+	int res;
+	if (value == NULL) return -1;
+	res = PyList_Append(list, value);
+	Py_DECREF(value);
+	return res;
+}
+
+// Strings from the core are not guaranteed to be valid UTF-8
+PyObject *stringFromC(const char *str) {
+	return PyUnicode_DecodeUTF8(str, strlen(str), "surrogateescape");
+}
+
+PyObject *listFromInt(int *array, long n) {
+
+	long i;
+	PyObject *list = PyList_New(n);
+	if (list == NULL) return NULL;
+	for (i = 0; i < n; i++) {
+		PyObject *item = PyLong_FromLong(array[i]);
+		if (item == NULL) { Py_DECREF(list); return NULL; }
+		PyList_SET_ITEM(list, i, item);
+	}
+	return list;
+}
+
+PyObject *listFromLong(long *array, long n) {
+
+	long i;
+	PyObject *list = PyList_New(n);
+	if (list == NULL) return NULL;
+	for (i = 0; i < n; i++) {
+		PyObject *item = PyLong_FromLong(array[i]);
+		if (item == NULL) { Py_DECREF(list); return NULL; }
+		PyList_SET_ITEM(list, i, item);
+	}
+	return list;
+}
+
+PyObject *listFromDouble(double *array, long n) {
+
+	long i;
+	PyObject *list = PyList_New(n);
+	if (list == NULL) return NULL;
+	for (i = 0; i < n; i++) {
+		PyObject *item = PyFloat_FromDouble(array[i]);
+		if (item == NULL) { Py_DECREF(list); return NULL; }
+		PyList_SET_ITEM(list, i, item);
+	}
+	return list;
+}
+
+// List of (low, high) tuples, None if n is negative
+PyObject *listFromBounds(double *low, double *high, long n) {
+
+	long i;
+	PyObject *list;
+	if (n < 0) {
+		Py_INCREF(Py_None);
+		return Py_None;
+	}
+	list = PyList_New(n);
+	if (list == NULL) return NULL;
+	for (i = 0; i < n; i++) {
+		PyObject *item = Py_BuildValue("(dd)", low[i], high[i]);
+		if (item == NULL) { Py_DECREF(list); return NULL; }
+		PyList_SET_ITEM(list, i, item);
+	}
+	return list;
+}
+
+// Group of each specimen at every recorded step
+PyObject *listFromSpart(Spart *spart, long n, int steps) {
+
+	long i;
+	int k;
+	PyObject *list = PyList_New(steps);
+	if (list == NULL) return NULL;
+	for (k = 0; k < steps; k++) {
+		PyObject *step = PyList_New(n);
+		if (step == NULL) { Py_DECREF(list); return NULL; }
+		for (i = 0; i < n; i++) {
+			PyObject *item = PyLong_FromLong(spart[i].specie[k]);
+			if (item == NULL) { Py_DECREF(step); Py_DECREF(list); return NULL; }
+			PyList_SET_ITEM(step, i, item);
+		}
+		PyList_SET_ITEM(list, k, step);
+	}
+	return list;
+}
+
+// Copy a sequence of numbers into a newly allocated C array, NULL on failure
+void *arrayFromSequence(PyObject *seq, const char t, long *n) {
+
+	long i;
+	void *array;
+	PyObject *fast = PySequence_Fast(seq, "arrayFromSequence: Expected a sequence");
+	if (fast == NULL) return NULL;
+	*n = PySequence_Fast_GET_SIZE(fast);
+	array = malloc(((t == 'd') ? sizeof(double) : (t == 'l') ? sizeof(long) : sizeof(int)) * (*n + 2));
+	if (array == NULL) { Py_DECREF(fast); PyErr_NoMemory(); return NULL; }
+	for (i = 0; i < *n; i++) {
+		PyObject *item = PySequence_Fast_GET_ITEM(fast, i);
+		switch(t){
+			case 'd': ((double *)array)[i] = PyFloat_AsDouble(item); break;
+			case 'l': ((long *)array)[i] = PyLong_AsLong(item); break;
+			default: ((int *)array)[i] = (int) PyLong_AsLong(item);
+		}
+	}
+	Py_DECREF(fast);
+	if (PyErr_Occurred()) { free(array); return NULL; }
+	return array;
+}
+
+// If positive, the peak search only sees a sample of this many pairs, see matrix2sample()
+static long sample_size = 0;
+
+// Sorted pairwise distances between the masked sequences, or a sample of them.
+// window is set to the smallest window size for the peak search: that of all pairs,
+// scaled down to the sample so that it spans the same share of the distribution.
+// Smallest window for nval sorted pairs out of npairs, scaled down if they are a sample
+long pairsWindow(long nval, long npairs) {
+
+	long window = min_ws(nval);
+
+	if (nval < npairs) {
+		window = (long)((double)min_ws(npairs) * nval / npairs);
+		if (window < 2)
+			window = 2;
+	}
+	return window;
+}
+
+double *sortedPairs(struct DistanceMatrix distmat, char *mask, long *nval, long *window) {
+
+	double *vals;
+	long j, nseq = 0, npairs;
+
+	if (sample_size > 0)
+		vals = matrix2sample(distmat, mask, sample_size, nval);
+	else
+		vals = matrix2list(distmat, mask, nval);
+	qsort((void *) vals, (size_t) *nval, (size_t) sizeof(double), Increase);
+
+	for (j = 0; j < distmat.n; j++)
+		nseq += mask[j];
+	npairs = (nseq * (nseq - 1)) / 2;
+	*window = pairsWindow(*nval, npairs);
+	return vals;
+}
+
+// Interval of the exact distance at the quantile of a gap found in a sample of nval sorted pairs.
+// The sample distribution is within eps of the exact one with 95% confidence (Dvoretzky-Kiefer-Wolfowitz).
+void gapBounds(double *vals, long nval, struct Peak peak, double *low, double *high) {
+
+	long rank = (long)(peak.Rank - 0.5);
+	long k = (long)ceil(sqrt(log(2.0 / 0.05) / (2.0 * nval)) * nval);
+
+	*low = vals[(rank - k > 0) ? rank - k : 0];
+	*high = vals[(rank + 1 + k < nval - 1) ? rank + 1 + k : nval - 1];
+}
+
+// Split each group of comp again with its own distances, until no group splits.
+// last is set to the latest peak found, if any. Returns early if cancelled.
+void resplitComposante(struct DistanceMatrix distmat, struct Composante *comp, char *mask,
+                       double MaxDist, double minSlopeIncrease, struct Peak *last) {
+
+	int a, b, nc;
+	int flag = 1;
+	long nval, window;
+	double *vals;
+	struct PhaseClock started = abgd_phase_start(), sorted, round, group;
+
+	while (flag) {
+		flag = 0;                 /* if no sub-split is done, do not start a new round */
+		abgd_counts[ABGD_COUNT_ROUNDS]++;
+		round = abgd_phase_start();
+		nc = comp->nc;
+		for (a = 0; a < nc; a++) {
+			struct Composante recursive_comp;
+			if (abgd_progress(ABGD_PHASE_PRIORS, 0, 0)) break;
+			reset_composante(&recursive_comp);                                     /* needed for the free in case of no new group */
+			memset((void *)mask, 0, (size_t)distmat.n*sizeof(char));
+			for (b = 0; b < comp->n_in_comp[a]; b++)
+				mask[ comp->comp[a][b] ] = 1;
+			sorted = abgd_phase_start();
+			vals = sortedPairs(distmat, mask, &nval, &window);                        /* built array of pairwise dist */
+			abgd_phase_stop(ABGD_METRIC_SORT, sorted);
+			if (nval > 2) {                                                          /* at least 3 sequences are needed */
+				group = abgd_phase_start();
+				*last = find_abgd(vals, nval, window, nval-1, 0, MaxDist, minSlopeIncrease);
+				abgd_trace("component", "sequences", comp->n_in_comp[a], group);
+				if (last->Rank != nval+0.5) {
+					recursive_comp = extract_composante(distmat, last->Dist, mask);
+					if (recursive_comp.nc > 1) {
+						update_composante(comp, a, recursive_comp);
+						flag = 1;
+					}
+				}
+			}
+			free(vals);
+			free_composante(recursive_comp);
+		}
+		abgd_trace("round", "groups", nc, round);
+	}
+	abgd_phase_stop(ABGD_METRIC_RECURSION, started);
+}
+
+// Hash of the group of each node (FNV-1a), the same however groups are numbered:
+// they are renumbered in order of their first node. NULL compid puts all nodes in one group.
+unsigned long long partitionKey(const int *compid, long n, int nc) {
+
+	unsigned long long key = 14695981039346656037ULL;
+	int *label, next = 0, id;
+	long j;
+
+	label = malloc(sizeof(int) * nc);
+	if (!label) fprintf(stderr, "partitionKey: cannot allocate labels, bye\n"), exit(2);
+	for (j = 0; j < nc; j++) label[j] = -1;
+	for (j = 0; j < n; j++) {
+		id = (compid != NULL) ? compid[j] : 0;
+		if (id >= 0 && label[id] < 0) label[id] = next++;
+		key = (key ^ (unsigned long long)(id >= 0 ? label[id] : -1)) * 1099511628211ULL;
+	}
+	free(label);
+	return key;
+}
+
+// Number of groups and partition key with and without recursion for a single prior
+void countGroups(struct DistanceMatrix distmat, struct PeakCache *cache, char *mask,
+                 double MaxDist, double minSlopeIncrease, int *groups, int *groups_init,
+                 unsigned long long *key, unsigned long long *key_init) {
+
+	long j;
+	struct Peak my_abgd, recursive_abgd;
+	struct Composante comp;
+
+	for (j = 0; j < distmat.n; j++) mask[j] = 1;
+	my_abgd = find_abgd_cached(cache, MaxDist, minSlopeIncrease);
+	if (my_abgd.Rank == cache->N+0.5) {
+		*groups = *groups_init = 1;
+		*key = *key_init = partitionKey(NULL, distmat.n, 1);
+		return;
+	}
+	comp = extract_composante(distmat, my_abgd.Dist, mask);
+	*groups_init = comp.nc;
+	*key_init = partitionKey(comp.node_compid, comp.nn, comp.nc);
+	resplitComposante(distmat, &comp, mask, MaxDist, minSlopeIncrease, &recursive_abgd);
+	*groups = comp.nc;
+	*key = partitionKey(comp.node_compid, comp.nn, comp.nc);
+	free_composante(comp);
+}
+
+// Priors giving distinct partitions, instead of a fixed log-spaced grid.
+// Start from a grid of steps priors, then bisect (in log scale) every interval where
+// the partition changes, with or without recursion, until its bounds are within a relative
+// tolerance. Partitions are told apart by the group of every sample, not by their number
+// of groups, through partitionKey(). The smallest prior of each distinct partition is kept,
+// up to the first single group. Sets n to the number of priors kept.
+double *adaptivePriors(struct DistanceMatrix distmat, double *ValArray, long NVal, char *mask,
+                       double minDist, double MaxDist, int steps, double tolerance,
+                       double minSlopeIncrease, int *n) {
+
+	struct PeakCache cache;
+	double *coarse, *prior, *next;
+	int *groups, *init, *next_groups, *next_init;
+	unsigned long long *key, *key_init, *next_key, *next_key_init;
+	int count = 0, evaluated, split = 1, i, k;
+
+	cache = init_peak_cache(ValArray, NVal, min_ws(NVal), NVal-1);
+	coarse = Compute_myDist(minDist, MaxDist, steps);
+	prior = malloc(sizeof(double) * steps);
+	groups = malloc(sizeof(int) * steps);
+	init = malloc(sizeof(int) * steps);
+	key = malloc(sizeof(unsigned long long) * steps);
+	key_init = malloc(sizeof(unsigned long long) * steps);
+	if (!prior || !groups || !init || !key || !key_init) fprintf(stderr, "adaptivePriors: cannot allocate priors, bye\n"), exit(2);
+
+	for (i = 0; i < steps && !abgd_progress(ABGD_PHASE_PRIORS, 0, 0); i++) {
+		prior[count] = coarse[i];
+		countGroups(distmat, &cache, mask, coarse[i], minSlopeIncrease,
+			&groups[count], &init[count], &key[count], &key_init[count]);
+		if (groups[count++] == 1) break;
+	}
+	evaluated = count;
+	free(coarse);
+
+	while (split && !abgd_progress(ABGD_PHASE_PRIORS, 0, 0)) {
+		split = 0;
+		next = malloc(sizeof(double) * 2 * count);
+		next_groups = malloc(sizeof(int) * 2 * count);
+		next_init = malloc(sizeof(int) * 2 * count);
+		next_key = malloc(sizeof(unsigned long long) * 2 * count);
+		next_key_init = malloc(sizeof(unsigned long long) * 2 * count);
+		if (!next || !next_groups || !next_init || !next_key || !next_key_init)
+			fprintf(stderr, "adaptivePriors: cannot allocate priors, bye\n"), exit(2);
+		for (i = 0, k = 0; i < count; i++) {
+			next[k] = prior[i];
+			next_groups[k] = groups[i];
+			next_init[k] = init[i];
+			next_key[k] = key[i];
+			next_key_init[k++] = key_init[i];
+			if (i+1 < count && (key[i] != key[i+1] || key_init[i] != key_init[i+1]) &&
+			    prior[i+1] > prior[i] * (1.0 + tolerance)) {
+				next[k] = sqrt(prior[i] * prior[i+1]);
+				countGroups(distmat, &cache, mask, next[k], minSlopeIncrease,
+					&next_groups[k], &next_init[k], &next_key[k], &next_key_init[k]);
+				k++;
+				evaluated++;
+				split = 1;
+			}
+		}
+		free(prior);
+		free(groups);
+		free(init);
+		free(key);
+		free(key_init);
+		prior = next;
+		groups = next_groups;
+		init = next_init;
+		key = next_key;
+		key_init = next_key_init;
+		count = k;
+	}
+	free_peak_cache(cache);
+
+	for (i = 0, k = 0; i < count; i++) {
+		if (i == 0 || key[i] != key[i-1] || key_init[i] != key_init[i-1])
+			prior[k++] = prior[i];
+		if (groups[i] == 1) break;
+	}
+	abgd_log(ABGD_LOG_INFO, "> Adaptive priors: %d evaluated, %d distinct partitions\n", evaluated, k);
+	free(groups);
+	free(init);
+	free(key);
+	free(key_init);
+	*n = k;
+	return prior;
+}
+
+// Borrow a distance matrix computed beforehand by abgd.distances():
+// rows point inside the buffer, which must outlive the matrix and is never written.
+// On failure, sets error indicator and returns -1.
+int distmatFromBuffer(PyObject *names, Py_buffer *view, struct DistanceMatrix *distmat) {
+
+	long i, n;
+	PyObject *fast, *bytes;
+
+	if (names == NULL) {
+		PyErr_SetString(PyExc_TypeError, "distmatFromBuffer: Expected names along with distances");
+		return -1;
+	}
+	fast = PySequence_Fast(names, "distmatFromBuffer: Expected a sequence of names");
+	if (fast == NULL) return -1;
+	n = PySequence_Fast_GET_SIZE(fast);
+	if (view->len != (Py_ssize_t)(n * n * sizeof(double))) {
+		PyErr_Format(PyExc_ValueError, "distmatFromBuffer: Expected %ld bytes for %ld names, got %zd",
+			(long)(n * n * sizeof(double)), n, view->len);
+		Py_DECREF(fast);
+		return -1;
+	}
+	distmat->n = n;
+	distmat->ratio_ts_tv = 0;
+	distmat->names = (char **)malloc(sizeof(char *) * n);
+	distmat->dist = (double **)malloc(sizeof(double *) * n);
+	if (!distmat->names || !distmat->dist) fprintf(stderr, "distmatFromBuffer: cannot allocate matrix, bye\n"), exit(3);
+	for (i = 0; i < n; i++) {
+		bytes = PyUnicode_AsEncodedString(PySequence_Fast_GET_ITEM(fast, i), "utf-8", "surrogateescape");
+		if (bytes == NULL) {
+			while (i--) free(distmat->names[i]);
+			free(distmat->names);
+			free(distmat->dist);
+			Py_DECREF(fast);
+			return -1;
+		}
+		distmat->names[i] = (char *)malloc(PyBytes_GET_SIZE(bytes) + 1);
+		strcpy(distmat->names[i], PyBytes_AS_STRING(bytes));
+		Py_DECREF(bytes);
+		distmat->dist[i] = (double *)view->buf + i * n;
+	}
+	Py_DECREF(fast);
+	return 0;
+}
+
+// Free a matrix from distmatFromBuffer(), its rows belong to the buffer
+void freeSharedDistmat(struct DistanceMatrix distmat, Py_buffer *view) {
+
+	long i;
+	for (i = 0; i < distmat.n; i++)
+		free(distmat.names[i]);
+	free(distmat.names);
+	free(distmat.dist);
+	PyBuffer_Release(view);
+}
+
+// The core does not check files it writes: make sure it can
+int checkWritable(const char *path) {
+
+	FILE *f = fopen(path, "w");
+	if (f == NULL) {
+		PyErr_SetFromErrnoWithFilename(PyExc_OSError, path);
+		return -1;
+	}
+	fclose(f);
+	return 0;
+}
+
+// Progress and cancellation of abgd_main(), the core polls them through abgd_progress()
+static PyObject *progress_callback = NULL;   /* called as progress(phase, done, total) */
+static Py_buffer cancel_view;               /* stop once its first byte is set */
+static int withcancel = 0;
+static int cancelled = 0;                    /* sticky, every later poll stops too */
+static int last_phase = -1;
+static long last_permille = -1;
+static const char *phase_names[] = {"distances", "priors", "replicates"};
+static PyObject *CancelledError = NULL;
+static PyObject *step_callback = NULL;       /* called as step(event) once each step of abgd_main() is done */
+
+// Start watching the given callback and cancel flag, either may be NULL or None.
+// On failure, sets error indicator and returns -1.
+int watchProgress(PyObject *callback, PyObject *cancel) {
+
+	cancelled = 0;
+	last_phase = -1;
+	last_permille = -1;
+	if (callback != NULL && callback != Py_None) {
+		if (!PyCallable_Check(callback)) {
+			PyErr_SetString(PyExc_TypeError, "watchProgress: Expected a callable for progress");
+			return -1;
+		}
+		Py_INCREF(callback);
+		progress_callback = callback;
+	}
+	if (cancel != NULL && cancel != Py_None) {
+		if (PyObject_GetBuffer(cancel, &cancel_view, PyBUF_SIMPLE)) {
+			Py_CLEAR(progress_callback);
+			return -1;
+		}
+		if (cancel_view.len < 1) {
+			PyErr_SetString(PyExc_ValueError, "watchProgress: Expected a buffer of at least one byte for cancel");
+			PyBuffer_Release(&cancel_view);
+			Py_CLEAR(progress_callback);
+			return -1;
+		}
+		withcancel = 1;
+	}
+	return 0;
+}
+
+// Stop watching, the core runs uninterrupted again
+void unwatchProgress(void) {
+
+	Py_CLEAR(progress_callback);
+	Py_CLEAR(step_callback);
+	if (withcancel)
+		PyBuffer_Release(&cancel_view);
+	withcancel = 0;
+	cancelled = 0;
+}
+
+// Called by the core on long loops, returns 1 once it should stop.
+// A total of 0 only polls the cancel flag. The callback is throttled to
+// one call per thousandth of each phase, and may run with the GIL released:
+// it is taken here. If the callback raises, the core stops and the error is kept.
+int abgd_progress(int phase, long done, long total) {
+
+	PyGILState_STATE gstate;
+	PyObject *result;
+	long permille;
+
+	if (cancelled) return 1;
+	if (withcancel && ((volatile char *)cancel_view.buf)[0]) {
+		cancelled = 1;
+		return 1;
+	}
+	if (progress_callback == NULL || total <= 0) return 0;
+	permille = (long)(1000.0 * done / total);
+	if (phase == last_phase && permille == last_permille) return 0;
+	last_phase = phase;
+	last_permille = permille;
+	gstate = PyGILState_Ensure();
+	result = PyObject_CallFunction(progress_callback, "sll", phase_names[phase], done, total);
+	if (result == NULL)
+		cancelled = 1;
+	Py_XDECREF(result);
+	PyGILState_Release(gstate);
+	return cancelled;
+}
+
+// Also call the given callback once each step is done, see reportStep(). May be NULL or None.
+// On failure, sets error indicator and returns -1.
+int watchSteps(PyObject *callback) {
+
+	if (callback == NULL || callback == Py_None) return 0;
+	if (!PyCallable_Check(callback)) {
+		PyErr_SetString(PyExc_TypeError, "watchSteps: Expected a callable for step");
+		return -1;
+	}
+	Py_INCREF(callback);
+	step_callback = callback;
+	return 0;
+}
+
+// Called by abgd_main() once a step is done, may run with the GIL released.
+// The callback gets a dict: {'step', 'prior', 'barcode_gap', 'groups', 'groups_init', 'files'},
+// files are the paths written for this step, the summary graph first if it was refreshed.
+// A negative gap means none was found: the step stopped at one group, its barcode_gap is None.
+// If the callback raises, the core stops as if cancelled and the error is kept.
+void reportStep(int step, double prior, double gap, int groups, int groups_init,
+                const char *dir, int graph, int text, int trees) {
+
+	PyGILState_STATE gstate;
+	PyObject *files, *barcode, *result;
+	const char *prefix[] = {"partinit", "part"};
+	char name[256];
+	int i;
+
+	if (step_callback == NULL || cancelled) return;
+	gstate = PyGILState_Ensure();
+	files = PyList_New(0);
+	if (files != NULL && graph) {
+		snprintf(name, sizeof(name), "%s/abgd.svg", dir);
+		if (appendItem(files, stringFromC(name))) Py_CLEAR(files);
+	}
+	for (i = 0; files != NULL && text && i < 2; i++) {
+		snprintf(name, sizeof(name), "%s/%s.%d.txt", dir, prefix[i], step);
+		if (appendItem(files, stringFromC(name))) Py_CLEAR(files);
+		snprintf(name, sizeof(name), "%s/%s.%d.tree", dir, prefix[i], step);
+		if (files != NULL && trees && appendItem(files, stringFromC(name))) Py_CLEAR(files);
+	}
+	barcode = (gap < 0) ? (Py_INCREF(Py_None), Py_None) : PyFloat_FromDouble(gap);
+	result = NULL;
+	if (files != NULL && barcode != NULL)
+		result = PyObject_CallFunction(step_callback, "({s:i,s:d,s:O,s:i,s:i,s:O})",
+			"step", step, "prior", prior, "barcode_gap", barcode,
+			"groups", groups, "groups_init", groups_init, "files", files);
+	if (result == NULL)
+		cancelled = 1;
+	Py_XDECREF(files);
+	Py_XDECREF(barcode);
+	Py_XDECREF(result);
+	PyGILState_Release(gstate);
+}
+
+// Rewrite the summary graph of the first n steps for the step callback.
+// It is written aside then renamed, so that it is never read half written.
+void refreshGraph(int *mySpecies, int *specInit, double *myDist, int n, char *ledir, char *meth, const char *dir) {
+
+	char name[256], temp[256];
+
+	snprintf(name, sizeof(name), "%s/abgd.svg", dir);
+	snprintf(temp, sizeof(temp), "%s/abgd.svg.tmp", dir);
+	CreateGraphFiles(mySpecies, specInit, myDist, n, ledir, meth, temp);
+	#ifdef _WIN32
+	remove(name);
+	#endif
+	rename(temp, name);
+}
+
+// Metrics of the last run, see abgd_phase_stop(), as
+// {'phases': {name: {'wall', 'cpu', 'calls', 'peak_rss'}}, 'counts': {name: count}}
+// Times are in seconds and memory in bytes.
+PyObject *dictFromMetrics(void) {
+
+	PyObject *phases, *counts;
+	int i;
+
+	phases = PyDict_New();
+	counts = PyDict_New();
+	for (i = 0; phases && counts && i < ABGD_NMETRICS; i++) {
+		if (setItem(phases, abgd_metric_names[i], Py_BuildValue("{s:d,s:d,s:l,s:L}",
+		            "wall", abgd_metrics[i].wall, "cpu", abgd_metrics[i].cpu,
+		            "calls", abgd_metrics[i].calls, "peak_rss", (long long)abgd_metrics[i].maxrss * 1024)))
+			Py_CLEAR(phases);
+	}
+	for (i = 0; phases && counts && i < ABGD_NCOUNTS; i++) {
+		if (setItem(counts, abgd_count_names[i], PyLong_FromLong(abgd_counts[i])))
+			Py_CLEAR(counts);
+	}
+	if (phases == NULL || counts == NULL) {
+		Py_XDECREF(phases);
+		Py_XDECREF(counts);
+		return NULL;
+	}
+	return Py_BuildValue("{s:N,s:N}", "phases", phases, "counts", counts);
+}
+
+// Events recorded by abgd_trace() as a list of (name, start, duration, argname, arg),
+// times in microseconds. argname and arg are None if there is no argument.
+PyObject *listFromTrace(void) {
+
+	PyObject *list, *item;
+	struct TraceEvent *event;
+	long i;
+
+	list = PyList_New(abgd_ntrace);
+	if (list == NULL) return NULL;
+	for (i = 0; i < abgd_ntrace; i++) {
+		event = abgd_trace_events + i;
+		if (event->argname)
+			item = Py_BuildValue("(sddsl)", event->name, event->start * 1e6, event->duration * 1e6, event->argname, event->arg);
+		else
+			item = Py_BuildValue("(sddOO)", event->name, event->start * 1e6, event->duration * 1e6, Py_None, Py_None);
+		if (item == NULL) { Py_DECREF(list); return NULL; }
+		PyList_SET_ITEM(list, i, item);
+	}
+	return list;
+}
+
+// Messages of the core, see abgd_log(): sent to a Python callable if given
+static PyObject *log_callback = NULL;        /* called as log(level, text) */
+
+// Forward a message to log_callback, the GIL may be released.
+// Errors of the callback are reported but do not stop the core.
+void logToPython(int level, const char *text) {
+
+	PyGILState_STATE gstate;
+	PyObject *etype, *evalue, *etb;
+	PyObject *result;
+
+	gstate = PyGILState_Ensure();
+	PyErr_Fetch(&etype, &evalue, &etb);
+	result = PyObject_CallFunction(log_callback, "iN", level, stringFromC(text));
+	if (result == NULL)
+		PyErr_WriteUnraisable(log_callback);
+	Py_XDECREF(result);
+	PyErr_Restore(etype, evalue, etb);
+	PyGILState_Release(gstate);
+}
+
+// Stop forwarding messages, restore default level and rate
+void unwatchLog(void) {
+
+	abgd_log_flush();
+	abgd_log_sink = NULL;
+	abgd_log_level = ABGD_LOG_INFO;
+	abgd_log_rate = 0;
+	Py_CLEAR(log_callback);
+}
+
+// Apply the log options of kwargs: log, loglevel and lograte.
+// On failure, sets error indicator and returns -1.
+int watchLog(PyObject *dict) {
+
+	PyObject *item;
+	int rate = 0;
+
+	unwatchLog();
+	if (dict == NULL) return 0;
+	if (parseItem(dict, "loglevel", 'i', &abgd_log_level)) return -1;
+	if (parseItem(dict, "lograte", 'i', &rate)) return -1;
+	abgd_log_rate = rate;
+	item = PyDict_GetItemString(dict, "log");
+	if (item != NULL && item != Py_None) {
+		if (!PyCallable_Check(item)) {
+			PyErr_SetString(PyExc_TypeError, "watchLog: Expected a callable for log");
+			return -1;
+		}
+		Py_INCREF(item);
+		log_callback = item;
+		abgd_log_sink = logToPython;
+	}
+	return 0;
+}
+
+// Undo the redirection of stdout/stderr to the log file.
+// On failure, sets error indicator and returns -1.
+int restoreStreams(int stdout_bak, int stderr_bak, fpos_t *stdout_pos, fpos_t *stderr_pos) {
+
+	fflush(stdout);
+	fflush(stderr);
+	int dout = dup2(stdout_bak, fileno(stdout));
+	int derr = dup2(stderr_bak, fileno(stderr));
+	close(stdout_bak);
+	close(stderr_bak);
+	clearerr(stdout);
+	clearerr(stderr);
+	fsetpos(stdout, stdout_pos);
+	fsetpos(stderr, stderr_pos);
+	if ((dout < 0) || (derr < 0)) {
+		PyErr_SetString(PyExc_SystemError, "restoreStreams: Failed to restore output.");
+		return -1;
+	}
+	abgd_log(ABGD_LOG_INFO, "< Restored stdout/stderr\n");
+	fflush(stdout);
+	fflush(stderr);
+	return 0;
+}
+
+// Undo what abgd_main() watched and acquired before failing, shared may be NULL.
+// Redirected output must be restored first. Returns NULL for convenience.
+PyObject *abortMain(FILE *f, Py_buffer *shared) {
+
+	unwatchLog();
+	unwatchProgress();
+	if (shared != NULL)
+		PyBuffer_Release(shared);
+	if (f != NULL)
+		fclose(f);
+	return NULL;
+}
+
 static PyObject *
-abgd_main(PyObject *self, PyObject *args, PyObject *kwargs) {
+abgd_main(PyObject *Py_UNUSED(self), PyObject *args, PyObject *kwargs) {
 
 	PyObject *dict = kwargs;
 	PyObject *item;
@@ -112,8 +833,6 @@ abgd_main(PyObject *self, PyObject *args, PyObject *kwargs) {
 	     ledir[128];
 
 	char *meth=NULL,
-	     *newickString=NULL,
-	     *newickStringOriginal=NULL,
 	     *simplename=NULL;
 
 	char *mask;                      /* used to mask some row/col in the distance matrix -- consider only sub-part of the matrix */
@@ -121,13 +840,11 @@ abgd_main(PyObject *self, PyObject *args, PyObject *kwargs) {
 	double *ValArray;               /* array where input data are stored */
 	double MaxDist=0.1;             /* default 'a priori' maximum distance within species */
 	double *myDist;
-	double *vals;                   /* pairwise distances */
 	double minSlopeIncrease=1.5;
 	double minDist=0.001;
 	double *bcod;
 	float ts_tv=2.0; /*defautl value for trans/transv rate for Kimura*/
 	long NVal=0;                    /* array size */
-	long nval=0;                    /* number of pairwise comparisons */
 
 
 	long i,j;       /* simple counting tmp variable */
@@ -136,24 +853,18 @@ abgd_main(PyObject *self, PyObject *args, PyObject *kwargs) {
 	struct DistanceMatrix distmat;   /* input matrix of distance all vs all */
 	struct Composante comp;          /* group partition */
 	struct Peak recursive_abgd;     /* structure for storing extra split distance */
+	struct NewickTree newickTree;    /* BIONJ tree used to write groups in newick format */
+	struct DistSummary summary;      /* what is drawn from the primary distances */
 
 	short output_slope=0;            /* to output slopes -- watch out it can be very verbose -- */
-	short output_groups=0;           /* output group composition ? */
-
-	short opt_recursion=0;           /* shall we attempt to re-split the primary partition ? */
 
 	short verbose;									/* a bit more verbose */
 	short stop_at_once=0;
-	char DEBUG;											/* way too much verbose.. only for debugging */
 
 	int myD,imethode=1;
 	int *mySpecies,*specInit;
 	int nbStepsABGD=10;             /* How many values are inserted in [p,P] */
 	int c;
-	int flag=1;                     /* if 0, do change in groups, if 1, need another round */
-	int a,b;                        /* dummy counters */
-	int nc;                         /* number of composantes from the first partition before sub-splitting */
-	int round=1;                    /* how many recurssion round */
 	int windsize_min=0;             /* the smallest wind_size */
 	int windsize_max=0;             /* the smallest wind_size */
 	int fmeg=0;
@@ -163,7 +874,6 @@ abgd_main(PyObject *self, PyObject *args, PyObject *kwargs) {
 	int nbbids=20;
 	int notreefile=0;/*option for only groups*/
 	int nbreal;
-	struct tm      *tm;
 	int ncomp_primary=0;
 	// char buffer2[80];
 	const char *timeSig = NULL;
@@ -174,10 +884,30 @@ abgd_main(PyObject *self, PyObject *args, PyObject *kwargs) {
 	fpos_t stdout_pos;
 	fpos_t stderr_pos;
 	int withspart=1;
+	int withfiles=1;                 /* if 0, nothing is written: everything is in the returned results */
+	int adaptive=0;                  /* if 1, priors are refined where the number of groups changes */
+	int withshared=0;                /* if 1, the distance matrix was given and is not ours */
+	Py_buffer shared;
+	int stopped;                     /* if 1, cancelled before the last step */
+	PyObject *etype=NULL, *evalue=NULL, *etb=NULL;   /* raised by the progress callback */
+	PyThreadState *_save;            /* the GIL is released while the core runs */
+	struct PhaseClock total, started, step;
+	int withtrace=0;                 /* if 1, the timeline of the run is returned */
+	double tolerance=0.05;           /* relative width at which adaptive refinement stops */
+	int sample=0;                    /* if positive, gaps are found in a sample of this many pairs */
+	int seed=1;                      /* of the pair sample */
+	long npairs;                     /* all pairs, NVal is less if sampled */
+	long window;                     /* default windsize_min for NVal */
+	double *gaplow, *gaphigh;        /* confidence interval of each sampled gap */
+	int withsummary;                 /* graph and spart files are only written if more than one partition */
+	int nbextract;                   /* number of steps whose partitions were recorded */
+	int graph;                       /* if 1, the summary graph was refreshed for the step callback */
+	PyObject *results;
+	PyObject *tree;
+	PyObject *names, *spart_names;
+	char proj[1024];
 	Spart *myspar,*myspar2;
 	int **nb_subsets;
-	struct stat st;
-	struct stat     statbuf;
 	FILE *fres=stdout;
 	char dataFilename[256];
 	// char buffer[80];
@@ -195,10 +925,44 @@ char *bout;
 	// *dirfiles='.';
 	// *(dirfiles+1)='\0';
 	ts_tv=2;
-	DEBUG=0;
 	verbose=0;
 
 	if (!PyArg_ParseTuple(args, "s", &file)) return NULL;
+
+	// Options are all checked before anything is acquired, invalid ones need no cleanup
+	if (parseItem(dict, "out", 's', &dirfiles)) return NULL;
+	if (!dirfiles) dirfiles = dirfiles_default;
+	if (parseItem(dict, "logfile", 'b', &withlogfile)) return NULL;
+	if (parseItem(dict, "time", 's', &timeSig)) return NULL;
+	if (!timeSig) timeSig = timeSig_default;
+	if (parseItem(dict, "method", 'i', &imethode)) return NULL;
+	if (parseItem(dict, "bids", 'i', &nbbids)) return NULL;
+	if (parseItem(dict, "steps", 'i', &nbStepsABGD)) return NULL;
+	if (parseItem(dict, "min", 'd', &minDist)) return NULL;
+	if (parseItem(dict, "max", 'd', &MaxDist)) return NULL;
+	if (parseItem(dict, "slope", 'd', &minSlopeIncrease)) return NULL;
+	if (parseItem(dict, "rate", 'f', &ts_tv)) return NULL;
+	if (parseItem(dict, "mega", 'b', &fmeg)) return NULL;
+	if (parseItem(dict, "all", 'b', &withallfiles)) return NULL;
+	if (parseItem(dict, "spart", 'b', &withspart)) return NULL;
+	if (parseItem(dict, "verbose", 'b', &verbose)) return NULL;
+	if (parseItem(dict, "simple", 'b', &notreefile)) return NULL;
+	if (parseItem(dict, "files", 'b', &withfiles)) return NULL;
+	if (parseItem(dict, "adaptive", 'b', &adaptive)) return NULL;
+	if (parseItem(dict, "tolerance", 'd', &tolerance)) return NULL;
+	if (parseItem(dict, "sample", 'i', &sample)) return NULL;
+	if (parseItem(dict, "seed", 'i', &seed)) return NULL;
+	if (parseItem(dict, "trace", 'b', &withtrace)) return NULL;
+
+	if (adaptive && (tolerance <= 0 || nbStepsABGD < 2)) {
+		PyErr_SetString(PyExc_ValueError, "abgd_main: Adaptive priors need a positive tolerance and at least 2 steps");
+		return NULL;
+	}
+	if ((sample != 0 && sample < 100) || seed < 1) {
+		PyErr_SetString(PyExc_ValueError, "abgd_main: Expected at least 100 sampled pairs (or 0 for all) and a positive seed");
+		return NULL;
+	}
+
 	f=fopen(file,"r");
 	if (f==NULL) {
 		PyErr_Format(PyExc_FileNotFoundError, "abgd_main: Input file not found: '%s'", file);
@@ -207,17 +971,25 @@ char *bout;
 	simplename = Built_OutfileName( file );
 	//	printf("%s\n",simplename);
 
-	if (parseItem(dict, "out", 's', &dirfiles)) return NULL;
-	if (!dirfiles) dirfiles = dirfiles_default;
-
-	if (parseItem(dict, "logfile", 'b', &withlogfile)) return NULL;
+	// From here on, failures go through abortMain()
+	item = (dict != NULL) ? PyDict_GetItemString(dict, "distances") : NULL;
+	if (item != NULL && item != Py_None) {
+		if (PyObject_GetBuffer(item, &shared, PyBUF_SIMPLE)) return abortMain(f, NULL);
+		withshared = 1;
+	}
+	if (dict != NULL && watchProgress(PyDict_GetItemString(dict, "progress"), PyDict_GetItemString(dict, "cancel")))
+		return abortMain(f, withshared ? &shared : NULL);
+	if (dict != NULL && watchSteps(PyDict_GetItemString(dict, "step")))
+		return abortMain(f, withshared ? &shared : NULL);
+	if (watchLog(dict))
+		return abortMain(f, withshared ? &shared : NULL);
 
 	if (withlogfile) {
 		sprintf(file_name,"%s/abgd.log",dirfiles);
-		printf("> Redirecting stdout/stderr to file: %s\n", file_name);
-		printf("BEFORE REDIRECT: \n");
-		printf("stdout %d\n", stdout);
-		printf("stderr %d\n", stderr);
+		abgd_log(ABGD_LOG_INFO, "> Redirecting stdout/stderr to file: %s\n", file_name);
+		abgd_log(ABGD_LOG_DEBUG, "BEFORE REDIRECT: \n");
+		abgd_log(ABGD_LOG_DEBUG, "stdout %d\n", stdout);
+		abgd_log(ABGD_LOG_DEBUG, "stderr %d\n", stderr);
 		fflush(stdout);
 		fflush(stderr);
 		fgetpos(stdout, &stdout_pos);
@@ -230,64 +1002,50 @@ char *bout;
 		FILE *derr = freopen("NUL:","w",stderr);
 		#endif
 		int ddup = dup2(fileno(stdout), fileno(stderr));
-		printf("AFTER REDIRECT: \n");
-		printf("stdout %d\n", stdout);
-		printf("stderr %d\n", stderr);
-		printf("ddup %d\n", ddup);
-		printf("stdout_bak %p\n", stdout_bak);
-		printf("stderr_bak %p\n", stderr_bak);
+		abgd_log(ABGD_LOG_DEBUG, "AFTER REDIRECT: \n");
+		abgd_log(ABGD_LOG_DEBUG, "stdout %d\n", stdout);
+		abgd_log(ABGD_LOG_DEBUG, "stderr %d\n", stderr);
+		abgd_log(ABGD_LOG_DEBUG, "ddup %d\n", ddup);
+		abgd_log(ABGD_LOG_DEBUG, "stdout_bak %p\n", stdout_bak);
+		abgd_log(ABGD_LOG_DEBUG, "stderr_bak %p\n", stderr_bak);
 		if ((dout == NULL) || (ddup < 0)) {
 			PyErr_SetString(PyExc_SystemError, "abgd_main: Failed to redirect output, aborting.");
-			return NULL;
+			if (!(stdout_bak < 0) && !(stderr_bak < 0))
+				restoreStreams(stdout_bak, stderr_bak, &stdout_pos, &stderr_pos);
+			return abortMain(f, withshared ? &shared : NULL);
 		}
 	}
 
 	// Print these here so they are redirected if needed
-	printf("> file = %s\n", file);
-	printf("> dirfiles = %s\n", dirfiles);
-	printf("> withlogfile = %i\n", withlogfile);
-
-	if (parseItem(dict, "time", 's', &timeSig)) return NULL;
-	if (!timeSig) timeSig = timeSig_default;
-	printf("> timeSig = %s\n", timeSig);
-
-	if (parseItem(dict, "method", 'i', &imethode)) return NULL;
-	printf("> imethode = %i\n", imethode);
-
-	if (parseItem(dict, "bids", 'i', &nbbids)) return NULL;
-	printf("> nbbids = %i\n", nbbids);
-
-	if (parseItem(dict, "steps", 'i', &nbStepsABGD)) return NULL;
-	printf("> nbStepsABGD = %i\n", nbStepsABGD);
-
-	if (parseItem(dict, "min", 'd', &minDist)) return NULL;
-	printf("> minDist = %f\n", minDist);
-
-	if (parseItem(dict, "max", 'd', &MaxDist)) return NULL;
-	printf("> MaxDist = %f\n", MaxDist);
-
-	if (parseItem(dict, "slope", 'd', &minSlopeIncrease)) return NULL;
-	printf("> minSlopeIncrease = %f\n", minSlopeIncrease);
-
-	if (parseItem(dict, "rate", 'f', &ts_tv)) return NULL;
-	printf("> ts_tv = %f\n", ts_tv);
-
-	if (parseItem(dict, "mega", 'b', &fmeg)) return NULL;
-	printf("> fmeg = %i\n", fmeg);
-
-	if (parseItem(dict, "all", 'b', &withallfiles)) return NULL;
-	printf("> withallfiles = %i\n", withallfiles);
-
-	if (parseItem(dict, "spart", 'b', &withspart)) return NULL;
-	printf("> withspart = %i\n", withspart);
-
-	if (parseItem(dict, "verbose", 'b', &verbose)) return NULL;
-	printf("> verbose = %i\n", verbose);
-
-	if (parseItem(dict, "simple", 'b', &notreefile)) return NULL;
-	printf("> notreefile = %i\n", notreefile);
-
-	printf("\n> Begin ABGD core:\n\n");
+	abgd_log(ABGD_LOG_DEBUG, "> file = %s\n", file);
+	abgd_log(ABGD_LOG_DEBUG, "> dirfiles = %s\n", dirfiles);
+	abgd_log(ABGD_LOG_DEBUG, "> withlogfile = %i\n", withlogfile);
+	abgd_log(ABGD_LOG_DEBUG, "> timeSig = %s\n", timeSig);
+	abgd_log(ABGD_LOG_DEBUG, "> imethode = %i\n", imethode);
+	abgd_log(ABGD_LOG_DEBUG, "> nbbids = %i\n", nbbids);
+	abgd_log(ABGD_LOG_DEBUG, "> nbStepsABGD = %i\n", nbStepsABGD);
+	abgd_log(ABGD_LOG_DEBUG, "> minDist = %f\n", minDist);
+	abgd_log(ABGD_LOG_DEBUG, "> MaxDist = %f\n", MaxDist);
+	abgd_log(ABGD_LOG_DEBUG, "> minSlopeIncrease = %f\n", minSlopeIncrease);
+	abgd_log(ABGD_LOG_DEBUG, "> ts_tv = %f\n", ts_tv);
+	abgd_log(ABGD_LOG_DEBUG, "> fmeg = %i\n", fmeg);
+	abgd_log(ABGD_LOG_DEBUG, "> withallfiles = %i\n", withallfiles);
+	abgd_log(ABGD_LOG_DEBUG, "> withspart = %i\n", withspart);
+	abgd_log(ABGD_LOG_DEBUG, "> verbose = %i\n", verbose);
+	abgd_log(ABGD_LOG_DEBUG, "> notreefile = %i\n", notreefile);
+	abgd_log(ABGD_LOG_DEBUG, "> withfiles = %i\n", withfiles);
+	abgd_log(ABGD_LOG_DEBUG, "> adaptive = %i\n", adaptive);
+	abgd_log(ABGD_LOG_DEBUG, "> tolerance = %f\n", tolerance);
+	abgd_log(ABGD_LOG_DEBUG, "> sample = %i\n", sample);
+	abgd_log(ABGD_LOG_DEBUG, "> seed = %i\n", seed);
+	abgd_log(ABGD_LOG_DEBUG, "> withtrace = %i\n", withtrace);
+	abgd_log(ABGD_LOG_DEBUG, "> withshared = %i\n", withshared);
+
+	abgd_metrics_reset();
+	abgd_trace_reset(withtrace);
+	total = abgd_phase_start();
+
+	abgd_log(ABGD_LOG_INFO, "\n> Begin ABGD core:\n\n");
 
 	//check that dirfiles ends by a '/' otherwise may have some pb
 
@@ -303,23 +1061,10 @@ char *bout;
 if (stat(dirfiles, &stfile) == -1)
     mkdir(dirfiles, 0700);
 
-	f=fopen(file,"r");
-	if (f==NULL)printf("Cannot locate your file. Please check, bye\n"),exit(1);
-
 		if (verbose) fprintf(stderr," Running abgd in verbose mode...\n");
-	simplename = Built_OutfileName( file );
-//	printf("%s\n",simplename);
-
-	mySpecies=malloc(sizeof(int)*nbStepsABGD+1);
-	specInit=malloc(sizeof(int)*nbStepsABGD+1);
-
-	myDist = Compute_myDist(  minDist,  MaxDist,  nbStepsABGD );
-	bcod=malloc(sizeof(double*)*nbStepsABGD);
 
 	NVal=0;
 	output_slope=0;
-	output_groups=0;
-	opt_recursion=1;
 
 	/*
 		readfile
@@ -328,6 +1073,18 @@ if (stat(dirfiles, &stfile) == -1)
 	c = fgetc(f);
 	rewind(f);
 
+	if (withshared)
+	{
+		if (distmatFromBuffer(PyDict_GetItemString(dict, "names"), &shared, &distmat)) {
+			abgd_trace_reset(0);
+			if ((withlogfile) && !(stdout_bak < 0) && !(stderr_bak < 0))
+				restoreStreams(stdout_bak, stderr_bak, &stdout_pos, &stderr_pos);
+			return abortMain(f, &shared);
+		}
+	}
+	else
+	{
+	Py_UNBLOCK_THREADS
 	if ( c == '>')
 	{
 	if (verbose) fprintf(stderr,"calculating dist matrix\n");
@@ -335,25 +1092,36 @@ if (stat(dirfiles, &stfile) == -1)
 	if (verbose)fprintf(stderr,"calculating dist matrix done\n");
 		}
 	else
+		{
+		started = abgd_phase_start();
 		distmat = read_distmat(f,ts_tv,fmeg);
+		abgd_phase_stop(ABGD_METRIC_PARSE, started);
+		}
+	Py_BLOCK_THREADS
+	}
+	fclose(f);
 
-	// printf("ok\n");
+	if (cancelled)
+	{
+		abgd_log(ABGD_LOG_INFO, "Cancelled while computing distances\n");
+		if (withshared)
+			freeSharedDistmat(distmat, &shared);
+		else
+			free_distmat(  distmat );
+		unwatchProgress();
+		unwatchLog();
+		abgd_trace_reset(0);
+		if ((withlogfile) && !(stdout_bak < 0) && !(stderr_bak < 0))
+			restoreStreams(stdout_bak, stderr_bak, &stdout_pos, &stderr_pos);
+		if (!PyErr_Occurred())
+			PyErr_SetString(CancelledError, "abgd_main: Cancelled while computing distances");
+		return NULL;
+	}
 
-		myspar=malloc(sizeof(Spart)*distmat.n);
-		myspar2=malloc(sizeof(Spart)*distmat.n);
-		nb_subsets=malloc(sizeof(int *) *nbStepsABGD);
+	// The tree, sort and priors are plain C, callbacks take the GIL back themselves
+	Py_UNBLOCK_THREADS
 
-		for (i=0;i<nbStepsABGD;i++)
-			nb_subsets[i]=malloc(sizeof(int)*2);
-		for (i=0;i<distmat.n;i++)
-		{
-			myspar[i].name=malloc(sizeof(char)*strlen( distmat.names[i])+1);
-			strcpy_spart(myspar[i].name,distmat.names[i]);
-			myspar2[i].name=malloc(sizeof(char)*strlen( distmat.names[i])+1);
-			strcpy_spart(myspar2[i].name,distmat.names[i]);
-			myspar[i].specie=malloc(sizeof(int)*nbStepsABGD);
-			myspar2[i].specie=malloc(sizeof(int)*nbStepsABGD);
-		}
+	// printf("ok\n");
 
 	if (verbose && c=='>')
 	{
@@ -370,12 +1138,9 @@ if (stat(dirfiles, &stfile) == -1)
 	if (withallfiles)
 		{
 		if (verbose)fprintf(stderr,"\nbuilding newick tree for your data (it can take time when many sequences)\n");
-		newickStringOriginal=compute_DistTree(  distmat, dirfiles );
-
-		newickString= malloc( (size_t)  sizeof(char) * strlen(newickStringOriginal)+1);
-		if (!newickString )
-			printf("pb malloc newick\n"),exit(1);
-		strcpy(newickString,newickStringOriginal);//make a copy because going to modify it in next function
+		started = abgd_phase_start();
+		newickTree=compute_DistTree(  distmat );
+		abgd_phase_stop(ABGD_METRIC_TREE, started);
 //		printf("tree ok\n");
 //		print_distmat(distmat);
 		}
@@ -395,7 +1160,7 @@ if (stat(dirfiles, &stfile) == -1)
 
 		case 2:
 			meth="N93 Tamura-Nei" ;
-			printf("Please choose another method as Tamura Nei dist method is not fully implemented\n");
+			abgd_log(ABGD_LOG_ERROR, "Please choose another method as Tamura Nei dist method is not fully implemented\n");
 			exit(1);
 			break;
 
@@ -410,36 +1175,88 @@ if (stat(dirfiles, &stfile) == -1)
 	*/
 	mask=(char*)malloc( distmat.n*sizeof(char) );
 	if(!mask)fprintf(stderr, "main: cannot allocate mask, bye<BR>\n");
-	if (verbose)fprintf(stderr,"Writing histogram files\n");
-	sprintf(file_name,"%s/",dirfiles);
- 	createSVGhisto(file_name,distmat,nbbids);
-	if (verbose)fprintf(stderr," histogram Done\nBegining ABGD--->\n");
 
-	for (myD=0;myD<nbStepsABGD;myD++)
-	{
-	if (verbose)fprintf(stderr,"ABGD step %d \n",myD);
+	/*
+		the primary distances do not depend on the prior: sort them once, for the plots and every step
+	*/
+	started = abgd_phase_start();
+	for(j=0; j<distmat.n; j++)mask[j]=1;
+	sample_size = sample;
+	idum_ran1 = -seed;               /* the same seed gives the same sample */
+	npairs = ((long)distmat.n * (distmat.n - 1)) / 2;
+
+	if (verbose)fprintf(stderr,"sorting \n");
+	ValArray = sortedPairs( distmat, mask , &NVal, &window);
+	if (verbose)fprintf(stderr,"done\n");
+	if (NVal < npairs)
+		abgd_log(ABGD_LOG_INFO, "Approximate gaps from a sample of %ld out of %ld pairs\n", NVal, npairs);
+
+	summary = summarize_distances(ValArray,NVal,nbbids);
+	abgd_phase_stop(ABGD_METRIC_HISTOGRAM, started);
+	if (withfiles) {
+		started = abgd_phase_start();
+		if (verbose)fprintf(stderr,"Writing histogram files\n");
+		sprintf(file_name,"%s/disthist.svg",dirfiles);
+		createSVGdisthist(file_name,summary);
+		sprintf(file_name,"%s/rank.svg",dirfiles);
+		createSVGrank(file_name,summary);
+		if (verbose)fprintf(stderr," histogram Done\n");
+		abgd_phase_stop(ABGD_METRIC_OUTPUT, started);
+	}
 
- 		MaxDist           = myDist[myD];
-		my_abgd.Rank      = -1;
-		my_abgd.Dist      = -1;   /* reset results */
-		my_abgd.theta_hat =  0;
-		flag=1;
-		windsize_min=0;
+	/*
+		the priors: a fixed grid, or only those giving distinct partitions
+	*/
+	if (adaptive)
+		myDist = adaptivePriors( distmat, ValArray, NVal, mask, minDist, MaxDist, nbStepsABGD, tolerance, minSlopeIncrease, &nbStepsABGD );
+	else
+		myDist = Compute_myDist(  minDist,  MaxDist,  nbStepsABGD );
+
+	mySpecies=calloc(nbStepsABGD+1,sizeof(int));
+	specInit=calloc(nbStepsABGD+1,sizeof(int));
+	bcod=malloc(sizeof(double*)*nbStepsABGD);
+	gaplow=malloc(sizeof(double)*nbStepsABGD);
+	gaphigh=malloc(sizeof(double)*nbStepsABGD);
+
+		myspar=malloc(sizeof(Spart)*distmat.n);
+		myspar2=malloc(sizeof(Spart)*distmat.n);
+		nb_subsets=malloc(sizeof(int *) *nbStepsABGD);
+
+		for (i=0;i<nbStepsABGD;i++)
+			nb_subsets[i]=malloc(sizeof(int)*2);
+		for (i=0;i<distmat.n;i++)
+		{
+			myspar[i].name=malloc(sizeof(char)*strlen( distmat.names[i])+1);
+			strcpy_spart(myspar[i].name,distmat.names[i]);
+			myspar2[i].name=malloc(sizeof(char)*strlen( distmat.names[i])+1);
+			strcpy_spart(myspar2[i].name,distmat.names[i]);
+			myspar[i].specie=malloc(sizeof(int)*nbStepsABGD);
+			myspar2[i].specie=malloc(sizeof(int)*nbStepsABGD);
+		}
+
+	if (verbose)fprintf(stderr,"Begining ABGD--->\n");
+
+	reset_composante( &comp);
+	for (myD=0;myD<nbStepsABGD;myD++)
+	{
+	if (abgd_progress(ABGD_PHASE_PRIORS, myD, nbStepsABGD))
+		break;
+	step = abgd_phase_start();
+	if (verbose)fprintf(stderr,"ABGD step %d \n",myD);
+
+ 		MaxDist           = myDist[myD];
+		my_abgd.Rank      = -1;
+		my_abgd.Dist      = -1;   /* reset results */
+		my_abgd.theta_hat =  0;
+		windsize_min=0;
 		windsize_max=0;
-		NVal=0;
 		output_slope=0;
-		output_groups=0;
 
 		for(j=0; j<distmat.n; j++)mask[j]=1;
-		ValArray = matrix2list( distmat, mask , &NVal);
-
-		if (verbose)fprintf(stderr,"sorting \n");
-		qsort((void *) ValArray, (size_t) NVal, (size_t) sizeof(double), Increase );
-		if (verbose)fprintf(stderr,"done\n");
 	/*
 		2. Find the estimated peak of the derivative on windsize values
 	*/
-		if(windsize_min==0)windsize_min = min_ws( NVal );
+		if(windsize_min==0)windsize_min = window;
 		if(windsize_max==0 || windsize_max>NVal-1)windsize_max = NVal-1;
 
 		if (verbose)fprintf(stderr,"look fisrt abgd\n");
@@ -448,16 +1265,24 @@ if (stat(dirfiles, &stfile) == -1)
 
 		if(my_abgd.Rank == NVal+0.5){
 
-			printf("Partition %d : found 1 group (prior maximal distance P= %f) \n**Stop here**\n",  myD+1, MaxDist);
+			abgd_log(ABGD_LOG_INFO, "Partition %d : found 1 group (prior maximal distance P= %f) \n**Stop here**\n",  myD+1, MaxDist);
 			stop_at_once=1;
 			fflush(stdout);
 
 			mySpecies[myD]=1;
+			specInit[myD]=1;                     /* no split at all: the initial partition is one group too */
+			if (step_callback != NULL) {
+				graph = withfiles && myD > 0;
+				if (graph) {
+					started = abgd_phase_start();
+					refreshGraph(mySpecies, specInit, myDist, myD+1, ledir, meth, dirfiles);
+					abgd_phase_stop(ABGD_METRIC_OUTPUT, started);
+				}
+				reportStep(myD+1, MaxDist, -1, 1, 1, dirfiles, graph, 0, 0);
+			}
+			abgd_trace("step", "step", myD+1, step);
 			myD++;
 
-			free(ValArray);
-
-
 			break;
 		}
 
@@ -478,36 +1303,38 @@ if (stat(dirfiles, &stfile) == -1)
 		specInit[myD]=comp.nc;
 
 		bcod[myD]=my_abgd.Dist;
+		gapBounds(ValArray, NVal, my_abgd, gaplow + myD, gaphigh + myD);
 
-		if (withallfiles)
+		started = abgd_phase_start();
+		if (withfiles && withallfiles)
 			{
 
 			sprintf(file_name,"%s/partinit.%d.txt",dirfiles,myD+1);
 			fout=fopen(file_name,"w");
 			if (fout==NULL)
-				printf("problem opening result file %s\n",file_name), exit(1);
+				abgd_log(ABGD_LOG_ERROR, "problem opening result file %s\n",file_name), exit(1);
 			sprintf(file_name,"%s/partinit.%d.tree",dirfiles,myD+1);
 			f2=fopen(file_name,"w");
-			print_groups_files_newick( comp ,  distmat ,  fout,newickString  ,f2,0,stdout,"");
+			print_groups_files_newick( comp ,  distmat ,  fout,newickTree  ,f2,0);
 
 			fclose(fout);
-			/* reseting newick string to original */
-			strcpy(newickString,newickStringOriginal);//make a copy because going to modify it in next function
 
 			}
-		else if(notreefile)
+		else if(withfiles && notreefile)
 			{
 			sprintf(file_name,"%s/partinit.%d.txt",dirfiles,myD+1);
 			fout=fopen(file_name,"w");
 
 			if (fout==NULL)
-				printf("problem opening result file %s\n",file_name), exit(1);
+				abgd_log(ABGD_LOG_ERROR, "problem opening result file %s\n",file_name), exit(1);
 
 			print_groups_files(  comp ,  distmat ,  fout,0);
 			fclose(fout);
 			}
+		if (withfiles)
+			abgd_phase_stop(ABGD_METRIC_OUTPUT, started);
 
-		if (withspart) mem_spart_files(comp,myspar,myD,nb_subsets,0,distmat.n,fres);
+		mem_spart_files(comp,myspar,myD,nb_subsets,0,distmat.n,fres);   /* also kept for the results */
 
 	/*
 		Try to resplit each group using recursion startegy on already defined groups
@@ -516,73 +1343,13 @@ if (stat(dirfiles, &stfile) == -1)
 		ncomp_primary=comp.nc;
 
 	if (verbose)fprintf(stderr,"entering recursion\n");
-		while( flag ){
-
-			flag=0;                 /* if no sub-split is done, do not start a new round */
-			nc= comp.nc;
-
-				//if (verbose)
-
-				for(a=0; a< nc; a++){
-
-
-				struct Composante recursive_comp;
-
-				reset_composante( &recursive_comp );                     /* needed for the free in case of no new group */
-
-				// bzero( (void *)mask, (size_t)distmat.n*sizeof(char) );   /* built mask used to only consider some cells of the matrix */
-				memset((void *)mask, 0, (size_t)distmat.n*sizeof(char));	/* Replaces the above */
-				for(b=0;b<comp.n_in_comp[a]; b++)
-					mask[ comp.comp[a][b] ] = 1;
-
-				vals = matrix2list( distmat, mask , &nval);                                /* built array of pairwise dist */
-				qsort((void *) vals, (size_t) nval, (size_t) sizeof(double), Increase );
-
-				if( nval > 2 ){                                                           /* at least 3 sequences are needed */
-					windsize_min = min_ws( nval );
-					windsize_max= nval-1;
-					recursive_abgd = find_abgd( vals, nval, windsize_min, windsize_max, output_slope, MaxDist ,minSlopeIncrease );
-
-					if(recursive_abgd.Rank != nval+0.5){
-
-						recursive_comp = extract_composante(  distmat, recursive_abgd.Dist, mask );
-
-						if( recursive_comp.nc > 1 ){
-
-							/*if(verbose){
-
-								printf("Subsequent partition %s\n", (verbose)?"":"(details with -v)" );
-								printf("theta_hat  : %g\n", recursive_abgd.theta_hat );
-								printf("ABGD dist  : %f\n",  recursive_abgd.Dist);
-								printf("ws         : [%d, %d]\n", windsize_min, windsize_max  );
-								printf("Group id   : %d (%d nodes)\n",  a, recursive_comp.nn);
-								printf("-> groups  : %d\n",  recursive_comp.nc);
-
-							//	printf("Subgroups are:\n");
-							//	print_groups( recursive_comp, distmat );
-								printf("\n");
-
-							}*/
-
-							update_composante(  &comp, a, recursive_comp );
-
-
-							flag=1;
-
-						}
-
-					}
-				}
-				free( vals );
-				free_composante( recursive_comp );
-			}
-			round++;
-		}
-
+		resplitComposante(distmat, &comp, mask, MaxDist, minSlopeIncrease, &recursive_abgd);
+		if (cancelled)                        /* the partial partitions of this step are dropped */
+			break;
 
 
 		bcod[myD]=recursive_abgd.Dist;
-		printf("Partition %d : %d / %d groups with / out recursion for P= %f\n",  myD+1, comp.nc,ncomp_primary, MaxDist );
+		abgd_log(ABGD_LOG_INFO, "Partition %d : %d / %d groups with / out recursion for P= %f\n",  myD+1, comp.nc,ncomp_primary, MaxDist );
 		fflush(stdout);
 
 		i=j=comp.n_in_comp[0];
@@ -597,46 +1364,59 @@ if (stat(dirfiles, &stfile) == -1)
 		*/
 
 
-		if (withallfiles){
+		started = abgd_phase_start();
+		if (withfiles && withallfiles){
 
 			sprintf(file_name,"%s/part.%d.txt",dirfiles,myD+1);
 			fout=fopen(file_name,"w");
 
 			if (fout==NULL)
-				printf("problem opening result file %s\n",file_name), exit(1);
+				abgd_log(ABGD_LOG_ERROR, "problem opening result file %s\n",file_name), exit(1);
 
 			sprintf(file_name,"%s/part.%d.tree",dirfiles,myD+1);
 			f2=fopen(file_name,"w");
 
-			print_groups_files_newick( comp ,  distmat ,  fout,newickString  ,f2,0,stdout,"");
+			print_groups_files_newick( comp ,  distmat ,  fout,newickTree  ,f2,0);
 
 
 			fclose(fout);
 
-			/*
-				reseting newick string to original
-			*/
-			strcpy(newickString,newickStringOriginal);   /* make a copy because going to modify it in next function */
-
 		}
-		else if(notreefile)
+		else if(withfiles && notreefile)
 		{
 		sprintf(file_name,"%s/part.%d.txt",dirfiles,myD+1);
 		fout=fopen(file_name,"w");
 
 		if (fout==NULL)
-				printf("problem opening result file %s\n",file_name), exit(1);
+				abgd_log(ABGD_LOG_ERROR, "problem opening result file %s\n",file_name), exit(1);
 
 		print_groups_files(  comp ,  distmat ,  fout,0);
 
 		fclose(fout);
 		}
+		if (withfiles)
+			abgd_phase_stop(ABGD_METRIC_OUTPUT, started);
 
-		if (withspart) mem_spart_files(comp,myspar2,myD,nb_subsets,1,distmat.n,fres);
+		mem_spart_files(comp,myspar2,myD,nb_subsets,1,distmat.n,fres);
 
 
 		mySpecies[myD]=comp.nc;
 
+		/*
+			let the caller show this step already, with the summary graph so far
+		*/
+		if (step_callback != NULL) {
+			graph = withfiles && myD > 0;   /* as at the end, only drawn for more than one partition */
+			if (graph) {
+				started = abgd_phase_start();
+				refreshGraph(mySpecies, specInit, myDist, myD+1, ledir, meth, dirfiles);
+				abgd_phase_stop(ABGD_METRIC_OUTPUT, started);
+			}
+			reportStep(myD+1, MaxDist, bcod[myD], comp.nc, specInit[myD], dirfiles,
+				graph, withfiles && (withallfiles || notreefile), withfiles && withallfiles);
+		}
+		abgd_trace("step", "step", myD+1, step);
+
 		if (comp.nc==1) /* found only one part no need to continue */
 		{
 			myD++;
@@ -644,76 +1424,154 @@ if (stat(dirfiles, &stfile) == -1)
 		}
 
 		reset_composante( &comp);
-		free(ValArray);
 	}
+	Py_BLOCK_THREADS
+	stopped=cancelled;
+	sample_size = 0;
+	unwatchProgress();
+	PyErr_Fetch(&etype, &evalue, &etb);
+	free(ValArray);
+	nbextract=myD-stop_at_once;
+	nbreal=((myD-1) < nbStepsABGD)? myD-1 : nbStepsABGD;
  // fprintf(stderr,"***************%d et nc=%d %d \n",myD,comp.nc,stop_at_once);
-	if ((myD==1 && comp.nc<=1) || (myD==1 && stop_at_once==1))
-	   printf("Only one partition found with your data. Nothing to output. You should try to rerun with a lower X (< %f) **Stop here**<BR>\n", minSlopeIncrease);
-	else
+	withsummary=!((myD==1 && comp.nc<=1) || (myD==1 && stop_at_once==1));
+	if (stopped)
+		{
+		abgd_log(ABGD_LOG_INFO, "Cancelled after %d partitions\n", myD);
+		withsummary=(myD>1);
+		}
+	if (!withsummary)
+		{
+		if (!stopped)
+	   abgd_log(ABGD_LOG_INFO, "Only one partition found with your data. Nothing to output. You should try to rerun with a lower X (< %f) **Stop here**<BR>\n", minSlopeIncrease);
+		}
+	else if (withfiles)
 		{
 
+		started = abgd_phase_start();
 		sprintf(file_name,"%s/abgd.svg",dirfiles);
 		if(verbose) fprintf(stderr,"writing graphx file\n");
 		CreateGraphFiles(mySpecies, specInit,myDist, myD, ledir, meth, file_name);   /* go for a nice piece of draw */
 		if(verbose) fprintf(stderr,"writing graphx file done\n");
-		printf("\n---------------------------------\n");
-		printf("\nGraphic files (SVG):\n");
-		printf("- Summary: %s/abgd.svg\n",dirfiles);
-		printf("- Distance histogram: %s/disthist.svg\n",dirfiles);
-		printf("- Rank distance: %s/rank.svg\n",dirfiles);
+		abgd_log(ABGD_LOG_INFO, "\n---------------------------------\n");
+		abgd_log(ABGD_LOG_INFO, "\nGraphic files (SVG):\n");
+		abgd_log(ABGD_LOG_INFO, "- Summary: %s/abgd.svg\n",dirfiles);
+		abgd_log(ABGD_LOG_INFO, "- Distance histogram: %s/disthist.svg\n",dirfiles);
+		abgd_log(ABGD_LOG_INFO, "- Rank distance: %s/rank.svg\n",dirfiles);
 
-		nbreal=((myD-1) < nbStepsABGD)? myD-1 : nbStepsABGD;
 		if (withallfiles) {
-			printf("\n%d Text Files summarize your work:\n",2+(nbreal*4));
-			printf("- Description of %d different init/recursives partitions in:\n",nbreal*2);
-			printf("  %s/[partinit/part].[1-%d].txt\n",dirfiles,nbreal);
-			printf("- Description of %d newick trees in from init/recursives partition:\n",nbreal*2);
-			printf("  %s/[partinit/part].[1-%d].tree\n",dirfiles,nbreal);
+			abgd_log(ABGD_LOG_INFO, "\n%d Text Files summarize your work:\n",2+(nbreal*4));
+			abgd_log(ABGD_LOG_INFO, "- Description of %d different init/recursives partitions in:\n",nbreal*2);
+			abgd_log(ABGD_LOG_INFO, "  %s/[partinit/part].[1-%d].txt\n",dirfiles,nbreal);
+			abgd_log(ABGD_LOG_INFO, "- Description of %d newick trees in from init/recursives partition:\n",nbreal*2);
+			abgd_log(ABGD_LOG_INFO, "  %s/[partinit/part].[1-%d].tree\n",dirfiles,nbreal);
 		}
 		else if (notreefile) {
-			printf("\n%d Text Files summarize your work:\n",2+(nbreal*4));
-			printf("- Description of %d different init/recursives partitions in:\n",nbreal*2);
-			printf("  %s/[partinit/part].[1-%d].txt\n",dirfiles,nbreal);
+			abgd_log(ABGD_LOG_INFO, "\n%d Text Files summarize your work:\n",2+(nbreal*4));
+			abgd_log(ABGD_LOG_INFO, "- Description of %d different init/recursives partitions in:\n",nbreal*2);
+			abgd_log(ABGD_LOG_INFO, "  %s/[partinit/part].[1-%d].txt\n",dirfiles,nbreal);
 		}
 
 		if (withspart) {
-			printf("\nTwo spart files summarize your partitions:\n");
-			printf("- %s/%s.spart\n",dirfiles,simplename);
-			printf("- %s/%s.rec.spart\n",dirfiles,simplename);
+			abgd_log(ABGD_LOG_INFO, "\nTwo spart files summarize your partitions:\n");
+			abgd_log(ABGD_LOG_INFO, "- %s/%s.spart\n",dirfiles,simplename);
+			abgd_log(ABGD_LOG_INFO, "- %s/%s.rec.spart\n",dirfiles,simplename);
 			CreateSpartFile(myspar,myspar2,dirfiles,nbreal,dataFilename,nb_subsets,distmat.n,timeSig,fres,"",meth,minSlopeIncrease,bcod);
 		}
 
-		printf("\n---------------------------------\n");
+		abgd_log(ABGD_LOG_INFO, "\n---------------------------------\n");
+		abgd_phase_stop(ABGD_METRIC_OUTPUT, started);
 	}
+	abgd_phase_stop(ABGD_METRIC_TOTAL, total);
 
-	if ((withlogfile) && !(stdout_bak < 0) && !(stderr_bak < 0)) {
-		fflush(stdout);
-		fflush(stderr);
-		int dout = dup2(stdout_bak, fileno(stdout));
-		int derr = dup2(stderr_bak, fileno(stderr));
-		close(stdout_bak);
-		close(stderr_bak);
-		clearerr(stdout);
-		clearerr(stderr);
-		fsetpos(stdout, &stdout_pos);
-		fsetpos(stderr, &stderr_pos);
-		if ((dout < 0) || (derr < 0)) {
-			PyErr_SetString(PyExc_SystemError, "abgd_main: Failed to restore output.");
-			return NULL;
+	if ((withlogfile) && !(stdout_bak < 0) && !(stderr_bak < 0))
+		if (restoreStreams(stdout_bak, stderr_bak, &stdout_pos, &stderr_pos)) {
+			results = NULL;
+			goto fail;
 		}
-		printf("< Restored stdout/stderr\n");
-		fflush(stdout);
-		fflush(stderr);
+
+
+	/*
+		Everything needed to write the output files later on
+	*/
+	strcpy_spart_simp(proj,dataFilename);
+	tree = Py_None;
+	Py_INCREF(tree);
+	results = PyDict_New();
+	if (results == NULL) {
+		Py_DECREF(tree);
+		goto fail;
+	}
+	if (setItem(results, "project", stringFromC(proj)) ||
+	    setItem(results, "method", stringFromC(meth)) ||
+	    setItem(results, "date", stringFromC(timeSig)) ||
+	    setItem(results, "slope", PyFloat_FromDouble((float)minSlopeIncrease)) ||
+	    setItem(results, "all", PyBool_FromLong(withallfiles)) ||
+	    setItem(results, "simple", PyBool_FromLong(notreefile)) ||
+	    setItem(results, "spart", PyBool_FromLong(withspart)) ||
+	    setItem(results, "summary", PyBool_FromLong(withsummary)) ||
+	    setItem(results, "cancelled", PyBool_FromLong(stopped)) ||
+	    setItem(results, "metrics", dictFromMetrics()) ||
+	    (withtrace && setItem(results, "trace", listFromTrace())) ||
+	    setItem(results, "priors", listFromDouble(myDist, myD)) ||
+	    setItem(results, "groups", listFromInt(mySpecies, myD)) ||
+	    setItem(results, "groups_init", listFromInt(specInit, myD)) ||
+	    setItem(results, "spart_steps", PyLong_FromLong(nbreal)) ||
+	    setItem(results, "barcode_gaps", listFromDouble(bcod, (nbreal > 0) ? nbreal : 0)) ||
+	    setItem(results, "pairs", PyLong_FromLong(npairs)) ||
+	    setItem(results, "sampled_pairs", PyLong_FromLong(NVal)) ||
+	    setItem(results, "gap_bounds", listFromBounds(gaplow, gaphigh, (NVal < npairs && nbreal > 0) ? nbreal : -1)) ||
+	    setItem(results, "partitions_init", listFromSpart(myspar, distmat.n, nbextract)) ||
+	    setItem(results, "partitions", listFromSpart(myspar2, distmat.n, nbextract)) ||
+	    setItem(results, "histogram", listFromInt(summary.histo, nbbids)) ||
+	    setItem(results, "histogram_max", PyFloat_FromDouble(summary.maxi)) ||
+	    setItem(results, "rank_index", listFromLong(summary.rank, summary.nrank)) ||
+	    setItem(results, "rank_value", listFromDouble(summary.value, summary.nrank)) ||
+	    setItem(results, "rank_total", PyLong_FromLong(summary.N))) {
+		Py_DECREF(tree);
+		Py_CLEAR(results);
+		goto fail;
 	}
 
+	names = PyList_New(distmat.n);
+	spart_names = PyList_New(distmat.n);
+	for (i=0;names && spart_names && i<distmat.n;i++) {
+		PyList_SET_ITEM(names, i, stringFromC(distmat.names[i]));
+		PyList_SET_ITEM(spart_names, i, stringFromC(myspar[i].name));
+	}
+	if (spart_names == NULL) Py_CLEAR(names);
+	if (names == NULL) Py_CLEAR(spart_names);
+	if (setItem(results, "names", names) || setItem(results, "spart_names", spart_names) || PyErr_Occurred()) {
+		Py_DECREF(tree);
+		Py_CLEAR(results);
+		goto fail;
+	}
 
-	free_distmat(  distmat );
+	if (withallfiles) {
+		Py_DECREF(tree);
+		tree = Py_BuildValue("{s:N,s:N,s:N}",
+			"text", PyBytes_FromStringAndSize(newickTree.text, newickTree.len),
+			"leaf_end", listFromLong(newickTree.leaf_end, newickTree.nleaf),
+			"leaf_node", listFromInt(newickTree.leaf_node, newickTree.nleaf));
+	}
+	if (setItem(results, "tree", tree) || PyErr_Occurred())
+		Py_CLEAR(results);
+
+	// Errors once the analysis is done come here too, with results NULL
+fail:
+	free_summary(summary);
+	if (withshared)
+		freeSharedDistmat(distmat, &shared);
+	else
+		free_distmat(  distmat );
 	if (stop_at_once==0 )
 	free_composante(comp);
 		if (withallfiles)
-			free(newickString);
+			free_newick(newickTree);
 
 	free(bcod);
+	free(gaplow);
+	free(gaphigh);
 	free(mySpecies);
 	free(mask);
 	free(specInit);
@@ -735,13 +1593,966 @@ if (stat(dirfiles, &stfile) == -1)
 	free (myspar);
 	free (myspar2);
 
+	unwatchLog();
+	abgd_trace_reset(0);
+	if (results == NULL) {
+		// The error raised above is kept over that of a callback
+		Py_XDECREF(etype);
+		Py_XDECREF(evalue);
+		Py_XDECREF(etb);
+		return NULL;
+	}
+	if (etype != NULL) {
+		Py_DECREF(results);
+		PyErr_Restore(etype, evalue, etb);
+		return NULL;
+	}
+	return results;
+}
+
+static PyObject *
+abgd_render_histogram(PyObject *Py_UNUSED(self), PyObject *args) {
+
+	const char *path;
+	PyObject *bins;
+	double maximum;
+	long n;
+	struct DistSummary summary;
+
+	if (!PyArg_ParseTuple(args, "sOd", &path, &bins, &maximum)) return NULL;
+	if (checkWritable(path)) return NULL;
+
+	summary.histo = arrayFromSequence(bins, 'i', &n);
+	if (summary.histo == NULL) return NULL;
+	if (n < 1) {
+		free(summary.histo);
+		PyErr_SetString(PyExc_ValueError, "render_histogram: Expected at least one bin");
+		return NULL;
+	}
+	summary.histo[n] = summary.histo[n+1] = 0;
+	summary.nbbids = (int) n;
+	summary.maxi = (float) maximum;
+	createSVGdisthist((char *)path, summary);
+	free(summary.histo);
+
+	Py_INCREF(Py_None);
+	return Py_None;
+}
+
+static PyObject *
+abgd_render_rank(PyObject *Py_UNUSED(self), PyObject *args) {
+
+	const char *path;
+	PyObject *ranks, *values;
+	long total;
+	double maximum;
+	long n, nv;
+	struct DistSummary summary;
+
+	if (!PyArg_ParseTuple(args, "sOOld", &path, &ranks, &values, &total, &maximum)) return NULL;
+	if (checkWritable(path)) return NULL;
+
+	summary.rank = arrayFromSequence(ranks, 'l', &n);
+	if (summary.rank == NULL) return NULL;
+	summary.value = arrayFromSequence(values, 'd', &nv);
+	if (summary.value == NULL) { free(summary.rank); return NULL; }
+	if (n < 1 || n != nv) {
+		free(summary.rank);
+		free(summary.value);
+		PyErr_SetString(PyExc_ValueError, "render_rank: Expected as many values as ranks");
+		return NULL;
+	}
+	summary.nrank = n;
+	summary.N = total;
+	summary.maxi = (float) maximum;
+	createSVGrank((char *)path, summary);
+	free(summary.rank);
+	free(summary.value);
+
+	Py_INCREF(Py_None);
+	return Py_None;
+}
+
+static PyObject *
+abgd_render_graph(PyObject *Py_UNUSED(self), PyObject *args) {
+
+	const char *path;
+	const char *method;
+	PyObject *priors, *groups, *groups_init;
+	double *myDist;
+	int *mySpecies, *specInit;
+	long n, ng, ni;
+
+	if (!PyArg_ParseTuple(args, "sOOOs", &path, &priors, &groups, &groups_init, &method)) return NULL;
+
+	myDist = arrayFromSequence(priors, 'd', &n);
+	if (myDist == NULL) return NULL;
+	mySpecies = arrayFromSequence(groups, 'i', &ng);
+	specInit = arrayFromSequence(groups_init, 'i', &ni);
+	if (mySpecies == NULL || specInit == NULL || n < 1 || n != ng || n != ni) {
+		if (!PyErr_Occurred())
+			PyErr_SetString(PyExc_ValueError, "render_graph: Expected as many group counts as priors");
+		free(myDist);
+		free(mySpecies);
+		free(specInit);
+		return NULL;
+	}
+	if (checkWritable(path) == 0)
+		CreateGraphFiles(mySpecies, specInit, myDist, (int) n, "", (char *)method, (char *)path);
+	free(myDist);
+	free(mySpecies);
+	free(specInit);
+	if (PyErr_Occurred()) return NULL;
+
 	Py_INCREF(Py_None);
 	return Py_None;
 }
 
+static PyObject *
+abgd_sweep(PyObject *Py_UNUSED(self), PyObject *args, PyObject *kwargs) {
+
+	PyObject *dict = kwargs;
+	PyObject *item;
+	PyObject *grid;
+	PyObject *names;
+	PyObject *results;
+
+	const char *file = NULL;
+
+	double MaxDist=0.1;
+	double minDist=0.001;
+	double *myDist;
+	double *slopes;
+	double *ValArray;
+	double *bcod;
+	float ts_tv=2.0;
+	long NVal=0;
+	long nslopes=0;
+	long i,j,k;
+
+	int imethode=1;
+	int nbStepsABGD=10;
+	int fmeg=0;
+	int verbose=0;
+	int myD, c, nc;
+	int *mySpecies, *specInit;
+	int **nb_subsets;
+	char *mask;
+	FILE *f;
+
+	struct DistanceMatrix distmat;
+	struct PeakCache cache;
+	struct Peak my_abgd;
+	struct Peak recursive_abgd;
+	struct Composante comp;
+	Spart *myspar, *myspar2;
+	Py_buffer shared;
+	int withshared=0;
+	int sample=0;
+	int seed=1;
+	long window;
+
+	if (!PyArg_ParseTuple(args, "s", &file)) return NULL;
+
+	if (parseItem(dict, "method", 'i', &imethode)) return NULL;
+	if (parseItem(dict, "steps", 'i', &nbStepsABGD)) return NULL;
+	if (parseItem(dict, "min", 'd', &minDist)) return NULL;
+	if (parseItem(dict, "max", 'd', &MaxDist)) return NULL;
+	if (parseItem(dict, "rate", 'f', &ts_tv)) return NULL;
+	if (parseItem(dict, "mega", 'b', &fmeg)) return NULL;
+	if (parseItem(dict, "verbose", 'b', &verbose)) return NULL;
+	if (parseItem(dict, "sample", 'i', &sample)) return NULL;
+	if (parseItem(dict, "seed", 'i', &seed)) return NULL;
+	if ((sample != 0 && sample < 100) || seed < 1) {
+		PyErr_SetString(PyExc_ValueError, "abgd_sweep: Expected at least 100 sampled pairs (or 0 for all) and a positive seed");
+		return NULL;
+	}
+	if (watchLog(dict)) return NULL;
+
+	item = (dict != NULL) ? PyDict_GetItemString(dict, "slopes") : NULL;
+	if (item == NULL) {
+		PyErr_SetString(PyExc_TypeError, "abgd_sweep: Expected a sequence of slopes");
+		return NULL;
+	}
+	slopes = arrayFromSequence(item, 'd', &nslopes);
+	if (slopes == NULL) return NULL;
+	if (nbStepsABGD < 2 || imethode == 2) {
+		free(slopes);
+		PyErr_SetString(PyExc_ValueError, "abgd_sweep: Invalid steps or method");
+		return NULL;
+	}
+
+	f=fopen(file,"r");
+	if (f==NULL) {
+		free(slopes);
+		PyErr_Format(PyExc_FileNotFoundError, "abgd_sweep: Input file not found: '%s'", file);
+		return NULL;
+	}
+
+	/*
+		Everything up to the peak search is shared by all slopes
+	*/
+	myDist = Compute_myDist( minDist, MaxDist, nbStepsABGD );
+
+	item = PyDict_GetItemString(dict, "distances");
+	if (item != NULL && item != Py_None) {
+		if (PyObject_GetBuffer(item, &shared, PyBUF_SIMPLE) == 0)
+			withshared = 1;
+		if (!withshared || distmatFromBuffer(PyDict_GetItemString(dict, "names"), &shared, &distmat)) {
+			if (withshared) PyBuffer_Release(&shared);
+			free(myDist);
+			free(slopes);
+			fclose(f);
+			return NULL;
+		}
+	}
+	else {
+		c = fgetc(f);
+		rewind(f);
+		if ( c == '>')
+			distmat = compute_dis(f,imethode,ts_tv);
+		else
+			distmat = read_distmat(f,ts_tv,fmeg);
+	}
+	fclose(f);
+
+	mask=(char*)malloc( distmat.n*sizeof(char) );
+	for(j=0; j<distmat.n; j++)mask[j]=1;
+	sample_size = sample;
+	idum_ran1 = -seed;
+	ValArray = sortedPairs( distmat, mask , &NVal, &window);
+	cache = init_peak_cache( ValArray, NVal, window, NVal-1 );
+
+	mySpecies=calloc(nbStepsABGD,sizeof(int));
+	specInit=calloc(nbStepsABGD,sizeof(int));
+	bcod=calloc(nbStepsABGD,sizeof(double));
+	nb_subsets=malloc(sizeof(int *) *nbStepsABGD);
+	for (i=0;i<nbStepsABGD;i++)
+		nb_subsets[i]=malloc(sizeof(int)*2);
+	myspar=malloc(sizeof(Spart)*distmat.n);
+	myspar2=malloc(sizeof(Spart)*distmat.n);
+	for (i=0;i<distmat.n;i++)
+		{
+		myspar[i].specie=malloc(sizeof(int)*nbStepsABGD);
+		myspar2[i].specie=malloc(sizeof(int)*nbStepsABGD);
+		}
+
+	grid = PyList_New(nslopes);
+	for (k=0; grid && k<nslopes; k++) {
+
+		if (verbose) fprintf(stderr,"ABGD sweep with X= %f\n",slopes[k]);
+
+		/* same steps as abgd_main(), stop at the first single group */
+		for (myD=0; myD<nbStepsABGD; myD++) {
+
+			for(j=0; j<distmat.n; j++)mask[j]=1;
+			my_abgd = find_abgd_cached( &cache, myDist[myD], slopes[k] );
+			bcod[myD]=my_abgd.Dist;
+
+			if (my_abgd.Rank == NVal+0.5) {
+				abgd_log(ABGD_LOG_INFO, "X= %f partition %d : found 1 group (prior maximal distance P= %f)\n", slopes[k], myD+1, myDist[myD]);
+				mySpecies[myD]=specInit[myD]=1;
+				for (i=0;i<distmat.n;i++)
+					myspar[i].specie[myD]=myspar2[i].specie[myD]=1;
+				myD++;
+				break;
+			}
+
+			comp = extract_composante( distmat, my_abgd.Dist, mask );
+			specInit[myD]=comp.nc;
+			mem_spart_files(comp,myspar,myD,nb_subsets,0,distmat.n,stdout);
+
+			resplitComposante(distmat, &comp, mask, myDist[myD], slopes[k], &recursive_abgd);
+			mySpecies[myD]=comp.nc;
+			mem_spart_files(comp,myspar2,myD,nb_subsets,1,distmat.n,stdout);
+			abgd_log(ABGD_LOG_INFO, "X= %f partition %d : %d / %d groups with / out recursion for P= %f\n", slopes[k], myD+1, comp.nc, specInit[myD], myDist[myD]);
+
+			nc=comp.nc;
+			free_composante(comp);
+			if (nc==1) {
+				myD++;
+				break;
+			}
+		}
+		fflush(stdout);
+
+		item = Py_BuildValue("{s:d,s:N,s:N,s:N,s:N,s:N,s:N}",
+			"slope", slopes[k],
+			"priors", listFromDouble(myDist, myD),
+			"groups", listFromInt(mySpecies, myD),
+			"groups_init", listFromInt(specInit, myD),
+			"thresholds", listFromDouble(bcod, myD),
+			"partitions", listFromSpart(myspar2, distmat.n, myD),
+			"partitions_init", listFromSpart(myspar, distmat.n, myD));
+		if (item == NULL) Py_CLEAR(grid);
+		else PyList_SET_ITEM(grid, k, item);
+	}
+
+	names = PyList_New(distmat.n);
+	for (i=0;names && i<distmat.n;i++)
+		PyList_SET_ITEM(names, i, stringFromC(distmat.names[i]));
+	results = Py_BuildValue("{s:N,s:N,s:N}",
+		"priors", listFromDouble(myDist, nbStepsABGD),
+		"names", names,
+		"grid", grid);
+
+	sample_size = 0;
+	free_peak_cache(cache);
+	free(ValArray);
+	if (withshared)
+		freeSharedDistmat(distmat, &shared);
+	else
+		free_distmat( distmat );
+	for (i=0;i<nbStepsABGD;i++)
+		free(nb_subsets[i]);
+	free(nb_subsets);
+	for (i=0;i<distmat.n;i++)
+		{
+		free(myspar[i].specie);
+		free(myspar2[i].specie);
+		}
+	free(myspar);
+	free(myspar2);
+	free(mySpecies);
+	free(specInit);
+	free(bcod);
+	free(myDist);
+	free(mask);
+	free(slopes);
+
+	unwatchLog();
+	if (PyErr_Occurred()) {
+		Py_XDECREF(results);
+		return NULL;
+	}
+	return results;
+}
+
+// Seed of replicate r of a bootstrap for ran1(), in [1, 2^31-2].
+// Seeds are mixed (splitmix64) so that neighbouring replicates get unrelated streams,
+// and depend on r only: replicates may be split between processes in any way.
+long replicateSeed(long seed, long r) {
+
+	unsigned long long z = (unsigned long long)seed * 0x9E3779B97F4A7C15ULL + (unsigned long long)r + 1;
+	z = (z ^ (z >> 30)) * 0xBF58476D1CE4E5B9ULL;
+	z = (z ^ (z >> 27)) * 0x94D049BB133111EBULL;
+	z ^= z >> 31;
+	return 1 + (long)(z % 2147483646ULL);
+}
+
+// Gap distance and number of groups (without recursion) at each prior step for sorted vals.
+// Gaps are NaN where none was found. Groups are only extracted again when the gap changes.
+void gapSteps(double *vals, long nval, long window, struct DistanceMatrix distmat, char *mask,
+              double *priors, int steps, double slope, double *gaps, int *groups) {
+
+	int s;
+	struct Peak peak;
+	struct Composante comp;
+
+	for (s = 0; s < steps; s++) {
+		peak = find_abgd(vals, nval, window, nval-1, 0, priors[s], slope);
+		if (peak.Rank == nval+0.5) {
+			gaps[s] = NAN;
+			groups[s] = 1;
+		}
+		else if (s > 0 && peak.Dist == gaps[s-1]) {
+			gaps[s] = gaps[s-1];
+			groups[s] = groups[s-1];
+		}
+		else {
+			gaps[s] = peak.Dist;
+			comp = extract_composante(distmat, peak.Dist, mask);
+			groups[s] = comp.nc;
+			free_composante(comp);
+		}
+	}
+}
+
+static PyObject *
+abgd_bootstrap(PyObject *Py_UNUSED(self), PyObject *args, PyObject *kwargs) {
+
+	PyObject *dict = kwargs;
+	PyObject *item;
+	PyObject *gaplist;
+	PyObject *grouplist;
+	PyObject *results;
+
+	const char *file = NULL;
+
+	double MaxDist=0.1;
+	double minDist=0.001;
+	double minSlopeIncrease=1.5;
+	double *myDist;
+	double *ValArray;
+	double *boot;
+	double *estimate, *gaps;
+	float ts_tv=2.0;
+	long NVal=0;
+	long window;
+	long j, r;
+
+	int imethode=1;
+	int nbStepsABGD=10;
+	int fmeg=0;
+	int c;
+	int sample=0;
+	int seed=1;
+	int replicates=100;
+	int first=0;
+	int stopped;
+	int *estimate_groups, *groups;
+	char *mask;
+	FILE *f;
+
+	struct DistanceMatrix distmat;
+	Py_buffer shared, pairs;
+	int withshared=0;
+	int withpairs=0;                 /* if 1, the sorted pairs were given and are not ours */
+
+	if (!PyArg_ParseTuple(args, "s", &file)) return NULL;
+
+	if (parseItem(dict, "method", 'i', &imethode)) return NULL;
+	if (parseItem(dict, "steps", 'i', &nbStepsABGD)) return NULL;
+	if (parseItem(dict, "min", 'd', &minDist)) return NULL;
+	if (parseItem(dict, "max", 'd', &MaxDist)) return NULL;
+	if (parseItem(dict, "slope", 'd', &minSlopeIncrease)) return NULL;
+	if (parseItem(dict, "rate", 'f', &ts_tv)) return NULL;
+	if (parseItem(dict, "mega", 'b', &fmeg)) return NULL;
+	if (parseItem(dict, "sample", 'i', &sample)) return NULL;
+	if (parseItem(dict, "seed", 'i', &seed)) return NULL;
+	if (parseItem(dict, "replicates", 'i', &replicates)) return NULL;
+	if (parseItem(dict, "first", 'i', &first)) return NULL;
+	if ((sample != 0 && sample < 100) || seed < 1) {
+		PyErr_SetString(PyExc_ValueError, "abgd_bootstrap: Expected at least 100 sampled pairs (or 0 for all) and a positive seed");
+		return NULL;
+	}
+	if (nbStepsABGD < 2 || imethode == 2 || replicates < 0 || first < 0) {
+		PyErr_SetString(PyExc_ValueError, "abgd_bootstrap: Invalid steps, method, replicates or first");
+		return NULL;
+	}
+	if (watchLog(dict)) return NULL;
+
+	f=fopen(file,"r");
+	if (f==NULL) {
+		PyErr_Format(PyExc_FileNotFoundError, "abgd_bootstrap: Input file not found: '%s'", file);
+		return NULL;
+	}
+
+	item = (dict != NULL) ? PyDict_GetItemString(dict, "distances") : NULL;
+	if (item != NULL && item != Py_None) {
+		if (PyObject_GetBuffer(item, &shared, PyBUF_SIMPLE) == 0)
+			withshared = 1;
+		if (!withshared || distmatFromBuffer(PyDict_GetItemString(dict, "names"), &shared, &distmat)) {
+			if (withshared) PyBuffer_Release(&shared);
+			fclose(f);
+			return NULL;
+		}
+	}
+	else {
+		c = fgetc(f);
+		rewind(f);
+		if ( c == '>')
+			distmat = compute_dis(f,imethode,ts_tv);
+		else
+			distmat = read_distmat(f,ts_tv,fmeg);
+	}
+	fclose(f);
+
+	if (dict != NULL && watchProgress(PyDict_GetItemString(dict, "progress"), PyDict_GetItemString(dict, "cancel"))) {
+		if (withshared)
+			freeSharedDistmat(distmat, &shared);
+		else
+			free_distmat( distmat );
+		return NULL;
+	}
+
+	/*
+		The sorted pairs given by abgd.pairs() for the same matrix, sample and seed,
+		are read in place of those computed here
+	*/
+	item = (dict != NULL) ? PyDict_GetItemString(dict, "pairs") : NULL;
+	if (item != NULL && item != Py_None) {
+		if (PyObject_GetBuffer(item, &pairs, PyBUF_SIMPLE) == 0)
+			withpairs = 1;
+		if (withpairs && (pairs.len % sizeof(double) != 0 || pairs.len == 0 ||
+		    pairs.len / (Py_ssize_t)sizeof(double) > ((long)distmat.n * (distmat.n - 1)) / 2))
+			PyErr_Format(PyExc_ValueError, "abgd_bootstrap: Expected at most %ld sorted pairs, got %zd bytes",
+				((long)distmat.n * (distmat.n - 1)) / 2, pairs.len);
+		if (PyErr_Occurred()) {
+			if (withpairs) PyBuffer_Release(&pairs);
+			unwatchProgress();
+			if (withshared)
+				freeSharedDistmat(distmat, &shared);
+			else
+				free_distmat( distmat );
+			return NULL;
+		}
+	}
+
+	/*
+		The estimate of the original distances, then that of each replicate.
+		Replicates resample the sorted pairs with replacement, the matrix is only read.
+	*/
+	myDist = Compute_myDist( minDist, MaxDist, nbStepsABGD );
+	mask=(char*)malloc( distmat.n*sizeof(char) );
+	for(j=0; j<distmat.n; j++)mask[j]=1;
+	if (withpairs) {
+		ValArray = (double *)pairs.buf;
+		NVal = pairs.len / sizeof(double);
+		window = pairsWindow(NVal, ((long)distmat.n * (distmat.n - 1)) / 2);
+	}
+	else {
+		sample_size = sample;
+		idum_ran1 = -seed;
+		ValArray = sortedPairs( distmat, mask , &NVal, &window);
+		sample_size = 0;
+	}
+
+	estimate=malloc(sizeof(double)*nbStepsABGD);
+	estimate_groups=malloc(sizeof(int)*nbStepsABGD);
+	gaps=malloc(sizeof(double)*nbStepsABGD*(size_t)(replicates ? replicates : 1));
+	groups=malloc(sizeof(int)*nbStepsABGD*(size_t)(replicates ? replicates : 1));
+	boot=malloc(sizeof(double)*NVal);
+	if (!estimate || !estimate_groups || !gaps || !groups || !boot)
+		fprintf(stderr, "abgd_bootstrap: cannot allocate replicates, bye\n"), exit(4);
+
+	Py_BEGIN_ALLOW_THREADS
+	gapSteps(ValArray, NVal, window, distmat, mask, myDist, nbStepsABGD, minSlopeIncrease, estimate, estimate_groups);
+	for (r = 0; r < replicates; r++) {
+		if (abgd_progress(ABGD_PHASE_REPLICATES, r, replicates)) break;
+		idum_ran1 = -replicateSeed(seed, first + r);
+		BootStrapArray(ValArray, boot, NVal);
+		qsort((void *) boot, (size_t) NVal, (size_t) sizeof(double), Increase);
+		gapSteps(boot, NVal, window, distmat, mask, myDist, nbStepsABGD, minSlopeIncrease,
+		         gaps + r*nbStepsABGD, groups + r*nbStepsABGD);
+	}
+	if (r == replicates)
+		abgd_progress(ABGD_PHASE_REPLICATES, r, replicates);
+	Py_END_ALLOW_THREADS
+	stopped = cancelled;
+	unwatchProgress();
+
+	gaplist = PyList_New(r);
+	grouplist = PyList_New(r);
+	for (j=0; gaplist && grouplist && j<r; j++) {
+		item = listFromDouble(gaps + j*nbStepsABGD, nbStepsABGD);
+		if (item == NULL) { Py_CLEAR(gaplist); break; }
+		PyList_SET_ITEM(gaplist, j, item);
+		item = listFromInt(groups + j*nbStepsABGD, nbStepsABGD);
+		if (item == NULL) { Py_CLEAR(grouplist); break; }
+		PyList_SET_ITEM(grouplist, j, item);
+	}
+	if (gaplist == NULL || grouplist == NULL) {
+		Py_XDECREF(gaplist);
+		Py_XDECREF(grouplist);
+		gaplist = grouplist = NULL;
+	}
+	results = Py_BuildValue("{s:N,s:N,s:N,s:N,s:N,s:i,s:i,s:l,s:O}",
+		"priors", listFromDouble(myDist, nbStepsABGD),
+		"thresholds", listFromDouble(estimate, nbStepsABGD),
+		"groups_init", listFromInt(estimate_groups, nbStepsABGD),
+		"gaps", gaplist,
+		"groups", grouplist,
+		"seed", seed,
+		"first", first,
+		"pairs", NVal,
+		"cancelled", stopped ? Py_True : Py_False);
+
+	free(boot);
+	free(gaps);
+	free(groups);
+	free(estimate);
+	free(estimate_groups);
+	if (withpairs)
+		PyBuffer_Release(&pairs);
+	else
+		free(ValArray);
+	if (withshared)
+		freeSharedDistmat(distmat, &shared);
+	else
+		free_distmat( distmat );
+	free(myDist);
+	free(mask);
+
+	unwatchLog();
+	if (PyErr_Occurred()) {
+		Py_XDECREF(results);
+		return NULL;
+	}
+	return results;
+}
+
+static PyObject *
+abgd_distances(PyObject *Py_UNUSED(self), PyObject *args, PyObject *kwargs) {
+
+	PyObject *dict = kwargs;
+	PyObject *allocate;
+	PyObject *target;
+	PyObject *names;
+	Py_buffer view;
+
+	const char *file = NULL;
+	float ts_tv=2.0;
+	int imethode=1;
+	int fmeg=0;
+	int c;
+	long i;
+	FILE *f;
+
+	struct DistanceMatrix distmat;
+
+	if (!PyArg_ParseTuple(args, "sO", &file, &allocate)) return NULL;
+	if (!PyCallable_Check(allocate)) {
+		PyErr_SetString(PyExc_TypeError, "abgd_distances: Expected a callable to allocate the matrix");
+		return NULL;
+	}
+
+	if (parseItem(dict, "method", 'i', &imethode)) return NULL;
+	if (parseItem(dict, "rate", 'f', &ts_tv)) return NULL;
+	if (parseItem(dict, "mega", 'b', &fmeg)) return NULL;
+	if (watchLog(dict)) return NULL;
+	if (imethode == 2) {
+		PyErr_SetString(PyExc_ValueError, "abgd_distances: Invalid method");
+		return NULL;
+	}
+
+	f=fopen(file,"r");
+	if (f==NULL) {
+		PyErr_Format(PyExc_FileNotFoundError, "abgd_distances: Input file not found: '%s'", file);
+		return NULL;
+	}
+	c = fgetc(f);
+	rewind(f);
+	if ( c == '>')
+		distmat = compute_dis(f,imethode,ts_tv);
+	else
+		distmat = read_distmat(f,ts_tv,fmeg);
+	fclose(f);
+	unwatchLog();
+
+	/* rows are copied one after the other in the buffer given by allocate(n) */
+	target = PyObject_CallFunction(allocate, "l", distmat.n);
+	if (target == NULL) {
+		free_distmat(distmat);
+		return NULL;
+	}
+	if (PyObject_GetBuffer(target, &view, PyBUF_WRITABLE)) {
+		Py_DECREF(target);
+		free_distmat(distmat);
+		return NULL;
+	}
+	if (view.len < (Py_ssize_t)(distmat.n * distmat.n * sizeof(double))) {
+		PyErr_Format(PyExc_ValueError, "abgd_distances: Buffer too small for %ld sequences", distmat.n);
+		PyBuffer_Release(&view);
+		Py_DECREF(target);
+		free_distmat(distmat);
+		return NULL;
+	}
+	for (i = 0; i < distmat.n; i++)
+		memcpy((double *)view.buf + i * distmat.n, distmat.dist[i], distmat.n * sizeof(double));
+	PyBuffer_Release(&view);
+	Py_DECREF(target);
+
+	names = PyList_New(distmat.n);
+	for (i=0;names && i<distmat.n;i++)
+		PyList_SET_ITEM(names, i, stringFromC(distmat.names[i]));
+	free_distmat(distmat);
+	if (PyErr_Occurred()) {
+		Py_XDECREF(names);
+		return NULL;
+	}
+	return names;
+}
+
+static PyObject *
+abgd_pairs(PyObject *Py_UNUSED(self), PyObject *args, PyObject *kwargs) {
+
+	PyObject *dict = kwargs;
+	PyObject *allocate;
+	PyObject *target;
+	PyObject *item;
+	Py_buffer view, shared;
+
+	const char *file = NULL;
+	float ts_tv=2.0;
+	int imethode=1;
+	int fmeg=0;
+	int sample=0;
+	int seed=1;
+	int withshared=0;
+	int c;
+	long j, NVal, window;
+	double *ValArray;
+	char *mask;
+	FILE *f;
+
+	struct DistanceMatrix distmat;
+
+	if (!PyArg_ParseTuple(args, "sO", &file, &allocate)) return NULL;
+	if (!PyCallable_Check(allocate)) {
+		PyErr_SetString(PyExc_TypeError, "abgd_pairs: Expected a callable to allocate the pairs");
+		return NULL;
+	}
+
+	if (parseItem(dict, "method", 'i', &imethode)) return NULL;
+	if (parseItem(dict, "rate", 'f', &ts_tv)) return NULL;
+	if (parseItem(dict, "mega", 'b', &fmeg)) return NULL;
+	if (parseItem(dict, "sample", 'i', &sample)) return NULL;
+	if (parseItem(dict, "seed", 'i', &seed)) return NULL;
+	if ((sample != 0 && sample < 100) || seed < 1) {
+		PyErr_SetString(PyExc_ValueError, "abgd_pairs: Expected at least 100 sampled pairs (or 0 for all) and a positive seed");
+		return NULL;
+	}
+	if (imethode == 2) {
+		PyErr_SetString(PyExc_ValueError, "abgd_pairs: Invalid method");
+		return NULL;
+	}
+	if (watchLog(dict)) return NULL;
+
+	item = (dict != NULL) ? PyDict_GetItemString(dict, "distances") : NULL;
+	if (item != NULL && item != Py_None) {
+		if (PyObject_GetBuffer(item, &shared, PyBUF_SIMPLE) == 0)
+			withshared = 1;
+		if (!withshared || distmatFromBuffer(PyDict_GetItemString(dict, "names"), &shared, &distmat)) {
+			if (withshared) PyBuffer_Release(&shared);
+			unwatchLog();
+			return NULL;
+		}
+	}
+	else {
+		f=fopen(file,"r");
+		if (f==NULL) {
+			PyErr_Format(PyExc_FileNotFoundError, "abgd_pairs: Input file not found: '%s'", file);
+			unwatchLog();
+			return NULL;
+		}
+		c = fgetc(f);
+		rewind(f);
+		if ( c == '>')
+			distmat = compute_dis(f,imethode,ts_tv);
+		else
+			distmat = read_distmat(f,ts_tv,fmeg);
+		fclose(f);
+	}
+
+	/* the same pairs as abgd_bootstrap() sorts for this sample and seed */
+	mask=(char*)malloc( distmat.n*sizeof(char) );
+	for(j=0; j<distmat.n; j++)mask[j]=1;
+	Py_BEGIN_ALLOW_THREADS
+	sample_size = sample;
+	idum_ran1 = -seed;
+	ValArray = sortedPairs( distmat, mask , &NVal, &window);
+	sample_size = 0;
+	Py_END_ALLOW_THREADS
+	free(mask);
+	if (withshared)
+		freeSharedDistmat(distmat, &shared);
+	else
+		free_distmat(distmat);
+	unwatchLog();
+
+	target = PyObject_CallFunction(allocate, "l", NVal);
+	if (target == NULL) {
+		free(ValArray);
+		return NULL;
+	}
+	if (PyObject_GetBuffer(target, &view, PyBUF_WRITABLE)) {
+		Py_DECREF(target);
+		free(ValArray);
+		return NULL;
+	}
+	if (view.len < (Py_ssize_t)(NVal * sizeof(double))) {
+		PyErr_Format(PyExc_ValueError, "abgd_pairs: Buffer too small for %ld pairs", NVal);
+		PyBuffer_Release(&view);
+		Py_DECREF(target);
+		free(ValArray);
+		return NULL;
+	}
+	memcpy(view.buf, ValArray, NVal * sizeof(double));
+	PyBuffer_Release(&view);
+	Py_DECREF(target);
+	free(ValArray);
+	return PyLong_FromLong(NVal);
+}
+
+static PyObject *
+abgd_tile(PyObject *Py_UNUSED(self), PyObject *args, PyObject *kwargs) {
+
+	PyObject *dict = kwargs;
+	PyObject *allocate;
+	PyObject *target;
+	PyObject *names;
+	Py_buffer view;
+
+	const char *file = NULL;
+	float ts_tv=2.0;
+	int imethode=1;
+	int nseq=0;
+	int c;
+	long first, last, count, i;
+	double *tile;
+	FILE *f;
+
+	struct FastaSeq *mesSeqs;
+
+	if (!PyArg_ParseTuple(args, "sllO", &file, &first, &last, &allocate)) return NULL;
+	if (!PyCallable_Check(allocate)) {
+		PyErr_SetString(PyExc_TypeError, "abgd_tile: Expected a callable to allocate the tile");
+		return NULL;
+	}
+
+	if (parseItem(dict, "method", 'i', &imethode)) return NULL;
+	if (parseItem(dict, "rate", 'f', &ts_tv)) return NULL;
+	if (imethode == 2) {
+		PyErr_SetString(PyExc_ValueError, "abgd_tile: Invalid method");
+		return NULL;
+	}
+
+	f=fopen(file,"r");
+	if (f==NULL) {
+		PyErr_Format(PyExc_FileNotFoundError, "abgd_tile: Input file not found: '%s'", file);
+		return NULL;
+	}
+	c = fgetc(f);
+	rewind(f);
+	if (c != '>') {
+		fclose(f);
+		PyErr_Format(PyExc_ValueError, "abgd_tile: Expected a fasta file: '%s'", file);
+		return NULL;
+	}
+	if (watchLog(dict)) {
+		fclose(f);
+		return NULL;
+	}
+	mesSeqs = read_sequences(f, &nseq);
+	fclose(f);
+	if (first < 0 || first > last || last > nseq) {
+		free_sequences(mesSeqs, nseq);
+		unwatchLog();
+		PyErr_Format(PyExc_ValueError, "abgd_tile: Invalid rows [%ld, %ld) for %d sequences", first, last, nseq);
+		return NULL;
+	}
+	tile = GetDistTile(nseq, mesSeqs, imethode, ts_tv, first, last, &count);
+	unwatchLog();
+
+	/* pairs are copied in the buffer given by allocate(count) */
+	target = PyObject_CallFunction(allocate, "l", count);
+	if (target == NULL || PyObject_GetBuffer(target, &view, PyBUF_WRITABLE)) {
+		Py_XDECREF(target);
+		free(tile);
+		free_sequences(mesSeqs, nseq);
+		return NULL;
+	}
+	if (view.len < (Py_ssize_t)(count * sizeof(double))) {
+		PyErr_Format(PyExc_ValueError, "abgd_tile: Buffer too small for %ld pairs", count);
+		PyBuffer_Release(&view);
+		Py_DECREF(target);
+		free(tile);
+		free_sequences(mesSeqs, nseq);
+		return NULL;
+	}
+	memcpy(view.buf, tile, count * sizeof(double));
+	PyBuffer_Release(&view);
+	Py_DECREF(target);
+	free(tile);
+
+	names = PyList_New(nseq);
+	for (i=0;names && i<nseq;i++)
+		PyList_SET_ITEM(names, i, stringFromC(mesSeqs[i].name));
+	free_sequences(mesSeqs, nseq);
+	if (PyErr_Occurred()) {
+		Py_XDECREF(names);
+		return NULL;
+	}
+	return names;
+}
+
+// The core keeps its state in statics (callbacks, cancel flag, sample, metrics and trace)
+// and runs without the GIL: core_lock serializes all calls that use it.
+// A call from one of its own callbacks would deadlock, it raises RuntimeError instead.
+static PyThread_type_lock core_lock = NULL;
+static unsigned long core_owner = 0;          /* thread holding core_lock, 0 if none */
+
+typedef PyObject *(*CoreFunction)(PyObject *, PyObject *, PyObject *);
+
+PyObject *callLocked(CoreFunction function, PyObject *self, PyObject *args, PyObject *kwargs) {
+
+	PyObject *result;
+
+	if (core_owner == PyThread_get_thread_ident()) {
+		PyErr_SetString(PyExc_RuntimeError, "abgd: The core may not be called from its own callbacks");
+		return NULL;
+	}
+	if (!PyThread_acquire_lock(core_lock, NOWAIT_LOCK)) {
+		Py_BEGIN_ALLOW_THREADS
+		PyThread_acquire_lock(core_lock, WAIT_LOCK);
+		Py_END_ALLOW_THREADS
+	}
+	core_owner = PyThread_get_thread_ident();
+	result = function(self, args, kwargs);
+	core_owner = 0;
+	PyThread_release_lock(core_lock);
+	return result;
+}
+
+#ifndef _WIN32
+// A child forked while another thread ran the core inherits core_lock held: start afresh
+void unlockCoreAfterFork(void) {
+
+	core_lock = PyThread_allocate_lock();
+	core_owner = 0;
+}
+#endif
+
+static PyObject *
+abgd_main_locked(PyObject *self, PyObject *args, PyObject *kwargs) {
+	return callLocked(abgd_main, self, args, kwargs);
+}
+
+static PyObject *
+abgd_sweep_locked(PyObject *self, PyObject *args, PyObject *kwargs) {
+	return callLocked(abgd_sweep, self, args, kwargs);
+}
+
+static PyObject *
+abgd_bootstrap_locked(PyObject *self, PyObject *args, PyObject *kwargs) {
+	return callLocked(abgd_bootstrap, self, args, kwargs);
+}
+
+static PyObject *
+abgd_distances_locked(PyObject *self, PyObject *args, PyObject *kwargs) {
+	return callLocked(abgd_distances, self, args, kwargs);
+}
+
+static PyObject *
+abgd_pairs_locked(PyObject *self, PyObject *args, PyObject *kwargs) {
+	return callLocked(abgd_pairs, self, args, kwargs);
+}
+
+static PyObject *
+abgd_tile_locked(PyObject *self, PyObject *args, PyObject *kwargs) {
+	return callLocked(abgd_tile, self, args, kwargs);
+}
+
 static PyMethodDef AbgdMethods[] = {
-  {"main",  abgd_main, METH_VARARGS | METH_KEYWORDS,
-   "Run ABGD for given parameters."},
+  {"main",  (PyCFunction)(void(*)(void)) abgd_main_locked, METH_VARARGS | METH_KEYWORDS,
+   "Run ABGD for given parameters, return a dictionary of results."},
+  {"sweep",  (PyCFunction)(void(*)(void)) abgd_sweep_locked, METH_VARARGS | METH_KEYWORDS,
+   "Run ABGD once for several slopes: sweep(file, slopes=[...], **kwargs)."},
+  {"bootstrap",  (PyCFunction)(void(*)(void)) abgd_bootstrap_locked, METH_VARARGS | METH_KEYWORDS,
+   "Resample the sorted distances: bootstrap(file, replicates=100, first=0, seed=1, **kwargs) returns the gap and groups of each replicate and step."},
+  {"distances",  (PyCFunction)(void(*)(void)) abgd_distances_locked, METH_VARARGS | METH_KEYWORDS,
+   "Compute the distance matrix only: distances(file, allocate, **kwargs) calls allocate(n) for a writable buffer of n*n doubles, returns the names."},
+  {"pairs",  (PyCFunction)(void(*)(void)) abgd_pairs_locked, METH_VARARGS | METH_KEYWORDS,
+   "Sort the pairwise distances as bootstrap() does: pairs(file, allocate, **kwargs) calls allocate(nval) for a writable buffer of nval doubles, returns nval."},
+  {"tile",  (PyCFunction)(void(*)(void)) abgd_tile_locked, METH_VARARGS | METH_KEYWORDS,
+   "Compute the upper triangle of some rows of the matrix: tile(file, first, last, allocate, **kwargs) calls allocate(count) for a writable buffer of count doubles, returns the names."},
+  {"render_histogram",  abgd_render_histogram, METH_VARARGS,
+   "Write the distance histogram from its bins: render_histogram(path, bins, maximum)."},
+  {"render_rank",  abgd_render_rank, METH_VARARGS,
+   "Write the ranked distances: render_rank(path, ranks, values, total, maximum)."},
+  {"render_graph",  abgd_render_graph, METH_VARARGS,
+   "Write the summary graph: render_graph(path, priors, groups, groups_init, method)."},
   {NULL, NULL, 0, NULL}        /* Sentinel */
 };
 
@@ -761,6 +2572,14 @@ PyMODINIT_FUNC
 PyInit_abgd(void)
 {
 	PyObject *m = NULL;
+	core_lock = PyThread_allocate_lock();
+	if (core_lock == NULL) {
+		PyErr_NoMemory();
+		return NULL;
+	}
+	#ifndef _WIN32
+	pthread_atfork(NULL, NULL, unlockCoreAfterFork);
+	#endif
   m = PyModule_Create(&abgdmodule);
 	if (m != NULL) {
 		if (PyModule_AddStringConstant(m, "separator", "/")) {
@@ -768,5 +2587,23 @@ PyInit_abgd(void)
 			m = NULL;
 		}
 	}
+	if (m != NULL) {
+		if (PyModule_AddIntConstant(m, "LOG_ERROR", ABGD_LOG_ERROR) ||
+		    PyModule_AddIntConstant(m, "LOG_INFO", ABGD_LOG_INFO) ||
+		    PyModule_AddIntConstant(m, "LOG_DEBUG", ABGD_LOG_DEBUG)) {
+			Py_DECREF(m);
+			m = NULL;
+		}
+	}
+	if (m != NULL) {
+		CancelledError = PyErr_NewException("abgdpy.abgd.Cancelled", NULL, NULL);
+		Py_XINCREF(CancelledError);
+		if (PyModule_AddObject(m, "Cancelled", CancelledError) < 0) {
+			Py_XDECREF(CancelledError);
+			Py_CLEAR(CancelledError);
+			Py_DECREF(m);
+			m = NULL;
+		}
+	}
 	return m;
 }
@@ -28,6 +28,7 @@
 typedef struct word
 {
   char name[LEN];
+  int leaf;                                /* row of the taxon, -1 if not a leaf */
   struct word *suiv;
 }WORD;
 
@@ -45,11 +46,13 @@ void   Compute_sums_Sx(float **delta, int n);
 
 void   Best_pair(float **delta, int r, int *a, int *b, int n);
 
-void   Finish(float **delta, int n, POINTERS *trees, FILE *output);
+void   Finish(float **delta, int n, POINTERS *trees, struct NewickTree *output);
 
 void   Concatenate(char chain1[LEN], int ind, POINTERS *trees, int post);
 
-void   Print_output(int i, POINTERS *trees, FILE *output);
+void   Print_output(int i, POINTERS *trees, struct NewickTree *output);
+
+void   Append_output(char *str, struct NewickTree *output);
 
 float Distance(int i, int j, float **delta);
 
@@ -146,6 +149,7 @@ void Initialize (float **delta, struct DistanceMatrix distMat, POINTERS *trees)
 	{
 	  	
 	  strcpy(name->name,distMat.names[lig-1]);
+	  name->leaf=lig-1;
 	  name->suiv=NULL;
 	  trees[lig].head=name;
 	  trees[lig].tail=name;
@@ -163,28 +167,61 @@ void Initialize (float **delta, struct DistanceMatrix distMat, POINTERS *trees)
 /*;;;;;;;;;;;;;;;;;;;;;;;;;;; Prin   t_output;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;*\
 ;                                                                           ;
 ;                                                                           ;
-; Description : This function prints out the tree in the output file.       ;
+; Description : This function prints out the subtree i in the output tree.  ;
 ;                                                                           ;
 ; input       :                                                             ;
 ;              POINTERS *trees : pointer to the subtrees.                   ;
 ;              int i          : indicate the subtree i to be printed.       ;
-:              FILE *output   : pointer to the output file.                 ;
+:              struct NewickTree *output : the tree in memory.              ;
 ;                                                                           ;
-; return value: The phylogenetic tree in the output file.                   ;
+; return value: The phylogenetic tree in output, where the end of each      ;
+;               leaf name is also recorded.                                 ;
 ;                                                                           ;
 \*;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;*/
 
 
-void Print_output(int i, POINTERS *trees, FILE *output)
+void Print_output(int i, POINTERS *trees, struct NewickTree *output)
 {
   WORD *parcour;
   parcour=trees[i].head;
   while(parcour != NULL)
     {
-      fprintf(output,"%s",parcour->name); // whites are size for printing 'group N°    '
+      Append_output(parcour->name,output); // whites are size for printing 'group N°    '
+      if(parcour->leaf >= 0)
+	{
+	  output->leaf_end[output->nleaf]=output->len;
+	  output->leaf_node[output->nleaf]=parcour->leaf;
+	  output->nleaf++;
+	}
       parcour=parcour->suiv;
     }
-  
+
+}
+
+/*;;;;;;;;;;;;;;;;;;;;;;;;;;; Append_output ;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;*\
+;                                                                           ;
+; Description : This function appends a string to the tree in memory,      ;
+;               growing the text when needed.                               ;
+;                                                                           ;
+\*;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;*/
+
+void Append_output(char *str, struct NewickTree *output)
+{
+  long l=strlen(str);
+
+  if(output->len+l+1 > output->nalloc)
+    {
+      while(output->len+l+1 > output->nalloc)
+	output->nalloc*=2;
+      output->text=(char *)realloc(output->text, output->nalloc*sizeof(char));
+      if(output->text == NULL)
+	{
+	  printf("Out of memories !!");fflush(stdout);
+	  exit(0);
+	}
+    }
+  memcpy(output->text+output->len, str, l+1);
+  output->len+=l;
 }
 
 
@@ -203,10 +240,9 @@ void Print_output(int i, POINTERS *trees, FILE *output)
 ;                                                                           ;
 \*;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;*/
 
-int mainBionj(struct DistanceMatrix distMat ,char *file_out)
+int mainBionj(struct DistanceMatrix distMat ,struct NewickTree *output)
 {
 //  FILE *input;                            /* pointer to input file       */
-  FILE *output;                           /* pointer to output file      */
   POINTERS *trees;                        /* list of subtrees            */
   char *Name_fich1;                       /* name of the input file      */
   char *Name_fich2;                       /* name of the output file     */
@@ -241,11 +277,21 @@ fflush(stdout);
 //  input= fopen(file_in,"r");
 //  printf("allocs done<BR>\n");fflush(stdout);
 
-  output= fopen(file_out,"w");
-  if (output==NULL)
-  	{printf("no file %s<BR>\n",file_out);fflush(stdout);exit(1);}
 n=distMat.n; 
 
+  output->nalloc=LEN;
+  output->len=0;
+  output->nleaf=0;
+  output->text=(char *)malloc(output->nalloc*sizeof(char));
+  output->leaf_end=(long *)malloc((n+1)*sizeof(long));
+  output->leaf_node=(int *)malloc((n+1)*sizeof(int));
+  if(output->text == NULL || output->leaf_end == NULL || output->leaf_node == NULL)
+  {
+	  printf("Out of memories!!<BR>\n");fflush(stdout);
+	  exit(0);
+	}
+  *output->text='\0';
+
 //  fscanf(input,"%d",&n);
   
   /*      Create the delta matrix     */
@@ -353,7 +399,6 @@ n=distMat.n;
   free(delta);
   free(trees);
  // fclose(input);
-  fclose(output);
 
 //  clock_end=clock(); i=(int)(t=(clock_end*1.0-clock_start)/CLOCKS_PER_SEC);
 /*   printf("\nTime used  %d:%d:%.3f\n", i/3600,(i%3600)/60, t-(i/60)*60); */
@@ -442,6 +487,7 @@ void Concatenate(char chain1[LEN], int ind, POINTERS *trees, int post)
   else
     {
       strcpy(bran->name,chain1);
+      bran->leaf=-1;
       bran->suiv=NULL;
     }
   if(post == 0)
@@ -662,7 +708,7 @@ float Finish_branch_length(int i, int j, int k, float **delta)
 ;                                                                           ;
 \*;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;*/
 
-void Finish(float **delta, int n, POINTERS *trees, FILE *output)
+void Finish(float **delta, int n, POINTERS *trees, struct NewickTree *output)
 {
   int l=1;
   int i=0;
@@ -690,28 +736,27 @@ void Finish(float **delta, int n, POINTERS *trees, FILE *output)
     }
   
   length=Finish_branch_length(last[0],last[1],last[2],delta);
-  fprintf(output,"(");
+  Append_output("(",output);
   Print_output(last[0],trees,output);
-  fprintf(output,"             :");
+  Append_output("             :",output);
 /*   gcvt(length,PREC, str); */
-/*   fprintf(output,"%s,",str); */
-  fprintf(output,"%f,",length);
+  sprintf(str,"%f,",length);
+  Append_output(str,output);
   
   length=Finish_branch_length(last[1],last[0],last[2],delta);
   Print_output(last[1],trees,output);
-  fprintf(output,"              :");
+  Append_output("              :",output);
 /*   gcvt(length,PREC, str); */
-/*   fprintf(output,"%s,",str); */
-  fprintf(output,"%f,",length);
+  sprintf(str,"%f,",length);
+  Append_output(str,output);
   
   length=Finish_branch_length(last[2],last[1],last[0],delta);
   Print_output(last[2],trees,output);
-  fprintf(output,"            :");
+  Append_output("            :",output);
 /*   gcvt(length,PREC,str); */
-/*   fprintf(output,"%s",str); */
-  fprintf(output,"%f",length);
-  fprintf(output,");");
-  fprintf(output,"\n");
+  sprintf(str,"%f",length);
+  Append_output(str,output);
+  Append_output(");\n",output);
   
   for(i=0; i < 3; i++)
     {
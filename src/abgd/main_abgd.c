@@ -49,6 +49,11 @@
 #include <dirent.h>
 #endif
 #define NBCHARMALLOC 256
+
+#define HISTO_WIDTH 720    /* size of the distance histogram and rank images */
+#define HISTO_HEIGHT 520
+#define HISTO_MARGIN 40
+#define HISTO_BORDER 60
 static char DEBUG;
 static short verbose;
 #define SIGN( a ) ( ( (a) > 0 )?1: ( ((a)==0)?0:-1)  )
@@ -137,15 +142,15 @@ int i;
 
 
 
-/*Read a Fasta File and compute the distance Matrix according to method*/
-struct DistanceMatrix compute_dis(FILE *f,int method,float ts_tv)
+/* All sequences of a fasta file with distinct names, *nseq is set to their number */
+struct FastaSeq *read_sequences(FILE *f,int *pnseq)
 {
 struct FastaSeq *mesSeq;
 
 int i=1;;
 int nalloc=256;
 int nseq=0;
-struct DistanceMatrix my_mat;   /* store distance matrix, names and matrix size */
+struct PhaseClock started=abgd_phase_start();
 
 
 mesSeq=(struct FastaSeq *)malloc (sizeof (struct FastaSeq ) *nalloc);
@@ -162,16 +167,34 @@ while (i)
 		if (mesSeq==NULL){printf("not enough memory\n");exit(1);}
 		}
 	}
+abgd_phase_stop(ABGD_METRIC_PARSE, started);
+started=abgd_phase_start();
 if (check_names(mesSeq,nseq)==0)
 	printf("Two seqs found with same name. Exit\n"),exit(1);
+abgd_phase_stop(ABGD_METRIC_NAMES, started);
+*pnseq=nseq;
+return mesSeq;
+}
 
-//printf("Going for dist: %d seqs\n",nseq);
-my_mat=GetDistMat(nseq,mesSeq, method,ts_tv,stdout,"");
-
-
+void free_sequences(struct FastaSeq *mesSeq,int nseq)
+{
+int i;
 for (i=0;i<nseq;i++)
 	{free(mesSeq[i].seq);free(mesSeq[i].name);}
 free(mesSeq);
+}
+
+/*Read a Fasta File and compute the distance Matrix according to method*/
+struct DistanceMatrix compute_dis(FILE *f,int method,float ts_tv)
+{
+struct FastaSeq *mesSeq;
+int nseq=0;
+struct DistanceMatrix my_mat;   /* store distance matrix, names and matrix size */
+
+mesSeq=read_sequences(f,&nseq);
+//printf("Going for dist: %d seqs\n",nseq);
+my_mat=GetDistMat(nseq,mesSeq, method,ts_tv,stdout,"");
+free_sequences(mesSeq,nseq);
 return my_mat;
 }
 
@@ -617,7 +640,7 @@ struct DistanceMatrix read_distmat(FILE *f_in,float ts_tv,int fmeg){
 				while( ( (letter=fgetc(f_in)) != '\n') && (letter !='\t'));
 			}
 
-			fclose(f_in);
+			// f_in is closed by the caller, as for compute_dis()
 
 
 
@@ -658,71 +681,104 @@ fprintf(svgout,"<g>\n"); // g for grouping all the graphic otherwise each square
 
 /*************************************************/
 /*plot 2 files distance hist and rank dist*/
-void createSVGhisto(char *file,struct DistanceMatrix dist_mat,int nbbids)
+/*
+	Array holds the N pairwise distances sorted in increasing order (as given to find_abgd).
+	Only what is drawn is kept: the bins of the histogram and the ranks of the rank curve
+*/
+struct DistSummary summarize_distances(double *Array,long N,int nbbids)
+{
+int k;
+long r,rfirst,rnext;
+struct DistSummary summary;
+
+	int largeur=HISTO_WIDTH-HISTO_BORDER;
+	int marge=HISTO_MARGIN;
+	int x1;
+
+	double intervalle,echellex;
+
+
+	summary.nbbids=nbbids;
+	summary.N=N;
+	summary.maxi=(float)Array[N-1];
+
+	summary.histo=malloc(sizeof(int)*(nbbids+2));
+	if (summary.histo==NULL)
+	fprintf(stderr,"pb malloc histo(1)\n"),exit(1);
+
+	for (k=0;k<nbbids+2;k++)summary.histo[k]=0;
+
+	intervalle=summary.maxi/(float)nbbids;
+	for (r=0;r<N;r++)
+		{
+		k=Array[r]/intervalle;
+		if (k<=nbbids+1)
+		summary.histo[k]++;
+		}
+
+	/*
+		values are sorted, so in one pixel column the curve is a vertical segment: only the first
+		and last rank falling in each column are kept instead of every pair, plus the very last one
+	*/
+	summary.rank=malloc(sizeof(long)*(2*(largeur+2)+1));
+	summary.value=malloc(sizeof(double)*(2*(largeur+2)+1));
+	if (summary.rank==NULL || summary.value==NULL)
+	fprintf(stderr,"pb malloc histo(2)\n"),exit(1);
+
+	summary.nrank=0;
+	echellex=(float)largeur/(float)N;
+	for (rfirst=0;rfirst<N-1;rfirst=rnext)
+		{
+			x1=marge+ ((rfirst)*echellex);
+			rnext=(long)((x1-marge+1)/echellex);             /* first rank of the next column, corrected for rounding */
+			while (rnext>rfirst+1 && (int)(marge+ ((rnext-1)*echellex))>x1)rnext--;
+			while (rnext<=rfirst || (rnext<N && (int)(marge+ ((rnext)*echellex))==x1))rnext++;
+
+			summary.rank[summary.nrank++]=rfirst;
+			if (rnext-1>rfirst && rnext-1<N-1)
+				summary.rank[summary.nrank++]=rnext-1;
+			}
+	summary.rank[summary.nrank++]=N-1;
+
+	for (r=0;r<summary.nrank;r++)
+		summary.value[r]=Array[summary.rank[r]];
+
+	return summary;
+}
+
+void free_summary(struct DistSummary summary)
+{
+	free(summary.histo);
+	free(summary.rank);
+	free(summary.value);
+}
+
+void createSVGdisthist(char *filename,struct DistSummary summary)
 {
-int i,j,k;
-int *histo;
-float maxi=0;
+int i;
+float maxi;
 char chaine [12];
 
-	int largeur=720;
-	int hauteur=520;
-	int marge=40;
-	int bordure=60;
+	int largeur=HISTO_WIDTH;
+	int hauteur=HISTO_HEIGHT;
+	int marge=HISTO_MARGIN;
+	int bordure=HISTO_BORDER;
 	int sizelegend=45;
-	int x1,y1,y2,x2,xt;
+	int x1,y1,y2;
 
 	float pas;
 	FILE *svgout;
 
 	double intervalle,echellex,echelley;
-	char filename[256];
-	float *histocum;
-	char  *colors[3]={"#FFFFFF","#D82424","#EBE448"};
-	int nbcomp=((dist_mat.n * (dist_mat.n -1)))/2.0;
+	int nbbids=summary.nbbids;
+	int *histo=summary.histo;
 
 
 
-	sprintf(filename,"%sdisthist.svg",file);
-
 	svgout=fopen(filename,"w");
 	CreateHeadersvg(svgout,largeur+sizelegend, hauteur+sizelegend);
 
-	histo=malloc(sizeof(int)*nbbids+2);
-	if (histo==NULL)
-	fprintf(stderr,"pb malloc histo(1)\n"),exit(1);
-
-	histocum=malloc(sizeof(float)*nbcomp+1);
-	if (histo==NULL)
-	fprintf(stderr,"pb malloc histo(2)\n"),exit(1);
-
-	for (i=0;i<nbbids;i++)histo[i]=0;
-
-	k=0;
-	for (i=0;i<dist_mat.n-1;i++)
-		{
-		for (j=i+1;j<dist_mat.n;j++)
-			{
-			if (maxi<dist_mat.dist[i][j])
-				maxi=dist_mat.dist[i][j];
-			histocum[k++] = (float) dist_mat.dist[i][j];
-
-			}
-	}
-	// printf("sorting distances\n");
-	qsort(histocum, nbcomp,sizeof(float),myCompare);
-	// printf("sorting distances done\n");
-
-	intervalle=maxi/(float)nbbids;
-	k=0;
-	for (i=0;i<dist_mat.n-1;i++)
-		for (j=i+1;j<dist_mat.n;j++)
-			{
-			k=dist_mat.dist[i][j]/intervalle;
-			if (k<=nbbids+1)
-			histo[k]++;
-			}
-
+	intervalle=summary.maxi/(float)nbbids;
 
 	maxi=0;
 
@@ -784,15 +840,35 @@ for (i=0;i<nbbids;i++)
 	fclose(svgout);
 
 // printf("first plot done\n");
+}
+
+void createSVGrank(char *filename,struct DistSummary summary)
+{
+int i,k;
+long r;
+float maxi;
+char chaine [24];
+
+	int largeur=HISTO_WIDTH-HISTO_BORDER;
+	int hauteur=HISTO_HEIGHT-HISTO_BORDER;
+	int marge=HISTO_MARGIN;
+	int sizelegend=45;
+	int x1,y1,y2,x2,xt;
+
+	float pas;
+	FILE *svgout;
+
+	double echellex,echelley;
+	char  *colors[3]={"#FFFFFF","#D82424","#EBE448"};
+	long N=summary.N;
 
 
 	//now draw the rank hist
-	sprintf(filename,"%srank.svg",file);
 	svgout=fopen(filename,"w");
 	CreateHeadersvg(svgout,largeur+sizelegend+marge, hauteur+sizelegend+marge);
 
 	fflush(stdout);
-	maxi=histocum[nbcomp-1];
+	maxi=summary.maxi;
 	echelley=(float)hauteur/maxi;
 
 
@@ -806,20 +882,20 @@ for (i=0;i<nbbids;i++)
 
 			y1=hauteur+marge - ((i+1)*pas) ;
 			fprintf(svgout,"<line x1=\"%d\" y1=\"%d\"  x2=\"%d\" y2=\"%d\" style=\" stroke: black;\"/>\n",marge-3, y1,marge,y1);
-			sprintf(chaine,"%.2f",(float)(i+1)*(maxi/10));
+			snprintf(chaine,sizeof(chaine),"%.2f",(float)(i+1)*(maxi/10));
 			fprintf(svgout,"<text x=\"%d\" y=\"%d\" style=\"font-family: monospace; font-size: 10px;\">%s</text>\n",marge-(8*(int)strlen(chaine)), y1 ,chaine);
 
 			}
 
 
 	//drawing x axis
-	echellex=(float)largeur/(float)nbcomp;
+	echellex=(float)largeur/(float)N;
 	for (i=0;i<10;i++)
 			{
 			k=(i+1)*((float)largeur/10.0);
 			xt=marge+ k;
 
-			sprintf(chaine,"%d",(i+1)*(nbcomp/10));
+			snprintf(chaine,sizeof(chaine),"%ld",(i+1)*(N/10));
  	 		fprintf(svgout,"<line x1=\"%d\" y1=\"%d\"  x2=\"%d\" y2=\"%d\" style=\" stroke: black;\"/>\n" ,	xt,marge+hauteur, xt,marge+hauteur+5);
 			fprintf(svgout,"<text x=\"%d\" y=\"%d\" transform=\"rotate(90,%d,%d)\" style=\"font-family: monospace; font-size: 10px;\">%s</text>\n",
 				xt,marge+hauteur+5,xt,marge+hauteur+5,chaine);
@@ -828,30 +904,43 @@ for (i=0;i<nbbids;i++)
 		fprintf(svgout,"<text x=\"%d\" y=\"%d\" style=\"font-family: monospace; font-size: 10px;\">Dist. value</text>\n",5,15);
 
 	fprintf(svgout,"<polyline style=\"stroke: %s; stroke-width:1;fill: none;\"  points=\"",colors[1]);
-	x2=y2=0;
-	for (i=0;i<nbcomp-1;i++)
+	x2=y2=-1;
+	for (r=0;r<summary.nrank-1;r++)
 		{
-			x1=marge+ ((i)*echellex);
-			y1=hauteur -(histocum[i]*echelley) +marge;
-			if (i==0 || x1!=x2 || y1!=y2)
+			x1=marge+ ((summary.rank[r])*echellex);
+			y1=hauteur -((float)summary.value[r]*echelley) +marge;
+			if (x1!=x2 || y1!=y2)
 				fprintf(svgout,"%d %d,",x1,y1); //draw new coords only
 			x2=x1;
 			y2=y1;
-
 			}
-	x1=marge+ ((i)*echellex);
-	y1=hauteur -(histocum[i]*echelley) +marge;
+	x1=marge+ ((summary.rank[r])*echellex);
+	y1=hauteur -((float)summary.value[r]*echelley) +marge;
 	fprintf(svgout,"%d %d\"/>",x1,y1);
 
 	fprintf(svgout,"</g>\n");
 	fprintf(svgout,"</svg>\n");
 	fclose(svgout);
 
-	free(histo);
-
 // printf("second plot done\n");
 }
 
+void createSVGhisto(char *file,double *Array,long N,int nbbids)
+{
+	char filename[256];
+	struct DistSummary summary;
+
+	summary=summarize_distances(Array,N,nbbids);
+
+	sprintf(filename,"%sdisthist.svg",file);
+	createSVGdisthist(filename,summary);
+
+	sprintf(filename,"%srank.svg",file);
+	createSVGrank(filename,summary);
+
+	free_summary(summary);
+}
+
 
 
 
@@ -1005,9 +1094,9 @@ double * Compute_myDist( double minDist, double MaxDist, int nbStepsABGD ){
 
 }
 
-char *Built_OutfileName( char *file ){
+char *Built_OutfileName( const char *file ){
 
-	char * bout;
+	const char * bout;
 	int ii;
 
 	char *simplename;
@@ -1026,46 +1115,19 @@ char *Built_OutfileName( char *file ){
 	return simplename;
 }
 
-char * compute_DistTree( struct DistanceMatrix  distmat, char *dirfiles ){
-
-
-	int ii=0;
-	FILE *fnex;
-	char fileNex[128];
-	int c;
-	char *newickStringOriginal;
-
-	sprintf(fileNex,"%s/.newick.tempo.%d",dirfiles,getpid());
-	mainBionj(distmat ,fileNex);
-
-	fnex=fopen(fileNex,"r");
-	if(!fnex)fprintf(stderr, "compute_DistTree: cannot read in file %s, bye\n", fileNex),exit(1);
-
-	while(fgetc(fnex)!=EOF)
-		ii++;
-
-	newickStringOriginal   = (char *)malloc( (size_t)  sizeof(char)*ii+1);
-
-	if(!newickStringOriginal )
-		fprintf(stderr, "compute_DistTree: cannot allocate newickStringOriginal or newickString, bye\n"),exit(1);
-
-	rewind (fnex);
-	ii=0;
-	while(1){
-		c=fgetc(fnex);
-		if (c==EOF)
-			break;
-		if ( isascii(c) )
-			*( newickStringOriginal + ii++ ) = c;
-	}
+/*
+	Build the BIONJ tree of the matrix, kept in memory with the position of each leaf
+*/
+struct NewickTree compute_DistTree( struct DistanceMatrix  distmat ){
 
-	*(newickStringOriginal +ii)='\0';
-		fclose(fnex);
-unlink(fileNex);
-return(newickStringOriginal);
+	struct NewickTree tree;
 
+	mainBionj(distmat ,&tree);
 
+	if( tree.nleaf != distmat.n )
+		fprintf(stderr, "compute_DistTree: found %d leaves for %ld sequences, bye\n", tree.nleaf, distmat.n),exit(1);
 
+	return(tree);
 }
 
 /********************
@@ -1120,6 +1182,12 @@ void usage(char *arg0)
 */
 #ifndef ismodule
 
+/* nothing to report to on the command line */
+int abgd_progress( int phase, long done, long total ){
+
+	return 0;
+}
+
 int main( int argc, char ** argv){
 
 
@@ -1129,8 +1197,6 @@ int main( int argc, char ** argv){
 	     ledir[128];
 
 	char *meth=NULL,
-	     *newickString=NULL,
-	     *newickStringOriginal=NULL,
 	     *simplename=NULL;
 
 	char *mask;                      /* used to mask some row/col in the distance matrix -- consider only sub-part of the matrix */
@@ -1153,6 +1219,7 @@ int main( int argc, char ** argv){
 	struct DistanceMatrix distmat;   /* input matrix of distance all vs all */
 	struct Composante comp;          /* group partition */
 	struct Peak recursive_abgd;     /* structure for storing extra split distance */
+	struct NewickTree newickTree;    /* BIONJ tree used to write groups in newick format */
 
 	short output_slope=0;            /* to output slopes -- watch out it can be very verbose -- */
 	short output_groups=0;           /* output group composition ? */
@@ -1252,6 +1319,7 @@ char *bout;
 
 			case 'v':
                  		verbose=1;
+				abgd_log_level=ABGD_LOG_DEBUG;
 				break;
 			case 't':
                  		 ts_tv=atof(optarg);		/*trans/trav rate */
@@ -1355,12 +1423,7 @@ if (stat(dirfiles, &stfile) == -1)
 	if (withallfiles)
 		{
 		if (verbose)fprintf(stderr,"\nbuilding newick tree for your data (it can take time when many sequences)\n");
-		newickStringOriginal=compute_DistTree(  distmat, dirfiles );
-
-		newickString= malloc( (size_t)  sizeof(char) * strlen(newickStringOriginal)+1);
-		if (!newickString )
-			printf("pb malloc newick\n"),exit(1);
-		strcpy(newickString,newickStringOriginal);//make a copy because going to modify it in next function
+		newickTree=compute_DistTree(  distmat );
 //		printf("tree ok\n");
 //		print_distmat(distmat);
 		}
@@ -1395,9 +1458,20 @@ if (stat(dirfiles, &stfile) == -1)
 	*/
 	mask=(char*)malloc( distmat.n*sizeof(char) );
 	if(!mask)fprintf(stderr, "main: cannot allocate mask, bye<BR>\n");
+
+	/*
+		the primary distances do not depend on the prior: sort them once, for the plots and every step
+	*/
+	for(j=0; j<distmat.n; j++)mask[j]=1;
+	ValArray = matrix2list( distmat, mask , &NVal);
+
+	if (verbose)fprintf(stderr,"sorting \n");
+	qsort((void *) ValArray, (size_t) NVal, (size_t) sizeof(double), Increase );
+	if (verbose)fprintf(stderr,"done\n");
+
 	if (verbose)fprintf(stderr,"Writing histogram files\n");
 	sprintf(file_name,"%s/%s",dirfiles,simplename);
- 	createSVGhisto(file_name,distmat,nbbids);
+ 	createSVGhisto(file_name,ValArray,NVal,nbbids);
 	if (verbose)fprintf(stderr," histogram Done\nBegining ABGD--->\n");
 
 	for (myD=0;myD<nbStepsABGD;myD++)
@@ -1411,16 +1485,10 @@ if (stat(dirfiles, &stfile) == -1)
 		flag=1;
 		windsize_min=0;
 		windsize_max=0;
-		NVal=0;
 		output_slope=0;
 		output_groups=0;
 
 		for(j=0; j<distmat.n; j++)mask[j]=1;
-		ValArray = matrix2list( distmat, mask , &NVal);
-
-		if (verbose)fprintf(stderr,"sorting \n");
-		qsort((void *) ValArray, (size_t) NVal, (size_t) sizeof(double), Increase );
-		if (verbose)fprintf(stderr,"done\n");
 	/*
 		2. Find the estimated peak of the derivative on windsize values
 	*/
@@ -1438,11 +1506,9 @@ if (stat(dirfiles, &stfile) == -1)
 			fflush(stdout);
 
 			mySpecies[myD]=1;
+			specInit[myD]=1;                     /* no split at all: the initial partition is one group too */
 			myD++;
 
-			free(ValArray);
-
-
 			break;
 		}
 
@@ -1473,11 +1539,9 @@ if (stat(dirfiles, &stfile) == -1)
 				printf("problem opening result file %s\n",file_name), exit(1);
 			sprintf(file_name,"%s/%s.partinit.%d.tree",dirfiles,simplename,myD+1);
 			f2=fopen(file_name,"w");
-			print_groups_files_newick( comp ,  distmat ,  fout,newickString  ,f2,0,stdout,"");
+			print_groups_files_newick( comp ,  distmat ,  fout,newickTree  ,f2,0);
 			mem_spart_files(comp , myspar,myD,nb_subsets,0,distmat.n,fres);
 			fclose(fout);
-			/* reseting newick string to original */
-			strcpy(newickString,newickStringOriginal);//make a copy because going to modify it in next function
 
 
 
@@ -1607,16 +1671,11 @@ if (stat(dirfiles, &stfile) == -1)
 			sprintf(file_name,"%s/%s.part.%d.tree",dirfiles,simplename,myD+1);
 			f2=fopen(file_name,"w");
 
-			print_groups_files_newick( comp ,  distmat ,  fout,newickString  ,f2,0,stdout,"");
+			print_groups_files_newick( comp ,  distmat ,  fout,newickTree  ,f2,0);
 			mem_spart_files(comp ,  myspar2,myD,nb_subsets,1 ,distmat.n,fres);
 
 			fclose(fout);
 
-			/*
-				reseting newick string to original
-			*/
-			strcpy(newickString,newickStringOriginal);   /* make a copy because going to modify it in next function */
-
 		}
 		else if(notreefile)
 		{
@@ -1642,8 +1701,8 @@ if (stat(dirfiles, &stfile) == -1)
 		}
 
 		reset_composante( &comp);
-		free(ValArray);
 	}
+	free(ValArray);
  //printf("***************%d et nc=%d %d \n",myD,comp.nc,stop_at_once);
 	if ((myD==1 && comp.nc<=1) || (myD==1 && stop_at_once==1))
 	   printf("Only one partition found with your data. Nothing to output. You should try to rerun with a lower X (< %f) **Stop here**<BR>\n", minSlopeIncrease);
@@ -1701,7 +1760,7 @@ if (stat(dirfiles, &stfile) == -1)
 	if (stop_at_once==0 )
 	free_composante(comp);
 		if (withallfiles)
-			free(newickString);
+			free_newick(newickTree);
 
 	free(bcod);
 	free(mySpecies);
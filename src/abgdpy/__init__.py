@@ -1,4 +1,10 @@
-from .core import BarcodeAnalysis, launch
+from .core import BarcodeAnalysis, launch, launch_async, launch_all
+from .results import Results
+from .batch import BatchAnalysis
+from .sweep import SlopeSweep
+from .bootstrap import GapBootstrap
+from .shared import SharedDistances, SharedPairs
+from .cache import ResultCache
 from . import abgd
 
 import os
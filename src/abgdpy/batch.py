@@ -0,0 +1,319 @@
+#-----------------------------------------------------------------------------
+# ABGDpy - Automatic Barcode Gap Discovery with ABGD
+# Copyright (C) 2021  Patmanidis Stefanos
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#-----------------------------------------------------------------------------
+
+
+"""
+Run ABGD on many input files at once.
+
+Each file is analyzed on its own process, as with core.launch().
+Jobs are started while their estimated memory fits in the budget,
+and reported as soon as they finish:
+
+>>> b = BatchAnalysis(['a.fas', 'b.fas'], 'results', jobs=4)
+>>> b.param.general.all = True
+>>> for job in b.run():
+...     print(job.describe())
+
+A summary of all partitions is written to 'results/summary.tsv'.
+"""
+
+from multiprocessing import Process, Pipe
+from multiprocessing.connection import wait
+
+import argparse
+import csv
+import os
+import pathlib
+import sys
+
+from . import cache
+from . import core
+from . import param
+from . import params
+
+
+# Memory of a child process before any data is loaded
+BASE_MEMORY = 32 * 2**20
+
+
+def count_sequences(file):
+    """Number of sequences in a fasta file, or rows in a distance matrix"""
+    with open(file, 'rb') as input:
+        first = input.read(1)
+        input.seek(0)
+        if first == b'>':
+            return sum(1 for line in input if line.startswith(b'>'))
+        return sum(1 for line in input if line.strip())
+
+
+def estimate_memory(file, trees=False):
+    """
+    Rough peak memory in bytes for analyzing file.
+    The core keeps a full matrix of doubles, the sorted list of all pairs
+    and the pairs of the group being split, plus the BIONJ matrix for trees.
+    """
+    n = count_sequences(file)
+    memory = BASE_MEMORY + os.path.getsize(file) + 16 * n * n
+    if trees:
+        memory += 4 * n * n
+    return memory
+
+
+def physical_memory():
+    """Total physical memory in bytes, None if unknown"""
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def worker(analysis, pipe):
+    """
+    Called by BatchAnalysis on a new process.
+    The core logs to file, anything printed before that is dropped.
+    """
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    os.dup2(devnull, 2)
+    core.worker(analysis, pipe)
+
+
+class BatchJob():
+    """
+    A single input file of a batch, with its analysis once finished.
+    """
+
+    def __init__(self, file, memory):
+        self.file = pathlib.Path(file)
+        self.memory = memory
+        self.analysis = None
+        self.process = None
+        self.receiver = None
+        self.error = None
+
+    def describe(self):
+        """One line summary"""
+        if self.error is not None:
+            return '{}: failed ({})'.format(self.file.name, self.error)
+        output = self.analysis.output
+        if not output.groups:
+            return '{}: no partition found'.format(self.file.name)
+        return '{}: {} sequences, {} partitions, {} to {} groups'.format(
+            self.file.name, len(output.names), len(output.priors),
+            min(output.groups), max(output.groups))
+
+
+class BatchAnalysis():
+    """
+    Schedule many BarcodeAnalysis runs on a bounded set of processes.
+    All files share the same parameters.
+    """
+
+    def __init__(self, files, target, jobs=None, memory=None):
+        """
+        Results for each file go in a subdirectory of target.
+        At most `jobs` processes run at once (default: cpu count), and
+        their estimated memory stays below `memory` bytes (default:
+        physical memory). A job larger than the budget runs alone.
+        """
+        self.files = [pathlib.Path(file) for file in files]
+        self.target = pathlib.Path(target)
+        self.jobs = jobs if jobs is not None else (os.cpu_count() or 1)
+        if self.jobs < 1:
+            raise ValueError('Expected at least one job, got: {}'.format(self.jobs))
+        self.memory = memory if memory is not None else physical_memory()
+        # Only the log and summary are written unless unset
+        self.lazy = True
+        # If set, the timeline of each run is written as trace.json next to its log
+        self.trace = False
+        # If set to a ResultCache, files analyzed before are not run again
+        self.cache = None
+        self.time_format = '%FT%T'
+        self.param = param.ParamList(params.params)
+
+    def start(self, job):
+        """Launch the analysis of job on a new process"""
+        analysis = core.BarcodeAnalysis(str(job.file))
+        analysis.param = self.param
+        analysis.lazy = self.lazy
+        analysis.useLogfile = True
+        analysis.time_format = self.time_format
+        analysis.target = (self.target / job.file.name).as_posix()
+        pathlib.Path(analysis.target).mkdir(parents=True, exist_ok=True)
+        if self.trace:
+            analysis.trace = analysis.target + '/trace.json'
+        analysis.cache = self.cache
+        job.analysis = analysis
+        job.receiver, sender = Pipe(duplex=False)
+        job.process = Process(target=worker, args=(analysis, sender))
+        job.process.start()
+        sender.close()
+
+    def finish(self, job):
+        """Collect the results of job once its process is done"""
+        try:
+            job.analysis.output = job.receiver.recv()
+        except EOFError:
+            pass
+        job.receiver.close()
+        job.process.join()
+        if job.process.exitcode != 0:
+            job.error = 'exit code {}, see {}/abgd.log'.format(
+                job.process.exitcode, job.analysis.target)
+        else:
+            job.analysis.results = job.analysis.target
+
+    def run(self):
+        """
+        Analyze all files, yield each BatchJob as soon as it is done.
+        The consolidated summary is updated along the way.
+        """
+        self.target.mkdir(parents=True, exist_ok=True)
+        trees = self.param.general.all
+        pending = []
+        for file in self.files:
+            try:
+                pending.append(BatchJob(file, estimate_memory(file, trees)))
+            except OSError as exception:
+                job = BatchJob(file, 0)
+                job.error = exception.strerror
+                pending.append(job)
+        running = []
+
+        with open(self.target / 'summary.tsv', 'w', newline='') as summary:
+            writer = csv.writer(summary, delimiter='\t')
+            writer.writerow(['file', 'status', 'sequences', 'step',
+                'prior', 'groups_init', 'groups'])
+
+            while pending or running:
+
+                # Admit jobs in order, skip those that do not fit for now
+                used = sum(job.memory for job in running)
+                for job in list(pending):
+                    if job.error is not None:
+                        pending.remove(job)
+                        self.write(writer, job)
+                        yield job
+                        continue
+                    if len(running) >= self.jobs:
+                        break
+                    if (running and self.memory is not None and
+                            used + job.memory > self.memory):
+                        continue
+                    pending.remove(job)
+                    self.start(job)
+                    running.append(job)
+                    used += job.memory
+
+                if not running:
+                    continue
+                ready = wait([job.receiver for job in running])
+                for job in [job for job in running if job.receiver in ready]:
+                    running.remove(job)
+                    self.finish(job)
+                    self.write(writer, job)
+                    summary.flush()
+                    yield job
+
+    def write(self, writer, job):
+        """Add the rows of job to the consolidated summary"""
+        if job.error is not None:
+            writer.writerow([job.file.name, 'failed', '', '', '', '', ''])
+            return
+        output = job.analysis.output
+        if not output.priors:
+            writer.writerow([job.file.name, 'done', len(output.names), '', '', '', ''])
+        for step, prior in enumerate(output.priors):
+            writer.writerow([job.file.name, 'done', len(output.names), step + 1,
+                prior, output.groups_init[step], output.groups[step]])
+
+
+def positive(text):
+    """A whole number of at least 1"""
+    try:
+        value = int(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected a number, got: {}'.format(text))
+    if value < 1:
+        raise argparse.ArgumentTypeError('expected at least 1, got: {}'.format(text))
+    return value
+
+
+def main(argv=None):
+    """Console entry point for: abgdpy batch DIR"""
+    parser = argparse.ArgumentParser(prog='abgdpy batch',
+        description='Analyze every file in a directory.')
+    parser.add_argument('directory', help='directory of input files')
+    parser.add_argument('--jobs', '-j', type=positive, default=None,
+        help='maximum number of parallel analyses (default: cpu count)')
+    parser.add_argument('--memory', '-m', type=int, default=None,
+        help='memory budget in MB (default: physical memory)')
+    parser.add_argument('--out', '-o', default=None,
+        help='output directory (default: DIR/abgd_batch)')
+    parser.add_argument('--files', action='store_true',
+        help='write all output files for each input, not just the summary')
+    parser.add_argument('--trace', action='store_true',
+        help='write a timeline of each run in Chrome trace-event format')
+    parser.add_argument('--cache', default=None, metavar='DIR',
+        help='reuse the results of identical analyses kept in this directory')
+
+    # Every analysis parameter is available as an option
+    defaults = param.ParamList(params.params)
+    booleans = {'true': True, 'false': False, '1': True, '0': False}
+    for category in defaults.values():
+        for key, field in category.items():
+            options = {}
+            if field.type == 'bool':
+                options['type'] = lambda value: booleans[value.lower()]
+                options['metavar'] = '{true,false}'
+            elif field.type == 'list':
+                options['type'] = int
+                options['choices'] = field.data['items']
+            else:
+                options['type'] = {'int': int, 'float': float}[field.type]
+            parser.add_argument('--' + key, default=None,
+                help='{} (default: {})'.format(field.doc, field.default),
+                **options)
+
+    args = parser.parse_args(argv)
+    directory = pathlib.Path(args.directory)
+    if not directory.is_dir():
+        parser.error('not a directory: {}'.format(directory))
+    target = pathlib.Path(args.out) if args.out else directory / 'abgd_batch'
+    files = sorted(file for file in directory.iterdir()
+        if file.is_file() and not file.name.startswith('.'))
+    memory = args.memory * 2**20 if args.memory is not None else None
+
+    batch = BatchAnalysis(files, target, jobs=args.jobs, memory=memory)
+    batch.lazy = not args.files
+    batch.trace = args.trace
+    if args.cache is not None:
+        batch.cache = cache.ResultCache(args.cache)
+    for category in batch.param.values():
+        for key in category.keys():
+            value = getattr(args, key)
+            if value is not None:
+                category[key].value = value
+
+    failed = 0
+    for job in batch.run():
+        print(job.describe())
+        sys.stdout.flush()
+        failed += job.error is not None
+    print('Summary written to:', target / 'summary.tsv')
+    return 1 if failed else 0
@@ -0,0 +1,13 @@
+"""
+Synthetic barcode datasets and benchmarks of the ABGD core.
+Results are saved as json for comparison across commits.
+"""
+
+__author__ = "Patmanidis Stefanos"
+__copyright__ = "Copyright (C) 2021 Patmanidis Stefanos. All rights reserved."
+__license__ = "GPLv3"
+__version__ = "0.1"
+
+from .synthetic import Dataset
+from .suite import Suite, compare
+from .differential import Harness, generate
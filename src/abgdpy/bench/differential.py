@@ -0,0 +1,285 @@
+#-----------------------------------------------------------------------------
+# ABGDpy - Automatic Barcode Gap Discovery with ABGD
+# Copyright (C) 2021  Patmanidis Stefanos
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#-----------------------------------------------------------------------------
+
+
+"""
+Check that a candidate engine gives the same results as the reference core.
+An engine is a module with the same main() and distances() as abgdpy.abgd:
+
+>>> h = Harness('mypackage.fastabgd')
+>>> h.grid(generate('check', [50, 200]) + ['tests/test.fas'],
+...     method=[0, 1, 3], slope=[0.5, 1.5])
+>>> for case, divergence in h.run():
+...     print(divergence.describe() if divergence else 'ok')
+
+Distance matrices are compared within a tolerance, everything derived
+from them exactly: priors, barcode gaps, group counts of each step
+(initial and recursive) and the group of each sample in every partition.
+Only the first divergence of each case is reported.
+"""
+
+from multiprocessing import Process, Pipe
+
+import importlib
+import itertools
+import os
+import pathlib
+
+from .synthetic import Dataset
+
+
+REFERENCE = 'abgdpy.abgd'
+
+# Fields of abgd.main() compared exactly, in order
+FIELDS = ['names', 'spart_names', 'priors', 'spart_steps', 'groups_init',
+    'groups', 'barcode_gaps', 'partitions_init', 'partitions']
+
+# Variants of the generated datasets, see Dataset
+VARIANTS = {
+    'plain': {},
+    'gaps': {'gaps': 0.05, 'missing': 0.02},
+    'duplicates': {'duplicates': 0.5},
+    'close': {'within': 0.03, 'between': 0.04},
+    }
+
+
+def generate(target, sizes, seeds=(0,), variants=None):
+    """
+    Write generated datasets in target, each as fasta and Phylip matrix.
+    Return the list of paths.
+    """
+    target = pathlib.Path(target)
+    target.mkdir(parents=True, exist_ok=True)
+    variants = variants if variants is not None else list(VARIANTS)
+    files = []
+    for size, seed, variant in itertools.product(sizes, seeds, variants):
+        dataset = Dataset(size, seed=seed, **VARIANTS[variant])
+        stem = target / 'check_{}_{}_{}'.format(variant, size, seed)
+        fasta = stem.with_suffix('.fas')
+        dataset.write_fasta(fasta)
+        matrix = stem.with_suffix('.phy')
+        dataset.write_matrix(matrix, fasta)
+        files += [str(fasta), str(matrix)]
+    return files
+
+
+def is_fasta(file):
+    """Fasta files start with '>', anything else is a matrix"""
+    with open(file, 'rb') as input:
+        return input.read(1) == b'>'
+
+
+def worker(engine, task, file, kwargs, pipe):
+    """
+    Called by Harness on a new process, since engines may exit().
+    Sends the result of engine.main() without metrics,
+    or the names and matrix bytes of engine.distances().
+    """
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    os.dup2(devnull, 2)
+    module = importlib.import_module(engine)
+    try:
+        if task == 'distances':
+            buffers = []
+            def allocate(n):
+                buffers.append(bytearray(8 * n * n))
+                return buffers[0]
+            names = module.distances(file, allocate, **kwargs)
+            result = (names, bytes(buffers[0]) if buffers else b'')
+        else:
+            result = module.main(file, **kwargs)
+            result.pop('metrics', None)
+            result.pop('trace', None)
+    except Exception as exception:
+        result = exception
+    pipe.send(result)
+    pipe.close()
+
+
+def call(engine, task, file, kwargs):
+    """Run task of engine on a new process and return its result"""
+    receiver, sender = Pipe(duplex=False)
+    p = Process(target=worker, args=(engine, task, file, kwargs, sender))
+    p.start()
+    sender.close()
+    try:
+        result = receiver.recv()
+    except EOFError:
+        result = None
+    p.join()
+    if p.exitcode != 0 or result is None:
+        raise RuntimeError('{} exited with code {} on {}'.format(
+            engine, p.exitcode, file))
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+
+class Divergence():
+    """First difference between the reference and the candidate"""
+
+    def __init__(self, case, field, where, reference, candidate):
+        self.case = case
+        self.field = field
+        self.where = where
+        self.reference = reference
+        self.candidate = candidate
+
+    def describe(self):
+        """One line summary"""
+        file, kwargs = self.case
+        return '{} {}: {}{}: reference {!r}, candidate {!r}'.format(
+            pathlib.Path(file).name, kwargs, self.field,
+            ' ' + self.where if self.where else '', self.reference, self.candidate)
+
+
+class Harness():
+    """
+    Runs the reference and a candidate engine on the same cases.
+    A case is an input file with keyword arguments for main().
+    """
+
+    def __init__(self, candidate, reference=REFERENCE,
+            tolerance=1e-9, gap_tolerance=0.0):
+        """
+        Distances d may differ from the reference r by tolerance * max(1, |r|),
+        barcode gaps by gap_tolerance in the same way.
+        """
+        self.candidate = candidate
+        self.reference = reference
+        self.tolerance = tolerance
+        self.gap_tolerance = gap_tolerance
+        self.cases = []
+        self._checked = set()
+
+    def add(self, file, **kwargs):
+        """Add a single case"""
+        self.cases.append((str(file), kwargs))
+
+    def grid(self, files, **grid):
+        """
+        Add a case for every file and combination of parameter values,
+        given as lists. Matrices ignore the distance method, so only
+        its first value is used with them; MEGA CSV files get mega=True.
+        """
+        keys = list(grid)
+        for file in files:
+            values = [grid[key] for key in keys]
+            if not is_fasta(file):
+                values = [value[:1] if key in ('method', 'rate') else value
+                    for key, value in zip(keys, values)]
+            for combination in itertools.product(*values):
+                kwargs = dict(zip(keys, combination))
+                if str(file).lower().endswith('.csv'):
+                    kwargs['mega'] = True
+                self.add(file, **kwargs)
+
+    def check_distances(self, case):
+        """Divergence of the distance matrices of a fasta case, if any"""
+        file, kwargs = case
+        distance_kwargs = {key: kwargs[key] for key in ('method', 'rate') if key in kwargs}
+        key = (file, tuple(sorted(distance_kwargs.items())))
+        if key in self._checked:
+            return None
+        self._checked.add(key)
+        names, reference = call(self.reference, 'distances', file, distance_kwargs)
+        other, candidate = call(self.candidate, 'distances', file, distance_kwargs)
+        if names != other:
+            index = first_difference(names, other)
+            return Divergence(case, 'distance names', 'sample {}'.format(index + 1),
+                item(names, index), item(other, index))
+        reference = memoryview(reference).cast('d')
+        candidate = memoryview(candidate).cast('d')
+        if len(reference) != len(candidate):
+            return Divergence(case, 'distance matrix', 'size',
+                len(reference), len(candidate))
+        n = len(names)
+        for index, (r, c) in enumerate(zip(reference, candidate)):
+            if not close(r, c, self.tolerance):
+                i, j = divmod(index, n)
+                return Divergence(case, 'distance',
+                    '{} - {}'.format(names[i], names[j]), r, c)
+        return None
+
+    def check_results(self, case, reference, candidate):
+        """Divergence of the results of main(), if any"""
+        for field in FIELDS:
+            r = reference.get(field)
+            c = candidate.get(field)
+            if field == 'barcode_gaps' and r is not None and c is not None:
+                if len(r) == len(c) and all(close(x, y, self.gap_tolerance)
+                        for x, y in zip(r, c)):
+                    continue
+            if r == c:
+                continue
+            if field.startswith('partitions') and r and c:
+                for step, (x, y) in enumerate(zip(r, c)):
+                    if x != y:
+                        index = first_difference(x, y)
+                        name = item(reference['names'], index)
+                        return Divergence(case, field,
+                            'step {} sample {}'.format(step + 1, name),
+                            item(x, index), item(y, index))
+            if isinstance(r, list) and isinstance(c, list):
+                index = first_difference(r, c)
+                where = 'sample {}' if field.endswith('names') else 'step {}'
+                return Divergence(case, field, where.format(index + 1),
+                    item(r, index), item(c, index))
+            return Divergence(case, field, '', r, c)
+        return None
+
+    def check(self, case):
+        """Divergence for a single case, None if both engines agree"""
+        file, kwargs = case
+        if is_fasta(file):
+            divergence = self.check_distances(case)
+            if divergence is not None:
+                return divergence
+        kwargs = dict(kwargs, files=False)
+        reference = call(self.reference, 'main', file, kwargs)
+        candidate = call(self.candidate, 'main', file, kwargs)
+        return self.check_results(case, reference, candidate)
+
+    def run(self):
+        """Check all cases, yield (case, divergence or None) for each"""
+        for case in self.cases:
+            yield case, self.check(case)
+
+
+def close(reference, candidate, tolerance):
+    """Values are equal within tolerance relative to max(1, |reference|)"""
+    if reference == candidate:
+        return True
+    # Undefined distances, such as saturated JC69, must be undefined in both
+    if reference != reference or candidate != candidate:
+        return reference != reference and candidate != candidate
+    return abs(reference - candidate) <= tolerance * max(1.0, abs(reference))
+
+
+def first_difference(reference, candidate):
+    """Index of the first differing item, or the length of the shortest"""
+    for index, (r, c) in enumerate(zip(reference, candidate)):
+        if r != c:
+            return index
+    return min(len(reference), len(candidate))
+
+
+def item(sequence, index):
+    """Item at index, None past the end"""
+    return sequence[index] if index < len(sequence) else None
@@ -0,0 +1,334 @@
+#-----------------------------------------------------------------------------
+# ABGDpy - Automatic Barcode Gap Discovery with ABGD
+# Copyright (C) 2021  Patmanidis Stefanos
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#-----------------------------------------------------------------------------
+
+
+"""
+Time each phase of the core on synthetic datasets of several sizes,
+for every distance method and input format:
+
+>>> s = Suite([100, 1000], target='bench')
+>>> for case in s.run():
+...     print(case['name'], case['best']['total']['wall'])
+>>> s.save('bench/HEAD.json')
+
+Each run is launched on a fresh process, so that peak memory is its own.
+Saved files are compared with compare(), or from the command line:
+
+    abgdpy bench run --sizes 100 1000 5000 --out HEAD.json
+    abgdpy bench compare BASE.json HEAD.json
+
+Results of another engine are checked against the core with:
+
+    abgdpy bench check --engine mypackage.fastabgd tests/test.fas
+
+and timed on the same cases, to be compared with a run of the core:
+
+    abgdpy bench run --engine abgdpy.vectorized --out vectorized.json
+"""
+
+from multiprocessing import Process, Pipe
+
+import argparse
+import json
+import os
+import pathlib
+import platform
+import subprocess
+import sys
+from datetime import datetime
+
+from .. import abgd
+from .. import batch
+from .. import core
+from .synthetic import Dataset
+from . import differential
+
+
+# Methods of the distance parameter, numbered as by the core (pick_distance)
+METHODS = {0: 'K80', 1: 'JC69', 3: 'simple'}
+FORMATS = ['fasta', 'phylip', 'mega']
+EXTENSIONS = {'fasta': 'fas', 'phylip': 'phy', 'mega': 'csv'}
+
+
+def revision():
+    """Current git commit of the package and whether the tree is dirty"""
+    here = pathlib.Path(__file__).parent
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=here,
+            capture_output=True, text=True, check=True).stdout.strip()
+        status = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'],
+            cwd=here, capture_output=True, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, bool(status.strip())
+
+
+class Suite():
+    """
+    Benchmark of the core over a grid of sizes, methods and formats.
+    Matrix formats are computed once with the default method,
+    their runs only differ from fasta by parsing and distances.
+    """
+
+    def __init__(self, sizes, target, methods=None, formats=None, repeat=3, engine=None, **dataset):
+        """
+        Datasets are written in target and reused if already there.
+        If given, engine is the module run instead of the core, see BarcodeAnalysis.engine.
+        Extra keywords are passed on to Dataset (species, within, seed...).
+        """
+        self.sizes = list(sizes)
+        self.target = pathlib.Path(target)
+        self.methods = list(methods) if methods is not None else list(METHODS)
+        self.formats = list(formats) if formats is not None else list(FORMATS)
+        self.repeat = repeat
+        self.engine = engine
+        self.dataset = dataset
+        self.cases = []
+
+    def prepare(self, size):
+        """Write the files of given size, return {format: (path, sha256)}"""
+        dataset = Dataset(size, **self.dataset)
+        stem = 'synthetic_{}_{}'.format(size, dataset.seed)
+        files = {}
+        fasta = self.target / '{}.fas'.format(stem)
+        files['fasta'] = (fasta, dataset.write_fasta(fasta))
+        for format in ['phylip', 'mega']:
+            if format in self.formats:
+                path = self.target / '{}.{}'.format(stem, EXTENSIONS[format])
+                files[format] = (path, dataset.write_matrix(path, fasta,
+                    mega=(format == 'mega')))
+        return dataset, files
+
+    def measure(self, path, method, mega):
+        """
+        Metrics of a single run of the core on a new process.
+        As with batch jobs, anything the core prints is dropped.
+        """
+        analysis = core.BarcodeAnalysis(str(path))
+        analysis.lazy = True
+        analysis.log_level = abgd.LOG_ERROR
+        analysis.param.distance.method = method
+        analysis.param.general.mega = mega
+        analysis.engine = self.engine
+        receiver, sender = Pipe(duplex=False)
+        p = Process(target=batch.worker, args=(analysis, sender))
+        p.start()
+        sender.close()
+        try:
+            output = receiver.recv()
+        except EOFError:
+            output = None
+        p.join()
+        if p.exitcode != 0 or output is None:
+            raise RuntimeError('ABGD internal error on {}'.format(path))
+        return output.metrics
+
+    def run(self):
+        """Run all cases, yield each as soon as it is done"""
+        self.target.mkdir(parents=True, exist_ok=True)
+        self.cases = []
+        for size in self.sizes:
+            dataset, files = self.prepare(size)
+            for format in self.formats:
+                path, digest = files[format]
+                # Distances are read as they are from matrices
+                methods = self.methods if format == 'fasta' else [None]
+                for method in methods:
+                    runs = [self.measure(path, method if method is not None else 1,
+                        format == 'mega') for i in range(self.repeat)]
+                    name = '{}-{}'.format(size, format)
+                    if method is not None:
+                        name += '-' + METHODS[method]
+                    case = {
+                        'name': name,
+                        'sequences': size,
+                        'format': format,
+                        'method': method,
+                        'engine': self.engine,
+                        'dataset': dict(dataset.parameters(), sha256=digest),
+                        'runs': runs,
+                        'best': best(runs),
+                        }
+                    self.cases.append(case)
+                    yield case
+
+    def save(self, path):
+        """Write all cases and the environment as json"""
+        commit, dirty = revision()
+        data = {
+            'version': 1,
+            'date': datetime.now().isoformat(timespec='seconds'),
+            'commit': commit,
+            'dirty': dirty,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'machine': platform.machine(),
+            'cpus': os.cpu_count(),
+            'repeat': self.repeat,
+            'engine': self.engine,
+            'cases': self.cases,
+            }
+        with open(path, 'w') as file:
+            json.dump(data, file, indent=1)
+
+
+def best(runs):
+    """Fastest wall and cpu time of each phase, and the highest peak memory"""
+    phases = {}
+    for name in runs[0]['phases']:
+        metrics = [run['phases'][name] for run in runs]
+        phases[name] = {
+            'wall': min(metric['wall'] for metric in metrics),
+            'cpu': min(metric['cpu'] for metric in metrics),
+            'calls': metrics[0]['calls'],
+            'peak_rss': max(metric['peak_rss'] for metric in metrics),
+            }
+    return phases
+
+
+def compare(base, head, phases=('total',)):
+    """
+    Rows of (case, phase, base wall, head wall, ratio) for cases and phases
+    found in both, given the dictionaries of two saved files.
+    """
+    cases = {case['name']: case for case in base['cases']}
+    rows = []
+    for case in head['cases']:
+        if case['name'] not in cases:
+            continue
+        for phase in phases:
+            old = cases[case['name']]['best'][phase]['wall']
+            new = case['best'][phase]['wall']
+            rows.append((case['name'], phase, old, new, new / old if old else None))
+    return rows
+
+
+def main(argv=None):
+    """Console entry point for: abgdpy bench"""
+    parser = argparse.ArgumentParser(prog='abgdpy bench',
+        description='Benchmark the ABGD core on synthetic datasets.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run = commands.add_parser('run', help='time all cases and save them as json')
+    run.add_argument('--sizes', '-n', type=int, nargs='+', default=[100, 1000],
+        help='number of sequences of each dataset, up to 20000 (default: 100 1000)')
+    run.add_argument('--methods', type=int, nargs='+', choices=list(METHODS), default=None,
+        help='distance methods for fasta input (default: all)')
+    run.add_argument('--formats', nargs='+', choices=FORMATS, default=None,
+        help='input formats (default: all); matrices grow as the square of the size')
+    run.add_argument('--repeat', '-r', type=int, default=3,
+        help='runs of each case, the fastest is kept (default: 3)')
+    run.add_argument('--species', type=int, default=None,
+        help='number of species (default: one for every 20 sequences)')
+    run.add_argument('--length', type=int, default=650)
+    run.add_argument('--within', type=float, default=0.01)
+    run.add_argument('--between', type=float, default=0.10)
+    run.add_argument('--gaps', type=float, default=0.0)
+    run.add_argument('--missing', type=float, default=0.0)
+    run.add_argument('--duplicates', type=float, default=0.0)
+    run.add_argument('--seed', type=int, default=0)
+    run.add_argument('--engine', default=None,
+        help='module to time instead of the core, such as abgdpy.vectorized')
+    run.add_argument('--data', default='abgd_bench',
+        help='directory for the generated datasets (default: abgd_bench)')
+    run.add_argument('--out', '-o', default=None,
+        help='json file for the results (default: DATA/COMMIT.json)')
+
+    diff = commands.add_parser('compare', help='compare two saved json files')
+    diff.add_argument('base')
+    diff.add_argument('head')
+    diff.add_argument('--phases', nargs='+', default=['total'],
+        help='phases to compare (default: total)')
+    diff.add_argument('--fail-above', type=float, default=None, metavar='RATIO',
+        help='exit with an error if any head/base ratio is above this')
+
+    check = commands.add_parser('check',
+        help='check that an engine gives the same results as the core')
+    check.add_argument('files', nargs='*',
+        help='real datasets to check along with the generated ones')
+    check.add_argument('--engine', default=differential.REFERENCE,
+        help='module with main() and distances() as abgdpy.abgd (default: the core itself)')
+    check.add_argument('--sizes', '-n', type=int, nargs='+', default=[30, 150],
+        help='number of sequences of generated datasets (default: 30 150)')
+    check.add_argument('--seeds', type=int, nargs='+', default=[0])
+    check.add_argument('--methods', type=int, nargs='+', choices=list(METHODS),
+        default=list(METHODS))
+    check.add_argument('--slopes', type=float, nargs='+', default=[0.5, 1.5])
+    check.add_argument('--steps', type=int, nargs='+', default=[10])
+    check.add_argument('--tolerance', type=float, default=1e-9,
+        help='relative tolerance of distances (default: 1e-9)')
+    check.add_argument('--gap-tolerance', type=float, default=0.0,
+        help='relative tolerance of barcode gaps (default: exact)')
+    check.add_argument('--keep-going', '-k', action='store_true',
+        help='check all cases instead of stopping at the first divergence')
+    check.add_argument('--data', default='abgd_check',
+        help='directory for the generated datasets (default: abgd_check)')
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'check':
+        harness = differential.Harness(args.engine,
+            tolerance=args.tolerance, gap_tolerance=args.gap_tolerance)
+        files = differential.generate(args.data, args.sizes, args.seeds)
+        harness.grid(files + args.files, method=args.methods,
+            slope=args.slopes, steps=args.steps)
+        checked = failed = 0
+        for case, divergence in harness.run():
+            checked += 1
+            if divergence is not None:
+                print('DIVERGES', divergence.describe())
+                failed += 1
+                if not args.keep_going:
+                    break
+        print('{} of {} cases checked, {} diverging'.format(
+            checked, len(harness.cases), failed))
+        return 1 if failed else 0
+
+    if args.command == 'compare':
+        with open(args.base) as file:
+            base = json.load(file)
+        with open(args.head) as file:
+            head = json.load(file)
+        failed = False
+        print('{:<24} {:<12} {:>12} {:>12} {:>8}'.format(
+            'case', 'phase', 'base (s)', 'head (s)', 'ratio'))
+        for name, phase, old, new, ratio in compare(base, head, args.phases):
+            print('{:<24} {:<12} {:>12.6f} {:>12.6f} {:>8}'.format(
+                name, phase, old, new, '-' if ratio is None else '{:.3f}'.format(ratio)))
+            if args.fail_above is not None and ratio is not None and ratio > args.fail_above:
+                failed = True
+        return 1 if failed else 0
+
+    suite = Suite(args.sizes, args.data, methods=args.methods,
+        formats=args.formats, repeat=args.repeat, species=args.species,
+        length=args.length, within=args.within, between=args.between,
+        gaps=args.gaps, missing=args.missing, duplicates=args.duplicates,
+        seed=args.seed, engine=args.engine)
+    for case in suite.run():
+        total = case['best']['total']
+        print('{:<24} {:>10.4f} s {:>8.1f} MB'.format(
+            case['name'], total['wall'], total['peak_rss'] / 2**20))
+        sys.stdout.flush()
+    out = args.out
+    if out is None:
+        commit, dirty = revision()
+        out = pathlib.Path(args.data) / '{}.json'.format(
+            (commit[:10] + ('-dirty' if dirty else '')) if commit else 'results')
+    suite.save(out)
+    print('Results written to:', out)
+    return 0
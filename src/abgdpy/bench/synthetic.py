@@ -0,0 +1,162 @@
+#-----------------------------------------------------------------------------
+# ABGDpy - Automatic Barcode Gap Discovery with ABGD
+# Copyright (C) 2021  Patmanidis Stefanos
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#-----------------------------------------------------------------------------
+
+
+"""
+Deterministic generator of aligned barcode sequences.
+Specimens are spread evenly over species, each species derives
+from a common ancestor and each specimen from its species:
+
+>>> d = Dataset(1000, species=50, within=0.01, between=0.12, seed=1)
+>>> d.write_fasta('1000.fas')
+>>> d.write_matrix('1000.txt', '1000.fas', method=1)
+
+The same parameters and seed always give the same files.
+"""
+
+import hashlib
+import random
+
+from .. import abgd
+
+
+BASES = 'acgt'
+
+
+class Dataset():
+    """
+    Parameters and sequences of a synthetic alignment.
+    Divergences are the mean fraction of differing sites:
+    within a species, and between the species ancestors.
+    """
+
+    def __init__(self, sequences, species=None, length=650,
+            within=0.01, between=0.10, gaps=0.0, missing=0.0,
+            duplicates=0.0, seed=0):
+        """
+        gaps: fraction of each sequence replaced by a run of gaps at one end,
+        missing: fraction of sites replaced by N,
+        duplicates: fraction of specimens identical to another of their species.
+        """
+        self.sequences = sequences
+        self.species = species if species is not None else max(1, sequences // 20)
+        self.length = length
+        self.within = within
+        self.between = between
+        self.gaps = gaps
+        self.missing = missing
+        self.duplicates = duplicates
+        self.seed = seed
+        self._records = None
+
+    def parameters(self):
+        """Dictionary of the generator parameters"""
+        return {
+            'sequences': self.sequences,
+            'species': self.species,
+            'length': self.length,
+            'within': self.within,
+            'between': self.between,
+            'gaps': self.gaps,
+            'missing': self.missing,
+            'duplicates': self.duplicates,
+            'seed': self.seed,
+            }
+
+    def _mutate(self, rng, sequence, rate):
+        """Substitute about rate * length random sites"""
+        sequence = list(sequence)
+        count = rng.randint(0, 2 * round(rate * self.length))
+        for site in rng.sample(range(self.length), count):
+            sequence[site] = rng.choice(BASES.replace(sequence[site], ''))
+        return sequence
+
+    def records(self):
+        """List of (name, sequence, species), generated once"""
+        if self._records is not None:
+            return self._records
+        rng = random.Random(self.seed)
+        ancestor = [rng.choice(BASES) for site in range(self.length)]
+        # Pairs of species differ by about twice their distance to the ancestor
+        roots = [self._mutate(rng, ancestor, self.between / 2)
+            for species in range(self.species)]
+        last = [None] * self.species
+        records = []
+        for specimen in range(self.sequences):
+            species = specimen % self.species
+            if last[species] is not None and rng.random() < self.duplicates:
+                sequence = last[species]
+            else:
+                sequence = self._mutate(rng, roots[species], self.within / 2)
+                for site in rng.sample(range(self.length), round(self.missing * self.length)):
+                    sequence[site] = 'n'
+                run = round(self.gaps * self.length)
+                if run:
+                    start = 0 if rng.random() < 0.5 else self.length - run
+                    sequence[start:start + run] = '-' * run
+                sequence = ''.join(sequence)
+            last[species] = sequence
+            name = 'sp{:04d}_{:06d}'.format(species + 1, specimen + 1)
+            records.append((name, sequence, species + 1))
+        self._records = records
+        return records
+
+    def truth(self):
+        """Species of each specimen (from 1), by name"""
+        return {name: species for name, sequence, species in self.records()}
+
+    def write_fasta(self, path):
+        """Write the alignment as fasta, return its sha256"""
+        with open(path, 'w') as file:
+            for name, sequence, species in self.records():
+                file.write('>{}\n{}\n'.format(name, sequence))
+        return checksum(path)
+
+    def write_matrix(self, path, fasta, method=1, rate=2.0, mega=False):
+        """
+        Write the distances of the core for given fasta file,
+        as Phylip or as MEGA CSV. Return the sha256 of the matrix.
+        """
+        n = self.sequences
+        matrix = bytearray(8 * n * n)
+        names = abgd.distances(str(fasta), lambda size: matrix,
+            method=method, rate=rate, loglevel=abgd.LOG_ERROR)
+        rows = memoryview(matrix).cast('d')
+        # MEGA values are read into 12 characters
+        with open(path, 'w') as file:
+            if mega:
+                for i, name in enumerate(names):
+                    file.write(name + ',')
+                    file.write(''.join('{:.8f},'.format(rows[i * n + j]) for j in range(i)))
+                    file.write('\n')
+            else:
+                file.write('{}\n'.format(n))
+                for i, name in enumerate(names):
+                    file.write(name + ' ')
+                    file.write(' '.join('{:.8f}'.format(rows[i * n + j]) for j in range(n)))
+                    file.write('\n')
+        return checksum(path)
+
+
+def checksum(path):
+    """Hex sha256 of a file"""
+    hash = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(2**20), b''):
+            hash.update(block)
+    return hash.hexdigest()
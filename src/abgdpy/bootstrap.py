@@ -0,0 +1,277 @@
+#-----------------------------------------------------------------------------
+# ABGDpy - Automatic Barcode Gap Discovery with ABGD
+# Copyright (C) 2021  Patmanidis Stefanos
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#-----------------------------------------------------------------------------
+
+
+
+"""
+Stability of the barcode gap under resampling of the pairwise distances.
+The sorted distances are resampled with replacement for each replicate,
+and the initial gap and groups found again at every prior step:
+
+>>> b = GapBootstrap('tests/test.fas', replicates=1000, jobs=8)
+>>> b.run()
+>>> b.output.summary()
+
+Replicates are split between processes, which all read the same matrix
+from a SharedDistances segment and the same sorted pairs from a SharedPairs
+segment. Each replicate has its own random stream derived from the seed,
+so results do not depend on the number of jobs.
+
+Besides the shared matrix (8*n*n bytes for n sequences) and sorted pairs
+(about 4*n*n bytes), each job keeps one resample of the pairs, so memory
+grows by about 4*n*n bytes per job.
+"""
+
+from multiprocessing import Process, Pipe, RawValue
+from multiprocessing.connection import wait
+
+import argparse
+import collections
+import csv
+import math
+import os
+import statistics
+import sys
+
+from . import abgd
+from . import param
+from . import params
+from .shared import SharedDistances, SharedPairs
+
+
+def worker(file, distances, pairs, kwargs, pipe):
+    """
+    Called by GapBootstrap on a new process for a range of replicates.
+    Progress is sent as ('progress', done), then ('done', data).
+    """
+    kwargs.update(distances.arguments())
+    kwargs.update(pairs.arguments())
+    kwargs['progress'] = lambda phase, done, total: pipe.send(('progress', done))
+    pipe.send(('done', abgd.bootstrap(file, **kwargs)))
+    pipe.close()
+
+
+def quantile(values, q):
+    """Linear interpolation between the closest ranks of sorted values"""
+    position = q * (len(values) - 1)
+    low = math.floor(position)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (position - low)
+
+
+class BootstrapResults():
+    """
+    Gap and number of groups (without recursion) of every replicate,
+    for each prior step. Gaps are None where no gap was found,
+    in which case the replicate counts a single group.
+    """
+
+    def __getstate__(self):
+        return self.__dict__
+
+    def __setstate__(self, state):
+        self.__dict__ = state
+
+    def __init__(self, chunks):
+        """Built from the dictionaries returned by abgd.bootstrap(), in order"""
+        first = chunks[0]
+        self.priors = first['priors']
+        self.seed = first['seed']
+        self.thresholds = [None if math.isnan(gap) else gap for gap in first['thresholds']]
+        self.groups_init = first['groups_init']
+        self.cancelled = any(chunk['cancelled'] for chunk in chunks)
+        rows = [row for chunk in chunks for row in chunk['gaps']]
+        self.replicates = len(rows)
+        self.gaps = [[None if math.isnan(row[step]) else row[step] for row in rows]
+            for step in range(len(self.priors))]
+        rows = [row for chunk in chunks for row in chunk['groups']]
+        self.groups = [[row[step] for row in rows]
+            for step in range(len(self.priors))]
+
+    def distribution(self, step):
+        """Number of replicates for each number of groups at step (from 1)"""
+        return collections.Counter(self.groups[step - 1])
+
+    def summary(self, level=0.95):
+        """
+        Rows of (step, prior, threshold, groups_init, found, mean, sd,
+        low, median, high, groups_low, groups_high) where found is the
+        share of replicates with a gap, and low/high bound the central
+        level interval of their gaps and number of groups.
+        """
+        rows = []
+        tail = (1 - level) / 2
+        for step, prior in enumerate(self.priors):
+            gaps = sorted(gap for gap in self.gaps[step] if gap is not None)
+            groups = sorted(self.groups[step])
+            found = len(gaps) / self.replicates if self.replicates else 0.0
+            if gaps:
+                mean = statistics.fmean(gaps)
+                sd = statistics.stdev(gaps) if len(gaps) > 1 else 0.0
+                low, median, high = (quantile(gaps, q) for q in (tail, 0.5, 1 - tail))
+            else:
+                mean = sd = low = median = high = None
+            if groups:
+                # Counts are not interpolated
+                groups_low, groups_high = (groups[round(q * (len(groups) - 1))]
+                    for q in (tail, 1 - tail))
+            else:
+                groups_low = groups_high = None
+            rows.append((step + 1, prior, self.thresholds[step], self.groups_init[step],
+                found, mean, sd, low, median, high, groups_low, groups_high))
+        return rows
+
+    def write(self, path, level=0.95):
+        """Write the summary as a tab separated file"""
+        with open(path, 'w', newline='') as file:
+            writer = csv.writer(file, delimiter='\t')
+            writer.writerow(['step', 'prior', 'threshold', 'groups_init', 'found',
+                'mean', 'sd', 'low', 'median', 'high', 'groups_low', 'groups_high'])
+            for row in self.summary(level):
+                writer.writerow(['' if value is None else value for value in row])
+
+
+class GapBootstrap():
+    """
+    Container for input/output of a bootstrap of the barcode gap.
+    Uses the prior and distance parameters of BarcodeAnalysis,
+    recursion and the general parameters are ignored (but for mega).
+    """
+
+    def __getstate__(self):
+        return self.__dict__
+
+    def __setstate__(self, state):
+        self.__dict__ = state
+
+    def __init__(self, file, replicates=100, jobs=None, seed=1):
+        self.file = file
+        self.replicates = replicates
+        self.jobs = jobs if jobs is not None else (os.cpu_count() or 1)
+        self.seed = seed
+        self.output = None
+        self.param = param.ParamList(params.params)
+        # If set to SharedDistances, its matrix is used instead of computing one
+        self.distances = None
+        # If set, called as progress('replicates', done, total)
+        self.progress = None
+        # If set to a buffer such as multiprocessing.RawValue('b'),
+        # all jobs stop at the next replicate once its first byte is non-zero
+        self.cancel = None
+
+    def arguments(self):
+        """Keyword arguments shared by all jobs"""
+        kwargs = self.param.prior.as_dictionary()
+        kwargs.update(self.param.distance.as_dictionary())
+        kwargs['mega'] = self.param.general.mega
+        kwargs['seed'] = self.seed
+        return kwargs
+
+    def run(self):
+        """Run all replicates, split in one contiguous range per job"""
+        distances = self.distances
+        if distances is None:
+            distances = SharedDistances(self.file,
+                method=self.param.distance.method,
+                rate=self.param.distance.rate,
+                mega=self.param.general.mega)
+        else:
+            distances.acquire()
+        try:
+            pairs = SharedPairs(distances, sample=self.param.distance.sample, seed=self.seed)
+        except BaseException:
+            distances.release()
+            raise
+        cancel = self.cancel if self.cancel is not None else RawValue('b', 0)
+
+        jobs = max(1, min(self.jobs, self.replicates))
+        ranges = [(self.replicates * k // jobs, self.replicates * (k + 1) // jobs)
+            for k in range(jobs)]
+        running = {}
+        try:
+            for first, last in ranges:
+                kwargs = self.arguments()
+                kwargs.update(first=first, replicates=last - first, cancel=cancel)
+                receiver, sender = Pipe(duplex=False)
+                p = Process(target=worker, args=(self.file, distances, pairs, kwargs, sender))
+                p.start()
+                sender.close()
+                running[receiver] = (first, p)
+
+            done = {first: 0 for first, _ in ranges}
+            chunks = {}
+            while running:
+                for receiver in wait(list(running)):
+                    first, p = running[receiver]
+                    try:
+                        message = receiver.recv()
+                    except EOFError:
+                        del running[receiver]
+                        receiver.close()
+                        p.join()
+                        if first not in chunks:
+                            cancel.value = 1
+                            raise RuntimeError('ABGD internal error, please check logs.')
+                        continue
+                    if message[0] == 'progress':
+                        done[first] = message[1]
+                        if self.progress is not None:
+                            self.progress('replicates', sum(done.values()), self.replicates)
+                    else:
+                        chunks[first] = message[1]
+        finally:
+            for receiver, (first, p) in running.items():
+                receiver.close()
+                p.join()
+            pairs.release()
+            distances.release()
+        self.output = BootstrapResults([chunks[first] for first, _ in ranges])
+
+
+def main(argv=None):
+    """Console entry point for: abgdpy bootstrap FILE"""
+    parser = argparse.ArgumentParser(prog='abgdpy bootstrap',
+        description='Assess the stability of the barcode gap by resampling distances.')
+    parser.add_argument('file', help='input fasta or distance matrix')
+    parser.add_argument('--replicates', '-B', type=int, default=100,
+        help='number of bootstrap replicates (default: 100)')
+    parser.add_argument('--jobs', '-j', type=int, default=None,
+        help='number of parallel processes (default: cpu count)')
+    parser.add_argument('--seed', type=int, default=1,
+        help='of the random streams, the same seed gives the same results (default: 1)')
+    parser.add_argument('--out', '-o', default=None,
+        help='write the summary to this tab separated file')
+    parser.add_argument('--level', type=float, default=0.95,
+        help='of the intervals (default: 0.95)')
+    args = parser.parse_args(argv)
+
+    b = GapBootstrap(args.file, args.replicates, args.jobs, args.seed)
+    b.run()
+    if args.out is not None:
+        b.output.write(args.out, args.level)
+        print('Summary written to:', args.out)
+        return 0
+    print('step\tprior\tgap\tfound\tgap interval\tgroups\tgroups interval')
+    for row in b.output.summary(args.level):
+        step, prior, threshold, groups, found, mean, sd, low, median, high, glow, ghigh = row
+        gap = '-' if threshold is None else '{:.6f}'.format(threshold)
+        interval = '-' if low is None else '{:.6f} - {:.6f}'.format(low, high)
+        print('{}\t{:.6f}\t{}\t{:.1%}\t{}\t{}\t{} - {}'.format(
+            step, prior, gap, found, interval, groups, glow, ghigh))
+    sys.stdout.flush()
+    return 0
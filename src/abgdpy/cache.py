@@ -0,0 +1,167 @@
+#-----------------------------------------------------------------------------
+# ABGDpy - Automatic Barcode Gap Discovery with ABGD
+# Copyright (C) 2021  Patmanidis Stefanos
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#-----------------------------------------------------------------------------
+
+
+"""
+Results of previous analyses, keyed on input content and parameters.
+A hit skips the core entirely, including the worker process of launch():
+
+>>> a = BarcodeAnalysis('tests/test.fas')
+>>> a.cache = ResultCache(max_size=2**30, max_age=7 * 86400)
+>>> launch(a)
+
+Entries are pickled Results in a directory shared by all processes.
+They are evicted once older than max_age seconds, then least recently
+used first while the directory is larger than max_size bytes.
+"""
+
+import hashlib
+import json
+import os
+import pathlib
+import pickle
+import tempfile
+import time
+
+from . import abgd
+
+
+# Bump when the stored Results change shape
+FORMAT = 1
+
+_core = None
+
+
+def core_digest():
+    """Hash of the compiled core, so that a rebuilt core misses old entries"""
+    global _core
+    if _core is None:
+        _core = file_digest(abgd.__file__)
+    return _core
+
+
+def file_digest(path):
+    """Hex sha256 of a file"""
+    hash = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(2**20), b''):
+            hash.update(block)
+    return hash.hexdigest()
+
+
+def default_directory():
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'abgdpy')
+
+
+class ResultCache():
+    """
+    On-disk cache of Results for BarcodeAnalysis.
+    The input bytes, all analysis parameters (output options all, simple
+    and spart included) and the engine make the key. Only the time,
+    useLogfile and time_format of the analysis are left out.
+    """
+
+    def __init__(self, directory=None, max_size=2**30, max_age=None):
+        self.directory = pathlib.Path(directory or default_directory())
+        self.max_size = max_size
+        self.max_age = max_age
+
+    def key(self, analysis):
+        """Hex digest for the input file and parameters of analysis"""
+        hash = hashlib.sha256()
+        hash.update('abgdpy {} {}\n'.format(FORMAT, core_digest()).encode())
+        hash.update(file_digest(analysis.file).encode())
+        hash.update(json.dumps(analysis.param.as_dictionary(), sort_keys=True).encode())
+        # Engines agree on partitions but not on every file, so never mix them
+        hash.update('engine {}\n'.format(getattr(analysis, 'engine', None) or 'abgd').encode())
+        return hash.hexdigest()
+
+    def path(self, key):
+        return self.directory / (key + '.pickle')
+
+    def expired(self, stat, now):
+        return self.max_age is not None and now - stat.st_mtime > self.max_age
+
+    def get(self, analysis):
+        """Cached Results for analysis, None if missing or expired"""
+        try:
+            path = self.path(self.key(analysis))
+            stat = path.stat()
+            if self.expired(stat, time.time()):
+                path.unlink()
+                return None
+            with open(path, 'rb') as file:
+                output = pickle.load(file)
+            # Access time orders eviction, modification time is the age
+            os.utime(path, (time.time(), stat.st_mtime))
+        except FileNotFoundError:
+            return None
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError):
+            # Unreadable or from an older version, compute again
+            path.unlink(missing_ok=True)
+            return None
+        return output
+
+    def put(self, analysis, output):
+        """Store the Results of analysis, then evict as needed"""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self.path(self.key(analysis))
+        # Write then rename, so that readers never see a partial entry
+        descriptor, temporary = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(descriptor, 'wb') as file:
+            pickle.dump(output, file)
+        os.replace(temporary, path)
+        self.evict()
+
+    def entries(self):
+        """List of (path, stat) for all entries"""
+        entries = []
+        for path in self.directory.glob('*.pickle'):
+            try:
+                entries.append((path, path.stat()))
+            except FileNotFoundError:
+                pass
+        return entries
+
+    def evict(self):
+        """Remove expired entries, then the least recently used beyond max_size"""
+        now = time.time()
+        entries = []
+        for path, stat in self.entries():
+            if self.expired(stat, now):
+                path.unlink(missing_ok=True)
+            else:
+                entries.append((path, stat))
+        if self.max_size is None:
+            return
+        total = sum(stat.st_size for path, stat in entries)
+        for path, stat in sorted(entries, key=lambda entry: entry[1].st_atime):
+            if total <= self.max_size:
+                break
+            path.unlink(missing_ok=True)
+            total -= stat.st_size
+
+    def clear(self):
+        """Remove all entries"""
+        for path, stat in self.entries():
+            path.unlink(missing_ok=True)
+
+    def size(self):
+        """Total size of entries in bytes"""
+        return sum(stat.st_size for path, stat in self.entries())
@@ -17,15 +17,22 @@
 #-----------------------------------------------------------------------------
 
 
-from multiprocessing import Process
+from multiprocessing import Process, Pipe, RawValue
 
+import asyncio
+import importlib
+import os
 import tempfile
 import shutil
+import pathlib
 from datetime import datetime
 
 from . import abgd
 from . import param
 from . import params
+from . import tiles
+from . import trace
+from .results import Results
 
 class BarcodeAnalysis():
     """
@@ -43,39 +50,157 @@ class BarcodeAnalysis():
         """
         self.file = file
         self.useLogfile = False
+        # If set, output files are only written when rendered
+        self.lazy = False
         self.target = None
         self.results = None
+        self.output = None
+        # Per-phase time and memory of the last run, see Results.metrics
+        self.metrics = None
         # self.time_format = '%x - %I:%M%p'
         self.time_format = '%FT%T'
         self.param = param.ParamList(params.params)
+        # If set to SharedDistances, its matrix is used instead of computing one
+        self.distances = None
+        # If set, called by the core as progress(phase, done, total)
+        self.progress = None
+        # If set, called by the core as step(event) once each step is done, see abgd.main()
+        self.step = None
+        # If set to a buffer such as multiprocessing.RawValue('b'),
+        # the core stops at the next step once its first byte is non-zero
+        self.cancel = None
+        # If set, called by the core as log(level, text) instead of printing
+        self.log = None
+        # Core messages above this level are dropped
+        self.log_level = abgd.LOG_INFO
+        # If set to a path, the timeline of the run is written there, see trace.py
+        self.trace = None
+        # If set to a ResultCache, identical analyses are not run again
+        self.cache = None
+        # If set to a module name such as 'abgdpy.vectorized', its main() is used instead of the core
+        self.engine = None
+        # If set and the engine allows it, small files are run on the calling process,
+        # sparing a new one: only worth it when the engine is faster than the core
+        self.inline = False
 
     def fetch(self, destination):
         """
         Copy results as a new directory.
+        Files not rendered yet are written there too.
         """
         if self.results is None:
             raise RuntimeError('No results to fetch.')
         shutil.copytree(self.results, destination)
+        if self.output is not None:
+            for name in self.output.artifacts():
+                if not (pathlib.Path(destination) / name).exists():
+                    self.output.render(name, destination)
+
+    def artifacts(self):
+        """
+        Names of all output files, rendered or not.
+        """
+        if self.output is None:
+            raise RuntimeError('No results available.')
+        return self.output.artifacts()
+
+    def render(self, name, destination=None):
+        """
+        Write the output file with given name, return its path.
+        Defaults to the results directory.
+        """
+        if self.output is None:
+            raise RuntimeError('No results available.')
+        if destination is None:
+            destination = self.results
+        if destination is None:
+            raise RuntimeError('No destination given.')
+        return self.output.render(name, destination)
+
+    def cached(self):
+        """
+        Load results from the cache if there, return True on a hit.
+        Output files are rendered unless lazy.
+        """
+        output = self.cache.get(self)
+        if output is None:
+            return False
+        output.date = datetime.now().strftime(self.time_format)
+        if not self.lazy and self.target is not None:
+            output.render_all(self.target)
+        self.output = output
+        self.metrics = output.metrics
+        self.results = self.target
+        return True
 
     def run(self):
         """
         Run the ABGD core with given params,
         save results to a temporary directory.
         """
+        if self.cache is not None and self.cached():
+            return
         kwargs = self.param.as_dictionary()
         kwargs['logfile'] = self.useLogfile
         kwargs['time'] = datetime.now().strftime(self.time_format)
+        kwargs['files'] = not self.lazy
         if self.target is not None:
             kwargs['out'] = self.target
-        abgd.main(self.file, **kwargs)
+        if self.distances is not None:
+            kwargs.update(self.distances.arguments())
+        elif tiles.is_matrix(self.file):
+            kwargs.update(tiles.load_matrix(self.file))
+        if self.progress is not None:
+            kwargs['progress'] = self.progress
+        if self.cancel is not None:
+            kwargs['cancel'] = self.cancel
+        if self.step is not None:
+            kwargs['step'] = self.step
+        if self.log is not None:
+            kwargs['log'] = self.log
+        kwargs['loglevel'] = self.log_level
+        if self.trace is not None:
+            kwargs['trace'] = True
+        data = engine(self).main(self.file, **kwargs)
+        if self.trace is not None:
+            trace.write(data.pop('trace'), self.trace)
+        self.output = Results(data)
+        self.metrics = self.output.metrics
         self.results = self.target
+        if self.cache is not None and not self.output.cancelled:
+            self.cache.put(self, self.output)
+
+    async def run_async(self, progress=None, grace=5.0):
+        """
+        Coroutine equivalent of launch(self), see launch_async().
+        """
+        return await launch_async(self, progress, grace)
 
 
-def worker(analysis):
+def engine(analysis):
+    """Module running the analysis, the core unless another engine is set"""
+    name = getattr(analysis, 'engine', None)
+    if name is None:
+        return abgd
+    return importlib.import_module(name)
+
+def inline(analysis):
+    """
+    True if analysis asks to run in this process and its engine may do so,
+    as it is re-entrant and the file is small enough.
+    """
+    if not getattr(analysis, 'inline', False):
+        return False
+    module = engine(analysis)
+    return hasattr(module, 'inline') and module.inline(analysis.file)
+
+def worker(analysis, pipe):
     """
     Called by launch() on a new process
     """
     analysis.run()
+    pipe.send(analysis.output)
+    pipe.close()
     # print('Analysis complete:', analysis.results)
 
 def launch(analysis):
@@ -88,10 +213,181 @@ def launch(analysis):
     # the directory is automatically cleaned up, so keep it here.
     analysis._temp = tempfile.TemporaryDirectory(prefix='abgd_')
     analysis.target = analysis._temp.name
-    p = Process(target=worker, args=(analysis,))
+    # A hit needs no process at all
+    if getattr(analysis, 'cache', None) is not None and analysis.cached():
+        return
+    # Neither is a process needed by an engine that can run inline
+    if inline(analysis):
+        analysis.run()
+        return
+    distances = getattr(analysis, 'distances', None)
+    if distances is not None:
+        distances.acquire()
+    receiver, sender = Pipe(duplex=False)
+    p = Process(target=worker, args=(analysis, sender))
     p.start()
+    # Only the child holds the sending end now, so a crash means EOF
+    sender.close()
+    try:
+        output = receiver.recv()
+    except EOFError:
+        output = None
     p.join()
+    if distances is not None:
+        distances.release()
     if p.exitcode != 0:
         raise RuntimeError('ABGD internal error, please check logs.')
     # Success, update analysis object for parent process
     analysis.results = analysis.target
+    analysis.output = output
+    analysis.metrics = getattr(output, 'metrics', None)
+
+def worker_async(analysis, pipe, cancel):
+    """
+    Called by launch_async() on a new process.
+    Progress is sent along the results as ('progress', phase, done, total),
+    exceptions raised by the core are sent back to be raised again.
+    """
+    analysis.cancel = cancel
+    analysis.progress = lambda *args: pipe.send(('progress',) + args)
+    try:
+        analysis.run()
+    except Exception as exception:
+        pipe.send(('error', exception))
+    else:
+        pipe.send(('done', analysis.output))
+    pipe.close()
+
+async def receive(connection):
+    """Wait for the next message of connection without blocking the event loop"""
+    loop = asyncio.get_running_loop()
+    if os.name == 'posix':
+        ready = loop.create_future()
+        loop.add_reader(connection.fileno(),
+            lambda: ready.done() or ready.set_result(None))
+        try:
+            await ready
+        finally:
+            loop.remove_reader(connection.fileno())
+    else:
+        while not connection.poll():
+            await asyncio.sleep(0.05)
+    return connection.recv()
+
+async def launch_async(analysis, progress=None, grace=5.0):
+    """
+    Same as launch(), but awaits the process instead of blocking.
+    If given, progress(phase, done, total) is called from the event loop.
+    When the task is cancelled, the core is asked to stop and the process
+    is terminated if still running after grace seconds.
+    The core is not re-entrant, so it always runs on its own process.
+    Engines that can run inline do so on a thread instead.
+    """
+    analysis._temp = tempfile.TemporaryDirectory(prefix='abgd_')
+    analysis.target = analysis._temp.name
+    if getattr(analysis, 'cache', None) is not None and analysis.cached():
+        return analysis.output
+    if inline(analysis):
+        return await launch_thread(analysis, progress)
+    distances = getattr(analysis, 'distances', None)
+    if distances is not None:
+        distances.acquire()
+    cancel = RawValue('b', 0)
+    receiver, sender = Pipe(duplex=False)
+    p = Process(target=worker_async, args=(analysis, sender, cancel))
+    p.start()
+    sender.close()
+    output = None
+    error = None
+    try:
+        while True:
+            try:
+                message = await receive(receiver)
+            except EOFError:
+                break
+            if message[0] == 'progress':
+                if progress is not None:
+                    progress(*message[1:])
+            elif message[0] == 'error':
+                error = message[1]
+            else:
+                output = message[1]
+        while p.is_alive():
+            await asyncio.sleep(0.01)
+    except asyncio.CancelledError:
+        cancel.value = 1
+        waited = 0.0
+        while p.is_alive() and waited < grace:
+            await asyncio.sleep(0.05)
+            waited += 0.05
+        if p.is_alive():
+            p.terminate()
+        raise
+    finally:
+        receiver.close()
+        p.join()
+        if distances is not None:
+            distances.release()
+    if error is not None:
+        raise error
+    if p.exitcode != 0:
+        raise RuntimeError('ABGD internal error, please check logs.')
+    analysis.results = analysis.target
+    analysis.output = output
+    analysis.metrics = getattr(output, 'metrics', None)
+    return output
+
+async def launch_thread(analysis, progress=None):
+    """
+    Called by launch_async() for engines that run inline.
+    The thread is asked to stop once the task is cancelled, then awaited.
+    """
+    loop = asyncio.get_running_loop()
+    saved = analysis.cancel, analysis.progress
+    analysis.cancel = bytearray(1)
+    if progress is not None:
+        analysis.progress = lambda *args: loop.call_soon_threadsafe(progress, *args)
+    future = loop.run_in_executor(None, analysis.run)
+    try:
+        await asyncio.shield(future)
+    except asyncio.CancelledError:
+        analysis.cancel[0] = 1
+        await asyncio.wait([future])
+        raise
+    finally:
+        analysis.cancel, analysis.progress = saved
+    return analysis.output
+
+async def launch_all(analyses, limit=None, grace=5.0):
+    """
+    Launch many analyses concurrently, at most limit at once (default: cpu count).
+    Async generator of events as they happen, tuples of either:
+    (analysis, 'progress', (phase, done, total)), (analysis, 'done', output)
+    or (analysis, 'failed', exception). Analyses still running are cancelled
+    if the generator is closed or cancelled early.
+    """
+    semaphore = asyncio.Semaphore(limit or os.cpu_count() or 1)
+    queue = asyncio.Queue()
+
+    async def one(analysis):
+        async with semaphore:
+            try:
+                output = await launch_async(analysis, lambda *args:
+                    queue.put_nowait((analysis, 'progress', args)), grace)
+            except Exception as exception:
+                queue.put_nowait((analysis, 'failed', exception))
+            else:
+                queue.put_nowait((analysis, 'done', output))
+
+    tasks = [asyncio.ensure_future(one(analysis)) for analysis in analyses]
+    remaining = len(tasks)
+    try:
+        while remaining:
+            event = await queue.get()
+            if event[1] != 'progress':
+                remaining -= 1
+            yield event
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -55,6 +55,18 @@ params = {
         "doc":      "Proxy for the minimum relative gap width; the minimum slope increase.",
         "type":     "float",
         "default":  1.5
+      },
+      "adaptive": {
+        "label":    "Adaptive",
+        "doc":      "Refine the priors where the partition changes, keep distinct partitions only.",
+        "type":     "bool",
+        "default":  False
+      },
+      "tolerance": {
+        "label":    "Tolerance",
+        "doc":      "Relative width of the prior intervals at which adaptive refinement stops.",
+        "type":     "float",
+        "default":  0.05
       }
     }
   },
@@ -76,6 +88,12 @@ params = {
         "doc":      "Transition/transversion for Kimura 3-P distance.",
         "type":     "float",
         "default":  2.0
+      },
+      "sample": {
+        "label":    "Sampled pairs",
+        "doc":      "If not 0, find gaps in a random sample of this many pairs (approximate, for very large datasets).",
+        "type":     "int",
+        "default":  0
       }
     }
   }
@@ -65,33 +65,50 @@ class ResultItem(QtWidgets.QListWidgetItem):
 class ResultView(QtWidgets.QListWidget):
     """
     Show each result file with icon and label.
-    Remember file type and path
+    Remember file type and path.
+    Files of the given results may not exist yet:
+    they are rendered when first needed.
     """
-    def open(self, folder):
+    Order = ['.svg', '.spart', '.txt', '.tree']
+
+    @classmethod
+    def key(cls, name):
+        """Files are listed by type, then by name"""
+        suffix = pathlib.Path(name).suffix
+        return (cls.Order.index(suffix) if suffix in cls.Order else len(cls.Order), name)
+
+    def open(self, folder, output=None):
         """Refresh contents"""
         self.clear()
         path = pathlib.Path(folder)
+        names = set(file.name for file in path.iterdir())
+        if output is not None:
+            names.update(output.artifacts())
 
-        # graph files
-        for file in sorted(list(path.glob('*.svg'))):
-            ResultItem(str(path / file), self)
-
-        # spart files
-        for file in sorted(list(path.glob('*.spart'))):
-            ResultItem(str(path / file), self)
-
-        # partition files
-        for file in sorted(list(path.glob('*.txt'))):
-            ResultItem(str(path / file), self)
-
-        # tree files
-        for file in sorted(list(path.glob('*.tree'))):
-            ResultItem(str(path / file), self)
+        # graph, spart, partition and tree files
+        for suffix in self.Order:
+            for name in sorted(name for name in names if pathlib.Path(name).suffix == suffix):
+                ResultItem(str(path / name), self)
 
         # log files
         for file in list(path.glob('*.log')):
             ResultItem(str(path / file), self)
 
+    def add(self, file):
+        """Insert a file written while running, in the same order as open()"""
+        name = pathlib.Path(file).name
+        row = self.count()
+        for index in range(self.count()):
+            other = pathlib.Path(self.item(index).file).name
+            if other == name:
+                return self.item(index)
+            if self.key(other) > self.key(name):
+                row = index
+                break
+        item = ResultItem(str(file))
+        self.insertItem(row, item)
+        return item
+
 class Main(widgets.ToolDialog):
     """Main window, handles everything"""
 
@@ -105,8 +122,12 @@ class Main(widgets.ToolDialog):
 
         self.title = 'ABGDpy'
         self.analysis = core.BarcodeAnalysis(None)
+        # Files of each step are written as soon as it is done,
+        # so that they may be previewed while the next ones are computed
+        self.analysis.lazy = False
         self._temp = None
         self.temp = None
+        self.previewed = None
 
         self.setWindowTitle(self.title)
         self.setWindowIcon(QtGui.QIcon(':/resources/abgd-icon-transparent.ico'))
@@ -324,10 +345,9 @@ class Main(widgets.ToolDialog):
         self.pane['list'].body.setContentsMargins(1, 1, 1, 1)
         # self.pane['list'].body.addStretch(1)
 
-        self.preview = QtWidgets.QTextEdit()
+        self.preview = widgets.TextPreview()
         self.preview.setFont(
             QtGui.QFontDatabase.systemFont(QtGui.QFontDatabase.FixedFont))
-        self.preview.setReadOnly(True)
 
         self.graphSvg = QtSvg.QSvgWidget()
 
@@ -472,8 +492,8 @@ class Main(widgets.ToolDialog):
         state.assignProperty(self.action['save'], 'enabled', False)
         state.assignProperty(self.paramWidget.container, 'enabled', False)
         state.assignProperty(self.pane['param'], 'enabled', False)
-        state.assignProperty(self.pane['list'], 'enabled', False)
-        state.assignProperty(self.pane['preview'], 'enabled', False)
+        state.assignProperty(self.pane['list'], 'enabled', True)
+        state.assignProperty(self.pane['preview'], 'enabled', True)
 
         state = self.state['idle_updated']
         def onEntry(event):
@@ -504,10 +524,8 @@ class Main(widgets.ToolDialog):
             self.setWindowTitle(self.title + ' - ' + fileName)
             self.line.file.setText(file)
             self.analysis.file = absolute
-            self.folder.clear()
-            self.pane['preview'].title = 'Preview'
-            self.stack.setCurrentWidget(self.preview)
-            self.preview.clear()
+            self.clearResults()
+            self.temp = None
         transition.onTransition = onTransition
         transition.setTargetState(self.state['idle_open'])
         self.state['idle'].addTransition(transition)
@@ -518,7 +536,7 @@ class Main(widgets.ToolDialog):
 
         transition = utility.NamedTransition('DONE')
         def onTransition(event):
-            self.folder.open(self.temp.name + '/')
+            self.folder.open(self.temp.name + '/', self.analysis.output)
             self.folder.setCurrentItem(self.folder.item(0))
             self.handlePreview(self.folder.item(0))
             msgBox = QtWidgets.QMessageBox(self)
@@ -547,6 +565,12 @@ class Main(widgets.ToolDialog):
         self.state['running'].addTransition(transition)
 
         transition = utility.NamedTransition('CANCEL')
+        def onTransition(event):
+            # Files of the cancelled run are dropped, show the last results again
+            self.clearResults()
+            if self.temp is not None:
+                self.folder.open(self.temp.name + '/', self.analysis.output)
+        transition.onTransition = onTransition
         transition.setTargetState(self.state['idle_last'])
         self.state['running'].addTransition(transition)
 
@@ -579,7 +603,9 @@ class Main(widgets.ToolDialog):
 
         def fromFilter(filter):
             def _fromFilter():
-                return list(pathlib.Path(self.temp.name).glob(filter))
+                files = [pathlib.Path(self.folder.item(row).file)
+                    for row in range(self.folder.count())]
+                return [file for file in files if file.match(filter)]
             return _fromFilter
 
         nameFiltersWithSelectors = {
@@ -644,15 +670,20 @@ class Main(widgets.ToolDialog):
             if confirm == QtWidgets.QMessageBox.No:
                 return
 
-        # Finally copy the files
+        # Finally copy the files, rendering those not written yet
         for file in filesMap.keys():
             print(file, '->', filesMap[file])
+            if not file.exists():
+                self.analysis.render(file.name, str(file.parent))
             shutil.copyfile(file, filesMap[file])
 
     def handleRun(self):
         """Called by toolbar action: run"""
         try:
             self.paramWidget.applyParams()
+            # Release previewed files before their folder is replaced,
+            # files of the new run are added as each step is done
+            self.clearResults()
             self._temp = tempfile.TemporaryDirectory(prefix='abgd_')
             self.analysis.target = pathlib.Path(self._temp.name).as_posix()
         except Exception as exception:
@@ -661,15 +692,23 @@ class Main(widgets.ToolDialog):
 
         def done(result):
             self.temp = self._temp
-            self.analysis.results = result
+            (self.analysis.results, self.analysis.output) = result
             self.machine.postEvent(utility.NamedEvent('DONE', True))
 
         def fail(exception):
             self.machine.postEvent(utility.NamedEvent('FAIL', exception))
 
+        def progress(data):
+            if data[0] == 'step':
+                self.handleStep(data[1])
+                return
+            (phase, done, total) = data
+            self.pane['list'].footer = 'Computing {}: {}%'.format(phase, 100 * done // total)
+
         self.launcher = utility.UProcess(self.workRun)
         self.launcher.done.connect(done)
         self.launcher.fail.connect(fail)
+        self.launcher.progress.connect(progress)
         # self.launcher.setLogger(logging.getLogger())
         self.launcher.start()
         self.machine.postEvent(utility.NamedEvent('RUN'))
@@ -677,9 +716,12 @@ class Main(widgets.ToolDialog):
     def workRun(self):
         """Runs on the UProcess, defined here for pickability"""
         self.analysis.useLogfile = True
+        self.analysis.progress = self.launcher.report
+        self.analysis.step = lambda event: self.launcher.report('step', event)
+        self.analysis.cancel = self.launcher.cancelToken
         self.analysis.run()
         # time.sleep(3)
-        return self.analysis.results
+        return (self.analysis.results, self.analysis.output)
 
     def handleStop(self):
         """Called by cancel button"""
@@ -694,10 +736,33 @@ class Main(widgets.ToolDialog):
             self.launcher.quit()
             self.machine.postEvent(utility.NamedEvent('CANCEL'))
 
+    def handleStep(self, event):
+        """
+        Called while running once each step is done, list its files.
+        The summary graph is refreshed if shown, or shown if nothing is.
+        """
+        for file in event['files']:
+            item = self.folder.add(file)
+            if pathlib.Path(file).name == 'abgd.svg':
+                if self.previewed is None or self.previewed.name == 'abgd.svg':
+                    self.handlePreview(item)
+
+    def clearResults(self):
+        """Empty file list and preview"""
+        self.folder.clear()
+        self.preview.clear()
+        self.previewed = None
+        self.pane['preview'].title = 'Preview'
+        self.pane['preview'].footer = 'Nothing to show'
+        self.stack.setCurrentWidget(self.preview)
+
     def handlePreview(self, item):
         """Called by file double-click"""
         try:
             path = pathlib.Path(item.file)
+            if not path.exists():
+                self.analysis.render(path.name, str(path.parent))
+            self.previewed = path
             self.pane['preview'].footer = path.name
             self.pane['preview'].title = 'Preview - ' + path.name
             if path.suffix == '.svg':
@@ -706,18 +771,7 @@ class Main(widgets.ToolDialog):
                 self.graphSvg.renderer().setAspectRatioMode(QtCore.Qt.KeepAspectRatio)
             else:
                 self.stack.setCurrentWidget(self.preview)
-                self.preview.clear()
-                with open(item.file) as input:
-                    for line in input:
-                        self.preview.insertPlainText(line)
-                format = QtGui.QTextBlockFormat()
-                # format.setLineHeight(200, QtGui.QTextBlockFormat.ProportionalHeight)
-                # format.setNonBreakableLines(True)
-                format.setTopMargin(10)
-                cursor = self.preview.textCursor()
-                cursor.select(QtGui.QTextCursor.Document);
-                cursor.mergeBlockFormat(format);
-                self.preview.moveCursor(QtGui.QTextCursor.Start)
+                self.preview.open(item.file)
         except Exception as exception:
             self.fail(exception)
             return
@@ -28,6 +28,7 @@ import sys, os, io
 import multiprocessing
 import ctypes
 import threading
+import time
 
 ##############################################################################
 ### Logging
@@ -50,10 +51,14 @@ class StdioLogger():
         sys.stdout.write = self.out
 
 class PipeIO(io.IOBase):
-    """File-like object that writes to a pipe connection"""
+    """
+    File-like object that writes to a pipe connection.
+    Complete lines are sent in batches: once size characters are waiting,
+    or every interval seconds from a daemon thread, instead of one by one.
+    """
     #? There are possibly better waiys to do this
     #? Todo- implement read
-    def __init__(self, connection, mode):
+    def __init__(self, connection, mode, interval=0.05, size=65536):
         super().__init__()
         self._pid = os.getpid()
         self._cache = ''
@@ -62,6 +67,10 @@ class PipeIO(io.IOBase):
         if not (mode == 'r' or mode == 'w'):
             raise ValueError("Invalid mode: '{}'".format(str(mode)))
         self.mode = mode
+        self.interval = interval
+        self.size = size
+        self.lock = threading.Lock()
+        self.flusher = None
 
     @property
     def cache(self):
@@ -78,8 +87,9 @@ class PipeIO(io.IOBase):
 
     def close(self):
         self.flush()
-        self.connection.close()
-        self.closed = True
+        with self.lock:
+            self.connection.close()
+        super().close()
 
     def fileno(self):
         return self.connection.fileno()
@@ -114,33 +124,78 @@ class PipeIO(io.IOBase):
     def write(self, text):
         if not self.writable():
             raise io.UnsupportedOperation('not writable')
-        temp = str(self.buffer) + str(text)
-        self.buffer = ''
-        for line in temp.splitlines(True):
-            if line[-1] == '\n':
-                self.connection.send(line)
-            else:
-                self.buffer += line
+        with self.lock:
+            self.buffer += str(text)
+            if len(self.buffer) >= self.size:
+                self._send(lines=False)
+        if self.flusher is None and self.interval > 0:
+            self.flusher = threading.Thread(target=self._flushEvery, daemon=True)
+            self.flusher.start()
 
     def writelines(self, lines):
-        for line in lines:
-            self.connection.send(line+'\n')
+        self.write(''.join(line + '\n' for line in lines))
+
+    def _send(self, lines=True):
+        """Send what is buffered, up to the last line break if lines"""
+        end = self.buffer.rfind('\n') + 1 if lines else len(self.buffer)
+        if end > 0:
+            self.connection.send(self.buffer[:end])
+            self.buffer = self.buffer[end:]
+
+    def _flushEvery(self):
+        """Runs on the flusher thread until closed"""
+        while not self.closed:
+            time.sleep(self.interval)
+            with self.lock:
+                if self.buffer and not self.connection.closed:
+                    self._send()
 
     def flush(self):
-        if self.buffer != '':
-            self.connection.send(self.buffer)
-        self.buffer = ''
+        with self.lock:
+            if not self.connection.closed:
+                self._send(lines=False)
 
 class TextEditLogger(QtWidgets.QPlainTextEdit):
-    """Thread-safe log display in a QPlainTextEdit"""
+    """
+    Thread-safe log display in a QPlainTextEdit.
+    Text from any thread is queued, then appended all at once
+    at most rate times per second. Only the last scrollback lines are kept.
+    """
     appendRecord = QtCore.pyqtSignal(object)
+    _pending = QtCore.pyqtSignal()
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, rate=30, scrollback=10000, **kwargs):
         super().__init__(*args, **kwargs)
         self.setReadOnly(True)
+        self.setMaximumBlockCount(scrollback)
+        self.scrollback = scrollback
+        self.queue = []
+        self.lock = threading.Lock()
+        self.timer = QtCore.QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(1000 // rate)
+        self.timer.timeout.connect(self.appendQueued)
+        self._pending.connect(self.timer.start)
         self.handler = logging.Handler()
         self.handler.emit = self.emit
-        self.appendRecord.connect(self.appendTextInline)
+        self.appendRecord.connect(self.appendText)
+
+    def appendText(self, text):
+        """Queue text, the first one since the last frame starts the timer"""
+        with self.lock:
+            first = not self.queue
+            self.queue.append(text)
+        if first:
+            self._pending.emit()
+
+    def appendQueued(self):
+        """Called by the timer on the GUI thread"""
+        with self.lock:
+            text = ''.join(self.queue)
+            self.queue = []
+        if text.count('\n') > self.scrollback:
+            text = ''.join(text.splitlines(True)[-self.scrollback:])
+        self.appendTextInline(text)
 
     def appendTextInline(self, text):
         self.moveCursor(QtGui.QTextCursor.End);
@@ -148,8 +203,7 @@ class TextEditLogger(QtWidgets.QPlainTextEdit):
         self.moveCursor(QtGui.QTextCursor.End);
 
     def emit(self, record):
-        text = self.handler.format(record)
-        self.appendRecord.emit(text)
+        self.appendText(self.handler.format(record))
 
 ##############################################################################
 ### Multiprocessing
@@ -235,6 +289,7 @@ class UProcess(QtCore.QThread):
     """
     done = QtCore.pyqtSignal(object)
     fail = QtCore.pyqtSignal(object)
+    progress = QtCore.pyqtSignal(object)
 
     def __getstate__(self):
         """Required for process spawning."""
@@ -266,6 +321,9 @@ class UProcess(QtCore.QThread):
         self.pipeOut = multiprocessing.Pipe(duplex=False)
         self.pipeErr = multiprocessing.Pipe(duplex=False)
         self.pipeIn = multiprocessing.Pipe(duplex=False)
+        self.pipeProgress = multiprocessing.Pipe(duplex=False)
+        # Set by quit(), the function may poll it to stop on its own
+        self.cancelToken = multiprocessing.RawValue(ctypes.c_byte, 0)
         self.process = multiprocessing.Process(
             target=self.target, daemon=True,
             args=(function,)+args, kwargs=kwargs)
@@ -295,6 +353,8 @@ class UProcess(QtCore.QThread):
         Alerts parent process via pipe.
         """
         self.pipeIn[1].close()
+        self.pipeProgress[0].close()
+        self.pipeProgress = self.pipeProgress[1]
         self.pipeControl = self.pipeControl[1]
         self.pipeData = self.pipeData[1]
         self.pipeOut = self.pipeOut[1]
@@ -315,9 +375,13 @@ class UProcess(QtCore.QThread):
 
         try:
             result = function(*args, **kwargs)
+            out.flush()
+            err.flush()
             self.pipeControl.send('RESULT')
             self.pipeData.send(result)
         except Exception as exception:
+            out.flush()
+            err.flush()
             self.pipeControl.send('EXCEPTION')
             self.pipeData.send(exception)
 
@@ -328,6 +392,8 @@ class UProcess(QtCore.QThread):
         Starts and watches the process.
         """
         self.process.start()
+        self.pipeProgress[1].close()
+        self.pipeProgress = self.pipeProgress[0]
         self.pipeData[1].close()
         self.pipeOut[1].close()
         self.pipeErr[1].close()
@@ -341,6 +407,7 @@ class UProcess(QtCore.QThread):
             self.pipeControl: self.handleControl,
             self.pipeOut: self.handleOut,
             self.pipeErr: self.handleErr,
+            self.pipeProgress: self.progress.emit,
             }
         while waitList:
             for pipe in multiprocessing.connection.wait(waitList.keys()):
@@ -361,8 +428,11 @@ class UProcess(QtCore.QThread):
         return
 
     def handleControl(self, data):
-        """Handle control pipe signals"""
-        if data == 'RESULT':
+        """Handle control pipe signals, results are dropped after quit()"""
+        if self._quit:
+            self.pipeData.recv()
+            self.process.join()
+        elif data == 'RESULT':
             result = self.pipeData.recv()
             self.done.emit(result)
             self.process.join()
@@ -379,12 +449,24 @@ class UProcess(QtCore.QThread):
         """Overload this to handle process stderr"""
         pass
 
-    def quit(self):
-        """Clean exit"""
+    def report(self, *data):
+        """Call from the child process, emits progress(data) on the parent"""
+        self.pipeProgress.send(data)
+
+    def quit(self, grace=5000):
+        """
+        Clean exit: set cancelToken and let the function return,
+        terminate the process if still running after grace milliseconds.
+        """
         self._quit = True
-        self.process.terminate()
+        self.cancelToken.value = 1
+        QtCore.QTimer.singleShot(grace, self._terminate)
         super().quit()
 
+    def _terminate(self):
+        if self.process.is_alive():
+            self.process.terminate()
+
 ##############################################################################
 ### States and Events
 
@@ -24,6 +24,10 @@ import PyQt5.QtWidgets as QtWidgets
 import PyQt5.QtGui as QtGui
 import PyQt5.QtSvg as QtSvg
 
+import array
+import codecs
+import mmap
+import os
 import re
 
 ##############################################################################
@@ -147,6 +151,207 @@ class ScalingImage(QtWidgets.QLabel):
             self.updateGeometry()
         return super().event(ev)
 
+##############################################################################
+### File preview
+
+class LineIndex(QtCore.QThread):
+    """
+    Find where each line of data starts, on a new thread.
+    Signal grown(lines) is emitted after each chunk, so that the lines
+    found so far may be shown while the rest is indexed.
+    """
+    grown = QtCore.pyqtSignal(int)
+    chunk = 1 << 20
+
+    def __init__(self, data):
+        super().__init__()
+        self.data = data
+        # Start of each line, then where the last complete line ends
+        self.offsets = array.array('q', [0])
+        # Widest line so far, see width()
+        self.longest = 0
+        self._stop = False
+
+    def lines(self):
+        """Number of lines indexed so far"""
+        return len(self.offsets) - 1
+
+    def width(self, start, end):
+        """
+        Width of data[start:end] in characters once tabs are expanded,
+        at most: multi-byte characters are counted for each of their bytes.
+        """
+        width = end - start
+        index = self.data.find(b'\t', start, end)
+        while index != -1:
+            width += 7
+            index = self.data.find(b'\t', index + 1, end)
+        return width
+
+    def run(self):
+        data = self.data
+        size = len(data)
+        offsets = self.offsets
+        position = 0
+        while position < size and not self._stop:
+            end = min(position + self.chunk, size)
+            index = data.find(b'\n', position, end)
+            while index != -1:
+                self.longest = max(self.longest, self.width(offsets[-1], index))
+                offsets.append(index + 1)
+                index = data.find(b'\n', index + 1, end)
+            position = end
+            self.grown.emit(self.lines())
+        if not self._stop and offsets[-1] < size:
+            self.longest = max(self.longest, self.width(offsets[-1], size))
+            offsets.append(size)
+            self.grown.emit(self.lines())
+
+    def stop(self):
+        """Stop indexing and wait for the thread"""
+        self._stop = True
+        self.wait()
+
+class TextPreview(QtWidgets.QAbstractScrollArea):
+    """
+    Read-only view of a text file of any size. The file is memory-mapped
+    and only the visible lines are decoded and drawn, while the offsets
+    of all lines are indexed on a thread. Lines are not wrapped.
+    """
+    copyLimit = 1 << 24
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.file = None
+        self.data = b''
+        self.index = None
+        # Space above each line, in pixels
+        self.margin = 10
+        self.viewport().setBackgroundRole(QtGui.QPalette.Base)
+        self.viewport().setAutoFillBackground(True)
+        self.setFocusPolicy(QtCore.Qt.StrongFocus)
+
+    def open(self, path):
+        """Show the file at path, from its first line"""
+        self.clear()
+        self.file = open(path, 'rb')
+        if os.fstat(self.file.fileno()).st_size > 0:
+            self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.index = LineIndex(self.data)
+        self.index.grown.connect(self.updateScrollBars)
+        self.index.start()
+        self.verticalScrollBar().setValue(0)
+        self.horizontalScrollBar().setValue(0)
+
+    def clear(self):
+        """Show nothing and release the file"""
+        if self.index is not None:
+            self.index.stop()
+            self.index = None
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.data = b''
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.updateScrollBars()
+
+    def lines(self):
+        """Number of lines that can be shown"""
+        return self.index.lines() if self.index is not None else 0
+
+    def text(self, line, column=0, columns=None):
+        """
+        Characters of given line from column, without the line break.
+        Columns count characters once tabs are expanded, so the line is
+        decoded from its start, up to 4 bytes for each column needed.
+        """
+        start = self.index.offsets[line]
+        end = self.index.offsets[line + 1]
+        while end > start and self.data[end - 1:end] in (b'\n', b'\r'):
+            end -= 1
+        stop = end
+        if columns is not None:
+            stop = min(start + 4 * (column + columns), end)
+        # A character cut at stop is left out instead of replaced
+        decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        text = decoder.decode(self.data[start:stop], stop == end).expandtabs(8)
+        return text[column:column + columns if columns is not None else None]
+
+    def rowHeight(self):
+        return self.fontMetrics().lineSpacing() + self.margin
+
+    def columnWidth(self):
+        return max(self.fontMetrics().horizontalAdvance('M'), 1)
+
+    def updateScrollBars(self, *args):
+        """Fit scroll ranges to the lines indexed so far"""
+        rows = max(self.viewport().height() // self.rowHeight(), 1)
+        self.verticalScrollBar().setRange(0, max(self.lines() - rows, 0))
+        self.verticalScrollBar().setPageStep(rows)
+        columns = max(self.viewport().width() // self.columnWidth(), 1)
+        longest = self.index.longest if self.index is not None else 0
+        self.horizontalScrollBar().setRange(0, max(longest - columns + 1, 0))
+        self.horizontalScrollBar().setPageStep(columns)
+        self.viewport().update()
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        self.updateScrollBars()
+
+    def scrollContentsBy(self, dx, dy):
+        self.viewport().update()
+
+    def paintEvent(self, event):
+        """Draw the visible lines only"""
+        if self.index is None:
+            return
+        painter = QtGui.QPainter(self.viewport())
+        painter.setFont(self.font())
+        painter.setPen(self.palette().color(QtGui.QPalette.Text))
+        height = self.rowHeight()
+        ascent = self.fontMetrics().ascent()
+        first = self.verticalScrollBar().value()
+        column = self.horizontalScrollBar().value()
+        columns = self.viewport().width() // self.columnWidth() + 2
+        last = min(first + self.viewport().height() // height + 2, self.lines())
+        for row, line in enumerate(range(first, last)):
+            painter.drawText(4, row * height + self.margin + ascent,
+                self.text(line, column, columns))
+        painter.end()
+
+    def keyPressEvent(self, event):
+        """Scroll with arrows, page keys, home and end"""
+        actions = {
+            QtCore.Qt.Key_Up: (self.verticalScrollBar(), QtWidgets.QAbstractSlider.SliderSingleStepSub),
+            QtCore.Qt.Key_Down: (self.verticalScrollBar(), QtWidgets.QAbstractSlider.SliderSingleStepAdd),
+            QtCore.Qt.Key_PageUp: (self.verticalScrollBar(), QtWidgets.QAbstractSlider.SliderPageStepSub),
+            QtCore.Qt.Key_PageDown: (self.verticalScrollBar(), QtWidgets.QAbstractSlider.SliderPageStepAdd),
+            QtCore.Qt.Key_Home: (self.verticalScrollBar(), QtWidgets.QAbstractSlider.SliderToMinimum),
+            QtCore.Qt.Key_End: (self.verticalScrollBar(), QtWidgets.QAbstractSlider.SliderToMaximum),
+            QtCore.Qt.Key_Left: (self.horizontalScrollBar(), QtWidgets.QAbstractSlider.SliderSingleStepSub),
+            QtCore.Qt.Key_Right: (self.horizontalScrollBar(), QtWidgets.QAbstractSlider.SliderSingleStepAdd),
+            }
+        if event.matches(QtGui.QKeySequence.Copy):
+            self.copy()
+        elif event.key() in actions:
+            bar, action = actions[event.key()]
+            bar.triggerAction(action)
+        else:
+            super().keyPressEvent(event)
+
+    def copy(self):
+        """Copy the whole file to the clipboard, unless too large"""
+        if 0 < len(self.data) <= self.copyLimit:
+            QtWidgets.QApplication.clipboard().setText(
+                self.data[:].decode('utf-8', 'replace'))
+
+    def contextMenuEvent(self, event):
+        menu = QtWidgets.QMenu(self)
+        action = menu.addAction('Copy all', self.copy)
+        action.setEnabled(0 < len(self.data) <= self.copyLimit)
+        menu.exec(event.globalPos())
+
 ##############################################################################
 ### Taxotool Layout
 
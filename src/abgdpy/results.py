@@ -0,0 +1,205 @@
+#-----------------------------------------------------------------------------
+# ABGDpy - Automatic Barcode Gap Discovery with ABGD
+# Copyright (C) 2021  Patmanidis Stefanos
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#-----------------------------------------------------------------------------
+
+
+"""
+Compact results returned by the ABGD core.
+Output files are only written when requested:
+
+>>> r = Results(abgd.main('tests/test.fas', files=False))
+>>> r.artifacts()
+>>> r.render('abgd.svg', '.')
+"""
+
+import pathlib
+import re
+
+from . import abgd
+
+
+class Results():
+    """
+    Partitions and plot data of an ABGD run.
+    Each output file of the core can be rendered from these.
+    """
+
+    def __getstate__(self):
+        return self.__dict__
+
+    def __setstate__(self, state):
+        self.__dict__ = state
+
+    def __init__(self, data):
+        """Built from the dictionary returned by abgd.main()"""
+        self.project = data['project']
+        self.method = data['method']
+        self.date = data['date']
+        self.slope = data['slope']
+        self.all = data['all']
+        self.simple = data['simple']
+        self.spart = data['spart']
+        self.summary = data['summary']
+        # Partitions stop at the last step completed before cancelling
+        self.cancelled = data['cancelled']
+        # Time, memory and counters of each phase of the core
+        self.metrics = data['metrics']
+        self.names = data['names']
+        self.spart_names = data['spart_names']
+        self.priors = data['priors']
+        self.groups = data['groups']
+        self.groups_init = data['groups_init']
+        self.spart_steps = data['spart_steps']
+        self.barcode_gaps = data['barcode_gaps']
+        # If gaps were found in a sample of the pairs, the 95% interval
+        # of each initial gap, else None
+        self.pairs = data['pairs']
+        self.sampled_pairs = data['sampled_pairs']
+        self.gap_bounds = data['gap_bounds']
+        self.partitions = data['partitions']
+        self.partitions_init = data['partitions_init']
+        self.histogram = data['histogram']
+        self.histogram_max = data['histogram_max']
+        self.rank_index = data['rank_index']
+        self.rank_value = data['rank_value']
+        self.rank_total = data['rank_total']
+        self.tree = data['tree']
+
+    def artifacts(self):
+        """Names of all files the core would have written, in order"""
+        files = []
+        if self.summary:
+            files.append('abgd.svg')
+        files.append('disthist.svg')
+        files.append('rank.svg')
+        if self.summary and self.spart:
+            files.append(self.project + '.spart')
+            files.append(self.project + '.rec.spart')
+        for step in range(1, len(self.partitions) + 1):
+            for prefix in ['partinit', 'part']:
+                if self.all or self.simple:
+                    files.append('{}.{}.txt'.format(prefix, step))
+                if self.all:
+                    files.append('{}.{}.tree'.format(prefix, step))
+        return files
+
+    def render(self, name, directory):
+        """Write the artifact with given name inside directory, return its path"""
+        if name not in self.artifacts():
+            raise ValueError('No such artifact: {}'.format(name))
+        path = pathlib.Path(directory) / name
+        if name == 'abgd.svg':
+            self.render_graph(path)
+        elif name == 'disthist.svg':
+            self.render_histogram(path)
+        elif name == 'rank.svg':
+            self.render_rank(path)
+        elif name.endswith('.spart'):
+            self.render_spart(path, recursive=name.endswith('.rec.spart'))
+        else:
+            match = re.fullmatch(r'(partinit|part)\.(\d+)\.(txt|tree)', name)
+            step = int(match.group(2))
+            recursive = (match.group(1) == 'part')
+            if match.group(3) == 'txt':
+                self.render_partition(path, step, recursive)
+            else:
+                self.render_tree(path, step, recursive)
+        return path
+
+    def render_all(self, directory):
+        """Write every artifact inside directory"""
+        return [self.render(name, directory) for name in self.artifacts()]
+
+    def render_graph(self, path):
+        """Number of groups for each prior"""
+        abgd.render_graph(str(path), self.priors,
+            self.groups, self.groups_init, self.method)
+
+    def render_histogram(self, path):
+        """Histogram of pairwise distances"""
+        abgd.render_histogram(str(path), self.histogram, self.histogram_max)
+
+    def render_rank(self, path):
+        """Pairwise distances by rank"""
+        abgd.render_rank(str(path), self.rank_index, self.rank_value,
+            self.rank_total, self.histogram_max)
+
+    def members(self, step, recursive=True):
+        """List of specimen indices for each group of given step (from 1)"""
+        partition = (self.partitions if recursive else self.partitions_init)[step - 1]
+        groups = [[] for group in range(max(partition))]
+        for index, group in enumerate(partition):
+            groups[group - 1].append(index)
+        return groups
+
+    def render_partition(self, path, step, recursive=True):
+        """Group composition for given step (from 1)"""
+        # Groups are numbered from 1 next to tree files, from 0 otherwise
+        base = 1 if self.all else 0
+        with open(path, 'w', encoding='utf-8', errors='surrogateescape') as file:
+            for group, members in enumerate(self.members(step, recursive)):
+                file.write('Group[ {} ] n: {} ;id:'.format(group + base, len(members)))
+                for index in members:
+                    file.write(' ' + self.names[index])
+                file.write('\n')
+
+    def render_tree(self, path, step, recursive=True):
+        """BIONJ tree with the group of each leaf for given step (from 1)"""
+        if self.tree is None:
+            raise RuntimeError('No tree available, run with option "all".')
+        partition = (self.partitions if recursive else self.partitions_init)[step - 1]
+        text = self.tree['text']
+        parts = []
+        start = 0
+        for end, node in zip(self.tree['leaf_end'], self.tree['leaf_node']):
+            parts.append(text[start:end])
+            blank = len(text[end:]) - len(text[end:].lstrip(b' '))
+            start = end + blank
+            label = ' _group {}'.format(partition[node]).encode()
+            parts.append(label + b' ' * max(blank - len(label), 0))
+        parts.append(text[start:])
+        parts.append(b'\n')
+        with open(path, 'wb') as file:
+            file.write(b''.join(parts))
+
+    def render_spart(self, path, recursive=True):
+        """All partitions in Spart format"""
+        steps = self.spart_steps
+        kind = 'rec' if recursive else 'init'
+        partitions = self.partitions if recursive else self.partitions_init
+        subsets = self.groups if recursive else self.groups_init
+        labels = ['{}_abgd_{}_{}'.format(self.project, kind, i + 1) for i in range(steps)]
+        with open(path, 'w', encoding='utf-8', errors='surrogateescape') as file:
+            file.write('begin spart;\n')
+            file.write('Project_name = {};\n'.format(self.project))
+            file.write('Date = {};\n'.format(self.date))
+            file.write('N_spartitions = {} : {};\n'.format(steps, ' / '.join(labels)))
+            file.write('N_individuals = {} {};\n'.format(
+                '{} / '.format(len(self.names)) * (steps - 1), len(self.names)))
+            file.write('N_subsets = {};\n'.format(
+                ' / '.join(str(subsets[i]) for i in range(steps))))
+            file.write('[Generated by ABGD with Distance %s / MinSlope = %f]\n' % (self.method, self.slope))
+            file.write('[Barcode gap distance :]\n[')
+            file.write(''.join('%3.2e / ' % gap for gap in self.barcode_gaps[:steps - 1]))
+            file.write('%e]\n' % self.barcode_gaps[steps - 1])
+            file.write('[WARNING: The sample names below may have been changed to fit SPART specification (only alphanumeric characters and _ )]\n')
+            file.write('Individual_assignment = \n')
+            for index, name in enumerate(self.spart_names):
+                groups = ' / '.join(str(partitions[i][index]) for i in range(steps))
+                end = ';' if index == len(self.spart_names) - 1 else ''
+                file.write('{} : {}{}\n'.format(name, groups, end))
+            file.write('end;\n')
@@ -3,17 +3,44 @@
 
 """Console entry point"""
 
+import os
 import sys
 from . import core
+from . import batch
+from . import bench
+from . import serve
+from . import bootstrap
+from . import tiles
 
 #! This should be expanded to accept all arguments
 def main():
-    """Anayze given file"""
-    if len(sys.argv) == 2:
+    """Anayze given file, or a directory of files with: abgdpy batch DIR"""
+    if len(sys.argv) >= 2 and sys.argv[1] == 'batch':
+        sys.exit(batch.main(sys.argv[2:]))
+    elif len(sys.argv) >= 2 and sys.argv[1] == 'bench':
+        sys.exit(bench.suite.main(sys.argv[2:]))
+    elif len(sys.argv) >= 2 and sys.argv[1] == 'serve':
+        sys.exit(serve.main(sys.argv[2:]))
+    elif len(sys.argv) >= 2 and sys.argv[1] == 'bootstrap':
+        sys.exit(bootstrap.main(sys.argv[2:]))
+    elif len(sys.argv) >= 2 and sys.argv[1] == 'distances':
+        sys.exit(tiles.main(sys.argv[2:]))
+    elif len(sys.argv) == 2 or (len(sys.argv) == 4 and sys.argv[2] == '--trace'):
         print(' ')
         a=core.BarcodeAnalysis(sys.argv[1])
+        # Results are not kept, so do not write any files
+        a.lazy = True
+        if len(sys.argv) == 4:
+            a.trace = os.path.abspath(sys.argv[3])
         core.launch(a)
         # a.fetch
     else:
-        print('Usage: abgd FILE')
+        print('Usage: abgd FILE [--trace JSON]')
+        print('       abgd batch DIR [--jobs N] [--memory MB] [--out DIR] [--trace]')
+        print('       abgd bench run [--sizes N ...] [--out JSON]')
+        print('       abgd bench compare BASE.json HEAD.json')
+        print('       abgd serve [--port N | --socket PATH] [--workers N]')
+        print('       abgd bootstrap FILE [--replicates N] [--jobs N] [--seed N]')
+        print('       abgd distances FILE --shard k/K [--out DIR]')
+        print('       abgd distances merge TILE ... --out MATRIX')
         print('Ex:    abgd tests/test.fas')
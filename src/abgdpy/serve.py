@@ -0,0 +1,539 @@
+#-----------------------------------------------------------------------------
+# ABGDpy - Automatic Barcode Gap Discovery with ABGD
+# Copyright (C) 2021  Patmanidis Stefanos
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#-----------------------------------------------------------------------------
+
+
+"""
+Local job server with a pool of warm worker processes.
+Workers keep the core loaded and run one job after another,
+so each job only pays for the analysis itself:
+
+    $ abgdpy serve --workers 4
+    $ curl -d '{"file": "/data/a.fas", "wait": true}' localhost:8421/jobs
+
+The same from Python:
+
+>>> c = Client()
+>>> job = c.submit(fasta=open('a.fas').read(), params={'slope': 1.0}, wait=True)
+>>> job['result']['groups']
+
+Requests are json objects with one input, either 'file' (path on the
+server), 'fasta' or 'matrix' (content, with 'mega' among params for CSV),
+and optionally 'params' (see params.py), 'priority' (higher runs first),
+'out' (write all output files to this directory) and 'wait'.
+
+    POST   /jobs              submit, returns the job (202, or 200 if waited)
+    GET    /jobs/ID[?wait=1]  job status and result once done
+    DELETE /jobs/ID           cancel a queued or running job
+    GET    /status            workers and queue
+"""
+
+from multiprocessing import Process, Pipe, RawValue
+from multiprocessing.connection import wait
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import argparse
+import heapq
+import http.client
+import itertools
+import json
+import os
+import pathlib
+import socket
+import socketserver
+import tempfile
+import threading
+import time
+
+from . import abgd
+from . import cache
+from . import core
+from . import param
+from . import params
+
+
+DEFAULT_PORT = 8421
+
+# Attributes of Results sent to clients, all json values
+RESULT_FIELDS = ['project', 'method', 'date', 'slope', 'all', 'simple', 'spart',
+    'summary', 'cancelled', 'metrics', 'names', 'spart_names', 'priors', 'groups',
+    'groups_init', 'spart_steps', 'barcode_gaps', 'pairs', 'sampled_pairs',
+    'gap_bounds', 'partitions', 'partitions_init', 'histogram', 'histogram_max',
+    'rank_index', 'rank_value', 'rank_total']
+
+
+def describe(output):
+    """
+    Results as a json object. The tree (option 'all') is sent as
+    Newick text, without the byte offsets of its leaves.
+    """
+    result = {field: getattr(output, field) for field in RESULT_FIELDS}
+    tree = output.tree
+    result['tree'] = tree['text'].decode('utf-8', 'replace') if tree is not None else None
+    return result
+
+
+def execute(request, directory, cancel, cache=None):
+    """Run the analysis described by request, return its results as a dictionary"""
+    if 'file' in request:
+        path = request['file']
+    else:
+        kind = 'fasta' if 'fasta' in request else 'matrix'
+        name = pathlib.Path(request.get('name', 'inline')).name
+        path = os.path.join(directory, name)
+        with open(path, 'w') as file:
+            file.write(request[kind])
+    analysis = core.BarcodeAnalysis(path)
+    for key, value in request.get('params', {}).items():
+        for category in analysis.param.values():
+            if key in category:
+                category[key].value = value
+                break
+    analysis.lazy = 'out' not in request
+    if 'out' in request:
+        analysis.target = request['out']
+        pathlib.Path(analysis.target).mkdir(parents=True, exist_ok=True)
+    analysis.cancel = cancel
+    analysis.cache = cache
+    messages = []
+    analysis.log = lambda level, text: messages.append(text)
+    analysis.run()
+    result = describe(analysis.output)
+    result['log'] = ''.join(messages)
+    return result
+
+
+def worker(connection, cancel, directory, cache=None):
+    """
+    Loop of a warm worker process: run each job received, reply with
+    (id, status, result or error). Stops when sent None.
+    Messages of the core are returned with the results, anything
+    else it prints is dropped.
+    """
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    os.dup2(devnull, 2)
+    while True:
+        try:
+            message = connection.recv()
+        except EOFError:
+            break
+        if message is None:
+            break
+        id, request = message
+        try:
+            result = execute(request, directory, cancel, cache)
+            reply = (id, 'cancelled' if result['cancelled'] else 'done', result)
+        except abgd.Cancelled:
+            reply = (id, 'cancelled', None)
+        except Exception as exception:
+            reply = (id, 'failed', '{}: {}'.format(type(exception).__name__, exception))
+        connection.send(reply)
+    connection.close()
+
+
+class Job():
+    """A request and its outcome"""
+
+    def __init__(self, id, request):
+        self.id = id
+        self.request = request
+        self.priority = request.get('priority', 0)
+        self.status = 'queued'
+        self.result = None
+        self.error = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.done = threading.Event()
+
+    def finish(self, status, result=None, error=None):
+        self.status = status
+        self.result = result
+        self.error = error
+        self.finished = time.time()
+        self.done.set()
+
+    def describe(self):
+        """Dictionary sent to clients"""
+        data = {
+            'id': self.id,
+            'status': self.status,
+            'priority': self.priority,
+            'submitted': self.submitted,
+            'started': self.started,
+            'finished': self.finished,
+            }
+        if self.error is not None:
+            data['error'] = self.error
+        if self.result is not None:
+            data['result'] = self.result
+        return data
+
+
+class Worker():
+    """A warm process and the job it is running, if any"""
+
+    def __init__(self, directory, cache=None):
+        self.connection, child = Pipe()
+        self.cancel = RawValue('b', 0)
+        self.directory = tempfile.mkdtemp(dir=directory)
+        self.process = Process(target=worker, daemon=True,
+            args=(child, self.cancel, self.directory, cache))
+        self.process.start()
+        child.close()
+        self.job = None
+        self.jobs = 0
+
+    def start(self, job):
+        self.cancel.value = 0
+        self.connection.send((job.id, job.request))
+        self.job = job
+        job.status = 'running'
+        job.started = time.time()
+
+    def stop(self):
+        try:
+            self.connection.send(None)
+        except OSError:
+            pass
+        self.connection.close()
+
+
+class WorkerPool():
+    """
+    Priority queue of jobs dispatched to warm workers by a thread.
+    A worker is replaced if the core exits, and after max_jobs jobs,
+    since the core does not always free what it allocates.
+    """
+
+    def __init__(self, workers=None, max_jobs=100, history=1000, cache=None):
+        self.size = workers if workers is not None else (os.cpu_count() or 1)
+        self.max_jobs = max_jobs
+        self.history = history
+        # Shared by all workers, see cache.py
+        self.cache = cache
+        self.jobs = {}
+        self.queue = []
+        self.counter = itertools.count(1)
+        self.lock = threading.Lock()
+        self.closing = False
+        self._temp = tempfile.TemporaryDirectory(prefix='abgd_serve_')
+        self._wake, self._waker = Pipe(duplex=False)
+        self.workers = [Worker(self._temp.name, self.cache) for i in range(self.size)]
+        self.thread = threading.Thread(target=self.dispatch, daemon=True)
+        self.thread.start()
+
+    def submit(self, request):
+        """Queue a new job, raise ValueError if the request is invalid"""
+        inputs = [key for key in ('file', 'fasta', 'matrix') if key in request]
+        if len(inputs) != 1:
+            raise ValueError('Give exactly one of: file, fasta, matrix')
+        if 'file' in request and not os.path.isfile(request['file']):
+            raise ValueError('No such file: {}'.format(request['file']))
+        values = request.get('params', {})
+        if not isinstance(values, dict):
+            raise ValueError('Params must be an object')
+        known = set(param.ParamList(params.params).as_dictionary())
+        for key in values:
+            if key not in known:
+                raise ValueError('Unknown parameter: {}'.format(key))
+        if not isinstance(request.get('priority', 0), (int, float)):
+            raise ValueError('Priority must be a number')
+        with self.lock:
+            job = Job(str(next(self.counter)), request)
+            self.jobs[job.id] = job
+            heapq.heappush(self.queue, (-job.priority, int(job.id), job))
+            self._waker.send(None)
+        return job
+
+    def get(self, id):
+        return self.jobs.get(id)
+
+    def cancel(self, id):
+        """Cancel a queued job, or ask the core to stop a running one"""
+        with self.lock:
+            job = self.jobs.get(id)
+            if job is None:
+                return None
+            if job.status == 'queued':
+                job.finish('cancelled')
+            elif job.status == 'running':
+                for worker in self.workers:
+                    if worker.job is job:
+                        worker.cancel.value = 1
+            return job
+
+    def status(self):
+        with self.lock:
+            return {
+                'workers': [{'pid': worker.process.pid, 'jobs': worker.jobs,
+                    'job': worker.job.id if worker.job else None}
+                    for worker in self.workers],
+                'queued': sum(job.status == 'queued' for job in self.jobs.values()),
+                }
+
+    def dispatch(self):
+        """Assign queued jobs to idle workers and collect their replies"""
+        while True:
+            with self.lock:
+                if self.closing:
+                    break
+                for worker in self.workers:
+                    if worker.job is not None:
+                        continue
+                    while self.queue:
+                        priority, order, job = heapq.heappop(self.queue)
+                        if job.status == 'queued':
+                            worker.start(job)
+                            break
+                    if not self.queue:
+                        break
+                busy = [worker.connection for worker in self.workers if worker.job]
+            ready = wait(busy + [self._wake], timeout=1.0)
+            with self.lock:
+                while self._wake.poll():
+                    self._wake.recv()
+                for index, worker in enumerate(self.workers):
+                    if worker.job is None or worker.connection not in ready:
+                        continue
+                    job = worker.job
+                    worker.job = None
+                    try:
+                        id, status, payload = worker.connection.recv()
+                    except EOFError:
+                        worker.process.join()
+                        job.finish('failed', error='Core exited with code {}'.format(
+                            worker.process.exitcode))
+                        self.workers[index] = Worker(self._temp.name, self.cache)
+                        continue
+                    if status == 'failed':
+                        job.finish(status, error=payload)
+                    else:
+                        job.finish(status, result=payload)
+                    worker.jobs += 1
+                    if worker.jobs >= self.max_jobs:
+                        worker.stop()
+                        self.workers[index] = Worker(self._temp.name, self.cache)
+                self.forget()
+
+    def forget(self):
+        """Drop the oldest finished jobs beyond history"""
+        finished = [job for job in self.jobs.values() if job.done.is_set()]
+        for job in finished[:max(0, len(finished) - self.history)]:
+            del self.jobs[job.id]
+
+    def close(self):
+        with self.lock:
+            self.closing = True
+            self._waker.send(None)
+        self.thread.join()
+        for worker in self.workers:
+            worker.stop()
+        for worker in self.workers:
+            worker.process.join(timeout=5)
+            if worker.process.is_alive():
+                worker.process.terminate()
+        self._temp.cleanup()
+
+
+class Handler(BaseHTTPRequestHandler):
+    """Json over HTTP, see the module docstring"""
+
+    server_version = 'abgdpy'
+
+    def address_string(self):
+        if isinstance(self.client_address, tuple):
+            return super().address_string()
+        return 'local'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def reply(self, code, data):
+        try:
+            body = json.dumps(data).encode()
+        except (TypeError, ValueError) as exception:
+            code = 500
+            body = json.dumps({'error': 'Cannot encode reply',
+                'type': type(exception).__name__, 'detail': str(exception)}).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def job(self, path):
+        """Job of a /jobs/ID path, None if not found"""
+        parts = path.strip('/').split('/')
+        if len(parts) != 2 or parts[0] != 'jobs':
+            return None
+        return self.server.pool.get(parts[1])
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/status':
+            return self.reply(200, self.server.pool.status())
+        job = self.job(url.path)
+        if job is None:
+            return self.reply(404, {'error': 'Not found'})
+        if parse_qs(url.query).get('wait', ['0'])[0] not in ('0', 'false'):
+            job.done.wait()
+        self.reply(200, job.describe())
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/jobs':
+            return self.reply(404, {'error': 'Not found'})
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length) or b'{}')
+            if not isinstance(request, dict):
+                raise ValueError('Request must be an object')
+            job = self.server.pool.submit(request)
+        except ValueError as exception:
+            return self.reply(400, {'error': str(exception)})
+        if request.get('wait'):
+            job.done.wait()
+            return self.reply(200, job.describe())
+        self.reply(202, job.describe())
+
+    def do_DELETE(self):
+        url = urlparse(self.path)
+        job = self.job(url.path)
+        if job is not None:
+            job = self.server.pool.cancel(job.id)
+        if job is None:
+            return self.reply(404, {'error': 'Not found'})
+        self.reply(200, job.describe())
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """HTTP on a Unix socket, only reachable by local users with access to it"""
+    daemon_threads = True
+
+
+def serve(pool, host='127.0.0.1', port=DEFAULT_PORT, socket_path=None, verbose=False):
+    """Serve requests for pool until interrupted"""
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        server = UnixHTTPServer(socket_path, Handler)
+        address = socket_path
+    else:
+        server = ThreadingHTTPServer((host, port), Handler)
+        address = 'http://{}:{}'.format(host, server.server_port)
+    server.pool = pool
+    server.verbose = verbose
+    print('Serving on', address, 'with', pool.size, 'workers', flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        pool.close()
+        if socket_path is not None and os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+
+
+class Client():
+    """Talk to a running server, given its URL or socket path"""
+
+    def __init__(self, address='http://127.0.0.1:{}'.format(DEFAULT_PORT), timeout=None):
+        self.address = address
+        self.timeout = timeout
+
+    def connection(self):
+        if not self.address.startswith('http'):
+            return UnixHTTPConnection(self.address, timeout=self.timeout)
+        url = urlparse(self.address)
+        return http.client.HTTPConnection(url.hostname, url.port, timeout=self.timeout)
+
+    def request(self, method, path, data=None):
+        """Send a request, return the decoded reply or raise RuntimeError"""
+        connection = self.connection()
+        try:
+            body = json.dumps(data) if data is not None else None
+            connection.request(method, path, body=body,
+                headers={'Content-Type': 'application/json'})
+            response = connection.getresponse()
+            reply = json.loads(response.read())
+        finally:
+            connection.close()
+        if response.status >= 400:
+            raise RuntimeError(reply.get('error', response.reason))
+        return reply
+
+    def submit(self, wait=False, priority=0, params=None, **input):
+        """Queue a job given file=, fasta= or matrix= (and name=, out=)"""
+        request = dict(input, priority=priority, params=params or {}, wait=wait)
+        return self.request('POST', '/jobs', request)
+
+    def get(self, id, wait=False):
+        return self.request('GET', '/jobs/{}{}'.format(id, '?wait=1' if wait else ''))
+
+    def cancel(self, id):
+        return self.request('DELETE', '/jobs/{}'.format(id))
+
+    def status(self):
+        return self.request('GET', '/status')
+
+
+def main(argv=None):
+    """Console entry point for: abgdpy serve"""
+    parser = argparse.ArgumentParser(prog='abgdpy serve',
+        description='Run analyses for local clients on warm worker processes.')
+    parser.add_argument('--host', default='127.0.0.1',
+        help='address to listen on (default: 127.0.0.1)')
+    parser.add_argument('--port', '-p', type=int, default=DEFAULT_PORT,
+        help='port to listen on (default: {})'.format(DEFAULT_PORT))
+    parser.add_argument('--socket', default=None, metavar='PATH',
+        help='listen on this Unix socket instead of a port')
+    parser.add_argument('--workers', '-j', type=int, default=None,
+        help='number of worker processes (default: cpu count)')
+    parser.add_argument('--max-jobs', type=int, default=100,
+        help='replace a worker after this many jobs (default: 100)')
+    parser.add_argument('--cache', default=None, metavar='DIR',
+        help='reuse the results of identical jobs kept in this directory')
+    parser.add_argument('--cache-size', type=int, default=1024, metavar='MB',
+        help='evict least recently used results beyond this size (default: 1024)')
+    parser.add_argument('--cache-age', type=float, default=None, metavar='DAYS',
+        help='evict results older than this (default: never)')
+    parser.add_argument('--verbose', '-v', action='store_true',
+        help='log every request')
+    args = parser.parse_args(argv)
+
+    results = None
+    if args.cache is not None:
+        results = cache.ResultCache(args.cache, max_size=args.cache_size * 2**20,
+            max_age=args.cache_age * 86400 if args.cache_age is not None else None)
+    pool = WorkerPool(args.workers, max_jobs=args.max_jobs, cache=results)
+    serve(pool, args.host, args.port, args.socket, args.verbose)
+    return 0
@@ -0,0 +1,189 @@
+#-----------------------------------------------------------------------------
+# ABGDpy - Automatic Barcode Gap Discovery with ABGD
+# Copyright (C) 2021  Patmanidis Stefanos
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#-----------------------------------------------------------------------------
+
+
+"""
+Distance matrix computed once and shared between analyses.
+The matrix is kept in a named shared memory segment, which analyses
+running on other processes attach to instead of building their own:
+
+>>> d = SharedDistances('tests/test.fas', method=0)
+>>> a = BarcodeAnalysis('tests/test.fas')
+>>> a.distances = d
+>>> launch(a)
+>>> d.release()
+
+The segment is removed once every user released it.
+SharedPairs likewise keeps the sorted pairwise distances of such a matrix.
+"""
+
+from multiprocessing import Process, Pipe
+from multiprocessing import resource_tracker
+from multiprocessing import shared_memory
+
+import os
+
+from . import abgd
+from . import tiles
+
+
+def worker(file, kwargs, pipe):
+    """
+    Called by SharedDistances on a new process.
+    The segment is created here, the parent attaches to it by name.
+    """
+    segments = []
+    def allocate(n):
+        segment = shared_memory.SharedMemory(create=True, size=max(n * n * 8, 1))
+        segments.append(segment)
+        return segment.buf[:n * n * 8]
+    if tiles.is_matrix(file):
+        names, kwargs['method'], kwargs['rate'] = tiles.read_matrix(file, allocate)
+    else:
+        names = abgd.distances(file, allocate, **kwargs)
+    pipe.send((segments[0].name, names, kwargs['method'], kwargs['rate']))
+    pipe.close()
+    segments[0].close()
+
+
+def worker_pairs(distances, kwargs, pipe):
+    """Called by SharedPairs on a new process, as worker() above"""
+    segments = []
+    def allocate(n):
+        segment = shared_memory.SharedMemory(create=True, size=max(n * 8, 1))
+        segments.append(segment)
+        return segment.buf[:n * 8]
+    kwargs.update(distances.arguments())
+    count = abgd.pairs(distances.file, allocate, **kwargs)
+    pipe.send((segments[0].name, count))
+    pipe.close()
+    segments[0].close()
+
+
+class SharedSegment():
+    """
+    Reference counted shared memory segment, attached to by name
+    when pickled to another process. The creator holds the first reference.
+    """
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['_segment']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__ = state
+        self._segment = shared_memory.SharedMemory(name=self.name)
+
+    def start(self, target, args):
+        """Create the segment on a new process, return what it sent"""
+        # The child must register the segment with our tracker,
+        # or its own would unlink the segment when the child exits
+        if os.name == 'posix':
+            resource_tracker.ensure_running()
+        receiver, sender = Pipe(duplex=False)
+        p = Process(target=target, args=args + (sender,))
+        p.start()
+        sender.close()
+        try:
+            message = receiver.recv()
+        except EOFError:
+            message = None
+        p.join()
+        if p.exitcode != 0 or message is None:
+            raise RuntimeError('ABGD internal error, please check logs.')
+        self.name = message[0]
+        self._segment = shared_memory.SharedMemory(name=self.name)
+        self._references = 1
+        return message[1:]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+    def acquire(self):
+        """Add a reference, the segment stays until it is released"""
+        if self._references <= 0:
+            raise RuntimeError('Shared memory was already released.')
+        self._references += 1
+        return self
+
+    def release(self):
+        """Remove a reference, unlink the segment when none are left"""
+        self._references -= 1
+        if self._references == 0:
+            self._segment.close()
+            self._segment.unlink()
+
+
+class SharedDistances(SharedSegment):
+    """
+    Reference counted distance matrix in shared memory.
+    The creator holds the first reference.
+    """
+
+    def __init__(self, file, method=1, rate=2.0, mega=False):
+        """
+        Compute the matrix on a new process, since the core may exit().
+        A matrix merged from tiles is read instead, with its own method and rate.
+        """
+        self.file = file
+        self.method = method
+        self.rate = rate
+        self.mega = mega
+        kwargs = {'method': method, 'rate': rate, 'mega': mega}
+        self.names, self.method, self.rate = self.start(worker, (file, kwargs))
+
+    def buffer(self):
+        """Read-only view of the n*n matrix of doubles"""
+        n = len(self.names)
+        return self._segment.buf[:n * n * 8].toreadonly()
+
+    def arguments(self):
+        """Keyword arguments for abgd.main() or abgd.sweep()"""
+        return {
+            'distances': self.buffer(),
+            'names': self.names,
+            'method': self.method,
+            'rate': self.rate,
+            'mega': self.mega,
+            }
+
+
+class SharedPairs(SharedSegment):
+    """
+    Reference counted sorted pairs of a SharedDistances matrix,
+    as abgd.bootstrap() would sort them for the same sample and seed.
+    Takes 8 bytes per pair, about 4*n*n bytes for n sequences.
+    """
+
+    def __init__(self, distances, sample=0, seed=1):
+        self.sample = sample
+        self.seed = seed
+        kwargs = {'sample': sample, 'seed': seed}
+        self.count, = self.start(worker_pairs, (distances, kwargs))
+
+    def buffer(self):
+        """Read-only view of the sorted doubles"""
+        return self._segment.buf[:self.count * 8].toreadonly()
+
+    def arguments(self):
+        """Keyword arguments for abgd.bootstrap()"""
+        return {'pairs': self.buffer()}
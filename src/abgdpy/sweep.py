@@ -0,0 +1,113 @@
+#-----------------------------------------------------------------------------
+# ABGDpy - Automatic Barcode Gap Discovery with ABGD
+# Copyright (C) 2021  Patmanidis Stefanos
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#-----------------------------------------------------------------------------
+
+
+"""
+Evaluate several slope values (X) over the same prior range in one pass.
+Distances, their sorting and the slopes used by the peak search
+are only computed once:
+
+>>> s = SlopeSweep('tests/test.fas', [0.5, 1.0, 1.5, 2.0])
+>>> s.param.prior.steps = 20
+>>> core.launch(s)
+>>> s.output.groups(1.5)
+"""
+
+from . import abgd
+from . import param
+from . import params
+
+
+class SweepResults():
+    """
+    Partitions for each slope and prior of a sweep.
+    Steps stop at the first prior yielding a single group, as in a normal run.
+    """
+
+    def __getstate__(self):
+        return self.__dict__
+
+    def __setstate__(self, state):
+        self.__dict__ = state
+
+    def __init__(self, data):
+        """Built from the dictionary returned by abgd.sweep()"""
+        self.priors = data['priors']
+        self.names = data['names']
+        self.grid = data['grid']
+        self.slopes = [entry['slope'] for entry in self.grid]
+
+    def entry(self, slope):
+        """Results for given slope value"""
+        for entry in self.grid:
+            if entry['slope'] == slope:
+                return entry
+        raise ValueError('Slope not in sweep: {}'.format(slope))
+
+    def groups(self, slope, recursive=True):
+        """Number of groups for each prior step of given slope"""
+        return self.entry(slope)['groups' if recursive else 'groups_init']
+
+    def partition(self, slope, step, recursive=True):
+        """Group of each specimen (from 1) for given slope and step (from 1)"""
+        entry = self.entry(slope)
+        return entry['partitions' if recursive else 'partitions_init'][step - 1]
+
+    def table(self):
+        """Rows of (slope, step, prior, groups_init, groups)"""
+        rows = []
+        for entry in self.grid:
+            for step, prior in enumerate(entry['priors']):
+                rows.append((entry['slope'], step + 1, prior,
+                    entry['groups_init'][step], entry['groups'][step]))
+        return rows
+
+
+class SlopeSweep():
+    """
+    Container for input/output of a slope sweep.
+    Uses the prior and distance parameters of BarcodeAnalysis,
+    the general parameters and slope are ignored.
+    """
+
+    def __getstate__(self):
+        return self.__dict__
+
+    def __setstate__(self, state):
+        self.__dict__ = state
+
+    def __init__(self, file, slopes):
+        self.file = file
+        self.slopes = list(slopes)
+        self.target = None
+        self.results = None
+        self.output = None
+        self.param = param.ParamList(params.params)
+        # If set to SharedDistances, its matrix is used instead of computing one
+        self.distances = None
+
+    def run(self):
+        """Run the ABGD core for all slopes"""
+        kwargs = self.param.prior.as_dictionary()
+        kwargs.update(self.param.distance.as_dictionary())
+        del kwargs['slope']
+        kwargs['mega'] = self.param.general.mega
+        kwargs['slopes'] = self.slopes
+        if self.distances is not None:
+            kwargs.update(self.distances.arguments())
+        self.output = SweepResults(abgd.sweep(self.file, **kwargs))
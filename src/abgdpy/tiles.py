@@ -0,0 +1,303 @@
+#-----------------------------------------------------------------------------
+# ABGDpy - Automatic Barcode Gap Discovery with ABGD
+# Copyright (C) 2021  Patmanidis Stefanos
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#-----------------------------------------------------------------------------
+
+
+
+"""
+Distances of a large fasta file computed in shards, possibly on several
+machines, then merged into a single matrix:
+
+    abgdpy distances library.fas --shard 1/4 --out tiles    (one per job, 1 to 4)
+    abgdpy distances merge tiles/*.tile --out library.dist
+    abgdpy library.dist
+
+Shards split the upper triangle of the matrix into blocks of whole rows
+holding about the same number of pairs. The merged matrix is read by
+BarcodeAnalysis and SharedDistances as is, without computing it again.
+
+Tiles and matrices are binary: a fixed header, the sequence names
+separated by newlines, then the distances as doubles.
+"""
+
+from array import array
+
+import argparse
+import os
+import pathlib
+import struct
+import sys
+
+from . import abgd
+from . import cache
+
+
+TILE_MAGIC = b'ABGDTILE'
+MATRIX_MAGIC = b'ABGDDIST'
+VERSION = 1
+
+# version, byte order, sequences, first row, last row, method, rate, pairs
+TILE_HEADER = struct.Struct('<IBqqqidq')
+# version, byte order, sequences, method, rate
+MATRIX_HEADER = struct.Struct('<IBqid')
+
+BYTE_ORDERS = {'little': 0, 'big': 1}
+
+
+def shard_rows(n, shard, shards):
+    """
+    Rows [first, last) of shard (from 0) among shards,
+    so that all shards hold about the same number of pairs.
+    """
+    if not 0 <= shard < shards:
+        raise ValueError('Invalid shard: {}/{}'.format(shard + 1, shards))
+    total = n * (n - 1) // 2
+
+    def start(k):
+        # First row with at least k/shards of all pairs before it
+        target = total * k / shards
+        low, high = 0, n
+        while low < high:
+            middle = (low + high) // 2
+            if middle * n - middle * (middle + 1) // 2 >= target:
+                high = middle
+            else:
+                low = middle + 1
+        return low
+
+    return start(shard), start(shard + 1) if shard + 1 < shards else n
+
+
+def write_names(file, names):
+    data = '\n'.join(names).encode('utf-8', 'surrogateescape')
+    file.write(struct.pack('<q', len(data)))
+    file.write(data)
+
+
+def read_names(file):
+    size, = struct.unpack('<q', file.read(8))
+    return file.read(size).decode('utf-8', 'surrogateescape').split('\n')
+
+
+def compute_tile(file, shard, shards, target, method=1, rate=2.0):
+    """
+    Compute shard (from 0) of the distances of a fasta file,
+    write it in directory target and return its path.
+    The core runs on the calling process and exits on invalid input.
+    """
+    with open(file, 'rb') as input:
+        n = sum(1 for line in input if line.startswith(b'>'))
+    first, last = shard_rows(n, shard, shards)
+    tiles = []
+    def allocate(count):
+        tiles.append(array('d', bytes(8 * count)))
+        return tiles[0]
+    names = abgd.tile(str(file), first, last, allocate,
+        method=method, rate=rate, loglevel=abgd.LOG_ERROR)
+    tile = tiles[0]
+
+    path = pathlib.Path(target) / '{}.{:0{w}}-of-{}.tile'.format(
+        pathlib.Path(file).stem, shard + 1, shards, w=len(str(shards)))
+    temporary = path.with_name(path.name + '.tmp')
+    with open(temporary, 'wb') as output:
+        output.write(TILE_MAGIC)
+        output.write(TILE_HEADER.pack(VERSION, BYTE_ORDERS[sys.byteorder],
+            len(names), first, last, method, rate, len(tile)))
+        # Tiles of different inputs are never merged
+        output.write(bytes.fromhex(cache.file_digest(file)))
+        write_names(output, names)
+        tile.tofile(output)
+    os.replace(temporary, path)
+    return path
+
+
+def read_tile_header(file):
+    """Header of an open tile as a dictionary, names included"""
+    if file.read(len(TILE_MAGIC)) != TILE_MAGIC:
+        raise ValueError('Not a distance tile: {}'.format(file.name))
+    version, order, n, first, last, method, rate, count = TILE_HEADER.unpack(
+        file.read(TILE_HEADER.size))
+    if version != VERSION:
+        raise ValueError('Unsupported tile version {}: {}'.format(version, file.name))
+    return {
+        'order': order, 'n': n, 'first': first, 'last': last,
+        'method': method, 'rate': rate, 'count': count,
+        'digest': file.read(32), 'names': read_names(file),
+        }
+
+
+def merge(tiles, target, phylip=False):
+    """
+    Assemble the tiles of all shards into a symmetric matrix written
+    to target, as a binary matrix or as Phylip text.
+    The whole matrix is kept in memory, as it is for the analysis.
+    """
+    tiles = list(tiles)
+    headers = {}
+    for path in tiles:
+        with open(path, 'rb') as file:
+            headers[path] = read_tile_header(file)
+    if not headers:
+        raise ValueError('No tiles to merge.')
+    reference = next(iter(headers.values()))
+    for path, header in headers.items():
+        for key in ('n', 'method', 'rate', 'digest', 'names'):
+            if header[key] != reference[key]:
+                raise ValueError('Tile {} does not match {}: different {}'.format(
+                    path, tiles[0], key))
+    n = reference['n']
+    rows = sorted((header['first'], header['last'], path) for path, header in headers.items())
+    end = 0
+    for first, last, path in rows:
+        if first > end:
+            raise ValueError('Rows {} to {} are missing'.format(end, first))
+        if first < end:
+            raise ValueError('Rows of {} are in another tile too'.format(path))
+        end = last
+    if end != n:
+        raise ValueError('Rows {} to {} are missing'.format(end, n))
+
+    matrix = array('d', bytes(8 * n * n))
+    for first, last, path in rows:
+        with open(path, 'rb') as file:
+            header = read_tile_header(file)
+            tile = array('d')
+            tile.frombytes(file.read(8 * header['count']))
+        if header['order'] != BYTE_ORDERS[sys.byteorder]:
+            tile.byteswap()
+        k = 0
+        for a in range(first, last):
+            values = tile[k:k + n - 1 - a]
+            matrix[a * n + a + 1:(a + 1) * n] = values
+            matrix[(a + 1) * n + a::n] = values
+            k += n - 1 - a
+
+    temporary = pathlib.Path(str(target) + '.tmp')
+    if phylip:
+        with open(temporary, 'w') as output:
+            output.write('{}\n'.format(n))
+            for i, name in enumerate(reference['names']):
+                output.write(name + ' ')
+                output.write(' '.join('{:.8f}'.format(value) for value in matrix[i * n:(i + 1) * n]))
+                output.write('\n')
+    else:
+        with open(temporary, 'wb') as output:
+            output.write(MATRIX_MAGIC)
+            output.write(MATRIX_HEADER.pack(VERSION, BYTE_ORDERS[sys.byteorder],
+                n, reference['method'], reference['rate']))
+            output.write(reference['digest'])
+            write_names(output, reference['names'])
+            matrix.tofile(output)
+    os.replace(temporary, target)
+    return target
+
+
+def is_matrix(path):
+    """True if path is a matrix written by merge()"""
+    try:
+        with open(path, 'rb') as file:
+            return file.read(len(MATRIX_MAGIC)) == MATRIX_MAGIC
+    except OSError:
+        return False
+
+
+def read_matrix(path, allocate):
+    """
+    Copy the distances of a merged matrix in the buffer returned by
+    allocate(n), as abgd.distances() does. Return (names, method, rate).
+    """
+    with open(path, 'rb') as file:
+        if file.read(len(MATRIX_MAGIC)) != MATRIX_MAGIC:
+            raise ValueError('Not a distance matrix: {}'.format(path))
+        version, order, n, method, rate = MATRIX_HEADER.unpack(file.read(MATRIX_HEADER.size))
+        if version != VERSION:
+            raise ValueError('Unsupported matrix version {}: {}'.format(version, path))
+        file.read(32)
+        names = read_names(file)
+        buffer = memoryview(allocate(n)).cast('B')
+        if file.readinto(buffer[:8 * n * n]) != 8 * n * n:
+            raise ValueError('Truncated distance matrix: {}'.format(path))
+    if order != BYTE_ORDERS[sys.byteorder]:
+        values = array('d', buffer[:8 * n * n])
+        values.byteswap()
+        buffer[:8 * n * n] = memoryview(values).cast('B')
+    return names, method, rate
+
+
+def load_matrix(path):
+    """Keyword arguments for abgd.main() or abgd.sweep() from a merged matrix"""
+    matrix = []
+    def allocate(n):
+        matrix.append(bytearray(8 * n * n))
+        return matrix[0]
+    names, method, rate = read_matrix(path, allocate)
+    return {
+        'distances': matrix[0],
+        'names': names,
+        'method': method,
+        'rate': rate,
+        'mega': False,
+        }
+
+
+def parse_shard(text):
+    """'k/K' with k from 1 to K, as (k - 1, K)"""
+    try:
+        shard, shards = (int(part) for part in text.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected k/K, got: {}'.format(text))
+    if not 1 <= shard <= shards:
+        raise argparse.ArgumentTypeError('expected 1 <= k <= K, got: {}'.format(text))
+    return shard - 1, shards
+
+
+def main(argv=None):
+    """Console entry point for: abgdpy distances"""
+    argv = sys.argv[2:] if argv is None else argv
+    if argv and argv[0] == 'merge':
+        parser = argparse.ArgumentParser(prog='abgdpy distances merge',
+            description='Assemble the tiles of all shards into one matrix.')
+        parser.add_argument('tiles', nargs='+', help='tile files of every shard')
+        parser.add_argument('--out', '-o', required=True,
+            help='merged matrix, to be analyzed as any input file')
+        parser.add_argument('--phylip', action='store_true',
+            help='write a Phylip text matrix instead of a binary one')
+        args = parser.parse_args(argv[1:])
+        try:
+            merge(args.tiles, args.out, args.phylip)
+        except ValueError as exception:
+            parser.error(str(exception))
+        print('Matrix written to:', args.out)
+        return 0
+
+    parser = argparse.ArgumentParser(prog='abgdpy distances',
+        description='Compute one shard of the distances of a fasta file.')
+    parser.add_argument('file', help='input fasta alignment')
+    parser.add_argument('--shard', type=parse_shard, required=True, metavar='k/K',
+        help='compute shard k (from 1) out of K')
+    parser.add_argument('--out', '-o', default='.',
+        help='directory of the tile (default: current)')
+    parser.add_argument('--method', type=int, choices=[0, 1, 3], default=1,
+        help='0: Kimura-2P, 1: Jukes-Cantor, 3: simple distance (default: 1)')
+    parser.add_argument('--rate', type=float, default=2.0,
+        help='transition/transversion for Kimura 2-P (default: 2.0)')
+    args = parser.parse_args(argv)
+    shard, shards = args.shard
+    pathlib.Path(args.out).mkdir(parents=True, exist_ok=True)
+    path = compute_tile(args.file, shard, shards, args.out, args.method, args.rate)
+    print('Tile written to:', path)
+    return 0
@@ -0,0 +1,63 @@
+#-----------------------------------------------------------------------------
+# ABGDpy - Automatic Barcode Gap Discovery with ABGD
+# Copyright (C) 2021  Patmanidis Stefanos
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#-----------------------------------------------------------------------------
+
+
+"""
+Timeline of a run in Chrome trace-event format,
+to be opened with chrome://tracing or https://ui.perfetto.dev:
+
+>>> a = BarcodeAnalysis('tests/test.fas')
+>>> a.trace = 'abgd.trace.json'
+>>> launch(a)
+
+Spans nest: each prior step holds its peak search, components and
+recursion rounds, each round holds the peak search of every component.
+"""
+
+import json
+import os
+import threading
+
+
+def events(spans, pid=None, tid=None, label='abgd core'):
+    """
+    Trace events from the spans returned by abgd.main(..., trace=True).
+    The core runs on the calling thread, which is used by default.
+    """
+    pid = os.getpid() if pid is None else pid
+    tid = threading.get_native_id() if tid is None else tid
+    result = [{
+        'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid,
+        'args': {'name': label},
+        }]
+    for name, start, duration, argname, arg in spans:
+        result.append({
+            'name': name, 'cat': 'abgd', 'ph': 'X',
+            'ts': start, 'dur': duration, 'pid': pid, 'tid': tid,
+            'args': {argname: arg} if argname is not None else {},
+            })
+    return result
+
+
+def write(spans, path, **kwargs):
+    """Write spans to path as a trace-event JSON file"""
+    with open(path, 'w') as file:
+        json.dump({
+            'traceEvents': events(spans, **kwargs),
+            'displayTimeUnit': 'ms',
+            }, file)
@@ -0,0 +1,1142 @@
+#-----------------------------------------------------------------------------
+# ABGDpy - Automatic Barcode Gap Discovery with ABGD
+# Copyright (C) 2021  Patmanidis Stefanos
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#-----------------------------------------------------------------------------
+
+
+
+"""
+An engine written with NumPy, with the same main() and distances()
+as the abgd core. Select it for an analysis with:
+
+>>> a = BarcodeAnalysis('tests/test.fas')
+>>> a.engine = 'abgdpy.vectorized'
+>>> launch(a)
+
+Distances are counted over the whole encoded alignment with matrix products,
+the running mean and the window slopes of the peak search are taken from
+cumulative sums and slices of the sorted distances, and groups are found
+with a vectorized union-find. Errors are raised instead of exiting the
+process, so launch() runs small and medium inputs without a new process.
+
+Results are the same as those of the core, see bench/differential.py.
+Trees (option "all") and sampled pairs are only available from the core.
+"""
+
+import contextlib
+import math
+import os
+import re
+import time
+
+try:
+    import numpy
+except ImportError as exception:
+    raise ImportError('The vectorized engine needs NumPy, '
+        'install it with: pip install numpy') from exception
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from . import abgd
+from . import tiles
+from .results import Results
+
+
+# Inputs with up to this many sequences may be analyzed on the calling process,
+# if the analysis sets inline: the engine is slower than the core from 50 sequences on,
+# so this only bounds how long the caller may be blocked
+INLINE_SEQUENCES = 2000
+
+# Distance method of each value of param.distance.method, as named by the core
+METHODS = {0: 'K80 Kimura', 1: 'JC69 Jukes-Cantor', 3: 'SSSI SimpleDistance'}
+
+# Symbols allowed in fasta sequences, after upper case
+SYMBOLS = b'ATGC-+NMRWSYKVHDBNZ'
+
+# Leading number of a distance, as read by strtod()
+NUMBER = re.compile(rb'\s*[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?|\s*[+-]?(inf|nan)', re.IGNORECASE)
+
+# Names of Phylip matrices are cut to this many characters, minus one
+SIZE_NAME_DIST = 100
+
+# Size of the distance histogram and rank images, see main_abgd.c
+HISTO_WIDTH = 720
+HISTO_MARGIN = 40
+HISTO_BORDER = 60
+
+PHASES = ['total', 'parse', 'names', 'distances', 'histogram',
+    'sort', 'peaks', 'components', 'recursion', 'tree', 'output']
+COUNTS = ['pairs', 'windows', 'rounds']
+
+
+class Context():
+    """
+    Options of a single call shared by all steps:
+    messages, progress, cancellation, metrics and trace spans.
+    """
+
+    def __init__(self, kwargs):
+        log = kwargs.get('log')
+        if log is not None and not callable(log):
+            raise TypeError('vectorized: Expected a callable for log')
+        self.log_callback = log
+        self.log_level = kwargs.get('loglevel', abgd.LOG_INFO)
+        self.logfile = None
+        progress = kwargs.get('progress')
+        self.progress_callback = progress
+        step = kwargs.get('step')
+        if step is not None and not callable(step):
+            raise TypeError('vectorized: Expected a callable for step')
+        self.step_callback = step
+        cancel = kwargs.get('cancel')
+        self.cancel = memoryview(cancel) if cancel is not None else None
+        self.cancelled = False
+        self.last_progress = None
+        self.phases = {name: {'wall': 0.0, 'cpu': 0.0, 'calls': 0, 'peak_rss': 0}
+            for name in PHASES}
+        self.counts = dict.fromkeys(COUNTS, 0)
+        self.spans = [] if kwargs.get('trace') else None
+        self.origin = time.perf_counter()
+
+    def log(self, level, format, *args):
+        """Same as abgd_log(), printf-like"""
+        if level > self.log_level:
+            return
+        text = format % args if args else format
+        if self.log_callback is not None:
+            self.log_callback(level, text)
+        elif self.logfile is not None:
+            self.logfile.write(text)
+        else:
+            print(text, end='')
+
+    def progress(self, phase, done=0, total=0):
+        """Same as abgd_progress(): report progress, return True once cancelled"""
+        if self.cancelled:
+            return True
+        if self.cancel is not None and any(self.cancel.tobytes()[:1]):
+            self.cancelled = True
+            return True
+        if self.progress_callback is None or total <= 0:
+            return False
+        permille = int(1000.0 * done / total)
+        if (phase, permille) != self.last_progress:
+            self.last_progress = (phase, permille)
+            self.progress_callback(phase, done, total)
+        return False
+
+    def step(self, step, prior, gap, groups, groups_init):
+        """
+        Same events as the core once each step is done, but files are empty:
+        they are all written at the end.
+        """
+        if self.step_callback is not None:
+            self.step_callback({'step': step, 'prior': prior, 'barcode_gap': gap,
+                'groups': groups, 'groups_init': groups_init, 'files': []})
+
+    def span(self, name, argname, arg, start):
+        """Record a span of the trace from start to now"""
+        if self.spans is not None:
+            now = time.perf_counter()
+            self.spans.append((name, (start - self.origin) * 1e6,
+                (now - start) * 1e6, argname, arg))
+
+    @contextlib.contextmanager
+    def phase(self, name, argname=None, arg=None):
+        """Add the time spent inside to the metrics of phase name"""
+        wall, cpu = time.perf_counter(), time.process_time()
+        yield
+        metric = self.phases[name]
+        metric['wall'] += time.perf_counter() - wall
+        metric['cpu'] += time.process_time() - cpu
+        metric['calls'] += 1
+        if resource is not None:
+            metric['peak_rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        self.span(name, argname, arg, wall)
+
+    def metrics(self):
+        """Same layout as the metrics of abgd.main()"""
+        return {'phases': self.phases, 'counts': self.counts}
+
+
+def compare_nucleotides(s1, s2):
+    """Same as compare_DNA(): 1 if both symbols may be the same nucleotide"""
+    if s1 in 'ACGT' and s2 in 'ACGT':
+        return int(s1 == s2)
+    if s1 in '-+' or s2 in '-+':
+        return int(not (s1 + s2 in ('-+', '+-')))
+    if s1 == 'N' or s2 == 'N':
+        return 1
+    for base, codes in (('A', 'MRWVHD'), ('C', 'MSYVHB'), ('G', 'RSKVDB'), ('T', 'WYKHDB')):
+        if s1 == base:
+            return int(s2 in codes)
+        if s2 == base:
+            return int(s1 in codes)
+    return int(s1 + s2 not in ('MK', 'KM', 'RY', 'YR', 'WS', 'SW'))
+
+
+def is_transition(s1, s2):
+    """Same as IsTransition(), which is not symmetric for ambiguous symbols"""
+    codes = {'T': 'CSMV', 'C': 'TWKD', 'A': 'GSKB', 'G': 'AWMH'}
+    return int(s2 in codes.get(s1, ''))
+
+
+def log(value):
+    """Natural logarithm of a double as in C, -inf at 0 and nan below"""
+    if value > 0:
+        return math.log(value)
+    return -math.inf if value == 0 else math.nan
+
+
+def exp(value):
+    """Exponential of a double as in C, inf on overflow"""
+    try:
+        return math.exp(value)
+    except OverflowError:
+        return math.inf
+
+
+def jukes_cantor(differences, sites):
+    """Same as distanceJC69() for a single pair"""
+    v = float(differences)
+    if sites != 0:
+        v = v / sites
+    if v > 0.74:
+        v = 0.74
+    h = (-3.0 / 4.0) * log(1.0 - ((4.0 / 3.0) * v))
+    return h if h != 0 else 0.0
+
+
+def kimura_likelihood(sites, transversions, transitions, t, R):
+    """Same as compute_logL_given_t_R()"""
+    P = 0.25 - 0.5 * exp(-t * (2 * R + 1) / (R + 1)) + 0.25 * exp(-2 * t / (R + 1))
+    Q = 0.5 - 0.5 * exp(-2 * t / (R + 1))
+    return (sites * log(0.25) +
+        (sites - transversions - transitions) * log(1.00 - P - Q) +
+        transitions * log(P) +
+        transversions * log(Q))
+
+
+def kimura(sites, transversions, transitions, R):
+    """Same as find_ML_t_given_R(): maximum likelihood distance, seeded with K80"""
+    Q = transversions / float(sites)
+    P = transitions / float(sites)
+    t = -0.25 * log((1 - 2 * Q) * (1 - 2 * P - Q) * (1 - 2 * P - Q))
+    eps = 1e-3
+    while eps >= 1e-7:
+        while (kimura_likelihood(sites, transversions, transitions, t + eps, R) >
+                kimura_likelihood(sites, transversions, transitions, t, R)):
+            t += eps
+        while (kimura_likelihood(sites, transversions, transitions, t - eps, R) >
+                kimura_likelihood(sites, transversions, transitions, t, R)):
+            t -= eps
+        eps *= 0.1
+    return t if t != 0 else 0.0
+
+
+def read_fasta(data):
+    """Names and sequences as bytes, same as read_sequences()"""
+    names, sequences = [], []
+    start = 0
+    while start < len(data) and data[start:start + 1] == b'>':
+        end = len(data)
+        for stop in (b'\n', b'\r'):
+            found = data.find(stop, start)
+            if found != -1:
+                end = min(end, found)
+        following = data.find(b'>', end)
+        if following == -1:
+            following = len(data)
+        sequence = data[end:following].translate(None, b'\n\r\t ').upper()
+        if sequence.translate(None, SYMBOLS):
+            raise ValueError('Your data contains at least one other symbol '
+                'than ATGC-+NMRWSYKVHDBNZ, please correct it')
+        names.append(data[start + 1:end])
+        sequences.append(sequence)
+        start = following
+    return names, sequences
+
+
+def check_names(names):
+    """Same as check_names(): raise if names are not unique or include each other"""
+    order = sorted(range(len(names)), key=lambda index: (names[index], index))
+    seen = set()
+    for index in order:
+        name = names[index]
+        if name in seen:
+            first = names.index(name)
+            raise ValueError('seq {}: {} and seq {}: {} have same name'.format(
+                first + 1, decode(name), index + 1, decode(name)))
+        seen.add(name)
+    for index in order:
+        key = names[index] + b' '
+        for other, name in enumerate(names):
+            if name.startswith(key):
+                raise ValueError('seq {}: {} has a name included in seq {}: {} . '
+                    "ABGD can't deal with that; change at least one of the names".format(
+                    other + 1, decode(name), index + 1, decode(names[index])))
+
+
+def decode(name):
+    """As the core returns names"""
+    return name.decode('utf-8', 'surrogateescape')
+
+
+def count_sites(codes, table):
+    """
+    For all pairs of sequences (i, j), the number of sites
+    with table[a, b] set where i has symbol a and j has symbol b.
+    Sequences are one-hot encoded on the symbols present, so this is one matrix product.
+    """
+    n, length = codes.shape
+    present = numpy.unique(codes)
+    onehot = (codes[:, :, None] == present[None, None, :]).astype(numpy.float32)
+    weights = table[numpy.ix_(present, present)].astype(numpy.float32)
+    other = onehot @ weights.T
+    counts = onehot.reshape(n, -1) @ other.reshape(n, -1).T
+    return numpy.rint(counts).astype(numpy.int64)
+
+
+def symbol_tables():
+    """Tables of compare_nucleotides() and transitions over byte values"""
+    same = numpy.ones((256, 256), dtype=bool)
+    transition = numpy.zeros((256, 256), dtype=bool)
+    for a in set(SYMBOLS):
+        for b in set(SYMBOLS):
+            same[a, b] = compare_nucleotides(chr(a), chr(b))
+            transition[a, b] = not same[a, b] and is_transition(chr(a), chr(b))
+    return same, transition
+
+
+def fasta_distances(names, sequences, method, rate, context):
+    """Same as GetDistMat(): the full matrix of distances between sequences"""
+    n = len(sequences)
+    length = len(sequences[0]) if sequences else 0
+    if length == 0:
+        raise ValueError('Your sequences are empty')
+    if any(len(sequence) < length for sequence in sequences):
+        raise ValueError('Your sequences are not aligned, all should have {} sites'.format(length))
+    context.log(abgd.LOG_INFO, {0: 'Kimura distance\n', 1: 'Jukes Cantor distance\n',
+        3: 'Simple distance\n'}[method])
+    if context.progress('distances', 0, n):
+        raise abgd.Cancelled('vectorized: Cancelled while computing distances')
+
+    codes = numpy.frombuffer(b''.join(sequence[:length] for sequence in sequences),
+        dtype=numpy.uint8).reshape(n, length)
+    same, transition = symbol_tables()
+    gap = codes == ord('-')
+    upper = numpy.triu_indices(n, 1)
+
+    # Sites where neither is a gap, at least one is needed for each pair
+    kept = (~gap).astype(numpy.float32)
+    common = numpy.rint(kept @ kept.T).astype(numpy.int64)
+    missing = numpy.flatnonzero(common[upper] == 0)
+    if missing.size:
+        a, b = upper[0][missing[0]], upper[1][missing[0]]
+        raise ValueError("Sequence {} and {} have no common site. Distance can't be computed.".format(
+            decode(names[a]), decode(names[b])))
+
+    differences = count_sites(codes, ~same)[upper]
+    matrix = numpy.zeros((n, n))
+    if method == 0:
+        # Each distinct count of sites, transitions and transversions is fitted once
+        R = float(numpy.float32(rate))
+        transitions = count_sites(codes, transition)[upper]
+        sites = common[upper]
+        keys = numpy.stack([sites, differences - transitions, transitions], axis=1)
+        distinct, inverse = numpy.unique(keys, axis=0, return_inverse=True)
+        values = numpy.array([kimura(s, tv, ts, R) for s, tv, ts in distinct.tolist()])
+    else:
+        known = ~(gap | (codes == ord('N')))
+        known = known.astype(numpy.float32)
+        valid = numpy.rint(known @ known.T).astype(numpy.int64)[upper]
+        if method == 1:
+            keys = numpy.stack([differences, valid], axis=1)
+            distinct, inverse = numpy.unique(keys, axis=0, return_inverse=True)
+            values = numpy.array([jukes_cantor(v, s) for v, s in distinct.tolist()])
+        else:
+            values = (differences + 1.0) / (valid + 1.0)
+            inverse = numpy.arange(len(values))
+    matrix[upper] = values[inverse.reshape(-1)]
+    matrix += matrix.T
+    context.counts['pairs'] += n * (n - 1) // 2
+    return matrix
+
+
+def strtod(text):
+    """Leading number of text as read by strtod(), 0 if there is none"""
+    match = NUMBER.match(text)
+    return float(match.group(0)) if match else 0.0
+
+
+def read_phylip(data):
+    """Same as read_distmat() for Phylip matrices, rows are kept as they are"""
+    match = re.match(rb'\s*([+-]?\d+)', data)
+    end = data.find(b'\n', match.end()) if match else -1
+    if end == -1:
+        raise ValueError('Pb with file')
+    n = int(match.group(1))
+    position = end + 1
+    names = []
+    matrix = numpy.zeros((n, n))
+    for a in range(n):
+        end = data.find(b' ', position)
+        tab = data.find(b'\t', position, len(data) if end == -1 else end)
+        end = tab if tab != -1 else end
+        if end == -1:
+            raise ValueError('Missing rows in Phylip matrix, expected {}'.format(n))
+        names.append(data[position:end][:SIZE_NAME_DIST - 1])
+        position = end + 1
+        # Most rows are on a single line
+        line = data.find(b'\n', position)
+        line = len(data) if line == -1 else line
+        row = data[position:line]
+        tokens = row.split()
+        if len(tokens) == n and b'\t' not in row[len(row.rstrip()):] and b'_' not in row:
+            try:
+                matrix[a] = numpy.array(tokens, dtype=numpy.float64)
+                position = line + 1
+                continue
+            except ValueError:
+                pass
+        for b in range(n):
+            match = NUMBER.match(data, position)
+            if match:
+                matrix[a, b] = float(match.group(0))
+                position = match.end()
+        ends = [index for index in (data.find(b'\n', position), data.find(b'\t', position))
+            if index != -1]
+        position = min(ends) + 1 if ends else len(data)
+    return names, matrix
+
+
+def read_mega_csv(data):
+    """Same as readMatrixMegaCSV(): lower triangle, comma separated"""
+    rows = []
+    for line in data.replace(b'\r', b'\n').split(b'\n'):
+        if line.startswith(b'Table'):
+            break
+        if len(line) > 2:
+            rows.append(line)
+    n = len(rows)
+    names = []
+    matrix = numpy.zeros((n, n))
+    for a, row in enumerate(rows):
+        fields = row.split(b',')
+        names.append(fields[0])
+        if len(fields) < a + 1:
+            raise ValueError('{} {} pb reading matrix CSV'.format(a, len(fields) - 1))
+        fields = fields[1:a + 1]
+        # Most rows are plain numbers, converted all at once
+        values = row[len(names[a]) + 1:]
+        if b'?' not in values and b'_' not in values and all(fields):
+            try:
+                matrix[a, :a] = numpy.array(fields, dtype=numpy.float64)
+                continue
+            except ValueError:
+                pass
+        for b, field in enumerate(fields):
+            if b'?' in field:
+                raise ValueError('Distance between {} and {} is unknown'.format(
+                    decode(names[a]), decode(names[b])))
+            matrix[a, b] = strtod(field) if field else 0.0
+    upper = numpy.triu_indices(n, 1)
+    matrix[upper] = matrix.T[upper]
+    return names, matrix
+
+
+class Stream():
+    """Reads bytes as the C stdio functions used by readMatrixMega()"""
+
+    def __init__(self, data):
+        self.data = data
+        self.position = 0
+        self.eof = False
+
+    def getc(self):
+        """Next byte, None once at the end"""
+        if self.position < len(self.data):
+            self.position += 1
+            return self.data[self.position - 1]
+        self.eof = True
+        return None
+
+    def line(self):
+        """Same as fscanf("%[^\\n]\\n"): a line, then skip any white space"""
+        end = self.data.find(b'\n', self.position)
+        end = len(self.data) if end == -1 else end
+        text = self.data[self.position:end]
+        self.position = end
+        while self.position < len(self.data) and self.data[self.position] in b' \t\n\r\v\f':
+            self.position += 1
+        self.eof = self.position >= len(self.data)
+        return text
+
+
+def read_mega(data):
+    """Same as readMatrixMega(): names then lower left triangle"""
+    stream = Stream(data)
+    n = 0
+    while True:
+        line = stream.line().upper()
+        if stream.eof:
+            raise ValueError('pb reading file...')
+        if b' OF TAXA :' in line:
+            n = int(strtod(line[line.index(b':') + 1:]))
+        if b'NTAXA=' in line:
+            n = int(strtod(line[line.index(b'NTAXA=') + 6:]))
+        if b'DATAFORMAT=' in line and b'LOWERLEFT' not in line and b'UPPERRIGHT' not in line:
+            raise ValueError('Unknown data format')
+        if not line.startswith(b'!') and b';' in line:
+            break
+    if n <= 0:
+        raise ValueError('abgd was not able to read your MEGA file: [TAXA] number not in the header')
+
+    names = []
+    while len(names) < n:
+        line = stream.line()
+        while len(line) <= 1:
+            if stream.eof:
+                raise ValueError('pb reading file...')
+            line = stream.line()
+        for mark in (b'#', b']'):
+            if mark in line:
+                line = line[line.index(mark) + 1:]
+                break
+        names.append(line.replace(b'(', b'_').replace(b')', b'_'))
+
+    matrix = numpy.zeros((n, n))
+    letter = None
+    while letter != ord(']'):
+        letter = stream.getc()
+        if stream.eof:
+            raise ValueError('error reading values')
+    letter = stream.getc()
+    for a in range(n):
+        while letter != ord(']') and not stream.eof:
+            letter = stream.getc()
+        if stream.eof:
+            raise ValueError('problem reading your file')
+        for b in range(a + 1):
+            letter = stream.getc()
+            while letter == ord(' '):
+                letter = stream.getc()
+            if stream.eof:
+                break
+            token = bytearray()
+            while letter not in b' \n\r[':
+                if letter == ord(','):
+                    letter = ord('.')
+                if letter == ord('?'):
+                    raise ValueError('Distance between {} and {} is unknown'.format(
+                        decode(names[a]), decode(names[b])))
+                token.append(letter)
+                if len(token) > 15:
+                    break
+                letter = stream.getc()
+                if stream.eof:
+                    break
+            matrix[a, b] = matrix[b, a] = strtod(bytes(token)) if token else 0.0
+        while letter not in b'\n]\r' and not stream.eof:
+            letter = stream.getc()
+        if a != n - 1 and stream.eof:
+            raise ValueError('pb reading matrix')
+    return names, matrix
+
+
+def read_input(file, method=1, rate=2.0, mega=False, context=None):
+    """
+    Names as bytes and the full distance matrix of a fasta file,
+    or of a Phylip or MEGA matrix, as the core reads them.
+    """
+    context = context if context is not None else Context({})
+    with context.phase('parse'):
+        with open(file, 'rb') as input:
+            data = input.read()
+        if data[:1] == b'>':
+            names, sequences = read_fasta(data)
+        elif mega:
+            names, matrix = read_mega_csv(data)
+        elif data[:1] == b'#':
+            names, matrix = read_mega(data)
+        else:
+            names, matrix = read_phylip(data)
+    if data[:1] == b'>':
+        if method not in METHODS:
+            raise ValueError('vectorized: Invalid method')
+        with context.phase('names'):
+            check_names(names)
+        with context.phase('distances'):
+            matrix = fasta_distances(names, sequences, method, rate, context)
+    return names, matrix
+
+
+def distances(file, allocate, **kwargs):
+    """
+    Same as abgd.distances(): copy the distance matrix of file
+    in the buffer returned by allocate(n), return the names.
+    """
+    if not callable(allocate):
+        raise TypeError('vectorized: Expected a callable to allocate the matrix')
+    context = Context(kwargs)
+    names, matrix = read_input(file, kwargs.get('method', 1),
+        kwargs.get('rate', 2.0), kwargs.get('mega', False), context)
+    n = len(names)
+    target = memoryview(allocate(n)).cast('B')
+    if len(target) < 8 * n * n:
+        raise ValueError('vectorized: Buffer too small for {} sequences'.format(n))
+    numpy.frombuffer(target, dtype=numpy.float64, count=n * n)[:] = matrix.reshape(-1)
+    return [decode(name) for name in names]
+
+
+def min_window(nval):
+    """Same as min_ws(): smallest window size for nval pairs"""
+    if nval > 10000:
+        return 1000
+    return nval // 10 if nval // 10 > 1 else 1
+
+
+def advance(stops, i, limit):
+    """First index from i in the sorted array stops, limit if none"""
+    if i >= limit:
+        return i
+    k = stops.searchsorted(i)
+    return int(stops[k]) if k < stops.size else limit
+
+
+class Pairs():
+    """
+    Sorted pairwise distances with their running mean Pi, as searched by find_abgd().
+    If kept, the slopes of each window size are only computed once.
+    """
+
+    def __init__(self, values, keep=False):
+        self.array = numpy.sort(values)
+        self.values = self.array.tolist()
+        self.n = len(self.values)
+        self.pi = numpy.cumsum(self.array) / numpy.arange(1, self.n + 1)
+        self.gaps = numpy.diff(self.array)
+        # Gaps closer than this may compare either way once rounded as in the core
+        self.tie = 8 * float(numpy.spacing(abs(self.array).max())) if self.n else 0.0
+        self.kept = {} if keep else None
+
+    def slopes(self, window):
+        """
+        Slopes of window size, with the indices where climbing up
+        and going down the slopes stop, as in FindPeakInSlope()
+        """
+        if self.kept is not None and window in self.kept:
+            return self.kept[window]
+        array = self.array
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            slope = (array[window - 1:] - array[:self.n - window + 1]) / float(window - 1)
+        climb = numpy.flatnonzero(~(slope[1:] >= slope[:-1]))
+        descend = numpy.flatnonzero(~(slope[1:] <= slope[:-1]))
+        slopes = (slope, climb, descend)
+        if self.kept is not None:
+            self.kept[window] = slopes
+        return slopes
+
+    def origin(self, top, window):
+        """
+        Same as the loop over wt of FindPeakInSlope(): from the window of size window at top,
+        the first value of the gap it shrinks to. This drops the smaller of the two
+        gaps at both ends until one is left, which is the first largest gap.
+        Near ties are resolved by running the loop as the core does.
+        """
+        if window > 64:
+            gaps = self.gaps[top:top + window - 1]
+            largest = int(gaps.argmax())
+            if not numpy.isnan(gaps[largest]) and (
+                    numpy.count_nonzero(gaps >= gaps[largest] - self.tie) == 1):
+                return top + largest
+        a, n, ct = self.values, self.n, top
+        for wt in range(window - 1, 1, -1):
+            if ct < n - wt - 1 and a[ct + wt - 1] - a[ct] < a[ct + wt] - a[ct + 1]:
+                ct += 1
+        return ct
+
+
+def find_peak(pairs, window, prior, increase):
+    """
+    Same as FindPeakInSlope(): (distance, rank) of the first gap
+    for this window size, or (-1, -1) if none.
+    """
+    a, n, pi = pairs.values, pairs.n, pairs.pi
+    slope, climb, descend = pairs.slopes(window)
+    above = int(pairs.array.searchsorted(prior, 'right'))
+    theta = float(pi[max(above, 1) - 1])
+    limit = n - window
+
+    # Highest slope of the windows ending below the prior
+    i = max(1, min(above - window, limit))
+    slope_max = float(slope[0])
+    if not math.isnan(slope_max) and i > 1:
+        inside = slope[1:i]
+        inside = inside[~numpy.isnan(inside)]
+        if inside.size and inside.max() > slope_max:
+            slope_max = float(inside.max())
+
+    reach = window // 10
+    while i < limit:
+        # Climb to a local maximum, then look for a higher one within window/10 of it
+        i = advance(climb, i, limit)
+        top = start = i
+        while True:
+            end = min(top + reach + 1, limit)
+            higher = numpy.flatnonzero(slope[start:end] > slope[top])
+            if higher.size == 0:
+                i = end
+                break
+            top = start + int(higher[0])
+            start = top + 1
+
+        ct = pairs.origin(top, window)
+        mean = (a[ct] + a[ct + 1]) / 2.0
+
+        if mean > 2.581 * 2 * theta and slope[top] > increase * slope_max:
+            return mean, ct + 0.5
+        if slope[top] > slope_max and pi[ct] <= theta:
+            slope_max = float(slope[top])
+        i = advance(descend, top + 1 if top > ct else ct + 1, limit)
+    return -1.0, -1.0
+
+
+def find_abgd(pairs, window_min, window_max, prior, increase, context):
+    """
+    Same as find_abgd(): the gap found once stable over increasing window sizes,
+    as (distance, rank). The rank is n + 0.5 if there is none.
+    """
+    step = window_min // 10 if window_min > 10 else 1
+    distance = rank = -1.0
+    stable, stable_distance = 0, -1.0
+    with context.phase('peaks'):
+        window = window_min
+        while window <= window_max and stable < 3:
+            distance, rank = find_peak(pairs, window, prior, increase)
+            context.counts['windows'] += 1
+            if distance != -1 and abs(distance - stable_distance) < 0.1 * stable_distance:
+                stable += 1
+            else:
+                stable = 1
+                stable_distance = distance
+            window += step
+        if distance == -1:
+            distance = pairs.values[-1]
+            rank = pairs.n + 0.5
+    return distance, rank
+
+
+def components(matrix, limit, context):
+    """
+    Same as extract_composante(): the group of each row, rows closer
+    than limit being in the same group. Groups are numbered from 0
+    in the order of their first row. Labels are merged by a union-find
+    over all links at once, with path halving.
+    """
+    with context.phase('components'):
+        rows, columns = numpy.nonzero(matrix < limit)
+        labels = numpy.arange(len(matrix))
+        while True:
+            lowest = numpy.minimum(labels[rows], labels[columns])
+            merged = labels.copy()
+            numpy.minimum.at(merged, rows, lowest)
+            numpy.minimum.at(merged, columns, lowest)
+            merged = merged[merged]
+            if numpy.array_equal(merged, labels):
+                break
+            labels = merged
+        return numpy.unique(labels, return_inverse=True)[1].reshape(-1)
+
+
+def sorted_pairs(matrix, keep=False):
+    """Pairs of the upper triangle of matrix"""
+    return Pairs(matrix[numpy.triu_indices(len(matrix), 1)], keep)
+
+
+class Partition():
+    """
+    Groups of all sequences: the group of each one, numbered from 0,
+    and the members of each group in increasing order.
+    """
+
+    def __init__(self, labels):
+        self.labels = labels
+        count = int(labels.max()) + 1 if labels.size else 0
+        order = numpy.argsort(labels, kind='stable')
+        bounds = numpy.searchsorted(labels[order], numpy.arange(count + 1))
+        self.members = [order[bounds[k]:bounds[k + 1]] for k in range(count)]
+
+    def split(self, group, labels):
+        """
+        Same as update_composante(): the first subgroup keeps the number of group,
+        the others are appended.
+        """
+        members = self.members[group]
+        sub = Partition(labels)
+        self.members[group] = members[sub.members[0]]
+        for part in sub.members[1:]:
+            self.labels[members[part]] = len(self.members)
+            self.members.append(members[part])
+
+
+def resplit(matrix, partition, prior, increase, last, context):
+    """
+    Same as resplitComposante(): split each group again with its own
+    distances until none splits. Return the last gap found, else last.
+    The gap of a group that did not split is kept for the next rounds.
+    """
+    settled = {}
+    with context.phase('recursion'):
+        split = True
+        while split:
+            split = False
+            context.counts['rounds'] += 1
+            started = time.perf_counter()
+            count = len(partition.members)
+            for group in range(count):
+                if context.progress('priors'):
+                    break
+                members = partition.members[group]
+                if group in settled and settled[group][0] is members:
+                    last = settled[group][1] or last
+                    continue
+                inside = matrix[numpy.ix_(members, members)]
+                with context.phase('sort'):
+                    pairs = sorted_pairs(inside)
+                settled[group] = (members, None)
+                if pairs.n > 2:
+                    found = time.perf_counter()
+                    last = find_abgd(pairs, min_window(pairs.n), pairs.n - 1, prior, increase, context)
+                    context.span('component', 'sequences', len(members), found)
+                    settled[group] = (members, last)
+                    if last[1] != pairs.n + 0.5:
+                        labels = components(inside, last[0], context)
+                        if labels.max() > 0:
+                            partition.split(group, labels)
+                            split = True
+            context.span('round', 'groups', count, started)
+    return last
+
+
+def count_groups(matrix, pairs, prior, increase, context):
+    """Same as countGroups(): groups with and without recursion for a prior"""
+    gap = find_abgd(pairs, min_window(pairs.n), pairs.n - 1, prior, increase, context)
+    if gap[1] == pairs.n + 0.5:
+        return 1, 1
+    partition = Partition(components(matrix, gap[0], context))
+    initial = len(partition.members)
+    resplit(matrix, partition, prior, increase, gap, context)
+    return len(partition.members), initial
+
+
+def compute_priors(low, high, steps):
+    """Same as Compute_myDist(): steps priors evenly spaced in log scale"""
+    priors = [low]
+    if steps < 2:
+        return priors
+    scale = math.log10(high / low) / float(numpy.float32(steps - 1.0))
+    init = math.log10(low)
+    priors += [math.pow(10, init + scale * step) for step in range(1, steps - 1)]
+    return priors + [high]
+
+
+def adaptive_priors(matrix, pairs, low, high, steps, tolerance, increase, context):
+    """
+    Same as adaptivePriors(): from a grid of steps priors, bisect in log scale
+    every interval where the number of groups changes, down to tolerance.
+    Keep the smallest prior of each distinct partition, up to a single group.
+    """
+    prior, groups, initial = [], [], []
+    for value in compute_priors(low, high, steps):
+        if context.progress('priors'):
+            break
+        prior.append(value)
+        count, count_initial = count_groups(matrix, pairs, value, increase, context)
+        groups.append(count)
+        initial.append(count_initial)
+        if count == 1:
+            break
+    evaluated = len(prior)
+
+    split = True
+    while split and not context.progress('priors'):
+        split = False
+        next, next_groups, next_initial = [], [], []
+        for i in range(len(prior)):
+            next.append(prior[i])
+            next_groups.append(groups[i])
+            next_initial.append(initial[i])
+            if (i + 1 < len(prior) and (groups[i] != groups[i + 1] or initial[i] != initial[i + 1]) and
+                    prior[i + 1] > prior[i] * (1.0 + tolerance)):
+                middle = math.sqrt(prior[i] * prior[i + 1])
+                count, count_initial = count_groups(matrix, pairs, middle, increase, context)
+                next.append(middle)
+                next_groups.append(count)
+                next_initial.append(count_initial)
+                evaluated += 1
+                split = True
+        prior, groups, initial = next, next_groups, next_initial
+
+    kept = []
+    for i in range(len(prior)):
+        if i == 0 or groups[i] != groups[i - 1] or initial[i] != initial[i - 1]:
+            kept.append(prior[i])
+        if groups[i] == 1:
+            break
+    context.log(abgd.LOG_INFO, '> Adaptive priors: %d evaluated, %d distinct partitions\n',
+        evaluated, len(kept))
+    return kept
+
+
+def summarize(pairs, bids):
+    """
+    Same as summarize_distances(): histogram bins and the ranks kept for the rank curve.
+    The core computes these in single precision, so does this.
+    """
+    f32 = numpy.float32
+    n = pairs.n
+    maximum = f32(pairs.values[-1])
+    interval = float(maximum / f32(bids))
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        bins = pairs.array / interval
+    bins = bins[(bins > -1) & (bins < bids + 2)].astype(numpy.int64)
+    histogram = numpy.bincount(bins, minlength=bids + 2)[:bids].tolist()
+
+    width = HISTO_WIDTH - HISTO_BORDER
+    margin = HISTO_MARGIN
+    scale = float(f32(width) / f32(n))
+    column = lambda rank: int(margin + rank * scale)
+    ranks = []
+    first = 0
+    while first < n - 1:
+        x1 = column(first)
+        following = int((x1 - margin + 1) / scale)
+        while following > first + 1 and column(following - 1) > x1:
+            following -= 1
+        while following <= first or (following < n and column(following) == x1):
+            following += 1
+        ranks.append(first)
+        if following - 1 > first and following - 1 < n - 1:
+            ranks.append(following - 1)
+        first = following
+    ranks.append(n - 1)
+    return {
+        'histogram': histogram,
+        'histogram_max': float(maximum),
+        'rank_index': ranks,
+        'rank_value': [pairs.values[rank] for rank in ranks],
+        'rank_total': n,
+        }
+
+
+def project_name(file):
+    """Same as strcpy_spart_simp() on the file name without its extension"""
+    name = os.fsencode(file).rsplit(b'/', 1)[-1]
+    if b'.' in name:
+        name = name[:name.rindex(b'.')]
+    if b'.txt' in name:
+        name = name[:-4]
+    return spart_name(name)
+
+
+def spart_name(name):
+    """Same as strcpy_spart(): anything but letters, digits and _ is replaced by _"""
+    return decode(bytes(c if (c < 128 and chr(c).isalnum()) or c == ord('_') else ord('_')
+        for c in name))
+
+
+
+def analyze(file, kwargs, context):
+    """Steps of main() between reading the input and writing the output files"""
+    method = kwargs.get('method', 1)
+    bids = kwargs.get('bids', 20)
+    steps = kwargs.get('steps', 10)
+    low = kwargs.get('min', 0.001)
+    high = kwargs.get('max', 0.1)
+    increase = kwargs.get('slope', 1.5)
+    rate = float(numpy.float32(kwargs.get('rate', 2.0)))
+    context.log(abgd.LOG_INFO, '\n> Begin ABGD core:\n\n')
+
+    shared = kwargs.get('distances')
+    if shared is not None:
+        names = [os.fsencode(name)[:SIZE_NAME_DIST] for name in kwargs['names']]
+        matrix = numpy.frombuffer(memoryview(shared).cast('B'), dtype=numpy.float64)
+        if matrix.size != len(names) ** 2:
+            raise ValueError('distmatFromBuffer: Expected {} bytes for {} names, got {}'.format(
+                8 * len(names) ** 2, len(names), 8 * matrix.size))
+        matrix = matrix.reshape(len(names), len(names))
+    else:
+        names, matrix = read_input(file, method, rate, kwargs.get('mega', False), context)
+    if context.progress('distances'):
+        raise abgd.Cancelled('abgd_main: Cancelled while computing distances')
+    if method not in METHODS:
+        raise ValueError('vectorized: Invalid method')
+
+    with context.phase('histogram'):
+        pairs = sorted_pairs(matrix, keep=kwargs.get('adaptive', False))
+        summary = summarize(pairs, bids)
+
+    if kwargs.get('adaptive', False):
+        priors = adaptive_priors(matrix, pairs, low, high, steps,
+            kwargs.get('tolerance', 0.0), increase, context)
+    else:
+        priors = compute_priors(low, high, steps)
+    steps = len(priors)
+
+    groups = [0] * (steps + 1)
+    groups_init = [0] * (steps + 1)
+    gaps = [0.0] * steps
+    partitions_init = []
+    partitions = []
+    stop_at_once = False
+    last = (-1.0, -1.0)
+    step = 0
+    while step < steps:
+        if context.progress('priors', step, steps):
+            break
+        started = time.perf_counter()
+        prior = priors[step]
+        gap = find_abgd(pairs, min_window(pairs.n), pairs.n - 1, prior, increase, context)
+        if gap[1] == pairs.n + 0.5:
+            context.log(abgd.LOG_INFO, 'Partition %d : found 1 group (prior maximal distance P= %f) \n**Stop here**\n',
+                step + 1, prior)
+            stop_at_once = True
+            groups[step] = groups_init[step] = 1
+            context.step(step + 1, prior, None, 1, 1)
+            context.span('step', 'step', step + 1, started)
+            step += 1
+            break
+
+        partition = Partition(components(matrix, gap[0], context))
+        groups_init[step] = len(partition.members)
+        gaps[step] = gap[0]
+        partitions_init.append((partition.labels + 1).tolist())
+        last = resplit(matrix, partition, prior, increase, last, context)
+        if context.cancelled:
+            break
+        gaps[step] = last[0]
+        context.log(abgd.LOG_INFO, 'Partition %d : %d / %d groups with / out recursion for P= %f\n',
+            step + 1, len(partition.members), groups_init[step], prior)
+        partitions.append((partition.labels + 1).tolist())
+        groups[step] = len(partition.members)
+        context.step(step + 1, prior, gaps[step], groups[step], groups_init[step])
+        context.span('step', 'step', step + 1, started)
+        step += 1
+        if len(partition.members) == 1:
+            break
+
+    extracted = step - stop_at_once
+    real = min(step - 1, steps)
+    if context.cancelled:
+        context.log(abgd.LOG_INFO, 'Cancelled after %d partitions\n', step)
+        withsummary = step > 1
+    else:
+        withsummary = step != 1
+        if not withsummary:
+            context.log(abgd.LOG_INFO, 'Only one partition found with your data. Nothing to output. '
+                'You should try to rerun with a lower X (< %f) **Stop here**<BR>\n', increase)
+
+    data = {
+        'project': project_name(file),
+        'method': METHODS[method],
+        'date': kwargs.get('time', '?'),
+        'slope': float(numpy.float32(increase)),
+        'all': False,
+        'simple': bool(kwargs.get('simple', False)),
+        'spart': bool(kwargs.get('spart', True)),
+        'summary': withsummary,
+        'cancelled': context.cancelled,
+        'priors': priors[:step],
+        'groups': groups[:step],
+        'groups_init': groups_init[:step],
+        'spart_steps': real,
+        'barcode_gaps': gaps[:max(real, 0)],
+        'pairs': pairs.n,
+        'sampled_pairs': pairs.n,
+        'gap_bounds': None,
+        'partitions_init': partitions_init[:extracted],
+        'partitions': partitions[:extracted],
+        'names': [decode(name) for name in names],
+        'spart_names': [spart_name(name) for name in names],
+        'tree': None,
+        'metrics': context.metrics(),
+        }
+    data.update(summary)
+    return data
+
+
+def main(file, **kwargs):
+    """
+    Same as abgd.main(): run all steps of ABGD on file,
+    return the same results and write the same output files.
+    Trees (all=True) and sampled pairs are only done by the core.
+    """
+    if not os.path.exists(file):
+        raise FileNotFoundError("abgd_main: Input file not found: '{}'".format(file))
+    if kwargs.get('all', False):
+        raise ValueError('vectorized: Trees are only built by the core, set all to False')
+    if kwargs.get('adaptive', False) and (kwargs.get('tolerance', 0.0) <= 0 or kwargs.get('steps', 10) < 2):
+        raise ValueError('abgd_main: Adaptive priors need a positive tolerance and at least 2 steps')
+    if kwargs.get('sample', 0):
+        raise ValueError('vectorized: Sampled pairs are only used by the core, set sample to 0')
+    out = kwargs.get('out') or '.'
+    os.makedirs(out, exist_ok=True)
+
+    context = Context(kwargs)
+    if kwargs.get('logfile', False):
+        context.log(abgd.LOG_INFO, '> Redirecting stdout/stderr to file: %s/abgd.log\n', out)
+        context.logfile = open(os.path.join(out, 'abgd.log'), 'w')
+    try:
+        with context.phase('total'):
+            data = analyze(file, kwargs, context)
+            if kwargs.get('files', True):
+                with context.phase('output'):
+                    Results(data).render_all(out)
+    finally:
+        if context.logfile is not None:
+            context.logfile.close()
+    if context.spans is not None:
+        data['trace'] = context.spans
+    return data
+
+
+def inline(file):
+    """
+    True if file is small enough to be analyzed in the calling process,
+    counting its sequences without reading the whole file.
+    """
+    try:
+        if tiles.is_matrix(file):
+            with open(file, 'rb') as input:
+                input.read(len(tiles.MATRIX_MAGIC))
+                header = input.read(tiles.MATRIX_HEADER.size)
+            return tiles.MATRIX_HEADER.unpack(header)[2] <= INLINE_SEQUENCES
+        with open(file, 'rb') as input:
+            first = input.read(1)
+            input.seek(0)
+            if first == b'>':
+                count = sum(1 for line in input if line[:1] == b'>')
+            elif first.isdigit() or first.isspace():
+                count = int(input.readline().split()[0])
+            else:
+                count = sum(1 for line in input if line.strip())
+    except (OSError, ValueError, IndexError):
+        return False
+    return count <= INLINE_SEQUENCES
@@ -0,0 +1,432 @@
+#-----------------------------------------------------------------------------
+# ABGDpy - Automatic Barcode Gap Discovery with ABGD
+# Copyright (C) 2021  Patmanidis Stefanos
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#-----------------------------------------------------------------------------
+
+
+"""
+Checks of the core and the modules around it, run with: pytest tests
+Datasets are small, so that the whole module runs in seconds.
+"""
+
+import collections
+import json
+import os
+import pathlib
+import re
+import subprocess
+import sys
+
+import pytest
+
+from abgdpy import abgd
+from abgdpy import core
+from abgdpy import tiles
+from abgdpy import trace
+from abgdpy.bench.differential import Harness, generate
+from abgdpy.bootstrap import GapBootstrap
+from abgdpy.cache import ResultCache
+from abgdpy.results import Results
+from abgdpy.shared import SharedDistances, SharedPairs
+
+
+TEST_FILE = str(pathlib.Path(__file__).parent / 'test.fas')
+
+
+@pytest.fixture(scope='module')
+def datasets(tmp_path_factory):
+    """Generated fasta files and matrices of a few small sizes"""
+    target = tmp_path_factory.mktemp('check')
+    return generate(target, [20, 40], variants=['plain', 'gaps', 'duplicates'])
+
+
+def canonical(partition):
+    """Groups renumbered in order of their first sample"""
+    labels = {}
+    return tuple(labels.setdefault(group, len(labels)) for group in partition)
+
+
+def partitions(result):
+    """Initial and recursive partition of each step, canonical"""
+    return [(canonical(init), canonical(recursive))
+        for init, recursive in zip(result['partitions_init'], result['partitions'])]
+
+
+def divergences(harness):
+    return [divergence.describe() for case, divergence in harness.run() if divergence]
+
+
+def distances(file, **kwargs):
+    """Names and matrix bytes of abgd.distances()"""
+    buffers = []
+    def allocate(n):
+        buffers.append(bytearray(8 * n * n))
+        return buffers[0]
+    names = abgd.distances(file, allocate, loglevel=abgd.LOG_ERROR, **kwargs)
+    return names, bytes(buffers[0])
+
+
+def test_harness_reference(datasets):
+    harness = Harness('abgdpy.abgd')
+    harness.grid(datasets + [TEST_FILE], method=[0, 1])
+    assert divergences(harness) == []
+
+
+def test_harness_vectorized(datasets):
+    pytest.importorskip('numpy')
+    harness = Harness('abgdpy.vectorized')
+    harness.grid(datasets + [TEST_FILE], method=[0, 1, 3])
+    assert divergences(harness) == []
+
+
+def test_bootstrap_jobs():
+    outputs = []
+    for jobs in (1, 3):
+        bootstrap = GapBootstrap(TEST_FILE, replicates=12, jobs=jobs, seed=7)
+        bootstrap.run()
+        outputs.append(bootstrap.output)
+    single, split = outputs
+    assert single.replicates == split.replicates == 12
+    assert single.gaps == split.gaps
+    assert single.groups == split.groups
+
+
+@pytest.mark.parametrize('sample', [0, 100])
+def test_bootstrap_pairs(sample):
+    # Replicates drawn from the shared sorted pairs are those sorted by each job
+    with SharedDistances(TEST_FILE) as distances:
+        pairs = SharedPairs(distances, sample=sample, seed=3)
+        kwargs = dict(distances.arguments(), sample=sample, seed=3, replicates=10,
+            loglevel=abgd.LOG_ERROR)
+        alone = abgd.bootstrap(TEST_FILE, **kwargs)
+        kwargs.update(pairs.arguments())
+        shared = abgd.bootstrap(TEST_FILE, **kwargs)
+        del kwargs
+        pairs.release()
+    assert repr(shared) == repr(alone)
+
+
+@pytest.mark.parametrize('method', [0, 1, 3])
+def test_shards_merge(tmp_path, datasets, method):
+    file = datasets[0]
+    paths = [tiles.compute_tile(file, shard, 3, tmp_path, method=method)
+        for shard in range(3)]
+    target = tmp_path / 'merged.dist'
+    tiles.merge(paths, target)
+    assert tiles.is_matrix(target)
+
+    names, matrix = distances(file, method=method)
+    merged = tiles.load_matrix(target)
+    assert merged['names'] == names
+    assert merged['method'] == method
+    assert bytes(merged['distances']) == matrix
+
+
+def test_cache_key():
+    cache = ResultCache()
+    analysis = core.BarcodeAnalysis(TEST_FILE)
+    key = cache.key(analysis)
+    analysis.useLogfile = True
+    analysis.time_format = '%Y'
+    assert cache.key(analysis) == key
+    steps = analysis.param.prior.steps
+    analysis.param.prior.steps = steps + 1
+    assert cache.key(analysis) != key
+    analysis.param.prior.steps = steps
+    assert cache.key(analysis) == key
+    analysis.engine = 'abgdpy.vectorized'
+    assert cache.key(analysis) != key
+
+
+def test_cache_hit(tmp_path, monkeypatch):
+    cache = ResultCache(tmp_path / 'cache')
+    first = core.BarcodeAnalysis(TEST_FILE)
+    first.cache = cache
+    core.launch(first)
+    assert len(cache.entries()) == 1
+
+    def refuse(*args, **kwargs):
+        raise AssertionError('A cache hit must not start a process')
+    monkeypatch.setattr(core, 'Process', refuse)
+    second = core.BarcodeAnalysis(TEST_FILE)
+    second.cache = cache
+    core.launch(second)
+    assert second.output.partitions == first.output.partitions
+    assert second.output.priors == first.output.priors
+    assert (pathlib.Path(second.results) / 'abgd.svg').exists()
+
+
+@pytest.mark.parametrize('method', [0, 1])
+def test_sample_zero(datasets, method):
+    file = datasets[0]
+    exact = abgd.main(file, method=method, files=False, loglevel=abgd.LOG_ERROR)
+    sampled = abgd.main(file, method=method, files=False, sample=0, loglevel=abgd.LOG_ERROR)
+    for result in (exact, sampled):
+        result.pop('metrics', None)
+        result.pop('trace', None)
+    assert sampled == exact
+
+
+@pytest.mark.parametrize('slope', [0.5, 1.5])
+def test_adaptive(datasets, slope):
+    for file in [file for file in datasets if file.endswith('.fas')] + [TEST_FILE]:
+        grid = abgd.main(file, files=False, steps=200, slope=slope, loglevel=abgd.LOG_ERROR)
+        adaptive = abgd.main(file, files=False, adaptive=True, tolerance=0.001,
+            slope=slope, loglevel=abgd.LOG_ERROR)
+        found = partitions(adaptive)
+        assert all(found[i] != found[i + 1] for i in range(len(found) - 1))
+        assert set(partitions(grid)) <= set(found)
+        assert adaptive['priors'] == sorted(adaptive['priors'])
+
+
+def test_stop_single_group():
+    # The last prior of the test file finds a single group, see its log
+    result = abgd.main(TEST_FILE, files=False, loglevel=abgd.LOG_ERROR)
+    assert len(result['groups']) == len(result['groups_init']) == len(result['priors'])
+    assert result['groups'][-1] == result['groups_init'][-1] == 1
+    assert len(result['partitions']) == len(result['priors']) - 1
+
+
+@pytest.mark.parametrize('options', [{}, {'all': True}, {'simple': True}, {'spart': True},
+    {'all': True, 'spart': True}])
+def test_render(tmp_path, datasets, options):
+    # Files rendered from the results are those the core writes
+    for k, file in enumerate(datasets + [TEST_FILE]):
+        core, rendered = tmp_path / str(k) / 'core', tmp_path / str(k) / 'rendered'
+        core.mkdir(parents=True)
+        rendered.mkdir()
+        data = abgd.main(file, out=str(core), time='20210101T000000',
+            loglevel=abgd.LOG_ERROR, **options)
+        results = Results(data)
+        results.render_all(rendered)
+        assert sorted(path.name for path in core.iterdir()) == sorted(results.artifacts())
+        for name in results.artifacts():
+            assert (rendered / name).read_bytes() == (core / name).read_bytes(), name
+
+
+def messages(**kwargs):
+    """Level and text of every message of abgd.main()"""
+    logged = []
+    abgd.main(TEST_FILE, files=False, log=lambda level, text: logged.append((level, text)),
+        **kwargs)
+    return logged
+
+
+def test_log_levels():
+    assert messages(loglevel=abgd.LOG_ERROR) == []
+    info = messages(loglevel=abgd.LOG_INFO)
+    debug = messages(loglevel=abgd.LOG_DEBUG)
+    assert info and {level for level, text in info} == {abgd.LOG_INFO}
+    assert [message for message in debug if message[0] == abgd.LOG_INFO] == info
+    assert len(debug) > len(info)
+
+
+def test_log_rate():
+    total = len(messages(loglevel=abgd.LOG_DEBUG))
+    logged = messages(loglevel=abgd.LOG_DEBUG, lograte=5)
+    dropped = [re.fullmatch(r'\((\d+) messages dropped\)\n', text) for level, text in logged]
+    # Every message is either delivered or counted as dropped
+    assert any(dropped)
+    assert sum(int(match.group(1)) if match else 1 for match in dropped) == total
+
+
+@pytest.mark.filterwarnings('ignore::pytest.PytestUnraisableExceptionWarning')
+def test_log_raises():
+    def log(level, text):
+        raise ZeroDivisionError(text)
+    result = abgd.main(TEST_FILE, files=False, log=log)
+    assert not result['cancelled']
+    assert len(result['priors']) == 10
+
+
+def test_metrics(tmp_path):
+    result = abgd.main(TEST_FILE, out=str(tmp_path), all=True, loglevel=abgd.LOG_ERROR)
+    phases = result['metrics']['phases']
+    names = len(result['names'])
+    assert result['metrics']['counts']['pairs'] == names * (names - 1) // 2
+    assert phases['total']['calls'] == phases['distances']['calls'] == phases['tree']['calls'] == 1
+    assert phases['output']['calls'] > 0
+    assert all(metrics['wall'] >= 0 and metrics['cpu'] >= 0 for metrics in phases.values())
+    assert all(metrics['wall'] <= phases['total']['wall'] for metrics in phases.values())
+    phases = abgd.main(TEST_FILE, files=False, loglevel=abgd.LOG_ERROR)['metrics']['phases']
+    assert phases['tree']['calls'] == phases['output']['calls'] == 0
+
+
+def within(span, spans):
+    """True if span lies inside one of spans"""
+    start, end = span[1], span[1] + span[2]
+    return any(other[1] <= start and end <= other[1] + other[2] for other in spans)
+
+
+def test_trace(tmp_path):
+    result = abgd.main(TEST_FILE, out=str(tmp_path), all=True, trace=True,
+        loglevel=abgd.LOG_ERROR)
+    spans = result['trace']
+    # Each call of a phase is one span
+    counts = collections.Counter(span[0] for span in spans)
+    for phase, metrics in result['metrics']['phases'].items():
+        assert counts[phase] == metrics['calls'], phase
+    assert counts['step'] == len(result['priors'])
+    total = [span for span in spans if span[0] == 'total']
+    steps = [span for span in spans if span[0] == 'step']
+    rounds = [span for span in spans if span[0] == 'round']
+    assert all(within(span, total) for span in spans)
+    assert all(within(span, steps) for span in rounds)
+    assert all(within(span, rounds) for span in spans if span[0] == 'component')
+    assert 'trace' not in abgd.main(TEST_FILE, files=False, loglevel=abgd.LOG_ERROR)
+
+    path = tmp_path / 'trace.json'
+    trace.write(spans, path, pid=1, tid=2)
+    events = json.loads(path.read_text())['traceEvents']
+    assert [event['name'] for event in events if event['ph'] == 'X'] == [span[0] for span in spans]
+    assert all(event['pid'] == 1 and event['tid'] == 2 for event in events)
+
+
+def test_cancel_distances():
+    with pytest.raises(abgd.Cancelled):
+        abgd.main(TEST_FILE, files=False, cancel=bytearray(b'\x01'), loglevel=abgd.LOG_ERROR)
+
+
+def test_cancel_priors():
+    calls = []
+    cancel = bytearray(1)
+    def progress(phase, done, total):
+        calls.append((phase, done, total))
+        if phase == 'priors' and done == 3:
+            cancel[0] = 1
+    result = abgd.main(TEST_FILE, files=False, progress=progress, cancel=cancel,
+        loglevel=abgd.LOG_ERROR)
+    assert result['cancelled']
+    assert len(result['priors']) == len(result['groups']) == 3
+    assert [phase for phase, done, total in calls if done == 0] == ['distances', 'priors']
+    assert all(0 <= done <= total for phase, done, total in calls)
+    assert not abgd.main(TEST_FILE, files=False, loglevel=abgd.LOG_ERROR)['cancelled']
+
+
+def test_progress_raises():
+    def progress(phase, done, total):
+        raise ZeroDivisionError(phase)
+    with pytest.raises(ZeroDivisionError):
+        abgd.main(TEST_FILE, files=False, progress=progress, loglevel=abgd.LOG_ERROR)
+
+
+def test_progress_reentrant():
+    def progress(phase, done, total):
+        abgd.main(TEST_FILE, files=False)
+    with pytest.raises(RuntimeError):
+        abgd.main(TEST_FILE, files=False, progress=progress, loglevel=abgd.LOG_ERROR)
+
+
+def test_step_events(tmp_path):
+    events = []
+    def step(event):
+        # Files of a step are complete once it is reported
+        sizes = [pathlib.Path(file).stat().st_size for file in event['files']]
+        events.append(dict(event, sizes=sizes))
+    result = abgd.main(TEST_FILE, out=str(tmp_path), all=True, step=step,
+        loglevel=abgd.LOG_ERROR)
+    assert [event['step'] for event in events] == list(range(1, len(result['priors']) + 1))
+    assert [event['prior'] for event in events] == result['priors']
+    assert [event['groups'] for event in events] == result['groups']
+    assert [event['groups_init'] for event in events] == result['groups_init']
+    for event, gap in zip(events, result['barcode_gaps']):
+        assert event['barcode_gap'] is None or event['barcode_gap'] == gap
+    assert events[-1]['barcode_gap'] is None and events[-1]['groups'] == 1
+    assert all(size > 0 for event in events for size in event['sizes'])
+    # The summary graph is rewritten from the second step on
+    assert 'abgd.svg' not in [pathlib.Path(file).name for file in events[0]['files']]
+    assert all(pathlib.Path(event['files'][0]).name == 'abgd.svg' for event in events[1:])
+    for event in events[:len(result['partitions'])]:
+        names = [pathlib.Path(file).name for file in event['files']]
+        assert 'part.{}.tree'.format(event['step']) in names
+
+
+def test_step_raises():
+    def step(event):
+        if event['step'] == 2:
+            raise ZeroDivisionError
+    with pytest.raises(ZeroDivisionError):
+        abgd.main(TEST_FILE, files=False, step=step, loglevel=abgd.LOG_ERROR)
+
+
+def test_step_vectorized():
+    pytest.importorskip('numpy')
+    from abgdpy import vectorized
+    core, numpy = [], []
+    abgd.main(TEST_FILE, files=False, step=core.append, loglevel=abgd.LOG_ERROR)
+    vectorized.main(TEST_FILE, files=False, step=numpy.append, loglevel=abgd.LOG_ERROR)
+    assert numpy == core
+
+
+def check_names(tmp_path, names):
+    """Exit code and output of the core on sequences with given names"""
+    file = tmp_path / 'names.fas'
+    file.write_text(''.join('>{}\nACGTACGT{}\n'.format(name, 'ACGT'[k % 4] * (k + 1))
+        for k, name in enumerate(names)))
+    # The core exits on invalid names, so it runs on its own process
+    code = 'from abgdpy import abgd; abgd.main({!r}, files=False)'.format(str(file))
+    process = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True,
+        env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path)))
+    return process.returncode, process.stdout
+
+
+def test_check_names(tmp_path):
+    code, output = check_names(tmp_path, ['a', 'b', 'a x', 'c', 'a', 'c', 'd'])
+    assert code == 1
+    # Every conflict is reported, not only the first
+    assert 'seq 1: a and seq 5: a have same name' in output
+    assert 'seq 4: c and seq 6: c have same name' in output
+    assert 'seq 3: a x has a name included in seq 1: a .' in output
+    code, output = check_names(tmp_path, ['a', 'ab', 'a_x', 'b a', 'ba'])
+    assert code == 0
+    assert 'same name' not in output and 'included' not in output
+
+
+def tree_groups(path):
+    """Group of each leaf of a tree file"""
+    text = pathlib.Path(path).read_text()
+    return {name: int(group) for name, group in
+        re.findall(r'[(,]([^(),:]+?) _group (\d+)', text)}
+
+
+def spart_groups(path):
+    """Groups of each individual at every step of a spart file"""
+    text = pathlib.Path(path).read_text()
+    assignment = text.split('Individual_assignment = \n')[1].split(';')[0]
+    return {name: [int(group) for group in groups.split(' / ')] for name, groups in
+        (line.split(' : ') for line in assignment.splitlines())}
+
+
+def test_membership(tmp_path, datasets):
+    # Groups written to trees and spart files are those of the partitions
+    for k, file in enumerate(datasets + [TEST_FILE]):
+        target = tmp_path / str(k)
+        target.mkdir()
+        result = abgd.main(file, out=str(target), all=True, spart=True,
+            loglevel=abgd.LOG_ERROR)
+        for prefix, partitions in [('partinit', result['partitions_init']),
+                                   ('part', result['partitions'])]:
+            for step, partition in enumerate(partitions, 1):
+                expected = dict(zip(result['names'], partition))
+                assert tree_groups(target / '{}.{}.tree'.format(prefix, step)) == expected
+        if not result['summary']:
+            continue
+        for suffix, partitions in [('.spart', result['partitions_init']),
+                                   ('.rec.spart', result['partitions'])]:
+            steps = result['spart_steps']
+            expected = {name: [partition[index] for partition in partitions[:steps]]
+                for index, name in enumerate(result['spart_names'])}
+            assert spart_groups(target / (result['project'] + suffix)) == expected
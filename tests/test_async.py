@@ -0,0 +1,95 @@
+#-----------------------------------------------------------------------------
+# ABGDpy - Automatic Barcode Gap Discovery with ABGD
+# Copyright (C) 2021  Patmanidis Stefanos
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#-----------------------------------------------------------------------------
+
+
+"""
+Checks of launch_async() and launch_all(), run with: pytest tests
+The event loops are run by asyncio.run(), no plugin is needed.
+"""
+
+import asyncio
+import multiprocessing
+import pathlib
+import time
+
+import pytest
+
+from abgdpy import core
+from abgdpy.bench.differential import generate
+
+
+TEST_FILE = str(pathlib.Path(__file__).parent / 'test.fas')
+
+
+@pytest.fixture(scope='module')
+def large(tmp_path_factory):
+    """A dataset that takes about a second, long enough to be cancelled"""
+    target = tmp_path_factory.mktemp('async')
+    return generate(target, [600], variants=['plain'])[0]
+
+
+def test_launch_async():
+    calls = []
+    analysis = core.BarcodeAnalysis(TEST_FILE)
+    output = asyncio.run(core.launch_async(analysis, lambda *args: calls.append(args)))
+    assert output is analysis.output
+    assert len(output.priors) == 10
+    assert {phase for phase, done, total in calls} == {'distances', 'priors'}
+
+
+def test_launch_async_cancel(large):
+    async def run():
+        started = asyncio.Event()
+        analysis = core.BarcodeAnalysis(large)
+        task = asyncio.ensure_future(
+            core.launch_async(analysis, lambda *args: started.set(), grace=30))
+        await started.wait()
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+    start = time.monotonic()
+    asyncio.run(run())
+    # The core stopped by itself, long before it would have been terminated
+    assert time.monotonic() - start < 10
+    assert multiprocessing.active_children() == []
+
+
+def test_launch_all():
+    async def run():
+        analyses = [core.BarcodeAnalysis(TEST_FILE), core.BarcodeAnalysis('missing.fas')]
+        events = [event async for event in core.launch_all(analyses, limit=1)]
+        return analyses, events
+    analyses, events = asyncio.run(run())
+    final = {analysis: (kind, value) for analysis, kind, value in events if kind != 'progress'}
+    assert final[analyses[0]] == ('done', analyses[0].output)
+    assert final[analyses[1]][0] == 'failed'
+    assert isinstance(final[analyses[1]][1], Exception)
+
+
+def test_launch_all_close(large):
+    async def run():
+        analyses = [core.BarcodeAnalysis(large) for i in range(2)]
+        events = core.launch_all(analyses, limit=2, grace=30)
+        async for analysis, kind, value in events:
+            assert kind == 'progress'
+            break
+        await events.aclose()
+    start = time.monotonic()
+    asyncio.run(run())
+    assert time.monotonic() - start < 10
+    assert multiprocessing.active_children() == []
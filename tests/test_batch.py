@@ -0,0 +1,88 @@
+#-----------------------------------------------------------------------------
+# ABGDpy - Automatic Barcode Gap Discovery with ABGD
+# Copyright (C) 2021  Patmanidis Stefanos
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#-----------------------------------------------------------------------------
+
+
+"""Scheduling of batch analyses"""
+
+import pathlib
+import shutil
+
+import pytest
+
+from abgdpy import batch
+
+
+TEST_FILE = pathlib.Path(__file__).parent / 'test.fas'
+
+
+@pytest.fixture
+def files(tmp_path):
+    """Three copies of the test file in their own directory"""
+    directory = tmp_path / 'inputs'
+    directory.mkdir()
+    for name in ('a.fas', 'b.fas', 'c.fas'):
+        shutil.copy(TEST_FILE, directory / name)
+    return sorted(directory.iterdir())
+
+
+def concurrency(monkeypatch, analysis):
+    """Run analysis, return the most jobs that were running at once"""
+    running = []
+    peak = []
+    start, finish = batch.BatchAnalysis.start, batch.BatchAnalysis.finish
+    def started(self, job):
+        running.append(job)
+        peak.append(len(running))
+        start(self, job)
+    def finished(self, job):
+        running.remove(job)
+        finish(self, job)
+    monkeypatch.setattr(batch.BatchAnalysis, 'start', started)
+    monkeypatch.setattr(batch.BatchAnalysis, 'finish', finished)
+    jobs = list(analysis.run())
+    assert all(job.error is None for job in jobs)
+    return max(peak)
+
+
+@pytest.mark.parametrize('jobs', [0, -1])
+def test_jobs_invalid(files, tmp_path, jobs):
+    with pytest.raises(ValueError):
+        batch.BatchAnalysis(files, tmp_path / 'out', jobs=jobs)
+    with pytest.raises(SystemExit):
+        batch.main([str(files[0].parent), '--jobs', str(jobs)])
+
+
+def test_jobs(files, tmp_path, monkeypatch):
+    analysis = batch.BatchAnalysis(files, tmp_path / 'out', jobs=2, memory=None)
+    assert concurrency(monkeypatch, analysis) <= 2
+    rows = (tmp_path / 'out' / 'summary.tsv').read_text().splitlines()
+    assert {row.split('\t')[0] for row in rows[1:]} == {file.name for file in files}
+
+
+def test_memory(files, tmp_path, monkeypatch):
+    # Each job fits in the budget alone, but no two do
+    monkeypatch.setattr(batch, 'estimate_memory', lambda file, trees=False: 600)
+    analysis = batch.BatchAnalysis(files, tmp_path / 'out', jobs=3, memory=1000)
+    assert concurrency(monkeypatch, analysis) == 1
+
+
+def test_memory_oversized(files, tmp_path, monkeypatch):
+    # A job larger than the budget still runs, alone
+    monkeypatch.setattr(batch, 'estimate_memory', lambda file, trees=False: 2000)
+    analysis = batch.BatchAnalysis(files, tmp_path / 'out', jobs=3, memory=1000)
+    assert concurrency(monkeypatch, analysis) == 1
@@ -0,0 +1,132 @@
+#-----------------------------------------------------------------------------
+# ABGDpy - Automatic Barcode Gap Discovery with ABGD
+# Copyright (C) 2021  Patmanidis Stefanos
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#-----------------------------------------------------------------------------
+
+
+"""Widgets of the graphical interface, drawn offscreen"""
+
+import multiprocessing
+import os
+import threading
+import time
+
+import pytest
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+QtWidgets = pytest.importorskip('PyQt5.QtWidgets')
+
+from abgdpy.qt import utility
+from abgdpy.qt import widgets
+
+
+LINES = [
+    '>Mantidactylus_été_Ändasibe\tcoll.\t№ 12',
+    'ACGT' * 30,
+    '\tindented\ttwice',
+    'plain',
+    ]
+
+
+@pytest.fixture(scope='module')
+def application():
+    return QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+
+
+@pytest.fixture
+def preview(application, tmp_path):
+    path = tmp_path / 'preview.txt'
+    path.write_bytes('\n'.join(LINES).encode('utf-8'))
+    view = widgets.TextPreview()
+    view.open(str(path))
+    view.index.wait()
+    yield view
+    view.clear()
+
+
+def test_preview_lines(preview):
+    assert preview.lines() == len(LINES)
+    for line, text in enumerate(LINES):
+        assert preview.text(line) == text.expandtabs(8)
+
+
+@pytest.mark.parametrize('columns', [1, 3, 7, 16])
+def test_preview_columns(preview, columns):
+    for line, text in enumerate(LINES):
+        expanded = text.expandtabs(8)
+        for column in range(len(expanded) + 2):
+            part = preview.text(line, column, columns)
+            assert part == expanded[column:column + columns]
+            assert '�' not in part
+
+
+def test_preview_longest(preview):
+    assert preview.index.longest >= max(len(text.expandtabs(8)) for text in LINES)
+
+
+def received(connection):
+    """All messages waiting on connection"""
+    messages = []
+    while connection.poll(0.1):
+        messages.append(connection.recv())
+    return messages
+
+
+def test_pipe_batches():
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    pipe = utility.PipeIO(sender, 'w', interval=0, size=1000)
+    lines = ['line {}\n'.format(i) for i in range(300)]
+    pipe.writelines(line.rstrip('\n') for line in lines[:100])
+    assert not receiver.poll(0.1)
+    for line in lines[100:]:
+        pipe.write(line)
+    pipe.write('partial')
+    pipe.flush()
+    messages = received(receiver)
+    assert len(messages) <= 3
+    assert ''.join(messages) == ''.join(lines) + 'partial'
+    pipe.close()
+
+
+def test_pipe_interval():
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    pipe = utility.PipeIO(sender, 'w', interval=0.01)
+    pipe.write('first\nsecond')
+    # Complete lines are sent by the flusher, the rest waits
+    assert receiver.poll(5)
+    assert receiver.recv() == 'first\n'
+    pipe.close()
+    assert receiver.recv() == 'second'
+
+
+def test_logger_batches(application):
+    logger = utility.TextEditLogger(rate=30, scrollback=100)
+    inserted = []
+    insert = logger.appendTextInline
+    logger.appendTextInline = lambda text: (inserted.append(text), insert(text))
+    thread = threading.Thread(target=lambda: [logger.appendText('line {}\n'.format(i))
+        for i in range(1000)])
+    thread.start()
+    thread.join()
+    deadline = time.monotonic() + 5
+    while (logger.queue or logger.timer.isActive()) and time.monotonic() < deadline:
+        application.processEvents()
+        time.sleep(0.01)
+    assert 1 <= len(inserted) <= 3
+    lines = logger.toPlainText().splitlines()
+    assert lines[-1] == 'line 999'
+    assert len(lines) <= 100
+    assert logger.blockCount() <= 101
@@ -0,0 +1,97 @@
+#-----------------------------------------------------------------------------
+# ABGDpy - Automatic Barcode Gap Discovery with ABGD
+# Copyright (C) 2021  Patmanidis Stefanos
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#-----------------------------------------------------------------------------
+
+
+"""Round trips through a job server on a free local port"""
+
+from http.server import ThreadingHTTPServer
+
+import io
+import pathlib
+import threading
+
+import pytest
+
+from abgdpy import abgd
+from abgdpy import serve
+
+
+TEST_FILE = str(pathlib.Path(__file__).parent / 'test.fas')
+
+
+@pytest.fixture(scope='module')
+def client():
+    pool = serve.WorkerPool(1)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), serve.Handler)
+    server.pool = pool
+    server.verbose = False
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield serve.Client('http://127.0.0.1:{}'.format(server.server_port), timeout=60)
+    server.shutdown()
+    server.server_close()
+    pool.close()
+
+
+def test_file(client):
+    job = client.submit(file=TEST_FILE, wait=True)
+    assert job['status'] == 'done'
+    expected = abgd.main(TEST_FILE, files=False, loglevel=abgd.LOG_ERROR)
+    assert job['result']['partitions'] == expected['partitions']
+    assert job['result']['priors'] == expected['priors']
+    assert job['result']['tree'] is None
+
+
+def test_fasta(client):
+    job = client.submit(fasta=open(TEST_FILE).read(), params={'slope': 1.0})
+    job = client.get(job['id'], wait=True)
+    assert job['status'] == 'done'
+    assert job['result']['slope'] == 1.0
+    assert len(job['result']['names']) == len(job['result']['partitions'][0])
+
+
+def test_tree(client):
+    job = client.submit(file=TEST_FILE, params={'all': True}, wait=True)
+    assert job['status'] == 'done'
+    tree = job['result']['tree']
+    assert tree.startswith('(') and tree.rstrip().endswith(';')
+    assert all(name in tree for name in job['result']['names'])
+
+
+def test_invalid(client):
+    with pytest.raises(RuntimeError, match='Unknown parameter'):
+        client.submit(file=TEST_FILE, params={'nope': 1})
+    with pytest.raises(RuntimeError, match='Not found'):
+        client.get('0')
+
+
+def test_reply_encoding():
+    class Reply(serve.Handler):
+        def __init__(self):
+            self.sent = []
+        def send_response(self, code):
+            self.sent.append(code)
+        def send_header(self, key, value):
+            pass
+        def end_headers(self):
+            pass
+    handler = Reply()
+    handler.wfile = io.BytesIO()
+    handler.reply(200, {'result': b'bytes'})
+    assert handler.sent == [500]
+    assert b'"type": "TypeError"' in handler.wfile.getvalue()